@@ -0,0 +1,253 @@
+# coarse version of the physics model grid used to find the regions of
+#  the grid with non-negligible probability before evaluating the full
+#  resolution models in these regions only
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import itertools
+
+import numpy as np
+
+__all__ = ['CoarseGrid']
+
+
+class CoarseGrid(object):
+    """
+    Decimated version of the physics model grid with the mapping between
+    the coarse nodes and the full resolution models around them
+
+    Each model is placed on the lattice of the nodes of the grid
+    parameters.  The node of a parameter is the rank of its value in the
+    unique values of the parameter, except for M_ini where it is the rank
+    in the masses of the same isochrone (logA, Z).  The coarse grid is the
+    models with all their nodes a multiple of step, and the full resolution
+    models are grouped in the cells between the coarse nodes.  The refined
+    region can be expanded cell by cell around the models at its boundary
+    (the ones with a neighboring node in the grid not refined).
+    """
+    def __init__(self, g0, model_indxs=None, step=2,
+                 params=['logA', 'M_ini', 'Z', 'Av', 'Rv', 'f_A',
+                         'distance']):
+        """
+        Parameters
+        ----------
+        g0: grid.SEDgrid instance
+            model grid
+
+        model_indxs: np.ndarray[int, ndim=1]
+            indices of the models to use (default is all)
+
+        step: int
+            every step-th node of each parameter is in the coarse grid
+
+        params: list of str
+            grid parameters defining the lattice
+            (the ones not in the grid are ignored)
+        """
+        if model_indxs is None:
+            model_indxs = np.arange(len(g0['weight']))
+        self.n_models = len(model_indxs)
+        self.step = step
+
+        gkeys = list(g0.keys())
+        self.params = [param for param in params if param in gkeys]
+
+        nodes = []
+        for param in self.params:
+            vals = np.asarray(g0[param])[model_indxs]
+            if param == 'M_ini':
+                group_vals = [np.asarray(g0[gparam])[model_indxs]
+                              for gparam in ['logA', 'Z'] if gparam in gkeys]
+                nodes.append(_node_indices(vals, group_vals=group_vals))
+            else:
+                nodes.append(_node_indices(vals))
+        nodes = np.array(nodes, dtype=np.int64).reshape(len(self.params),
+                                                        self.n_models)
+
+        # only the parameters with more than one node matter
+        active = nodes.max(axis=1) > 0
+        self.params = [param for k, param in enumerate(self.params)
+                       if active[k]]
+        nodes = nodes[active, :]
+        n_dims = len(self.params)
+
+        # lattice key of each model (mixed radix key of the nodes)
+        self.node_shape = nodes.max(axis=1) + 1
+        self.node_strides = _strides(self.node_shape)
+        self.model_keys = np.dot(self.node_strides, nodes)
+        self.sorted_model_keys = np.sort(self.model_keys)
+
+        # coarse nodes
+        self.coarse_indxs, = np.where(np.all(nodes % step == 0, axis=0))
+
+        # cell of each model (mixed radix key)
+        cells = nodes // step
+        self.cell_shape = cells.max(axis=1) + 1
+        self.cell_strides = _strides(self.cell_shape)
+        cell_keys = np.dot(self.cell_strides, cells)
+
+        # models in each cell
+        self.cell_order = np.argsort(cell_keys, kind='mergesort')
+        (self.cell_keys, self.cell_starts,
+         cell_counts) = np.unique(cell_keys[self.cell_order],
+                                  return_index=True, return_counts=True)
+        self.cell_ends = self.cell_starts + cell_counts
+
+        # cells with each coarse model as a corner
+        #   (the cell itself and the ones before it in each dimension)
+        coarse_cells = cells[:, self.coarse_indxs]
+        offsets = np.array(list(itertools.product([0, 1], repeat=n_dims)),
+                           dtype=np.int64).reshape(-1, n_dims).T
+        corner_cells = coarse_cells[:, :, None] - offsets[:, None, :]
+        corner_keys = np.tensordot(self.cell_strides, corner_cells, axes=1)
+        corner_keys[np.any(corner_cells < 0, axis=0)] = -1
+        self.corner_keys = corner_keys
+
+        # neighboring cells of each cell (+/-1 in each dimension)
+        neighbors = []
+        cell_coords = (self.cell_keys[None, :] // self.cell_strides[:, None]
+                       % self.cell_shape[:, None])
+        for k in range(n_dims):
+            for delta in [-1, 1]:
+                ncoords = cell_coords[k, :] + delta
+                nkeys = self.cell_keys + delta*self.cell_strides[k]
+                nkeys[(ncoords < 0) | (ncoords >= self.cell_shape[k])] = -1
+                neighbors.append(nkeys)
+        self.cell_neighbors = np.array(neighbors, dtype=np.int64).reshape(
+            -1, len(self.cell_keys))
+
+    def refine(self, coarse_keep):
+        """
+        Full resolution models around the kept coarse models
+
+        Parameters
+        ----------
+        coarse_keep: np.ndarray[bool, ndim=1]
+            coarse models with non-negligible probability
+            (same order as coarse_indxs)
+
+        Returns
+        -------
+        indxs: np.ndarray[int, ndim=1]
+            sorted indices of the models in the cells around the kept
+            coarse models
+        """
+        keys = np.unique(self.corner_keys[coarse_keep, :])
+        keys = keys[keys >= 0]
+        return self._cell_models(keys)
+
+    def shell(self, indxs):
+        """
+        Models at the boundary of a refined region
+
+        Parameters
+        ----------
+        indxs: np.ndarray[int, ndim=1]
+            indices of the models in the refined region
+
+        Returns
+        -------
+        shell: np.ndarray[bool, ndim=1]
+            if each model has a neighboring node (+/-1 in one dimension)
+            that is in the grid but not in the refined region
+        """
+        keys = self.model_keys[indxs]
+        region_keys = np.sort(keys)
+        coords = (keys[None, :] // self.node_strides[:, None]
+                  % self.node_shape[:, None])
+        shell = np.zeros(len(indxs), dtype=bool)
+        for k in range(len(self.node_shape)):
+            for delta in [-1, 1]:
+                ncoords = coords[k, :] + delta
+                nkeys = keys + delta*self.node_strides[k]
+                exists = ((ncoords >= 0) & (ncoords < self.node_shape[k])
+                          & _in_sorted(self.sorted_model_keys, nkeys))
+                shell |= exists & ~_in_sorted(region_keys, nkeys)
+        return shell
+
+    def expand(self, indxs, shell):
+        """
+        Full resolution models of the cells next to the boundary of a
+        refined region
+
+        Parameters
+        ----------
+        indxs: np.ndarray[int, ndim=1]
+            indices of the models in the refined region
+
+        shell: np.ndarray[bool, ndim=1]
+            models at the boundary of the refined region to expand around
+            (see shell)
+
+        Returns
+        -------
+        new_indxs: np.ndarray[int, ndim=1]
+            sorted indices of the models in the neighboring cells of the
+            cells of the shell models that are not in the refined region
+        """
+        keys = self.model_keys[indxs[shell]]
+        cells = (keys[None, :] // self.node_strides[:, None]
+                 % self.node_shape[:, None]) // self.step
+        cell_pos = np.searchsorted(self.cell_keys,
+                                   np.unique(np.dot(self.cell_strides,
+                                                    cells)))
+        neighbors = self.cell_neighbors[:, cell_pos].ravel()
+        neighbors = np.unique(neighbors[neighbors >= 0])
+        return np.setdiff1d(self._cell_models(neighbors), indxs,
+                            assume_unique=True)
+
+    def _cell_models(self, keys):
+        """ sorted indices of the models in the cells with the given keys """
+        cell_pos = np.minimum(np.searchsorted(self.cell_keys, keys),
+                              len(self.cell_keys) - 1)
+        cell_pos = cell_pos[self.cell_keys[cell_pos] == keys]
+
+        counts = self.cell_ends[cell_pos] - self.cell_starts[cell_pos]
+        sorted_pos = (np.repeat(self.cell_starts[cell_pos] - np.cumsum(
+            np.concatenate([[0], counts[:-1]])), counts)
+            + np.arange(counts.sum()))
+        return np.sort(self.cell_order[sorted_pos])
+
+
+def _strides(shape):
+    """ strides of the mixed radix keys of coordinates in a shape """
+    strides = np.ones(len(shape), dtype=np.int64)
+    for k in range(len(shape) - 2, -1, -1):
+        strides[k] = strides[k+1] * shape[k+1]
+    return strides
+
+
+def _in_sorted(sorted_vals, vals):
+    """ if each value is in an array of sorted values """
+    if len(sorted_vals) == 0:
+        return np.zeros(len(vals), dtype=bool)
+    pos = np.minimum(np.searchsorted(sorted_vals, vals),
+                     len(sorted_vals) - 1)
+    return sorted_vals[pos] == vals
+
+
+def _node_indices(vals, group_vals=[]):
+    """
+    Rank of the values in the unique values (within each group)
+
+    Parameters
+    ----------
+    vals: np.ndarray[float, ndim=1]
+        parameter values
+
+    group_vals: list of np.ndarray[float, ndim=1]
+        values of the parameters defining the groups
+
+    Returns
+    -------
+    nodes: np.ndarray[int, ndim=1]
+    """
+    if len(group_vals) == 0:
+        return np.unique(vals, return_inverse=True)[1]
+
+    groups = np.unique(np.column_stack(group_vals), axis=0,
+                       return_inverse=True)[1].ravel()
+    combos, inv = np.unique(np.column_stack([groups, vals]), axis=0,
+                            return_inverse=True)
+    first = np.searchsorted(combos[:, 0], combos[:, 0], side='left')
+    return (np.arange(len(combos)) - first)[inv.ravel()]
@@ -30,6 +30,7 @@ import math
 import tables
 import string
 from itertools import islice
+from multiprocessing.pool import ThreadPool
 
 import numexpr
 
@@ -41,21 +42,31 @@ from astropy.io import fits
 from astropy.table import Table
 
 from ..physicsmodel import grid
+from ..physicsmodel.helpers.gridinfo import unique_capped
+from ..physicsmodel.helpers.gridbackends import CacheBackend
 from ..tools.pbar import Pbar
 
 from .fit_metrics.likelihood import (N_covar_logLikelihood,
+                                     N_covar_logLikelihood_chol,
                                      N_logLikelihood_NM,
                                      getNorm_lnP)
 from .fit_metrics import expectation, percentile
 
 from .pdf1d import pdf1d
+from .pdf2d import pdf2d
+from .model_index import ModelFluxIndex
+from .coarse_grid import CoarseGrid
+from .fit_profile import FitProfile, file_size
 
 __all__ = ['summary_table_memory',
            'Q_all_memory',
            'IAU_names_and_extra_info',
            'save_stats',
            'save_pdf1d',
-           'save_lnp']
+           'save_lnp',
+           'save_pdf2d',
+           'setup_pdf1d_objs',
+           'setup_fit']
 
 def save_stats(stats_outname, stats_dict_in, best_vals, exp_vals,
                per_vals, chi2_vals, chi2_indx, lnp_vals, lnp_indx,
@@ -81,7 +92,7 @@ def save_stats(stats_outname, stats_dict_in, best_vals, exp_vals,
 
     Returns
     -------
-    N/A
+    summary_tab(astropy.table.Table) : the stats table
     """
 
     stats_dict = stats_dict_in.copy()
@@ -106,6 +117,8 @@ def save_stats(stats_outname, stats_dict_in, best_vals, exp_vals,
     if stats_outname is not None:
         summary_tab.write(stats_outname, overwrite=True)
 
+    return summary_tab
+
 def save_pdf1d(pdf1d_outname, save_pdf1d_vals, qnames):
     """ Saves the 1D PDFs to a file
 
@@ -132,6 +145,39 @@ def save_pdf1d(pdf1d_outname, save_pdf1d_vals, qnames):
         pheader.set('EXTNAME',qname)
         fits.append(pdf1d_outname, save_pdf1d_vals[k], header=pheader)
 
+def save_pdf2d(pdf2d_outname, save_pdf2d_vals, pdf2d_objs, pdf2d_names):
+    """ Saves the 2D PDFs to a file
+
+    Keywords
+    ----------
+    pdf2d_outname(str) : output filename (HDF5)
+    save_pdf2d_vals(list) : list of 3D nparrays giving the 2D PDFs for
+                            each pair of parameters (nobs, nbins_x, nbins_y)
+    pdf2d_objs(list) : pdf2d instance for each pair of parameters
+    pdf2d_names(list) : list of the (qname_x, qname_y) parameter pairs
+
+    Returns
+    -------
+    N/A
+    """
+
+    filters = tables.Filters(complevel=5, complib='zlib', shuffle=True)
+
+    # 1 group per pair of parameters
+    with tables.open_file(pdf2d_outname, 'w') as outfile:
+        for k, (qname_x, qname_y) in enumerate(pdf2d_names):
+            pair_group = outfile.create_group('/',
+                                              qname_x + '__' + qname_y,
+                                              title=qname_x + ' ' + qname_y)
+            pair_group._v_attrs.qname_x = qname_x
+            pair_group._v_attrs.qname_y = qname_y
+            outfile.create_array(pair_group, 'bin_vals_x',
+                                 pdf2d_objs[k].bin_vals_x)
+            outfile.create_array(pair_group, 'bin_vals_y',
+                                 pdf2d_objs[k].bin_vals_y)
+            outfile.create_carray(pair_group, 'pdf2d',
+                                  obj=save_pdf2d_vals[k], filters=filters)
+
 def save_lnp(lnp_outname, save_lnp_vals, resume):
     """ Saves the nD lnps to a file
 
@@ -139,7 +185,8 @@ def save_lnp(lnp_outname, save_lnp_vals, resume):
     ----------
     lnp_outname(str) : output filename
     save_lnp_vals(list) : list of 5 parameter lists giving the lnp/chisqr
-                          info for each star
+                          info for each star (6 if the prior-free
+                          log-likelihoods are also saved)
     resume(boolean) : **not used** remove later
 
     Returns
@@ -174,14 +221,319 @@ def save_lnp(lnp_outname, save_lnp_vals, resume):
             outfile.create_array(star_group, 'idx', lnp_val[1])
             outfile.create_array(star_group, 'lnp', lnp_val[2])
             outfile.create_array(star_group, 'chi2', lnp_val[3])
+            if len(lnp_val) > 5:
+                outfile.create_array(star_group, 'lnl', lnp_val[5])
     outfile.close()
 
+def setup_pdf1d_objs(g0, qnames, full_model_flux, filters, max_nbins=50,
+                     grid_info_dict=None, qvals=None):
+    """ Setup the fast 1D PDF mappings for all the requested quantities
+
+    Keywords
+    ----------
+    g0(grid.SEDgrid) : model grid
+    qnames(list) : list of the parameter names, including the
+                   'symlog<filter>_wd_bias' full model flux quantities
+    full_model_flux(2D nparray) : symlog of the model fluxes plus the
+                                  noise model bias (nmodels, nfilters)
+    filters(list) : names of the filters in full_model_flux
+    max_nbins(int) : maxiumum number of bins to use for the 1D PDFs
+    grid_info_dict(dict) : overrides for the mins/maxes/number of unique
+                           values (see Q_all_memory)
+    qvals(list) : values (arrays or CodedColumns) of each qname
+                  (default is to get them from g0 and full_model_flux)
+
+    Returns
+    -------
+    fast_pdf1d_objs(list) : pdf1d instance for each qname
+    """
+    fast_pdf1d_objs = []
+
+    # mins/maxes/number of unique values saved in the grid file
+    #   (avoids scanning the columns)
+    saved_grid_info = getattr(g0, 'grid_info', None)
+
+    for k, qname in enumerate(qnames):
+        #q = g0[qname][g0_indxs]
+        if qvals is not None:
+            q = qvals[k]
+        elif '_bias' in qname:
+            fname = (qname.replace('_wd_bias','')).replace('symlog','')
+            q = full_model_flux[:,filters.index(fname)]
+        else:
+            q = g0[qname]
+
+        if grid_info_dict is not None and qname in grid_info_dict:
+            # When processing a subgrid, we actuall need the number of
+            # unique values across all the subgrids to make the 1dpdfs
+            # compatible
+            n_uniq = grid_info_dict[qname]['num_unique']
+        elif saved_grid_info is not None and qname in saved_grid_info:
+            n_uniq = saved_grid_info[qname]['num_unique']
+        else:
+            # only need to know if there are more than max_nbins
+            n_uniq = len(unique_capped(q, cap_unique=max_nbins))
+
+        if n_uniq > max_nbins:
+            # limit the number of bins in the 1D likelihood for speed
+            nbins = max_nbins
+        else:
+            nbins = n_uniq
+
+        # temp code for BEAST paper figure
+        if qname == 'Z':
+            nbins = nbins + 1
+
+        # setup the fast 1d pdf
+
+        # needed for mass parameters as they are stored as linear values
+        # computationally, less bins needed if 1D PDFs done as log spacing
+        if qname in set(['M_ini', 'M_act','radius']):
+            logspacing = True
+        else:
+            logspacing = False
+
+        if grid_info_dict is not None and qname in grid_info_dict:
+            minval = grid_info_dict[qname]['min']
+            maxval = grid_info_dict[qname]['max']
+        elif saved_grid_info is not None and qname in saved_grid_info:
+            # same type as the values to give the exact same bins
+            minval = q.dtype.type(saved_grid_info[qname]['min'])
+            maxval = q.dtype.type(saved_grid_info[qname]['max'])
+        else:
+            minval = None
+            maxval = None
+
+        # generate the fast 1d pdf mapping
+        _tpdf1d = pdf1d(q, nbins,
+                        logspacing=logspacing, minval=minval,
+                        maxval=maxval)
+        fast_pdf1d_objs.append(_tpdf1d)
+
+    return fast_pdf1d_objs
+
+def setup_fit(sedgrid, ast, qnames_in, gridbackend='cache', max_nbins=50,
+              grid_info_dict=None, use_full_cov_matrix=True,
+              use_icov_chol=False,
+              do_not_normalize=False, prune_models=False, coarse_step=None,
+              coarse_params=['logA', 'M_ini', 'Z', 'Av', 'Rv', 'f_A',
+                             'distance'],
+              use_float32=False, use_grid_codes=False):
+    """ Setup the model grid and noise model precomputations of the fitting
+        (independent of the observations, can be reused to fit several
+        catalogs with Q_all_memory)
+
+    Keywords
+    ----------
+    sedgrid(str or grid.SEDgrid) : model grid
+    ast(tables file) : noise model data
+    qnames_in(list) : list of the parameter names (the full model flux
+                      names are appended)
+    gridbackend, max_nbins, grid_info_dict, use_full_cov_matrix,
+    use_icov_chol, do_not_normalize, prune_models, coarse_step,
+    coarse_params, use_float32, use_grid_codes : see Q_all_memory
+
+    Returns
+    -------
+    fit_setup(dict) : the grid, the qnames, the model fluxes with bias,
+                      the noise model arrays, the 1D PDF mappings, and the
+                      coarse grid/flux index (if requested)
+    """
+
+    if type(sedgrid) == str:
+        g0 = grid.FileSEDGrid(sedgrid, backend=gridbackend)
+    else:
+        g0 = sedgrid
+
+    # remove weights that are less than zero
+    g0_indxs, = np.where(g0['weight'] > 0.0)
+
+    g0_weights = np.log(g0['weight'][g0_indxs])
+    if not do_not_normalize:
+        g0_weights_sum = np.log(g0['weight'][g0_indxs].sum())
+        g0_weights = numexpr.evaluate("g0_weights - g0_weights_sum")
+
+    if len(g0['weight']) != len(g0_indxs):
+        print('some zero weight models exist')
+        print('orig/g0_indxs', len(g0['weight']),len(g0_indxs))
+
+    # get the model SEDs
+    if hasattr(g0.seds, 'read'):
+        _seds = g0.seds.read()
+    else:
+        _seds = g0.seds
+
+    # get the names of all the children in the ast structure
+    ast_children = []
+    for label, node in list(ast.root._v_children.items()):
+        ast_children.append(label)
+
+    # links to errors and biases
+    ast_error = ast.root.error[:]
+    ast_bias = ast.root.bias[:]
+
+    # precision of the model and noise model grids used for the fitting
+    #   in float32, the fluxes are scaled by a reference flux of each filter
+    #   (median of the model fluxes) and the noise model terms accordingly,
+    #   as the inverse variances of fluxes in physical units (~1/1e-21^2)
+    #   are beyond the float32 range, the chi2 is unchanged by the scaling
+    if use_float32:
+        grid_dtype = np.float32
+        flux_scale = np.median(np.abs(_seds[::max(1, len(_seds)//100000)]),
+                               axis=0)
+        flux_scale[~(flux_scale > 0)] = 1.
+    else:
+        grid_dtype = np.float64
+        flux_scale = None
+
+    # if the ast file includes the full covariance matrices, make links
+    full_cov_mat = False
+    ast_q_norm = None
+    ast_icov_chol = None
+    ast_icov_diag = None
+    two_ast_icov_offdiag = None
+    ast_ivar = None
+    if (use_full_cov_matrix &
+        ('q_norm' in ast_children) &
+        ('icov_diag' in ast_children) &
+        ('icov_offdiag' in ast_children)):
+        full_cov_mat = True
+        ast_q_norm = np.asfortranarray(ast.root.q_norm[:])
+        # use the whitening factors if requested and precomputed
+        #   (see beast.observationmodel.noisemodel.trunchen.icov_cholesky)
+        if use_icov_chol and ('icov_chol' in ast_children):
+            ast_icov_chol = ast.root.icov_chol[:]
+            if flux_scale is not None:
+                # U[k,j] multiplies the flux difference in filter j
+                chol_indxs = np.triu_indices(len(flux_scale))
+                ast_icov_chol *= flux_scale[chol_indxs[1]]
+            ast_icov_chol = np.asfortranarray(ast_icov_chol, dtype=grid_dtype)
+        else:
+            if use_icov_chol:
+                print('no precomputed whitening factors in the noise model')
+            ast_icov_diag = ast.root.icov_diag[:]
+            two_ast_icov_offdiag = ast.root.icov_offdiag[:]
+            if flux_scale is not None:
+                up_indxs = np.triu_indices(len(flux_scale), 1)
+                ast_icov_diag *= flux_scale**2
+                two_ast_icov_offdiag *= (flux_scale[up_indxs[0]]
+                                         * flux_scale[up_indxs[1]])
+            ast_icov_diag = np.asfortranarray(ast_icov_diag, dtype=grid_dtype)
+            two_ast_icov_offdiag = 2.0 * np.asfortranarray(
+                two_ast_icov_offdiag, dtype=grid_dtype)
+    elif flux_scale is not None:
+        ast_ivar = 1. / np.asfortranarray(ast_error / flux_scale,
+                                          dtype=grid_dtype)**2
+    else:
+        ast_ivar = 1. / np.asfortranarray(ast_error, dtype=grid_dtype)**2
+    use_icov_chol = ast_icov_chol is not None
+
+    if full_cov_mat:
+        print('using full covariance matrix')
+        if use_icov_chol:
+            print('using the precomputed whitening factors')
+    else:
+        print('not using full covariance matrix')
+
+    # augment the qnames to include the *full* model SED
+    #  by this it means the physical model flux plus the noise model bias term
+    qnames = qnames_in
+    filters = g0.filters
+    for i, cfilter in enumerate(filters):
+        qnames.append('symlog'+cfilter+'_wd_bias')
+
+    # create the full model fluxes for later use
+    #   save as symmetric log, since the fluxes can be negative
+    #   (summed in float64 without a float64 temporary copy)
+    model_seds_with_bias = np.empty(_seds.shape, dtype=grid_dtype, order='F')
+    np.add(_seds, ast_bias, out=model_seds_with_bias, casting='same_kind')
+    #full_model_flux = np.sign(logtempseds) * np.log10(1 + np.abs(logtempseds * math.log(10)))
+    full_model_flux = (np.sign(model_seds_with_bias)
+                       * np.log1p(np.abs(model_seds_with_bias * math.log(10)))
+                       /math.log(10))
+    if flux_scale is not None:
+        model_seds_with_bias /= flux_scale.astype(grid_dtype)
+
+    # in float32, the float64 model fluxes are not kept for the fitting
+    #   (fluxes cached by the grid are released and reloaded from the file
+    #   if needed, the fluxes of a grid in memory are kept by the grid)
+    if use_float32:
+        del _seds
+        if isinstance(getattr(g0, '_backend', None), CacheBackend):
+            g0._backend.clear('seds')
+
+    if prune_models and (coarse_step is not None):
+        raise ValueError('prune_models and coarse_step cannot be both set')
+
+    # setup the coarse grid
+    coarse_grid = None
+    if coarse_step is not None:
+        coarse_grid = CoarseGrid(g0, model_indxs=g0_indxs, step=coarse_step,
+                                 params=coarse_params)
+        print('coarse grid with ' + str(len(coarse_grid.coarse_indxs)) +
+              ' models out of ' + str(len(g0_indxs)))
+
+    # setup the flux space index of the models
+    model_index = None
+    if prune_models:
+        model_index = ModelFluxIndex.from_noisemodel(
+            model_seds_with_bias, ast, g0_weights, model_indxs=g0_indxs,
+            full_cov_mat=full_cov_mat, flux_scale=flux_scale)
+
+    # values of the quantities
+    #   the grid columns with a codebook are kept as codes if requested
+    #   (only decoded for the models in the sparse likelihoods)
+    qvals = []
+    for qname in qnames:
+        if '_bias' in qname:
+            fname = (qname.replace('_wd_bias','')).replace('symlog','')
+            qvals.append(full_model_flux[:,filters.index(fname)])
+        else:
+            q = g0.get_coded(qname) if use_grid_codes else None
+            qvals.append(g0[qname] if q is None else q)
+
+    # setup the mapping for the 1D PDFs
+    fast_pdf1d_objs = setup_pdf1d_objs(g0, qnames, full_model_flux, filters,
+                                       max_nbins=max_nbins,
+                                       grid_info_dict=grid_info_dict,
+                                       qvals=qvals)
+
+    return {'g0': g0,
+            'g0_indxs': g0_indxs,
+            'g0_weights': g0_weights,
+            'qnames': qnames,
+            'filters': filters,
+            'full_cov_mat': full_cov_mat,
+            'use_icov_chol': use_icov_chol,
+            'ast_q_norm': ast_q_norm,
+            'ast_icov_chol': ast_icov_chol,
+            'ast_icov_diag': ast_icov_diag,
+            'two_ast_icov_offdiag': two_ast_icov_offdiag,
+            'ast_ivar': ast_ivar,
+            'model_seds_with_bias': model_seds_with_bias,
+            'flux_scale': flux_scale,
+            'full_model_flux': full_model_flux,
+            'prune_models': prune_models,
+            'model_index': model_index,
+            'coarse_step': coarse_step,
+            'coarse_grid': coarse_grid,
+            'qvals': qvals,
+            'fast_pdf1d_objs': fast_pdf1d_objs}
+
 def Q_all_memory(prev_result, obs, sedgrid, ast, qnames_in, p=[16., 50., 84.],
                  gridbackend='cache', max_nbins=50,
                  stats_outname=None, pdf1d_outname=None, grid_info_dict=None,
                  lnp_outname=None, lnp_npts=None, save_every_npts=None,
                  threshold=-40, resume=False,
-                 use_full_cov_matrix=True, do_not_normalize=False):
+                 use_full_cov_matrix=True, use_icov_chol=False,
+                 do_not_normalize=False, save_lnl=False,
+                 pdf2d_outname=None, pdf2d_param_list=None,
+                 pdf2d_batch_npts=100, prune_models=False,
+                 coarse_step=None, coarse_threshold=None,
+                 coarse_params=['logA', 'M_ini', 'Z', 'Av', 'Rv', 'f_A',
+                                'distance'], coarse_edge_tol=1e-3,
+                 use_float32=False, use_grid_codes=False, nthreads=1,
+                 min_chunk_size=10000, fit_setup=None, profile_outname=None):
     """ Fit each star, calculate various fit statistics, and output them
         to files
       (done in one function for speed and ability to resume partially
@@ -189,9 +541,11 @@ def Q_all_memory(prev_result, obs, sedgrid, ast, qnames_in, p=[16., 50., 84.],
 
     keywords
     --------
-    prev_result: dict
+    prev_result: dict or callable
         previous results to include in the output summary table
         usually basic data on each source
+        (a callable returning the dict is only called when the stats
+        are first saved)
 
     obs: Observation object instance
         observation catalog
@@ -225,11 +579,31 @@ def Q_all_memory(prev_result, obs, sedgrid, ast, qnames_in, p=[16., 50., 84.],
         set to use the full covariance matrix if it is present in the
         noise model file
 
+    use_icov_chol: boolean
+        set to compute the full covariance chi2 with the whitening factors
+        of the covariance matrices if they are present in the noise model
+        file (see beast.observationmodel.noisemodel.trunchen.icov_cholesky
+        and beast.fitting.fit_metrics.likelihood.N_covar_chi2_chol)
+        the results are the same up to round off and the speed is about
+        the same as with the inverse covariance terms
+
     stats_outname: set to output the stats file into a FITS file with
                    extensions
 
     pdf1d_outname: set to output the 1D PDFs into a FITS file with extensions
 
+    pdf2d_outname: set to output the joint 2D PDFs of pairs of parameters
+                   into an HDF5 file (1 group per pair)
+
+    pdf2d_param_list: list of str
+        parameters to compute the 2D PDFs for (all pairs are computed)
+        default is Av, M_ini, logA, Rv, and f_A (if in qnames)
+        the bins are the same as for the 1D PDFs
+
+    pdf2d_batch_npts: integer
+        number of stars to accumulate before computing their 2D PDFs
+        in a single batch
+
     grid_info_dict: dict: {'qname': {'min': float,
                                      'max': float,
                                      'num_unique': int},
@@ -253,78 +627,167 @@ def Q_all_memory(prev_result, obs, sedgrid, ast, qnames_in, p=[16., 50., 84.],
         single grid, but is essential when using the subgridding
         approach.
 
+    save_lnl: bool
+        set to also save the log-likelihoods without the prior weights
+        (lnl) with the sparse lnps, allowing the stats and 1D PDFs to be
+        recomputed for different priors without refitting
+        (see beast.fitting.reweight)
+
+    prune_models: bool
+        set to only compute the likelihoods of the models that can be
+        within the threshold of the maximum lnp, found with a flux space
+        index of the model grid (see beast.fitting.model_index)
+        the results are identical to computing all the likelihoods
+
+    coarse_step: int
+        set to first compute the likelihoods of a coarse grid with every
+        coarse_step-th node of each parameter in coarse_params, and then
+        of the full resolution models only around the coarse models within
+        coarse_threshold of the maximum coarse lnp, the refined region is
+        then expanded until the posterior mass in its outermost shell of
+        models is below coarse_edge_tol
+        (see beast.fitting.coarse_grid)
+        the diagnostics of the posterior mass potentially missed are added
+        to the stats: coarse_edge_mass (fraction of the posterior mass in
+        the outermost shell of models of the refined region),
+        coarse_missed_mass (fraction of the posterior mass outside of the
+        refined region extrapolated from the falloff between the two
+        outermost shells, 1 if the mass does not decrease outward), and
+        coarse_n_models (number of full resolution models computed)
+
+    coarse_threshold: float
+        threshold on the coarse lnps defining the refined region
+        default is 2.5*coarse_step**2*threshold (the lnps fall off about
+        quadratically with the distance in nodes and the coarse models
+        around a narrow peak are up to coarse_step nodes away from it)
+
+    coarse_params: list of str
+        grid parameters to decimate for the coarse grid
+
+    coarse_edge_tol: float
+        maximum fraction of the posterior mass in the outermost shell of
+        models of the refined region
+
+    use_float32: bool
+        set to store the model fluxes, noise model terms, and full model
+        fluxes used for the fitting in float32 (half the memory of these
+        arrays, the float64 arrays are still read one at a time during the
+        setup and the float64 model fluxes stay in memory if the grid is
+        in memory, e.g., gridbackend='memory' or a grid instance read in
+        memory, but not with gridbackend='cache' or 'hdf')
+        the fluxes and noise model terms are scaled by a reference flux of
+        each filter to stay in the float32 range and the chi2, lnps, and
+        weighted sums are still computed in float64
+        (see beast/tools/validate_float32_fitting.py to check the
+        differences with float64 for a catalog)
+
+    use_grid_codes: bool
+        set to keep the grid columns with few unique values (e.g., the
+        grid parameters) as uint8/uint16 codes into their unique values,
+        using the codes saved in the grid file if available
+        (see beast.physicsmodel.helpers.gridinfo), the results are
+        identical
+
+    nthreads: int
+        number of threads used to compute the likelihoods of each star
+        (the models are split in chunks computed in parallel, including the
+        selection of the sparse likelihood), the results are identical
+
+    min_chunk_size: int
+        minimum number of models per chunk when nthreads > 1
+
+    fit_setup: dict
+        precomputations of the model grid and noise model from setup_fit
+        (reused to fit several catalogs with the same grids, sedgrid, ast,
+        qnames_in and the keywords of setup_fit are then ignored)
+
+    profile_outname: str
+        set to time the stages of the fitting (setup, likelihoods, sparse
+        likelihood selection, normalization, expectation values, 1D PDFs,
+        percentiles, 2D PDFs, file I/O), count the bytes read/written and
+        the models evaluated, and record the number of models evaluated,
+        the size of the sparse likelihood, and the time of each star
+        the profile report is saved in this JSON file at each incremental
+        save and at the end (see beast.fitting.fit_profile)
+
     returns
     -------
-    N/A
+    (stats_tab, pdf1d_vals): astropy.table.Table, list of 2D nparrays
+        the stats and the 1D PDFs of each qname (last row gives the bin
+        values) of the fitted stars
     """
 
-    if type(sedgrid) == str:
-        g0 = grid.FileSEDGrid(sedgrid, backend=gridbackend)
-    else:
-        g0 = sedgrid
-
-    # remove weights that are less than zero
-    g0_indxs, = np.where(g0['weight'] > 0.0)
-
-    g0_weights = np.log(g0['weight'][g0_indxs])
-    if not do_not_normalize:
-        g0_weights_sum = np.log(g0['weight'][g0_indxs].sum())
-        g0_weights = numexpr.evaluate("g0_weights - g0_weights_sum")
-
-    if len(g0['weight']) != len(g0_indxs):
-        print('some zero weight models exist')
-        print('orig/g0_indxs', len(g0['weight']),len(g0_indxs))
-
-    # get the model SEDs
-    if hasattr(g0.seds, 'read'):
-        _seds = g0.seds.read()
-    else:
-        _seds = g0.seds
-
-    # get the names of all the children in the ast structure
-    ast_children = []
-    for label, node in list(ast.root._v_children.items()):
-        ast_children.append(label)
-
-    # links to errors and biases
-    ast_error = ast.root.error[:]
-    ast_bias = ast.root.bias[:]
-
-    # if the ast file includes the full covariance matrices, make links
-    full_cov_mat = False
-    if (use_full_cov_matrix &
-        ('q_norm' in ast_children) &
-        ('icov_diag' in ast_children) &
-        ('icov_offdiag' in ast_children)):
-        full_cov_mat = True
-        ast_q_norm = np.asfortranarray(ast.root.q_norm[:])
-        ast_icov_diag = np.asfortranarray(ast.root.icov_diag[:])
-        two_ast_icov_offdiag = 2.0 * np.asfortranarray(ast.root.icov_offdiag)
-    else:
-        ast_ivar = 1. / np.asfortranarray(ast_error)**2
-
-    if full_cov_mat:
-        print('using full covariance matrix')
-    else:
-        print('not using full covariance matrix')
+    # timers and counters (no-ops if not profiling)
+    prof = FitProfile(enabled=profile_outname is not None)
+
+    t_stage = prof.tic()
+    if fit_setup is None:
+        fit_setup = setup_fit(sedgrid, ast, qnames_in,
+                              gridbackend=gridbackend, max_nbins=max_nbins,
+                              grid_info_dict=grid_info_dict,
+                              use_full_cov_matrix=use_full_cov_matrix,
+                              use_icov_chol=use_icov_chol,
+                              do_not_normalize=do_not_normalize,
+                              prune_models=prune_models,
+                              coarse_step=coarse_step,
+                              coarse_params=coarse_params,
+                              use_float32=use_float32,
+                              use_grid_codes=use_grid_codes)
+        if prof.enabled:
+            # model fluxes and noise model terms read for the fitting
+            prof.count('bytes_read', sum(
+                fit_setup[name].nbytes
+                for name in ['model_seds_with_bias', 'ast_q_norm',
+                             'ast_icov_chol', 'ast_icov_diag',
+                             'two_ast_icov_offdiag', 'ast_ivar']
+                if fit_setup[name] is not None))
+        t_stage = prof.toc('setup', t_stage)
+
+    g0 = fit_setup['g0']
+    g0_indxs = fit_setup['g0_indxs']
+    g0_weights = fit_setup['g0_weights']
+    qnames = fit_setup['qnames']
+    filters = fit_setup['filters']
+    full_cov_mat = fit_setup['full_cov_mat']
+    use_icov_chol = fit_setup['use_icov_chol']
+    ast_q_norm = fit_setup['ast_q_norm']
+    ast_icov_chol = fit_setup['ast_icov_chol']
+    ast_icov_diag = fit_setup['ast_icov_diag']
+    two_ast_icov_offdiag = fit_setup['two_ast_icov_offdiag']
+    ast_ivar = fit_setup['ast_ivar']
+    model_seds_with_bias = fit_setup['model_seds_with_bias']
+    flux_scale = fit_setup['flux_scale']
+    prune_models = fit_setup['prune_models']
+    model_index = fit_setup['model_index']
+    coarse_step = fit_setup['coarse_step']
+    coarse_grid = fit_setup['coarse_grid']
+    qvals = fit_setup['qvals']
+    fast_pdf1d_objs = fit_setup['fast_pdf1d_objs']
 
     # number of observed SEDs to fit
     nobs = len(obs)
 
-    # augment the qnames to include the *full* model SED
-    #  by this it means the physical model flux plus the noise model bias term
-    qnames = qnames_in
-    filters = sedgrid.filters
-    for i, cfilter in enumerate(filters):
-        qnames.append('symlog'+cfilter+'_wd_bias')
-
-    # create the full model fluxes for later use
-    #   save as symmetric log, since the fluxes can be negative
-    model_seds_with_bias = np.asfortranarray(_seds + ast_bias)
-    #full_model_flux = np.sign(logtempseds) * np.log10(1 + np.abs(logtempseds * math.log(10)))
-    full_model_flux = (np.sign(model_seds_with_bias)
-                       * np.log1p(np.abs(model_seds_with_bias * math.log(10)))
-                       /math.log(10))
+    # setup the arrays of the coarse grid diagnostics (included in the stats)
+    if coarse_step is not None:
+        if coarse_threshold is None:
+            coarse_threshold = 2.5 * coarse_step**2 * threshold
+        coarse_missed_mass = np.zeros(nobs)
+        coarse_edge_mass = np.zeros(nobs)
+        coarse_n_models = np.zeros(nobs, dtype=int)
+
+    # the previous results are only built when the stats are first saved
+    prev_result_cache = []
+
+    def _get_prev_result():
+        if not prev_result_cache:
+            res = dict(prev_result() if callable(prev_result)
+                       else prev_result)
+            if coarse_step is not None:
+                res['coarse_missed_mass'] = coarse_missed_mass
+                res['coarse_edge_mass'] = coarse_edge_mass
+                res['coarse_n_models'] = coarse_n_models
+            prev_result_cache.append(res)
+        return prev_result_cache[0]
 
     # setup the arrays to temp store the results
     n_qnames = len(qnames)
@@ -342,66 +805,41 @@ def Q_all_memory(prev_result, obs, sedgrid, ast, qnames_in, p=[16., 50., 84.],
     # variable to save the lnp files
     save_lnp_vals = []
 
-    # setup the mapping for the 1D PDFs
-    fast_pdf1d_objs = []
+    # setup the arrays to save the 1d PDFs
     save_pdf1d_vals = []
-
-    for qname in qnames:
-        #q = g0[qname][g0_indxs]
-        if '_bias' in qname:
-            fname = (qname.replace('_wd_bias','')).replace('symlog','')
-            q = full_model_flux[:,filters.index(fname)]
-        else:
-            q = g0[qname]
-
-        if grid_info_dict is not None and qname in grid_info_dict:
-            # When processing a subgrid, we actuall need the number of
-            # unique values across all the subgrids to make the 1dpdfs
-            # compatible
-            n_uniq = grid_info_dict[qname]['num_unique']
-        else:
-            n_uniq = len(np.unique(q))
-
-        if n_uniq > max_nbins:
-            # limit the number of bins in the 1D likelihood for speed
-            nbins = max_nbins
-        else:
-            nbins = n_uniq
-
-        # temp code for BEAST paper figure
-        if qname == 'Z':
-            nbins = nbins + 1
-
-        # setup the fast 1d pdf
-
-        # needed for mass parameters as they are stored as linear values
-        # computationally, less bins needed if 1D PDFs done as log spacing
-        if qname in set(['M_ini', 'M_act','radius']):
-            logspacing = True
-        else:
-            logspacing = False
-
-        if grid_info_dict is not None and qname in grid_info_dict:
-            minval = grid_info_dict[qname]['min']
-            maxval = grid_info_dict[qname]['max']
-        else:
-            minval = None
-            maxval = None
-
-        # generate the fast 1d pdf mapping
-        _tpdf1d = pdf1d(q, nbins,
-                        logspacing=logspacing, minval=minval,
-                        maxval=maxval)
-        fast_pdf1d_objs.append(_tpdf1d)
-
-        # setup the arrays to save the 1d PDFs
-        save_pdf1d_vals.append(np.zeros((nobs+1, nbins)))
+    for _tpdf1d in fast_pdf1d_objs:
+        save_pdf1d_vals.append(np.zeros((nobs+1, _tpdf1d.nbins)))
         save_pdf1d_vals[-1][nobs,:] = _tpdf1d.bin_vals
 
+    # setup the mapping for the 2D PDFs
+    #   (float32 to limit the memory needed)
+    pdf2d_names = []
+    fast_pdf2d_objs = []
+    save_pdf2d_vals = []
+    if pdf2d_outname is not None:
+        if pdf2d_param_list is None:
+            pdf2d_param_list = ['Av', 'M_ini', 'logA', 'Rv', 'f_A']
+        pdf2d_qnames = [qname for qname in pdf2d_param_list
+                        if qname in qnames]
+        for i, qname_x in enumerate(pdf2d_qnames):
+            for qname_y in pdf2d_qnames[i+1:]:
+                _tpdf2d = pdf2d(fast_pdf1d_objs[qnames.index(qname_x)],
+                                fast_pdf1d_objs[qnames.index(qname_y)])
+                pdf2d_names.append((qname_x, qname_y))
+                fast_pdf2d_objs.append(_tpdf2d)
+                save_pdf2d_vals.append(np.zeros((nobs, _tpdf2d.nbins_x,
+                                                 _tpdf2d.nbins_y),
+                                                dtype=np.float32))
+
+    # buffer of the sparse likelihoods to compute the 2D PDFs in batches
+    pdf2d_buffer = []
+
     # if this is a resume job, read in the already computed stats and
     #     fill the variables
     # also - find the start position for the resumed run
     if resume:
+        t_stage = prof.tic()
+        prof.count('bytes_read', file_size(stats_outname))
         stats_table = Table.read(stats_outname)
 
         for k, qname in enumerate(qnames):
@@ -411,6 +849,11 @@ def Q_all_memory(prev_result, obs, sedgrid, ast, qnames_in, p=[16., 50., 84.],
                 per_vals[:,k,i] = stats_table['{0:s}_p{1:d}'.format(qname,
                                                                     int(pval))]
 
+        if coarse_step is not None:
+            coarse_missed_mass[:] = stats_table['coarse_missed_mass']
+            coarse_edge_mass[:] = stats_table['coarse_edge_mass']
+            coarse_n_models[:] = stats_table['coarse_n_models']
+
         chi2_vals = stats_table['chi2min']
         chi2_indx = stats_table['chi2min_indx']
         lnp_vals = stats_table['Pmax']
@@ -426,10 +869,22 @@ def Q_all_memory(prev_result, obs, sedgrid, ast, qnames_in, p=[16., 50., 84.],
         if pdf1d_outname != None:
             print('restoring the already computed 1D PDFs from ' +
                   pdf1d_outname)
+            prof.count('bytes_read', file_size(pdf1d_outname))
             hdulist = fits.open(pdf1d_outname)
             for k in range(len(qnames)):
                 save_pdf1d_vals[k] = hdulist[k+1].data
             hdulist.close()
+
+        # read in the already computed 2D PDFs
+        if pdf2d_outname is not None and os.path.isfile(pdf2d_outname):
+            print('restoring the already computed 2D PDFs from ' +
+                  pdf2d_outname)
+            prof.count('bytes_read', file_size(pdf2d_outname))
+            with tables.open_file(pdf2d_outname, 'r') as pdf2d_file:
+                for k, (qname_x, qname_y) in enumerate(pdf2d_names):
+                    save_pdf2d_vals[k] = pdf2d_file.get_node(
+                        '/' + qname_x + '__' + qname_y, 'pdf2d').read()
+        t_stage = prof.toc('resume_io', t_stage)
     else:
         start_pos = 0
 
@@ -446,10 +901,184 @@ def Q_all_memory(prev_result, obs, sedgrid, ast, qnames_in, p=[16., 50., 84.],
     g0_specgrid_indx = g0['specgrid_indx']
     _p = np.asarray(p, dtype=float)
 
+    def _lnp_models(sed, model_indxs, mask=None):
+        # lnp and chi2 of the models (all the models if model_indxs is None)
+        #   subsets are kept in fortran order to give the exact same values
+        #   the sed is scaled as the float32 model fluxes
+        if flux_scale is not None:
+            sed = sed / flux_scale
+        if model_indxs is None:
+            _subset = lambda vals: vals
+        elif isinstance(model_indxs, slice):
+            _subset = lambda vals: vals[model_indxs]
+        else:
+            _subset = lambda vals: np.take(vals.T, model_indxs, axis=-1).T
+        if full_cov_mat and use_icov_chol:
+            return N_covar_logLikelihood_chol(sed,
+                                              _subset(model_seds_with_bias),
+                                              _subset(ast_q_norm),
+                                              _subset(ast_icov_chol),
+                                              lnp_threshold=abs(threshold))
+        elif full_cov_mat:
+            return N_covar_logLikelihood(sed,
+                                         _subset(model_seds_with_bias),
+                                         _subset(ast_q_norm),
+                                         _subset(ast_icov_diag),
+                                         _subset(two_ast_icov_offdiag),
+                                         lnp_threshold=abs(threshold))
+        else:
+            (lnp, chi2) = N_logLikelihood_NM(sed,
+                                             _subset(model_seds_with_bias),
+                                             _subset(ast_ivar),
+                                             mask=mask,
+                                             lnp_threshold=abs(threshold))
+            # normalization with the unscaled inverse variances
+            if flux_scale is not None:
+                if mask is None:
+                    lnp -= np.sum(np.log(flux_scale))
+                else:
+                    lnp -= np.sum(np.log(flux_scale[~mask.astype(bool)]))
+            return (lnp, chi2)
+
+    # thread pool to compute the likelihoods of chunks of models in parallel
+    #   (numpy releases the GIL in the likelihood computations)
+    if nthreads > 1:
+        pool = ThreadPool(nthreads)
+
+    def _sparse_lnp_threaded(sed, cand_indxs, mask):
+        # sparse likelihood computed in chunks of models in parallel
+        #   gives the same values as the serial computation
+        #   (and the positions of the selected models in cand_indxs)
+        if cand_indxs is None:
+            n_models = len(g0_indxs)
+        else:
+            n_models = len(cand_indxs)
+        chunk_size = max(min_chunk_size,
+                         int(math.ceil(n_models / (4.*nthreads))))
+        bounds = [(i, min(i + chunk_size, n_models))
+                  for i in range(0, n_models, chunk_size)]
+
+        def _lnp_chunk(bound):
+            i, j = bound
+            if cand_indxs is None:
+                pos = slice(i, j)
+                if g0_indxs[j-1] - g0_indxs[i] == j - i - 1:
+                    model_indxs = slice(g0_indxs[i], g0_indxs[j-1] + 1)
+                else:
+                    model_indxs = g0_indxs[i:j]
+            else:
+                pos = cand_indxs[i:j]
+                model_indxs = g0_indxs[pos]
+            (lnp, chi2) = _lnp_models(sed, model_indxs, mask=mask)
+            lnp += g0_weights[pos]
+            good = np.isfinite(lnp)
+            max_lnp = np.max(lnp[good]) if np.any(good) else -np.inf
+            return (lnp, chi2, max_lnp)
+
+        t_stage = prof.tic()
+        chunks = pool.map(_lnp_chunk, bounds)
+        max_lnp = max([chunk[2] for chunk in chunks])
+        t_stage = prof.toc('likelihood', t_stage)
+
+        def _select_chunk(k):
+            (lnp, chi2, _) = chunks[k]
+            sindx, = np.where((lnp - max_lnp) > threshold)
+            pos = sindx + bounds[k][0]
+            if cand_indxs is None:
+                indx = pos
+            else:
+                indx = cand_indxs[pos]
+            return (lnp[sindx], chi2[sindx], indx, pos)
+
+        selected = pool.map(_select_chunk, range(len(chunks)))
+        sparse_lnp = tuple(np.concatenate([sel[m] for sel in selected])
+                           for m in range(4))
+        prof.toc('selection', t_stage)
+        return sparse_lnp
+
+    def _coarse_shell_mass(lnps, sindx, cand_indxs):
+        # fractions of the posterior mass of the refined region in its
+        #   outermost shell of models and in the shell just inside
+        shell = coarse_grid.shell(cand_indxs)
+        inner = np.zeros(len(cand_indxs), dtype=bool)
+        inner[~shell] = coarse_grid.shell(cand_indxs[~shell])
+        weights = np.exp(lnps - lnps.max())
+        weights /= weights.sum()
+        return (shell, weights[shell[sindx]].sum(),
+                weights[inner[sindx]].sum())
+
+    def _expand_coarse(sed, mask, lnps, chi2s, indx, sindx, cand_indxs):
+        # add the cells around the boundary of the refined region while its
+        #   outermost shell has more than coarse_edge_tol of the mass
+        #   the sparse likelihoods of the new models are merged with the
+        #   previous ones and the threshold applied again (same selection
+        #   as computing all the models of the region at once)
+        expanded = False
+        while True:
+            (shell, edge_mass,
+             inner_mass) = _coarse_shell_mass(lnps, sindx, cand_indxs)
+            if edge_mass <= coarse_edge_tol:
+                break
+            new_indxs = coarse_grid.expand(cand_indxs, shell)
+            if len(new_indxs) == 0:
+                break
+            prof.count('models_evaluated', len(new_indxs))
+            if nthreads > 1:
+                (new_lnps, new_chi2s, new_indx,
+                 new_sindx) = _sparse_lnp_threaded(sed, new_indxs, mask)
+            else:
+                (lnp, chi2) = _lnp_models(sed, g0_indxs[new_indxs],
+                                          mask=mask)
+                lnp += g0_weights[new_indxs]
+                new_sindx, = np.where((lnp - np.max(lnp[np.isfinite(lnp)]))
+                                      > threshold)
+                (new_lnps, new_chi2s, new_indx) = (
+                    lnp[new_sindx], chi2[new_sindx], new_indxs[new_sindx])
+            lnps = np.concatenate([lnps, new_lnps])
+            chi2s = np.concatenate([chi2s, new_chi2s])
+            indx = np.concatenate([indx, new_indx])
+            sindx = np.concatenate([sindx, new_sindx + len(cand_indxs)])
+            cand_indxs = np.concatenate([cand_indxs, new_indxs])
+            keep, = np.where((lnps - lnps.max()) > threshold)
+            (lnps, chi2s, indx, sindx) = (lnps[keep], chi2s[keep],
+                                          indx[keep], sindx[keep])
+            expanded = True
+
+        # same order as the models of the grid
+        if expanded:
+            order = np.argsort(indx)
+            (lnps, chi2s, indx) = (lnps[order], chi2s[order], indx[order])
+            cand_indxs = np.sort(cand_indxs)
+
+        # mass outside of the refined region extrapolated from the falloff
+        #   of the mass from the inner to the outermost shell (geometric
+        #   series of shells), the posterior is not decreasing outward if
+        #   the ratio is not below one
+        if edge_mass == 0.:
+            missed_mass = 0.
+        elif edge_mass < inner_mass:
+            ratio = edge_mass / inner_mass
+            missed_mass = edge_mass * ratio / (1. - ratio)
+            missed_mass /= 1. + missed_mass
+        else:
+            missed_mass = 1.
+
+        return (lnps, chi2s, indx, cand_indxs, edge_mass, missed_mass)
+
+    def _count_bytes_written(lnp_size):
+        # size of the saved files (the lnps are appended to the lnp file)
+        prof.count('bytes_written',
+                   file_size(stats_outname) + file_size(pdf1d_outname)
+                   + file_size(pdf2d_outname)
+                   + file_size(lnp_outname) - lnp_size)
+
     it = Pbar(len(obs)-start_pos,
               desc='Calculating Lnp/Stats').iterover(islice(obs.enumobs(),
                                                             int(start_pos),None))
     for e, obj in it:
+        t_star = prof.tic()
+        t_stage = t_star
+
         # calculate the full nD posterior
         (sed) = obj
 
@@ -459,35 +1088,90 @@ def Q_all_memory(prev_result, obs, sedgrid, ast, qnames_in, p=[16., 50., 84.],
         # currently, set mask to False always
         cur_mask[:] = False
 
-        if full_cov_mat:
-            (lnp, chi2) = N_covar_logLikelihood(sed,
-                                                model_seds_with_bias,
-                                                ast_q_norm,
-                                                ast_icov_diag,
-                                                two_ast_icov_offdiag,
-                                                lnp_threshold=abs(threshold))
+        cand_indxs = None
+        if prune_models:
+            # lower bound on the max lnp from models close to the sed
+            index_sed = sed if flux_scale is None else sed / flux_scale
+            seed_indxs = model_index.seeds(index_sed)
+            seed_lnp = _lnp_models(sed, g0_indxs[seed_indxs],
+                                   mask=cur_mask)[0]
+            seed_lnp += g0_weights[seed_indxs]
+            seed_lnp = seed_lnp[np.isfinite(seed_lnp)]
+            max_lnp_lower = seed_lnp.max() if len(seed_lnp) > 0 else -np.inf
+
+            # only compute the likelihoods of the candidate models
+            cand_indxs = model_index.candidates(index_sed, max_lnp_lower,
+                                                threshold)
+        elif coarse_step is not None:
+            # coarse grid likelihoods
+            coarse_indxs = coarse_grid.coarse_indxs
+            coarse_lnp = _lnp_models(sed, g0_indxs[coarse_indxs],
+                                     mask=cur_mask)[0]
+            coarse_lnp += g0_weights[coarse_indxs]
+            coarse_good = np.isfinite(coarse_lnp)
+            coarse_lnp -= np.max(coarse_lnp[coarse_good])
+            coarse_keep = coarse_good & (coarse_lnp > coarse_threshold)
+
+            # full resolution models around the kept coarse models
+            cand_indxs = coarse_grid.refine(coarse_keep)
+
+        if prof.enabled:
+            if prune_models:
+                n_models = len(seed_indxs) + len(cand_indxs)
+            elif coarse_step is not None:
+                n_models = len(coarse_indxs) + len(cand_indxs)
+            else:
+                n_models = len(g0_indxs)
+            prof.count('models_evaluated', n_models)
+            if cand_indxs is not None:
+                t_stage = prof.toc('candidates', t_stage)
+
+        if nthreads > 1:
+            (lnps, chi2s, indx, sindx) = _sparse_lnp_threaded(sed,
+                                                              cand_indxs,
+                                                              cur_mask)
+            t_stage = prof.tic()
         else:
-            (lnp,chi2) = N_logLikelihood_NM(sed,
-                                            model_seds_with_bias,
-                                            ast_ivar,
-                                            mask=cur_mask,
-                                            lnp_threshold=abs(threshold) )
-
-        lnp = lnp[g0_indxs]
-        chi2 = chi2[g0_indxs]
-        #lnp = numexpr.evaluate('lnp + g0_weights')
-        lnp +=  g0_weights  # multiply by the prior weights (sum in log space)
-
-        indx, = np.where((lnp - max(lnp[np.isfinite(lnp)])) > threshold)
-
-        # now generate the sparse likelihood (remove later if this works
-        #       by updating code below)
-        #   checked if changing to the full likelihood speeds things up
-        #       - the answer is no
-        #   and is likely related to the switch here to the sparse
-        #       likelihood for the weight calculation
-        lnps = lnp[indx]
-        chi2s = chi2[indx]
+            if cand_indxs is not None:
+                (lnp, chi2) = _lnp_models(sed, g0_indxs[cand_indxs],
+                                          mask=cur_mask)
+                lnp += g0_weights[cand_indxs]
+            else:
+                (lnp, chi2) = _lnp_models(sed, None, mask=cur_mask)
+                lnp = lnp[g0_indxs]
+                chi2 = chi2[g0_indxs]
+                #lnp = numexpr.evaluate('lnp + g0_weights')
+                lnp +=  g0_weights  # multiply by the prior weights (sum in log space)
+            t_stage = prof.toc('likelihood', t_stage)
+
+            sindx, = np.where((lnp - np.max(lnp[np.isfinite(lnp)]))
+                              > threshold)
+
+            # now generate the sparse likelihood (remove later if this works
+            #       by updating code below)
+            #   checked if changing to the full likelihood speeds things up
+            #       - the answer is no
+            #   and is likely related to the switch here to the sparse
+            #       likelihood for the weight calculation
+            lnps = lnp[sindx]
+            chi2s = chi2[sindx]
+
+            # indices of the sparse likelihood in g0_indxs
+            if cand_indxs is not None:
+                indx = cand_indxs[sindx]
+            else:
+                indx = sindx
+            t_stage = prof.toc('selection', t_stage)
+
+        if coarse_step is not None:
+            # expand the refined region until the posterior mass at its
+            #   boundary is negligible
+            (lnps, chi2s, indx, cand_indxs,
+             coarse_edge_mass[e], coarse_missed_mass[e]) = \
+                _expand_coarse(sed, cur_mask, lnps, chi2s, indx, sindx,
+                               cand_indxs)
+            coarse_n_models[e] = len(cand_indxs)
+            t_stage = prof.toc('candidates', t_stage)
 
         #log_norm = np.log(getNorm_lnP(lnps))
         #if not np.isfinite(log_norm):
@@ -500,20 +1184,30 @@ def Q_all_memory(prev_result, obs, sedgrid, ast, qnames_in, p=[16., 50., 84.],
         weight_sum = np.sum(weights)
         weights /= weight_sum
 
+        t_stage = prof.toc('normalize', t_stage)
+
         # save the current set of lnps
         if lnp_outname is not None:
             if lnp_npts is not None:
                 if lnp_npts < len(indx):
-                    rindx = np.random.choice(indx, size=lnp_npts, replace=False)
+                    rindx = np.random.choice(len(indx), size=lnp_npts,
+                                             replace=False)
                 if lnp_npts >= len(indx):
-                    rindx = indx
+                    rindx = np.arange(len(indx))
             else:
-                rindx = indx
+                rindx = np.arange(len(indx))
             save_lnp_vals.append([e,
-                                  np.array(g0_indxs[rindx], dtype=np.int64),
-                                  np.array(lnp[rindx], dtype=np.float32),
-                                  np.array(chi2[rindx], dtype=np.float32),
+                                  np.array(g0_indxs[indx[rindx]],
+                                           dtype=np.int64),
+                                  np.array(lnps[rindx], dtype=np.float32),
+                                  np.array(chi2s[rindx], dtype=np.float32),
                                   np.array([sed]).T])
+            if save_lnl:
+                # remove the prior weights (difference in log space)
+                save_lnp_vals[-1].append(
+                    np.array(lnps[rindx] - g0_weights[indx[rindx]],
+                             dtype=np.float32))
+            t_stage = prof.toc('lnp_buffer', t_stage)
 
         # To merge the stats for different subgrids, we need the total
         # weight of a grid, which is sum(exp(lnps)). Since sum(exp(lnps
@@ -535,21 +1229,19 @@ def Q_all_memory(prev_result, obs, sedgrid, ast, qnames_in, p=[16., 50., 84.],
         lnp_indx[e] = best_full_indx
 
         for k, qname in enumerate(qnames):
-            if '_bias' in qname:
-                fname = (qname.replace('_wd_bias','')).replace('symlog','')
-                q = full_model_flux[:,filters.index(fname)]
-            else:
-                q = g0[qname]
+            q = qvals[k]
 
             # best value
             best_vals[e,k] = q[best_full_indx]
 
             # expectation value
             exp_vals[e,k] = expectation(q[g0_indxs[indx]], weights=weights)
+            t_stage = prof.toc('expectation', t_stage)
 
             # percentile values
             pdf1d_bins, pdf1d_vals = fast_pdf1d_objs[k].gen1d(g0_indxs[indx],
                                                               weights)
+            t_stage = prof.toc('pdf1d', t_stage)
 
             save_pdf1d_vals[k][e,:] = pdf1d_vals
             if pdf1d_vals.max() > 0:
@@ -560,43 +1252,158 @@ def Q_all_memory(prev_result, obs, sedgrid, ast, qnames_in, p=[16., 50., 84.],
                                              weights=pdf1d_vals)
             else:
                 per_vals[e,k,:] = [0.0,0.0,0.0]
+            t_stage = prof.toc('percentiles', t_stage)
+
+        # 2D PDFs (computed in batches of stars)
+        if pdf2d_outname is not None:
+            pdf2d_buffer.append((e, g0_indxs[indx], weights))
+            if len(pdf2d_buffer) >= pdf2d_batch_npts:
+                _fill_pdf2d_vals(pdf2d_buffer, fast_pdf2d_objs,
+                                 save_pdf2d_vals)
+                pdf2d_buffer = []
+            t_stage = prof.toc('pdf2d', t_stage)
+
+        prof.add_star(e, n_models if prof.enabled else 0, len(indx),
+                      t_stage - t_star)
 
         # incremental save (useful if job dies early to recover most
         #    of the computations)
         if save_every_npts is not None:
             if (e > 0) & (e%save_every_npts == 0):
+                t_stage = prof.tic()
+                lnp_size = file_size(lnp_outname) if prof.enabled else 0
+
                 # save the 1D PDFs
                 if pdf1d_outname is not None:
                     save_pdf1d(pdf1d_outname,save_pdf1d_vals, qnames)
 
+                # save the 2D PDFs
+                if pdf2d_outname is not None:
+                    _fill_pdf2d_vals(pdf2d_buffer, fast_pdf2d_objs,
+                                     save_pdf2d_vals)
+                    pdf2d_buffer = []
+                    save_pdf2d(pdf2d_outname, save_pdf2d_vals,
+                               fast_pdf2d_objs, pdf2d_names)
+
                 # save the stats/catalog
                 if stats_outname is not None:
-                    save_stats(stats_outname, prev_result, best_vals,
-                               exp_vals, per_vals, chi2_vals, chi2_indx,
-                               lnp_vals, lnp_indx, best_specgrid_indx,
-                               total_log_norm, qnames, p)
+                    save_stats(stats_outname, _get_prev_result(),
+                               best_vals, exp_vals, per_vals, chi2_vals,
+                               chi2_indx, lnp_vals, lnp_indx,
+                               best_specgrid_indx, total_log_norm, qnames, p)
 
                 # save the lnps
                 if lnp_outname is not None:
                     save_lnp(lnp_outname, save_lnp_vals, resume)
                     save_lnp_vals = []
 
+                if prof.enabled:
+                    _count_bytes_written(lnp_size)
+                    prof.toc('checkpoint_io', t_stage)
+                    prof.write(profile_outname)
+
     ## do the final save of everything (or the last set for the lnp values)
+    t_stage = prof.tic()
+    lnp_size = file_size(lnp_outname) if prof.enabled else 0
 
     # save the 1D PDFs
     if pdf1d_outname is not None:
         save_pdf1d(pdf1d_outname,save_pdf1d_vals, qnames)
 
+    # save the 2D PDFs
+    if pdf2d_outname is not None:
+        _fill_pdf2d_vals(pdf2d_buffer, fast_pdf2d_objs, save_pdf2d_vals)
+        save_pdf2d(pdf2d_outname, save_pdf2d_vals, fast_pdf2d_objs,
+                   pdf2d_names)
+
     # save the stats/catalog
-    if stats_outname is not None:
-        save_stats(stats_outname, prev_result, best_vals, exp_vals,
-                   per_vals, chi2_vals, chi2_indx, lnp_vals, lnp_indx,
-                   best_specgrid_indx, total_log_norm, qnames, p)
+    stats_tab = save_stats(stats_outname, _get_prev_result(), best_vals,
+                           exp_vals, per_vals, chi2_vals, chi2_indx,
+                           lnp_vals, lnp_indx, best_specgrid_indx,
+                           total_log_norm, qnames, p)
 
     # save the lnps
     if lnp_outname is not None:
         save_lnp(lnp_outname, save_lnp_vals, resume)
 
+    if prof.enabled:
+        _count_bytes_written(lnp_size)
+        prof.toc('checkpoint_io', t_stage)
+        prof.write(profile_outname)
+
+    if nthreads > 1:
+        pool.close()
+        pool.join()
+
+    return (stats_tab, save_pdf1d_vals)
+
+def _fill_pdf2d_vals(pdf2d_buffer, fast_pdf2d_objs, save_pdf2d_vals):
+    """ Compute the 2D PDFs for a batch of stars
+
+    Keywords
+    ----------
+    pdf2d_buffer(list) : (star index, grid indices, weights) of the sparse
+                         likelihood of each star in the batch
+    fast_pdf2d_objs(list) : pdf2d instance for each pair of parameters
+    save_pdf2d_vals(list) : 3D nparrays to fill with the 2D PDFs
+
+    Returns
+    -------
+    N/A
+    """
+    if len(pdf2d_buffer) == 0:
+        return
+
+    star_nums = np.array([b[0] for b in pdf2d_buffer])
+    star_indxs = np.repeat(np.arange(len(pdf2d_buffer)),
+                           [len(b[1]) for b in pdf2d_buffer])
+    gindxs = np.concatenate([b[1] for b in pdf2d_buffer])
+    weights = np.concatenate([b[2] for b in pdf2d_buffer])
+
+    for k, _tpdf2d in enumerate(fast_pdf2d_objs):
+        _, _, pdf2d_vals = _tpdf2d.gen2d_multi(star_indxs, gindxs, weights,
+                                               len(pdf2d_buffer))
+        save_pdf2d_vals[k][star_nums] = pdf2d_vals
+
+def _sexagesimal_strings(vals, alwayssign=False):
+    """ Format sexagesimal strings for many values at once
+
+    Equivalent to astropy's Angle.to_string(sep="", precision=2, pad=True)
+
+    Keywords
+    ----------
+    vals(1D nparray) : values in hours or degrees
+    alwayssign(bool) : set to always include the sign
+
+    Returns
+    -------
+    strs(1D nparray) : formatted strings (e.g. 004312.34 or +411523.45)
+    """
+    vals = np.atleast_1d(np.asarray(vals, dtype=float))
+
+    # split into the sexagesimal fields
+    #   seconds that would print as 60.00 are carried (as astropy does)
+    absvals = np.abs(vals)
+    units = np.floor(absvals)
+    mins = np.floor((absvals - units)*60.)
+    secs = ((absvals - units)*60. - mins)*60.
+    carry = secs >= 59.99
+    secs[carry] = 0.
+    mins[carry] += 1
+    carry = mins >= 60.
+    mins[carry] = 0.
+    units[carry] += 1
+
+    strs = np.char.add(np.char.add(np.char.mod('%02d', units),
+                                   np.char.mod('%02d', mins)),
+                       np.char.mod('%05.2f', secs))
+    if alwayssign:
+        strs = np.char.add(np.where(np.signbit(vals), '-', '+'), strs)
+    else:
+        strs = np.char.add(np.where(np.signbit(vals), '-', ''), strs)
+
+    return strs
+
 def IAU_names_and_extra_info(obsdata, surveyname='PHAT',extraInfo=False):
     """
     generates IAU approved names for the data using RA & DEC
@@ -630,26 +1437,23 @@ def IAU_names_and_extra_info(obsdata, surveyname='PHAT',extraInfo=False):
 
     if go_name:
         # generate the IAU names
-        _tnames = []
-        for i in range(len(obsdata)):
-            c = ap_SkyCoord(ra=obsdata.data[ra_str][i]*ap_units.degree,
-                            dec=obsdata.data[dec_str][i]*ap_units.degree,
-                            frame='icrs')
-            _tnames.append(surveyname + ' J' +
-                           c.ra.to_string(unit=ap_units.hourangle,
-                                          sep="",precision=2,
-                                          alwayssign=False,pad=True) +
-                           c.dec.to_string(sep="",precision=2,
-                                           alwayssign=True,pad=True))
-            r['Name'] = _tnames
-
-            # other useful information
-            r['RA'] = obsdata.data[ra_str]
-            r['DEC'] = obsdata.data[dec_str]
-            if extraInfo:
-                r['field'] = obsdata.data['field']
-                r['inside_brick'] = obsdata.data['inside_brick']
-                r['inside_chipgap'] = obsdata.data['inside_chipgap']
+        #   all the coordinates at once and vectorized string formatting
+        c = ap_SkyCoord(ra=np.asarray(obsdata.data[ra_str])*ap_units.degree,
+                        dec=np.asarray(obsdata.data[dec_str])*ap_units.degree,
+                        frame='icrs')
+        r['Name'] = np.char.add(
+            np.char.add(surveyname + ' J',
+                        _sexagesimal_strings(c.ra.hourangle,
+                                             alwayssign=False)),
+            _sexagesimal_strings(c.dec.degree, alwayssign=True))
+
+        # other useful information
+        r['RA'] = obsdata.data[ra_str]
+        r['DEC'] = obsdata.data[dec_str]
+        if extraInfo:
+            r['field'] = obsdata.data['field']
+            r['inside_brick'] = obsdata.data['inside_brick']
+            r['inside_chipgap'] = obsdata.data['inside_chipgap']
     else:
         r['Name'] = ["noname" for x in range(len(obsdata))]
 
@@ -664,10 +1468,16 @@ def summary_table_memory(obs, noisemodel, sedgrid, keys=None,
                          gridbackend='cache', threshold=-10,
                          save_every_npts=None, lnp_npts=None,
                          resume=False, stats_outname=None,
-                         pdf1d_outname=None, grid_info_dict=None,
+                         pdf1d_outname=None, pdf2d_outname=None,
+                         pdf2d_param_list=None, grid_info_dict=None,
                          lnp_outname=None, use_full_cov_matrix=True,
+                         use_icov_chol=False,
                          surveyname='PHAT', extraInfo=False,
-                         do_not_normalize=False):
+                         do_not_normalize=False, save_lnl=False,
+                         prune_models=False, coarse_step=None,
+                         coarse_threshold=None, coarse_edge_tol=1e-3,
+                         use_float32=False, use_grid_codes=False,
+                         nthreads=1, profile_outname=None):
     """
     keywords
     --------
@@ -701,11 +1511,20 @@ def summary_table_memory(obs, noisemodel, sedgrid, keys=None,
         set to use the full covariance matrix if it is present in the
         noise model file
 
+    use_icov_chol: boolean
+        set to use the precomputed whitening factors of the covariance
+        matrices if present in the noise model file (see Q_all_memory)
+
     stats_outname: set to output the stats file into a FITS file with
                    extensions
 
     pdf1d_outname: set to output the 1D PDFs into a FITS file with extensions
 
+    pdf2d_outname: set to output the joint 2D PDFs into an HDF5 file
+
+    pdf2d_param_list: list of parameters to compute the 2D PDFs for
+                      (all pairs are computed)
+
     grid_info_dict: dict: {'qname': {'min': float,
                                      'max': float,
                                      'num_unique': int},
@@ -735,6 +1554,41 @@ def summary_table_memory(obs, noisemodel, sedgrid, keys=None,
         single grid, but is essential when using the subgridding
         approach.
 
+    save_lnl: bool
+        set to also save the log-likelihoods without the prior weights
+        with the sparse lnps
+
+    prune_models: bool
+        set to only compute the likelihoods of the models that can be in
+        the sparse likelihood (identical results, faster for large grids)
+
+    coarse_step: int
+        set to use the coarse-to-fine search of the model grid with every
+        coarse_step-th node of each parameter in the coarse grid
+        (see Q_all_memory)
+
+    coarse_threshold: float
+        threshold on the coarse lnps defining the refined region
+
+    coarse_edge_tol: float
+        maximum fraction of the posterior mass in the outermost shell of
+        the refined region (see Q_all_memory)
+
+    use_float32: bool
+        set to store the model and noise model grids in float32 for the
+        fitting (see Q_all_memory)
+
+    use_grid_codes: bool
+        set to keep the grid parameters as codes into their unique values
+        (see Q_all_memory)
+
+    nthreads: int
+        number of threads used to compute the likelihoods of each star
+
+    profile_outname: str
+        set to save a JSON profile report of the stages of the fitting
+        (see Q_all_memory)
+
     returns
     -------
     N/A
@@ -757,9 +1611,10 @@ def summary_table_memory(obs, noisemodel, sedgrid, keys=None,
             raise KeyError('Key "{0}" not recognized'.format(key))
 
     # generate an IAU complient name for each source and add other inform
-    res = IAU_names_and_extra_info(obs,
-                                   surveyname=surveyname,
-                                   extraInfo=False)
+    #   (on demand, when the stats are first saved)
+    def res():
+        return IAU_names_and_extra_info(obs, surveyname=surveyname,
+                                        extraInfo=False)
 
     Q_all_memory(res, obs, g0, noisemodel, keys, p=[16., 50., 84.],
                  resume=resume,
@@ -767,7 +1622,19 @@ def summary_table_memory(obs, noisemodel, sedgrid, keys=None,
                  lnp_npts=lnp_npts,
                  stats_outname=stats_outname,
                  pdf1d_outname=pdf1d_outname,
+                 pdf2d_outname=pdf2d_outname,
+                 pdf2d_param_list=pdf2d_param_list,
                  grid_info_dict=grid_info_dict,
                  lnp_outname=lnp_outname,
                  use_full_cov_matrix=use_full_cov_matrix,
-                 do_not_normalize=do_not_normalize)
+                 use_icov_chol=use_icov_chol,
+                 do_not_normalize=do_not_normalize,
+                 save_lnl=save_lnl,
+                 prune_models=prune_models,
+                 coarse_step=coarse_step,
+                 coarse_threshold=coarse_threshold,
+                 coarse_edge_tol=coarse_edge_tol,
+                 use_float32=use_float32,
+                 use_grid_codes=use_grid_codes,
+                 nthreads=nthreads,
+                 profile_outname=profile_outname)
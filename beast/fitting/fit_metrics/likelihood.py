@@ -122,6 +122,8 @@ def N_chi2_NM(flux, fluxmod_wbias, ivar, mask=None):
     chi2:    np.ndarray[float, ndim=1]
         array of chi2 values (nmodels)
     """
+    # differences (and chi2) in float64 even for float32 models
+    flux = np.asarray(flux, dtype=np.float64)
     if (mask is None) or np.all(mask == False):
         temp = flux - fluxmod_wbias
         _ie = ivar
@@ -165,7 +167,8 @@ def N_covar_chi2(flux, fluxmod_wbias, icov_diag, two_icov_offdiag):
     n_models, n_filters = fluxmod_wbias.shape
 
     # compute the difference in fluxes
-    fluxdiff = flux[None, :] - fluxmod_wbias
+    #   (and chi2) in float64 even for float32 models
+    fluxdiff = np.asarray(flux, dtype=np.float64)[None, :] - fluxmod_wbias
 
     #diagonal terms
     chisqr = np.einsum('ij,ij,ij->i', fluxdiff, fluxdiff, icov_diag)
@@ -182,6 +185,56 @@ def N_covar_chi2(flux, fluxmod_wbias, icov_diag, two_icov_offdiag):
     return chisqr
 
 
+def N_covar_chi2_chol(flux, fluxmod_wbias, icov_chol):
+    """ compute the non-reduced chi2 between data and model using
+    the whitening factors of the covariance matrices computed from ASTs.
+
+    Parameters
+    ----------
+    flux:    np.ndarray[float, ndim=1]
+        array of fluxes
+
+    fluxmod_wbias: np.ndarray[float, ndim=2]
+        array of modeled fluxes (nfilters , nmodels)
+
+    icov_chol: np.ndarray[float, ndim=2]
+        array giving the packed upper triangular whitening factors U
+        (U^T U = inverse covariance matrix), packed by rows
+        (see beast.observationmodel.noisemodel.trunchen.icov_cholesky)
+
+    Returns
+    -------
+    chi2:    np.ndarray[float, ndim=1]
+        array of chi2 values (nmodels)
+
+    Note
+    ----
+    Same chi2 as N_covar_chi2 (up to round off) and about the same speed.
+    Not to be confused with N_covar_logLikelihood_cholesky, which takes
+    the full inverse Cholesky factors of the covariance matrices
+    (nmodels, nfilters, nfilters) and is not used by the fitting.
+    """
+    # get the number of models and filters
+    n_models, n_filters = fluxmod_wbias.shape
+
+    # compute the difference in fluxes
+    #   (and chi2) in float64 even for float32 models
+    fluxdiff = np.asarray(flux, dtype=np.float64)[None, :] - fluxmod_wbias
+
+    # whitened differences (one row of U at a time) and their squared norm
+    chisqr = np.zeros(n_models)
+    m_start = 0
+    for k in range(n_filters):
+        m_end = m_start + n_filters - k
+        wdiff = np.einsum('ij,ij->i', icov_chol[:, m_start:m_end],
+                          fluxdiff[:, k:])
+        wdiff *= wdiff
+        chisqr += wdiff
+        m_start = m_end
+
+    return chisqr
+
+
 def SN_logLikelihood(flux, fluxerr_m, fluxerr_p, fluxmod, mask=None,
                      lnp_threshold=1000.):
     """ Compute the log of the chi2 likelihood between data with
@@ -341,7 +394,8 @@ def N_logLikelihood_NM(flux, fluxmod_wbias, ivar, mask=None,
     # By definition errors computed from ASTs are positive.
     n = np.shape(temp1)[1]
     # lnQ different for each model
-    lnQ = n * temp - 0.5 * np.sum(np.log(temp1),axis=1)
+    #   (computed in float64 even for float32 inverse variances)
+    lnQ = n * temp - 0.5 * np.sum(np.log(temp1, dtype=np.float64),axis=1)
     #lnQ is to be used * -1
 
     #compute the lnp = -lnQ - 0.5 * chi2
@@ -404,6 +458,55 @@ def N_covar_logLikelihood(flux, fluxmod_wbias,
     return (lnP, _chi2)
 
 
+def N_covar_logLikelihood_chol(flux, fluxmod_wbias, q_norm, icov_chol,
+                               lnp_threshold=1000.):
+    """ Computes the log of the chi2 likelihood between data and model taking
+    into account the noise model with the whitening factors of the
+    covariance matrices.
+
+    Parameters
+    ----------
+    flux: np.ndarray[float, ndim=1]
+        array of fluxes
+
+    fluxmod_wbias: np.ndarray[float, ndim=2]
+        array of modeled fluxes + ast-derived biases (nfilters , nmodels)
+
+    q_norm: np.ndarray[float, ndim=2]
+        array givign the q normalization of the likelihood
+        q_norm = ln(1./Q) where Q = det(cov matrix)
+
+    icov_chol: np.ndarray[float, ndim=2]
+        array giving the packed whitening factors of the covariance matrices
+
+    lnp_threshold:  float
+        cut the values outside -x, x in lnp
+
+    Returns
+    -------
+    (lnp, chi2)
+    lnP:    np.ndarray[float, ndim=1]
+            array of ln(P) values (Nmodels)
+    chi2:    np.ndarray[float, ndim=1]
+            array of chi-squared values (Nmodels)
+
+    Note
+    ----
+    Same normalization as N_covar_logLikelihood (see N_covar_chi2_chol).
+    """
+    n_models, n_filters = np.shape(fluxmod_wbias)
+
+    pi_term = -0.5*n_filters*np.log(2.0*np.pi)
+
+    # get the chi2 value
+    _chi2 = N_covar_chi2_chol(flux, fluxmod_wbias, icov_chol)
+
+    # compute the lnp = pi_term + q_norm - 0.5*chi2
+    lnP = pi_term + q_norm - (0.5*_chi2)
+
+    return (lnP, _chi2)
+
+
 def N_covar_logLikelihood_cholesky(flux, inv_cholesky_covar, lnQ,
                                    bias, fluxmod):
     """
@@ -421,6 +524,11 @@ def N_covar_logLikelihood_cholesky(flux, inv_cholesky_covar, lnQ,
     lnQ:     np.ndarray([float, ndim=1])
             Logarithm of the determinants of the covariance matrices
 
+    Note
+    ----
+    Not the packed whitening factors of the inverse covariance matrices
+    used by the fitting (see N_covar_logLikelihood_chol), and without the
+    2 pi normalization term.
     """
     lnP = np.zeros(fluxmod.shape)
     off = flux - (fluxmod + bias)
@@ -0,0 +1,198 @@
+# lightweight instrumentation of the fitting: timers per stage, counters,
+#  and per star records saved as a JSON profile report
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+__all__ = ['FitProfile']
+
+# monotonic clock (time.time for python 2)
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class FitProfile(object):
+    """
+    Timers per stage, counters (e.g., bytes read/written, models
+    evaluated), and per star records (models evaluated, size of the sparse
+    likelihood, time) of a fitting run
+
+    When disabled, all the methods return immediately so the
+    instrumentation calls can stay in the fitting loop.
+
+    Usage in a loop::
+
+        t = prof.tic()
+        <stage 1>
+        t = prof.toc('stage1', t)
+        <stage 2>
+        t = prof.toc('stage2', t)
+    """
+    def __init__(self, enabled=True):
+        """
+        Parameters
+        ----------
+        enabled: bool
+            set to record the timers and counters
+        """
+        self.enabled = enabled
+        self.start_time = _clock()
+        self.stage_times = OrderedDict()
+        self.stage_calls = OrderedDict()
+        self.counters = OrderedDict()
+        self.star_indxs = []
+        self.star_n_models = []
+        self.star_n_sparse = []
+        self.star_times = []
+
+    def tic(self):
+        """
+        Current time of the monotonic clock (0 if disabled)
+        """
+        if not self.enabled:
+            return 0.0
+        return _clock()
+
+    def toc(self, stage, t_start):
+        """
+        Add the time since t_start to a stage
+
+        Parameters
+        ----------
+        stage: str
+            name of the stage
+
+        t_start: float
+            start time (from tic or the previous toc)
+
+        Returns
+        -------
+        t_end: float
+            current time (to time the next stage)
+        """
+        if not self.enabled:
+            return 0.0
+        t_end = _clock()
+        self.stage_times[stage] = (self.stage_times.get(stage, 0.0)
+                                   + t_end - t_start)
+        self.stage_calls[stage] = self.stage_calls.get(stage, 0) + 1
+        return t_end
+
+    def count(self, name, n=1):
+        """
+        Increment a counter
+
+        Parameters
+        ----------
+        name: str
+            name of the counter
+
+        n: int or float
+            increment
+        """
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_star(self, star_indx, n_models, n_sparse, star_time):
+        """
+        Record the fit of a star
+
+        Parameters
+        ----------
+        star_indx: int
+            index of the star in the catalog
+
+        n_models: int
+            number of models whose likelihood was computed
+
+        n_sparse: int
+            number of models in the sparse likelihood
+
+        star_time: float
+            time to fit the star [s]
+        """
+        if not self.enabled:
+            return
+        self.star_indxs.append(int(star_indx))
+        self.star_n_models.append(int(n_models))
+        self.star_n_sparse.append(int(n_sparse))
+        self.star_times.append(star_time)
+
+    def report(self, n_slowest=10):
+        """
+        Profile report
+
+        Parameters
+        ----------
+        n_slowest: int
+            number of the slowest stars to list
+
+        Returns
+        -------
+        report: dict
+            total time, time and number of calls per stage, counters,
+            per star summary, the slowest stars, and the per star records
+        """
+        star_times = np.array(self.star_times)
+        n_stars = len(star_times)
+        report = OrderedDict()
+        report['total_time'] = _clock() - self.start_time
+        report['stages'] = OrderedDict(
+            (stage, {'time': self.stage_times[stage],
+                     'calls': self.stage_calls[stage]})
+            for stage in self.stage_times)
+        report['counters'] = OrderedDict(self.counters)
+
+        summary = OrderedDict()
+        summary['n_stars'] = n_stars
+        if n_stars > 0:
+            summary['stars_per_second'] = (n_stars / star_times.sum()
+                                           if star_times.sum() > 0 else None)
+            for name, vals in [('time', star_times),
+                               ('n_models', self.star_n_models),
+                               ('n_sparse', self.star_n_sparse)]:
+                summary[name] = {'min': float(np.min(vals)),
+                                 'median': float(np.median(vals)),
+                                 'max': float(np.max(vals))}
+        report['stars_summary'] = summary
+
+        slowest = np.argsort(star_times)[::-1][:n_slowest]
+        report['slowest_stars'] = [{'star': self.star_indxs[k],
+                                    'time': self.star_times[k],
+                                    'n_models': self.star_n_models[k],
+                                    'n_sparse': self.star_n_sparse[k]}
+                                   for k in slowest]
+        report['stars'] = {'star': self.star_indxs,
+                           'time': self.star_times,
+                           'n_models': self.star_n_models,
+                           'n_sparse': self.star_n_sparse}
+        return report
+
+    def write(self, outname):
+        """
+        Save the profile report in JSON
+
+        Parameters
+        ----------
+        outname: str
+            output filename
+        """
+        if not self.enabled:
+            return
+        with open(outname, 'w') as outfile:
+            json.dump(self.report(), outfile, indent=1)
+
+
+def file_size(fname):
+    """
+    Size of a file in bytes (0 if it does not exist)
+    """
+    if (fname is not None) and os.path.isfile(fname):
+        return os.path.getsize(fname)
+    return 0
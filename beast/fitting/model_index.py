@@ -0,0 +1,220 @@
+# index of the model grid in flux space used to find the models that can
+#  be in the sparse likelihood of an observed SED without computing the
+#  likelihood of every model
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import numpy as np
+
+__all__ = ['ModelFluxIndex']
+
+
+class ModelFluxIndex(object):
+    """
+    Index of the models in flux space giving, for an observed SED, a
+    guaranteed superset of the models within the threshold of the maximum
+    lnp (the sparse likelihood)
+
+    For each filter, the models are sorted by flux (with bias) and split in
+    blocks of consecutive models.  Each block stores its flux range,
+    its largest flux uncertainty, and its largest lnp normalization
+    (including the prior weight).  As the chi2 of a model is larger than
+    the chi2 in any single filter (also true with the full covariance
+    matrix), the lnp of all the models in a block is bounded from above.
+    The blocks whose bound is below the threshold from a lower bound of the
+    maximum lnp (computed exactly from a few seed models) cannot contain
+    any model of the sparse likelihood.  The candidates are the models
+    that are in kept blocks for all the filters.
+    """
+    def __init__(self, model_seds_with_bias, lnp_norm, sigmas,
+                 block_size=64):
+        """
+        Parameters
+        ----------
+        model_seds_with_bias: np.ndarray[float, ndim=2]
+            model fluxes + ast-derived biases (nmodels, nfilters)
+
+        lnp_norm: np.ndarray[float, ndim=1]
+            part of the lnp of each model that does not depend on the
+            observed SED (normalization + log prior weights) (nmodels)
+
+        sigmas: np.ndarray[float, ndim=2]
+            flux uncertainties of each model (nmodels, nfilters)
+            (sqrt of the diagonal of the covariance matrix)
+
+        block_size: int
+            number of models per block
+        """
+        n_models, n_filters = model_seds_with_bias.shape
+        self.n_models = n_models
+        self.n_filters = n_filters
+        self.block_size = block_size
+
+        self.lnp_norm = np.asarray(lnp_norm, dtype=np.float64)
+
+        sigmas = np.abs(sigmas)
+        block_starts = np.arange(0, n_models, block_size)
+        self.n_blocks = len(block_starts)
+
+        self.sort_indxs = np.empty((n_filters, n_models), dtype=np.int64)
+        self.model_blocks = np.empty((n_filters, n_models), dtype=np.int32)
+        self.sorted_fluxes = np.empty((n_filters, n_models),
+                                      dtype=model_seds_with_bias.dtype)
+        self.block_min = np.empty((n_filters, self.n_blocks))
+        self.block_max = np.empty((n_filters, self.n_blocks))
+        self.block_max_sigma = np.empty((n_filters, self.n_blocks))
+        self.block_max_norm = np.empty((n_filters, self.n_blocks))
+        for k in range(n_filters):
+            sindxs = np.argsort(model_seds_with_bias[:, k], kind='mergesort')
+            sfluxes = model_seds_with_bias[sindxs, k]
+            self.sort_indxs[k, :] = sindxs
+            self.model_blocks[k, sindxs] = np.arange(n_models) // block_size
+            self.sorted_fluxes[k, :] = sfluxes
+            self.block_min[k, :] = sfluxes[block_starts]
+            self.block_max[k, :] = sfluxes[np.minimum(block_starts
+                                                      + block_size - 1,
+                                                      n_models - 1)]
+            self.block_max_sigma[k, :] = np.maximum.reduceat(sigmas[sindxs, k],
+                                                             block_starts)
+            self.block_max_norm[k, :] = np.maximum.reduceat(
+                self.lnp_norm[sindxs], block_starts)
+
+    @classmethod
+    def from_noisemodel(cls, model_seds_with_bias, ast, lnp_weights,
+                        model_indxs=None, full_cov_mat=True, block_size=64,
+                        chunk_size=100000, flux_scale=None):
+        """
+        Create the index using the noise model arrays
+
+        Parameters
+        ----------
+        model_seds_with_bias: np.ndarray[float, ndim=2]
+            model fluxes + ast-derived biases (nmodels, nfilters)
+
+        ast: beast noisemodel instance
+            noise model data
+
+        lnp_weights: np.ndarray[float, ndim=1]
+            log of the prior weights of the indexed models
+
+        model_indxs: np.ndarray[int, ndim=1]
+            indices of the models to index (default is all)
+
+        full_cov_mat: boolean
+            set to use the full covariance matrix terms of the noise model
+
+        block_size: int
+            number of models per block
+
+        chunk_size: int
+            number of covariance matrices to invert at once
+
+        flux_scale: np.ndarray[float, ndim=1]
+            reference flux of each filter if the model fluxes are scaled
+            (the flux uncertainties are then scaled the same way, and the
+            observed SEDs must be scaled too)
+
+        Returns
+        -------
+        ModelFluxIndex instance (indices relative to model_indxs)
+        """
+        if model_indxs is None:
+            model_indxs = slice(None)
+        model_seds_with_bias = model_seds_with_bias[model_indxs]
+        n_models, n_filters = model_seds_with_bias.shape
+        if full_cov_mat:
+            # normalization as in N_covar_logLikelihood
+            icov_diag = ast.root.icov_diag[:][model_indxs]
+            icov_offdiag = ast.root.icov_offdiag[:][model_indxs]
+            lnp_norm = (-0.5*n_filters*np.log(2.0*np.pi)
+                        + ast.root.q_norm[:][model_indxs])
+
+            # sigmas from the diagonal of the covariance matrices
+            #   (from the packed inverse covariance matrices)
+            up_indxs = np.triu_indices(n_filters, 1)
+            diag_indxs = np.diag_indices(n_filters)
+            sigmas = np.empty((n_models, n_filters))
+            for i in range(0, n_models, chunk_size):
+                j = min(i + chunk_size, n_models)
+                icov = np.zeros((j - i, n_filters, n_filters))
+                icov[:, diag_indxs[0], diag_indxs[1]] = icov_diag[i:j]
+                icov[:, up_indxs[0], up_indxs[1]] = icov_offdiag[i:j]
+                icov[:, up_indxs[1], up_indxs[0]] = icov_offdiag[i:j]
+                sigmas[i:j] = np.sqrt(np.diagonal(np.linalg.inv(icov),
+                                                  axis1=1, axis2=2))
+        else:
+            # normalization as in N_logLikelihood_NM
+            sigmas = np.abs(ast.root.error[:][model_indxs])
+            lnp_norm = (-0.5*n_filters*np.log(2.0*np.pi)
+                        - np.sum(np.log(sigmas), axis=1))
+
+        if flux_scale is not None:
+            sigmas = sigmas / flux_scale
+
+        return cls(model_seds_with_bias, lnp_norm + lnp_weights, sigmas,
+                   block_size=block_size)
+
+    def seeds(self, sed):
+        """
+        Models close to the observed SED in each filter
+
+        Parameters
+        ----------
+        sed: np.ndarray[float, ndim=1]
+            observed fluxes
+
+        Returns
+        -------
+        indxs: np.ndarray[int, ndim=1]
+            indices of the seed models
+        """
+        indxs = []
+        for k in range(self.n_filters):
+            pos = np.searchsorted(self.sorted_fluxes[k, :], sed[k])
+            start = max(0, min(pos - self.block_size // 2,
+                               self.n_models - self.block_size))
+            indxs.append(self.sort_indxs[k, start:start + self.block_size])
+        return np.unique(np.concatenate(indxs))
+
+    def candidates(self, sed, max_lnp_lower, threshold, tolerance=1e-6):
+        """
+        Models that can be in the sparse likelihood of an observed SED
+
+        Parameters
+        ----------
+        sed: np.ndarray[float, ndim=1]
+            observed fluxes
+
+        max_lnp_lower: float
+            lower bound on the maximum lnp (e.g., max lnp of the seeds)
+
+        threshold: float
+            sparse likelihood threshold (negative)
+
+        tolerance: float
+            margin on the bound to allow for rounding errors
+
+        Returns
+        -------
+        indxs: np.ndarray[int, ndim=1]
+            sorted indices of the candidate models
+        """
+        keep = np.empty((self.n_filters, self.n_blocks), dtype=bool)
+        for k in range(self.n_filters):
+            dist = np.maximum(0.0, np.maximum(self.block_min[k, :] - sed[k],
+                                              sed[k] - self.block_max[k, :]))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                chi2_lower = (dist / self.block_max_sigma[k, :])**2
+            keep[k, :] = ~(self.block_max_norm[k, :] - 0.5*chi2_lower
+                           - max_lnp_lower <= threshold - tolerance)
+
+        # models in the kept blocks of the most constraining filter
+        best_k = np.argmin(keep.sum(axis=1))
+        indxs, = np.where(keep[best_k, self.model_blocks[best_k, :]])
+
+        # remove the models in pruned blocks for the other filters
+        for k in range(self.n_filters):
+            if k != best_k:
+                indxs = indxs[keep[k, self.model_blocks[k, indxs]]]
+
+        return indxs
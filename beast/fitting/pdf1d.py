@@ -14,8 +14,9 @@ class pdf1d():
         Parameters
         ----------
 
-        gridvals: array-like
+        gridvals: array-like or CodedColumn
             values of the quantity for all the grid points
+            (if coded, only the codebook values are binned)
 
         nbins: int
             number of bins to use for the 1D pdf
@@ -35,7 +36,12 @@ class pdf1d():
         self.n_indxs = len(indxs)
             
         # storage of the grid values to consider
-        tgridvals = np.array(gridvals[indxs])
+        #   (the unique values for a coded column)
+        codes = getattr(gridvals, 'codes', None)
+        if codes is not None:
+            tgridvals = np.array(gridvals.codebook)
+        else:
+            tgridvals = np.array(gridvals[indxs])
 
         if len(tgridvals) <= 0:
             # this is a hack to just get the code to work when
@@ -64,6 +70,14 @@ class pdf1d():
 
             # get in indices of the grid for each bin in the PDF
             _tpdf_indxs = np.digitize(tgridvals, self.bin_edges)
+            if codes is not None:
+                _tpdf_indxs = _tpdf_indxs[codes]
+
+            # bin of each grid point (-1 for points outside of all bins)
+            #   used for the batch generation of 1D pdfs
+            self.grid_bin_indxs = _tpdf_indxs - 1
+            self.grid_bin_indxs[(_tpdf_indxs < 1)
+                                | (_tpdf_indxs > self.nbins)] = -1
         
             # generate the reverse indices 
             # (like the IDL version returned by the histogram function)
@@ -117,3 +131,37 @@ class pdf1d():
 
             return (self.bin_vals, _vals_1d)
 
+    def gen1d_multi(self, star_indxs, gindxs, weights, nstars):
+        """
+        Generate the 1D pdfs for many objects at once
+
+        Parameters
+        ----------
+        star_indxs: array-like
+            index of the object for each entry of gindxs/weights
+
+        gindxs: array-like
+            grid indices of the (sparse) likelihoods of all the objects
+
+        weights: array-like
+            weights of the (sparse) likelihoods of all the objects
+
+        nstars: int
+            total number of objects
+
+        Returns
+        -------
+        (bin_vals, vals_1d): bin values and 2D array (nstars, nbins)
+        """
+        if self.bad:
+            return (self.bin_vals, np.zeros((nstars, self.nbins)))
+        else:
+            _bins = self.grid_bin_indxs[gindxs]
+            _good = _bins >= 0
+            _flat_indxs = (np.asarray(star_indxs)[_good]*self.nbins
+                           + _bins[_good])
+            _vals_1d = np.bincount(_flat_indxs,
+                                   weights=np.asarray(weights)[_good],
+                                   minlength=nstars*self.nbins)
+
+            return (self.bin_vals, _vals_1d.reshape(nstars, self.nbins))
@@ -0,0 +1,95 @@
+# class to generate 2D PDFs for many objects all with
+#  spare or full nD likelihoods on the same grid of models
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import numpy as np
+
+
+class pdf2d():
+    def __init__(self, pdf1d_x, pdf1d_y):
+        """
+        Create an object which can be used to efficiently generate a joint
+        2D pdf of two quantities for an observed object
+
+        The bins are those of the 1D pdfs of the two quantities.
+
+        Parameters
+        ----------
+
+        pdf1d_x, pdf1d_y: pdf1d instances
+            fast 1D pdf mappings for the two quantities (on the same grid)
+        """
+        self.nbins_x = pdf1d_x.nbins
+        self.nbins_y = pdf1d_y.nbins
+        self.bin_vals_x = pdf1d_x.bin_vals
+        self.bin_vals_y = pdf1d_y.bin_vals
+
+        self.bad = pdf1d_x.bad or pdf1d_y.bad
+
+        if not self.bad:
+            # precompute the flat (bin_x, bin_y) index of each grid point
+            #   -1 for points outside of the bins
+            self.grid_bin_indxs = (pdf1d_x.grid_bin_indxs*self.nbins_y
+                                   + pdf1d_y.grid_bin_indxs)
+            self.grid_bin_indxs[(pdf1d_x.grid_bin_indxs < 0)
+                                | (pdf1d_y.grid_bin_indxs < 0)] = -1
+
+    def gen2d(self, gindxs, weights):
+        """
+        Generate the 2D pdf for one object
+
+        Parameters
+        ----------
+        gindxs: array-like
+            grid indices of the (sparse) likelihood
+
+        weights: array-like
+            weights of the (sparse) likelihood
+
+        Returns
+        -------
+        (bin_vals_x, bin_vals_y, vals_2d): bin values and 2D array
+            (nbins_x, nbins_y)
+        """
+        _vals_2d = self.gen2d_multi(np.zeros(len(gindxs), dtype=int),
+                                    gindxs, weights, 1)[2]
+
+        return (self.bin_vals_x, self.bin_vals_y, _vals_2d[0])
+
+    def gen2d_multi(self, star_indxs, gindxs, weights, nstars):
+        """
+        Generate the 2D pdfs for many objects at once
+
+        Parameters
+        ----------
+        star_indxs: array-like
+            index of the object for each entry of gindxs/weights
+
+        gindxs: array-like
+            grid indices of the (sparse) likelihoods of all the objects
+
+        weights: array-like
+            weights of the (sparse) likelihoods of all the objects
+
+        nstars: int
+            total number of objects
+
+        Returns
+        -------
+        (bin_vals_x, bin_vals_y, vals_2d): bin values and 3D array
+            (nstars, nbins_x, nbins_y)
+        """
+        nbins = self.nbins_x*self.nbins_y
+        if self.bad:
+            _vals_2d = np.zeros(nstars*nbins)
+        else:
+            _bins = self.grid_bin_indxs[gindxs]
+            _good = _bins >= 0
+            _flat_indxs = np.asarray(star_indxs)[_good]*nbins + _bins[_good]
+            _vals_2d = np.bincount(_flat_indxs,
+                                   weights=np.asarray(weights)[_good],
+                                   minlength=nstars*nbins)
+
+        return (self.bin_vals_x, self.bin_vals_y,
+                _vals_2d.reshape(nstars, self.nbins_x, self.nbins_y))
@@ -0,0 +1,417 @@
+"""
+Prior reweighting of saved sparse likelihoods
+=============================================
+Recompute the fit statistics and 1D PDFs for new prior weights using the
+sparse likelihoods saved by the fitting (lnp files), without refitting.
+
+The sparse likelihoods of all the stars are read into flat arrays
+(CSR-like with one offset per star) and all the stats are computed in
+vectorized batches.
+
+Notes
+-----
+Only the models saved in the lnp file are used.  For the results to be
+accurate for the new priors, the lnp file should have been created with
+a low enough threshold (e.g., -40) and without random sampling
+(lnp_npts=None).  Saving the prior-free log-likelihoods
+(save_lnl=True in fit.summary_table_memory) is preferred, otherwise
+they are recovered from the lnps using the original grid weights.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import math
+import numpy as np
+import tables
+
+from ..physicsmodel import grid
+from ..physicsmodel.prior_weights_dust import PriorWeightsDust
+from .fit import save_stats, save_pdf1d, setup_pdf1d_objs
+
+__all__ = ['read_lnp_data', 'dust_prior_weights', 'pdf1d_percentiles',
+           'reweight_lnp']
+
+
+def read_lnp_data(lnp_fname, nstars=None):
+    """
+    Read the sparse likelihoods of all the stars in an lnp file into
+    flat arrays
+
+    Parameters
+    ----------
+    lnp_fname : str
+        name of the lnp file (created by fit.Q_all_memory)
+
+    nstars : int (optional)
+        only read the stars with index less than nstars
+
+    Returns
+    -------
+    lnp_data : dict
+        'star' : star index for each star in the file (sorted)
+        'offsets' : start of the entries of each star in the flat arrays
+                    (len(star) + 1 elements)
+        'idx', 'lnp', 'chi2' : flat arrays of the sparse likelihoods
+        'lnl' : flat array of the prior-free log-likelihoods
+                (None if not saved in the file)
+    """
+    with tables.open_file(lnp_fname, 'r') as lnp_file:
+        star_groups = [(int(name.split('_')[1]), name)
+                       for name in lnp_file.root._v_groups.keys()
+                       if name.startswith('star_')]
+        star_groups.sort()
+        if nstars is not None:
+            star_groups = [sg for sg in star_groups if sg[0] < nstars]
+
+        has_lnl = (len(star_groups) > 0) \
+            and ('lnl' in lnp_file.get_node('/', star_groups[0][1]))
+
+        star_indxs = np.array([sg[0] for sg in star_groups], dtype=np.int64)
+        idx_list = []
+        lnp_list = []
+        chi2_list = []
+        lnl_list = []
+        for e, name in star_groups:
+            star_group = lnp_file.get_node('/', name)
+            idx_list.append(star_group.idx.read())
+            lnp_list.append(star_group.lnp.read())
+            chi2_list.append(star_group.chi2.read())
+            if has_lnl:
+                lnl_list.append(star_group.lnl.read())
+
+    offsets = np.zeros(len(star_indxs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(idx) for idx in idx_list])
+
+    def _concat(vals, dtype):
+        if len(vals) > 0:
+            return np.concatenate(vals).astype(dtype)
+        else:
+            return np.zeros(0, dtype=dtype)
+
+    lnp_data = {'star': star_indxs,
+                'offsets': offsets,
+                'idx': _concat(idx_list, np.int64),
+                'lnp': _concat(lnp_list, float),
+                'chi2': _concat(chi2_list, float),
+                'lnl': _concat(lnl_list, float) if has_lnl else None}
+
+    return lnp_data
+
+
+def dust_prior_weights(sedgrid, av_prior_model={'name': 'flat'},
+                       rv_prior_model={'name': 'flat'},
+                       fA_prior_model={'name': 'flat'}):
+    """
+    Compute the dust prior weight of every model in the grid
+
+    Parameters
+    ----------
+    sedgrid : grid.SEDgrid instance
+        model grid with 'Av', 'Rv', and (optionally) 'f_A' columns
+
+    av_prior_model, rv_prior_model, fA_prior_model : dict
+        prior models (see PriorWeightsDust)
+
+    Returns
+    -------
+    weights : numpy vector
+        product of the A(V), R(V), and f_A prior weights for each model
+    """
+    av_vals, av_inv = np.unique(sedgrid['Av'], return_inverse=True)
+    rv_vals, rv_inv = np.unique(sedgrid['Rv'], return_inverse=True)
+    if 'f_A' in sedgrid.keys():
+        fA_vals, fA_inv = np.unique(sedgrid['f_A'], return_inverse=True)
+    else:
+        fA_vals = np.array([1.0])
+        fA_inv = np.zeros(len(av_inv), dtype=int)
+
+    dustpriors = PriorWeightsDust(av_vals, av_prior_model,
+                                  rv_vals, rv_prior_model,
+                                  fA_vals, fA_prior_model)
+
+    return (dustpriors.av_priors[av_inv] * dustpriors.rv_priors[rv_inv]
+            * dustpriors.fA_priors[fA_inv])
+
+
+def pdf1d_percentiles(bin_vals, pdf1d_vals, p):
+    """
+    Weighted percentiles of many 1D PDFs sharing the same bins
+    (vectorized version of fit_metrics.percentile)
+
+    Parameters
+    ----------
+    bin_vals : numpy vector
+        values of the bins (increasing)
+
+    pdf1d_vals : 2D numpy array
+        1D PDFs (nstars, nbins)
+
+    p : array-like
+        percentiles to compute (between 0 and 100)
+
+    Returns
+    -------
+    per_vals : 2D numpy array
+        percentile values (nstars, len(p)), zero for empty PDFs
+    """
+    nstars, nbins = pdf1d_vals.shape
+    _p = np.asarray(p, dtype=float) * 0.01
+
+    aw = np.cumsum(pdf1d_vals, axis=1)
+    total = aw[:, -1]
+    good = total > 0
+
+    per_vals = np.zeros((nstars, len(_p)))
+    if not np.any(good):
+        return per_vals
+
+    aw = aw[good]
+    w = (aw - 0.5 * pdf1d_vals[good]) / total[good, None]
+    rows = np.arange(w.shape[0])
+
+    for k, pk in enumerate(_p):
+        # equivalent to searchsorted(w, p) for each row
+        s = np.sum(w < pk, axis=1)
+        s_lo = np.clip(s - 1, 0, nbins - 1)
+        s_hi = np.clip(s, 0, nbins - 1)
+        w_lo = w[rows, s_lo]
+        w_hi = w[rows, s_hi]
+        dw = w_hi - w_lo
+        dw[dw == 0] = 1.0
+        f2 = (pk - w_lo) / dw
+        vals = bin_vals[s_lo] * (1.0 - f2) + bin_vals[s_hi] * f2
+        vals[s == 0] = bin_vals[0]
+        vals[s == nbins] = bin_vals[nbins - 1]
+        per_vals[good, k] = vals
+
+    return per_vals
+
+
+def reweight_lnp(lnp_data, sedgrid, new_weights, qnames=None,
+                 noisemodel=None, orig_weights=None, p=[16., 50., 84.],
+                 max_nbins=50, grid_info_dict=None, threshold=None,
+                 do_not_normalize=False, prev_result={}, nobs=None,
+                 stats_outname=None, pdf1d_outname=None):
+    """
+    Recompute the stats and 1D PDFs from the sparse likelihoods for a
+    new set of prior weights
+
+    Parameters
+    ----------
+    lnp_data : str or dict
+        lnp file name or the output of read_lnp_data
+
+    sedgrid : str or grid.SEDgrid instance
+        model grid used for the fitting
+
+    new_weights : numpy vector
+        new weights (grid * prior) for every model in the grid
+        e.g., the 'weight' column after compute_age_mass_metallicity_weights
+        times the dust_prior_weights for the new dust priors
+
+    qnames : list of str
+        quantities to compute the stats for (default: all grid columns
+        that are fit parameters)
+
+    noisemodel : beast noisemodel instance (optional)
+        if given, the stats of the full model fluxes
+        ('symlog<filter>_wd_bias') are also computed
+
+    orig_weights : numpy vector (optional)
+        weights used for the fit (default: the grid 'weight' column)
+        only needed if the lnp file does not have the prior-free
+        log-likelihoods
+
+    p : array-like
+        list of percentile values
+
+    max_nbins : int
+        maxiumum number of bins to use for the 1D PDFs
+
+    grid_info_dict : dict
+        overrides for the mins/maxes of the 1D PDFs (see fit.Q_all_memory)
+
+    threshold : float (optional)
+        if set, only use the models with lnp (new priors) within threshold
+        of the maximum (same meaning as in fit.Q_all_memory)
+
+    do_not_normalize : bool
+        do not normalize the weights (as in fit.Q_all_memory)
+
+    prev_result : dict
+        basic data on each source to include in the stats table
+
+    nobs : int (optional)
+        number of stars in the catalog (default: max star index + 1)
+
+    stats_outname : str (optional)
+        output name for the new stats file
+
+    pdf1d_outname : str (optional)
+        output name for the new 1D PDF file
+
+    Returns
+    -------
+    (summary_tab, save_pdf1d_vals) : stats table and list of 1D PDFs
+        in the same format as the fit outputs
+    """
+    if isinstance(lnp_data, str):
+        lnp_data = read_lnp_data(lnp_data, nstars=nobs)
+
+    if isinstance(sedgrid, str):
+        g0 = grid.FileSEDGrid(sedgrid)
+    else:
+        g0 = sedgrid
+
+    if qnames is None:
+        skip_keys = ('osl keep weight grid_weight prior_weight fullgrid_idx '
+                     'stage specgrid_indx').split()
+        qnames = [k for k in g0.keys() if k not in skip_keys]
+    else:
+        qnames = list(qnames)
+
+    new_weights = np.asarray(new_weights, dtype=float)
+    if len(new_weights) != len(g0['weight']):
+        raise ValueError('new_weights must have one weight per grid model')
+
+    # full model fluxes as in the fitting
+    filters = g0.filters
+    full_model_flux = None
+    if noisemodel is not None:
+        model_seds_with_bias = g0.seds[:] + noisemodel.root.bias[:]
+        full_model_flux = (np.sign(model_seds_with_bias)
+                           * np.log1p(np.abs(model_seds_with_bias
+                                             * math.log(10)))
+                           / math.log(10))
+        for cfilter in filters:
+            qnames.append('symlog' + cfilter + '_wd_bias')
+
+    # prior-free log-likelihoods
+    idx = lnp_data['idx']
+    if lnp_data['lnl'] is not None:
+        lnl = lnp_data['lnl']
+    else:
+        if orig_weights is None:
+            orig_weights = g0['weight']
+        orig_weights = np.asarray(orig_weights, dtype=float)
+        log_orig = np.log(orig_weights[idx])
+        if not do_not_normalize:
+            log_orig -= np.log(orig_weights[orig_weights > 0.0].sum())
+        lnl = lnp_data['lnp'] - log_orig
+
+    # apply the new priors
+    with np.errstate(divide='ignore'):
+        log_new = np.log(new_weights)
+    if not do_not_normalize:
+        log_new -= np.log(new_weights[new_weights > 0.0].sum())
+    lnp = lnl + log_new[idx]
+
+    # star position of each sparse entry
+    nstars_file = len(lnp_data['star'])
+    counts = np.diff(lnp_data['offsets'])
+    spos = np.repeat(np.arange(nstars_file), counts)
+
+    # remove the zero weight models and the ones below the threshold
+    keep = np.isfinite(lnp)
+    star_max = _segment_max(lnp, keep, spos, nstars_file)
+    if threshold is not None:
+        keep &= (lnp - star_max[spos]) > threshold
+    idx = idx[keep]
+    lnp = lnp[keep]
+    chi2 = lnp_data['chi2'][keep]
+    spos = spos[keep]
+
+    if nobs is None:
+        nobs = lnp_data['star'].max() + 1 if nstars_file > 0 else 0
+    star_indxs = lnp_data['star']
+
+    # normalized weights for each star
+    weights = np.exp(lnp - star_max[spos])
+    weight_sum = np.bincount(spos, weights=weights, minlength=nstars_file)
+    has_vals = weight_sum > 0
+    weights /= np.where(has_vals, weight_sum, 1.0)[spos]
+
+    # best fit (first maximum as np.argmax) and min chi2 for each star
+    best_pos = _segment_argfirst(lnp == star_max[spos], spos, nstars_file)
+    chi2_min = _segment_min(chi2, spos, nstars_file)
+    chi2_pos = _segment_argfirst(chi2 == chi2_min[spos], spos, nstars_file)
+
+    n_qnames = len(qnames)
+    n_pers = len(p)
+    best_vals = np.zeros((nobs, n_qnames))
+    exp_vals = np.zeros((nobs, n_qnames))
+    per_vals = np.zeros((nobs, n_qnames, n_pers))
+    chi2_vals = np.zeros(nobs)
+    chi2_indx = np.zeros(nobs)
+    lnp_vals = np.zeros(nobs)
+    lnp_indx = np.zeros(nobs)
+    best_specgrid_indx = np.zeros(nobs)
+    total_log_norm = np.zeros(nobs)
+
+    out_stars = star_indxs[has_vals]
+    best_full_indx = idx[best_pos[has_vals]]
+    lnp_vals[out_stars] = star_max[has_vals]
+    lnp_indx[out_stars] = best_full_indx
+    chi2_vals[out_stars] = chi2_min[has_vals]
+    chi2_indx[out_stars] = idx[chi2_pos[has_vals]]
+    best_specgrid_indx[out_stars] = g0['specgrid_indx'][best_full_indx]
+    total_log_norm[out_stars] = (star_max[has_vals]
+                                 + np.log(weight_sum[has_vals]))
+
+    # 1D PDFs, best, expectation, and percentile values
+    fast_pdf1d_objs = setup_pdf1d_objs(g0, qnames, full_model_flux, filters,
+                                       max_nbins=max_nbins,
+                                       grid_info_dict=grid_info_dict)
+    save_pdf1d_vals = []
+    for k, qname in enumerate(qnames):
+        if '_bias' in qname:
+            fname = (qname.replace('_wd_bias', '')).replace('symlog', '')
+            q = full_model_flux[:, filters.index(fname)]
+        else:
+            q = g0[qname]
+
+        best_vals[out_stars, k] = q[best_full_indx]
+        exp_vals[out_stars, k] = np.bincount(spos, weights=weights * q[idx],
+                                             minlength=nstars_file)[has_vals]
+
+        pdf1d_bins, pdf1d_vals = fast_pdf1d_objs[k].gen1d_multi(
+            spos, idx, weights, nstars_file)
+        per_vals[out_stars, k, :] = pdf1d_percentiles(
+            pdf1d_bins, pdf1d_vals[has_vals], p)
+
+        save_pdf1d_vals.append(np.zeros((nobs + 1, fast_pdf1d_objs[k].nbins)))
+        save_pdf1d_vals[-1][star_indxs, :] = pdf1d_vals
+        save_pdf1d_vals[-1][nobs, :] = pdf1d_bins
+
+    if pdf1d_outname is not None:
+        save_pdf1d(pdf1d_outname, save_pdf1d_vals, qnames)
+
+    summary_tab = save_stats(stats_outname, prev_result, best_vals, exp_vals,
+                             per_vals, chi2_vals, chi2_indx, lnp_vals,
+                             lnp_indx, best_specgrid_indx, total_log_norm,
+                             qnames, p)
+
+    return (summary_tab, save_pdf1d_vals)
+
+
+def _segment_max(vals, mask, spos, nsegs):
+    """ Maximum of the masked values for each segment (-inf if none) """
+    seg_max = np.full(nsegs, -np.inf)
+    np.maximum.at(seg_max, spos[mask], vals[mask])
+    return seg_max
+
+
+def _segment_min(vals, spos, nsegs):
+    """ Minimum of the values for each segment (inf if none) """
+    seg_min = np.full(nsegs, np.inf)
+    np.minimum.at(seg_min, spos, vals)
+    return seg_min
+
+
+def _segment_argfirst(flags, spos, nsegs):
+    """ Position of the first flagged entry for each segment (0 if none) """
+    first = np.zeros(nsegs, dtype=np.int64)
+    flagged, = np.where(flags)
+    uspos, uindxs = np.unique(spos[flagged], return_index=True)
+    first[uspos] = flagged[uindxs]
+    return first
@@ -161,3 +161,52 @@ def test_fit_grid():
 
     # check that the pdf1d files are exactly the same
     compare_fits(pdf1d_fname_cache, pdf1d_fname)
+
+
+@remote_data
+def test_fit_grid_prune_models():
+
+    # download the needed files
+    vega_fname = download_rename('vega.hd5')
+    obs_fname = download_rename('b15_4band_det_27_A.fits')
+    noise_trim_fname = download_rename(
+                                'beast_example_phat_noisemodel_trim.grid.hd5')
+    seds_trim_fname = download_rename(
+                                'beast_example_phat_seds_trim.grid.hd5')
+
+    # download cached version of fitting results
+    stats_fname_cache = download_rename('beast_example_phat_stats.fits')
+    pdf1d_fname_cache = download_rename('beast_example_phat_pdf1d.fits')
+
+    ################
+
+    noisemodel_vals = noisemodel.get_noisemodelcat(noise_trim_fname)
+
+    filters = ['HST_WFC3_F275W', 'HST_WFC3_F336W', 'HST_ACS_WFC_F475W',
+               'HST_ACS_WFC_F814W', 'HST_WFC3_F110W', 'HST_WFC3_F160W']
+    basefilters = ['F275W', 'F336W', 'F475W',
+                   'F814W', 'F110W', 'F160W']
+    obs_colnames = [f.lower() + '_rate' for f in basefilters]
+
+    obsdata = get_obscat(obs_fname,
+                         filters,
+                         obs_colnames,
+                         vega_fname=vega_fname)
+
+    # only computing the likelihoods of the candidate models should give
+    #   exactly the same results
+    stats_fname = '/tmp/beast_example_phat_prune_stats.fits'
+    pdf1d_fname = '/tmp/beast_example_phat_prune_pdf1d.fits'
+
+    fit.summary_table_memory(obsdata, noisemodel_vals, seds_trim_fname,
+                             threshold=-10.,
+                             stats_outname=stats_fname,
+                             pdf1d_outname=pdf1d_fname,
+                             prune_models=True)
+
+    table_cache = Table.read(stats_fname_cache)
+    table_new = Table.read(stats_fname)
+
+    compare_tables(table_cache, table_new)
+
+    compare_fits(pdf1d_fname_cache, pdf1d_fname)
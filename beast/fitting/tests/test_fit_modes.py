@@ -0,0 +1,275 @@
+import numpy as np
+import pytest
+import tables
+from astropy import units
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.table import Table
+
+import beast.observationmodel.noisemodel.generic_noisemodel as noisemodel
+from beast.observationmodel.noisemodel.trunchen import add_icov_cholesky
+from beast.physicsmodel.grid import FileSEDGrid
+from beast.fitting import fit
+from beast.tools.fit_server import SEDObservations
+from beast.tests.helpers import (make_sed_grid, make_noisemodel,
+                                 make_obs_seds, compare_tables)
+
+
+def _fit(obs, sedgrid, noise, **kwargs):
+    """ fit the synthetic stars and return the stats and 1D PDFs """
+    res = {'Name': np.arange(len(obs))}
+    return fit.Q_all_memory(res, obs, sedgrid, noise, ['logA', 'M_ini', 'Av'],
+                            threshold=-10., **kwargs)
+
+
+def test_fit_coarse_threads(tmpdir):
+    sedgrid = make_sed_grid()
+    noise = noisemodel.get_noisemodelcat(
+        make_noisemodel(sedgrid, str(tmpdir.join('noise.hd5'))))
+    obs = SEDObservations(make_obs_seds(sedgrid, 20),
+                          sedgrid.header['filters'].split())
+
+    # the likelihoods of the refined models computed in chunks in parallel
+    #   give the same results as the serial computation
+    (stats, pdf1d) = _fit(obs, sedgrid, noise, coarse_step=2)
+    (stats_threads, pdf1d_threads) = _fit(obs, sedgrid, noise,
+                                          coarse_step=2, nthreads=2,
+                                          min_chunk_size=50)
+    noise.close()
+
+    compare_tables(stats, stats_threads)
+    for vals, vals_threads in zip(pdf1d, pdf1d_threads):
+        np.testing.assert_allclose(vals, vals_threads)
+
+
+def test_fit_coarse_vs_full(tmpdir):
+    sedgrid = make_sed_grid(n_age=10, n_mass=30, n_av=10)
+    noise = noisemodel.get_noisemodelcat(
+        make_noisemodel(sedgrid, str(tmpdir.join('noise.hd5'))))
+    obs = SEDObservations(make_obs_seds(sedgrid, 30),
+                          sedgrid.header['filters'].split())
+
+    # the refined region around the coarse grid includes the best model of
+    #   the full grid and only a negligible posterior mass is at its edge
+    (stats, _) = _fit(obs, sedgrid, noise)
+    (stats_coarse, _) = _fit(obs, sedgrid, noise, coarse_step=2)
+    noise.close()
+
+    np.testing.assert_equal(stats_coarse['Pmax_indx'], stats['Pmax_indx'])
+    np.testing.assert_allclose(stats_coarse['Pmax'], stats['Pmax'])
+    np.testing.assert_equal(stats_coarse['chi2min_indx'],
+                            stats['chi2min_indx'])
+    assert np.all(stats_coarse['coarse_edge_mass'] <= 1e-3)
+    assert np.all(stats_coarse['coarse_missed_mass'] < 1e-3)
+    assert np.all(stats_coarse['coarse_n_models'] < len(sedgrid.seds))
+
+
+@pytest.mark.parametrize('full_cov', [False, True])
+def test_fit_prune_models(tmpdir, full_cov):
+    sedgrid = make_sed_grid(n_age=10, n_mass=30, n_av=10)
+    noise = noisemodel.get_noisemodelcat(
+        make_noisemodel(sedgrid, str(tmpdir.join('noise.hd5')),
+                        full_cov=full_cov))
+    obs = SEDObservations(make_obs_seds(sedgrid, 30),
+                          sedgrid.header['filters'].split())
+
+    # only computing the likelihoods of the candidate models should give
+    #   exactly the same results
+    results = []
+    for prune_models in [False, True]:
+        lnp_fname = str(tmpdir.join('lnp_{0}.hd5'.format(prune_models)))
+        (stats, pdf1d) = _fit(obs, sedgrid, noise, lnp_outname=lnp_fname,
+                              prune_models=prune_models)
+        results.append((stats, pdf1d, lnp_fname))
+    noise.close()
+
+    compare_tables(results[0][0], results[1][0])
+    for vals, vals_prune in zip(results[0][1], results[1][1]):
+        np.testing.assert_array_equal(vals, vals_prune)
+    with tables.open_file(results[0][2], 'r') as lnp_file, \
+            tables.open_file(results[1][2], 'r') as lnp_prune_file:
+        assert (sorted(lnp_file.root._v_children.keys()) ==
+                sorted(lnp_prune_file.root._v_children.keys()))
+        for e in range(len(obs)):
+            star = lnp_file.get_node('/star_{0:d}'.format(e))
+            star_prune = lnp_prune_file.get_node('/star_{0:d}'.format(e))
+            np.testing.assert_array_equal(star.idx.read(),
+                                          star_prune.idx.read())
+            np.testing.assert_array_equal(star.lnp.read(),
+                                          star_prune.lnp.read())
+
+
+def test_fit_icov_chol(tmpdir, capsys):
+    sedgrid = make_sed_grid()
+    noise_fname = make_noisemodel(sedgrid, str(tmpdir.join('noise.hd5')),
+                                  full_cov=True)
+    add_icov_cholesky(noise_fname)
+    noise = noisemodel.get_noisemodelcat(noise_fname)
+    obs = SEDObservations(make_obs_seds(sedgrid, 20),
+                          sedgrid.header['filters'].split())
+
+    # the precomputed whitening factors are only used if requested
+    (stats, pdf1d) = _fit(obs, sedgrid, noise)
+    assert 'whitening' not in capsys.readouterr().out
+    (stats_chol, pdf1d_chol) = _fit(obs, sedgrid, noise, use_icov_chol=True)
+    assert 'using the precomputed whitening factors' in \
+        capsys.readouterr().out
+    noise.close()
+
+    compare_tables(stats, stats_chol)
+    for vals, vals_chol in zip(pdf1d, pdf1d_chol):
+        np.testing.assert_allclose(vals, vals_chol, rtol=1e-6, atol=1e-12)
+
+
+def test_setup_fit_float32(tmpdir):
+    sedgrid = make_sed_grid()
+    seds_fname = str(tmpdir.join('seds.grid.hd5'))
+    sedgrid.writeHDF(seds_fname)
+    noise = noisemodel.get_noisemodelcat(
+        make_noisemodel(sedgrid, str(tmpdir.join('noise.hd5'))))
+
+    # the float64 fluxes cached by the grid are released, and reloaded
+    #   from the file if needed
+    g = FileSEDGrid(seds_fname, backend='cache')
+    fit_setup = fit.setup_fit(g, noise, ['logA'], use_float32=True)
+    noise.close()
+    assert fit_setup['model_seds_with_bias'].dtype == np.float32
+    assert g._backend._seds is None
+    np.testing.assert_array_equal(g.seds, sedgrid.seds)
+
+
+def test_fit_grid_codes(tmpdir):
+    # grid parameters kept as codes into their unique values
+    sedgrid = make_sed_grid()
+    seds_fname = str(tmpdir.join('seds.grid.hd5'))
+    sedgrid.writeHDF(seds_fname, grid_codes=True)
+    noise = noisemodel.get_noisemodelcat(
+        make_noisemodel(sedgrid, str(tmpdir.join('noise.hd5'))))
+    obs = SEDObservations(make_obs_seds(sedgrid, 20),
+                          sedgrid.header['filters'].split())
+
+    results = []
+    for use_grid_codes in [False, True]:
+        stats_fname = str(tmpdir.join('stats_{0}.fits'.format(
+            use_grid_codes)))
+        pdf1d_fname = str(tmpdir.join('pdf1d_{0}.fits'.format(
+            use_grid_codes)))
+        fit.summary_table_memory(obs, noise, seds_fname,
+                                 keys=['logA', 'M_ini', 'Av'],
+                                 threshold=-10., stats_outname=stats_fname,
+                                 pdf1d_outname=pdf1d_fname,
+                                 use_grid_codes=use_grid_codes)
+        results.append((stats_fname, pdf1d_fname))
+    noise.close()
+
+    compare_tables(Table.read(results[0][0]), Table.read(results[1][0]))
+    pdf1d = fits.open(results[0][1])
+    pdf1d_codes = fits.open(results[1][1])
+    assert len(pdf1d) == len(pdf1d_codes)
+    for k in range(1, len(pdf1d)):
+        qname = pdf1d[k].header['EXTNAME']
+        np.testing.assert_array_equal(pdf1d[k].data,
+                                      pdf1d_codes[qname].data)
+    pdf1d.close()
+    pdf1d_codes.close()
+
+
+def test_fit_pdf2d(tmpdir):
+    sedgrid = make_sed_grid()
+    noise = noisemodel.get_noisemodelcat(
+        make_noisemodel(sedgrid, str(tmpdir.join('noise.hd5'))))
+    n_stars = 7
+    obs = SEDObservations(make_obs_seds(sedgrid, n_stars),
+                          sedgrid.header['filters'].split())
+
+    keys = ['logA', 'M_ini', 'Av']
+    pdf1d_fname = str(tmpdir.join('pdf1d.fits'))
+    pdf2d_fname = str(tmpdir.join('pdf2d.hd5'))
+    lnp_fname = str(tmpdir.join('lnp.hd5'))
+    # 2D PDFs computed in several batches of stars
+    _fit(obs, sedgrid, noise, stats_outname=str(tmpdir.join('stats.fits')),
+         pdf1d_outname=pdf1d_fname, lnp_outname=lnp_fname,
+         pdf2d_outname=pdf2d_fname, pdf2d_param_list=keys,
+         pdf2d_batch_npts=3)
+    noise.close()
+
+    pdf1d = fits.open(pdf1d_fname)
+    with tables.open_file(pdf2d_fname, 'r') as pdf2d_file, \
+            tables.open_file(lnp_fname, 'r') as lnp_file:
+        for i, qname_x in enumerate(keys):
+            for qname_y in keys[i+1:]:
+                group = pdf2d_file.get_node('/{0}__{1}'.format(qname_x,
+                                                               qname_y))
+                assert group._v_attrs.qname_x == qname_x
+                assert group._v_attrs.qname_y == qname_y
+                pdf2d_vals = group.pdf2d.read()
+                assert pdf2d_vals.shape[0] == n_stars
+
+                # bin edges halfway between the regularly spaced bins
+                edges = []
+                for bin_vals in [group.bin_vals_x.read(),
+                                 group.bin_vals_y.read()]:
+                    delta = bin_vals[1] - bin_vals[0]
+                    edges.append(np.append(bin_vals - 0.5*delta,
+                                           bin_vals[-1] + 0.5*delta))
+
+                for e in range(n_stars):
+                    # histogram of the parameters of the sparse likelihood
+                    star = lnp_file.get_node('/star_{0:d}'.format(e))
+                    indxs = star.idx.read()
+                    lnps = star.lnp.read().astype(float)
+                    weights = np.exp(lnps - lnps.max())
+                    weights /= weights.sum()
+                    hist, _, _ = np.histogram2d(
+                        sedgrid.grid[qname_x][indxs],
+                        sedgrid.grid[qname_y][indxs],
+                        bins=edges, weights=weights)
+                    np.testing.assert_allclose(pdf2d_vals[e], hist,
+                                               rtol=1e-5, atol=1e-8)
+
+                    # marginals are the 1D PDFs (2D PDFs saved in float32)
+                    np.testing.assert_allclose(pdf2d_vals[e].sum(axis=1),
+                                               pdf1d[qname_x].data[e],
+                                               rtol=1e-6, atol=1e-9)
+                    np.testing.assert_allclose(pdf2d_vals[e].sum(axis=0),
+                                               pdf1d[qname_y].data[e],
+                                               rtol=1e-6, atol=1e-9)
+    pdf1d.close()
+
+
+def test_IAU_names():
+    # random coordinates, seconds close to the carries to the next
+    #   minute/hour/degree (including 24h) and negative declinations
+    #   (including -0 degrees)
+    rng = np.random.RandomState(5)
+    hms = np.array([[0, 43, 12.34], [1, 59, 59.992], [1, 59, 59.996],
+                    [0, 0, 59.9951], [23, 59, 59.999], [5, 4, 59.989],
+                    [5, 4, 59.985], [12, 59, 59.9899], [3, 0, 0.]])
+    dms = np.array([[41, 59, 59.992], [-0, 59, 59.997], [-0, 0, 0.0036],
+                    [-12, 0, 59.995], [-89, 59, 59.9999], [-3, 29, 59.989],
+                    [0, 0, 59.99], [-59, 59, 59.9951], [-0, 0, 0.]])
+    dec_sign = np.array([1, -1, -1, -1, -1, -1, 1, -1, -1])
+    ra = 15. * (hms[:, 0] + hms[:, 1] / 60. + hms[:, 2] / 3600.)
+    dec = dec_sign * (np.abs(dms[:, 0]) + dms[:, 1] / 60.
+                      + dms[:, 2] / 3600.)
+    ra = np.concatenate([ra, rng.uniform(0., 360., 50)])
+    dec = np.concatenate([dec, rng.uniform(-90., 90., 50)])
+
+    filters = ['F0', 'F1']
+    obs = SEDObservations(np.ones((len(ra), len(filters))), filters,
+                          ra=ra, dec=dec)
+    names = fit.IAU_names_and_extra_info(obs, surveyname='TEST')['Name']
+
+    # names built one star at a time
+    expected = []
+    for cur_ra, cur_dec in zip(ra, dec):
+        c = SkyCoord(ra=cur_ra*units.degree, dec=cur_dec*units.degree,
+                     frame='icrs')
+        expected.append('TEST J'
+                        + c.ra.to_string(unit=units.hourangle, sep='',
+                                         precision=2, alwayssign=False,
+                                         pad=True)
+                        + c.dec.to_string(sep='', precision=2,
+                                          alwayssign=True, pad=True))
+    np.testing.assert_equal(names, expected)
+    assert names[4] == 'TEST J240000.00-900000.00'
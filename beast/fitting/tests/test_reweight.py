@@ -0,0 +1,93 @@
+import numpy as np
+
+from astropy.table import Table
+from astropy.tests.helper import remote_data
+
+import beast.observationmodel.noisemodel.generic_noisemodel as noisemodel
+from beast.physicsmodel.grid import FileSEDGrid
+from beast.fitting import fit, reweight
+from beast.fitting.tests.test_fit_grid import get_obscat
+from beast.tools.fit_server import SEDObservations
+from beast.tests.helpers import (download_rename, make_sed_grid,
+                                 make_noisemodel, make_obs_seds)
+
+
+@remote_data
+def test_reweight_lnp():
+
+    # download the needed files
+    vega_fname = download_rename('vega.hd5')
+    obs_fname = download_rename('b15_4band_det_27_A.fits')
+    noise_trim_fname = download_rename(
+                                'beast_example_phat_noisemodel_trim.grid.hd5')
+    seds_trim_fname = download_rename(
+                                'beast_example_phat_seds_trim.grid.hd5')
+
+    ################
+
+    noisemodel_vals = noisemodel.get_noisemodelcat(noise_trim_fname)
+
+    filters = ['HST_WFC3_F275W', 'HST_WFC3_F336W', 'HST_ACS_WFC_F475W',
+               'HST_ACS_WFC_F814W', 'HST_WFC3_F110W', 'HST_WFC3_F160W']
+    basefilters = ['F275W', 'F336W', 'F475W',
+                   'F814W', 'F110W', 'F160W']
+    obs_colnames = [f.lower() + '_rate' for f in basefilters]
+
+    obsdata = get_obscat(obs_fname,
+                         filters,
+                         obs_colnames,
+                         vega_fname=vega_fname)
+
+    # fit saving the full sparse likelihoods without the priors
+    stats_fname = '/tmp/beast_example_phat_reweight_stats.fits'
+    lnp_fname = '/tmp/beast_example_phat_reweight_lnp.hd5'
+    fit.summary_table_memory(obsdata, noisemodel_vals, seds_trim_fname,
+                             threshold=-40., stats_outname=stats_fname,
+                             lnp_outname=lnp_fname, save_lnl=True)
+
+    # reweighting with the original weights should give the same stats
+    modelsedgrid = FileSEDGrid(seds_trim_fname)
+    table_new, pdf1d_vals = reweight.reweight_lnp(
+        lnp_fname, modelsedgrid, modelsedgrid['weight'],
+        noisemodel=noisemodel_vals, threshold=-40., nobs=len(obsdata))
+
+    table_fit = Table.read(stats_fname)
+    for tcolname in table_new.colnames:
+        np.testing.assert_allclose(table_new[tcolname],
+                                   table_fit[tcolname],
+                                   rtol=1e-4, atol=1e-6,
+                                   err_msg=('%s columns not equal'
+                                            % tcolname))
+
+
+def test_reweight_lnp_synthetic(tmpdir):
+    sedgrid = make_sed_grid()
+    seds_fname = str(tmpdir.join('seds.grid.hd5'))
+    sedgrid.writeHDF(seds_fname)
+    noise = noisemodel.get_noisemodelcat(
+        make_noisemodel(sedgrid, str(tmpdir.join('noise.hd5'))))
+    obs = SEDObservations(make_obs_seds(sedgrid, 20),
+                          sedgrid.header['filters'].split())
+
+    # fit saving the full sparse likelihoods without the priors
+    stats_fname = str(tmpdir.join('reweight_stats.fits'))
+    lnp_fname = str(tmpdir.join('reweight_lnp.hd5'))
+    fit.summary_table_memory(obs, noise, seds_fname, threshold=-40.,
+                             stats_outname=stats_fname,
+                             lnp_outname=lnp_fname, save_lnl=True)
+
+    # reweighting with the original weights should give the same stats
+    modelsedgrid = FileSEDGrid(seds_fname)
+    table_new, pdf1d_vals = reweight.reweight_lnp(
+        lnp_fname, modelsedgrid, modelsedgrid['weight'], noisemodel=noise,
+        threshold=-40., nobs=len(obs))
+    noise.close()
+
+    table_fit = Table.read(stats_fname)
+    assert len(table_new) == len(obs)
+    for tcolname in table_new.colnames:
+        np.testing.assert_allclose(table_new[tcolname],
+                                   table_fit[tcolname],
+                                   rtol=1e-4, atol=1e-6,
+                                   err_msg=('%s columns not equal'
+                                            % tcolname))
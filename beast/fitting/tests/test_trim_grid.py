@@ -1,13 +1,16 @@
 import numpy as np
 
+from astropy.table import Table
 from astropy.tests.helper import remote_data
 
 from ...physicsmodel.grid import FileSEDGrid
 from ...observationmodel.observations import Observations
 from ...observationmodel.vega import Vega
 from ...observationmodel.noisemodel import generic_noisemodel as noisemodel
-from ..trim_grid import trim_models
-from beast.tests.helpers import (download_rename, compare_hdf5)
+from ..trim_grid import trim_models, trim_models_multi
+from beast.tests.helpers import (download_rename, compare_hdf5,
+                                 make_sed_grid, make_noisemodel,
+                                 make_obs_seds)
 
 
 class GenFluxCatalog(Observations):
@@ -151,3 +154,44 @@ def test_trim_grid():
     # compare the new to the cached version
     compare_hdf5(seds_trim_fname_cache, seds_trim_fname, ctype='seds')
     compare_hdf5(noise_trim_fname_cache, noise_trim_fname, ctype='noise')
+
+
+def test_trim_models_multi(tmpdir):
+    sedgrid = make_sed_grid()
+    filters = sedgrid.header['filters'].split()
+    noise_vals = noisemodel.get_noisemodelcat(
+        make_noisemodel(sedgrid, str(tmpdir.join('noise.hd5'))))
+
+    # two catalogs covering different flux ranges to trim different models
+    seds = make_obs_seds(sedgrid, 40)
+    seds = seds[np.argsort(seds[:, 0])]
+    obsdatas = []
+    for i, cat_seds in enumerate([seds[:20], seds[20:]]):
+        obs_fname = str(tmpdir.join('obs_{0}.fits'.format(i)))
+        Table(cat_seds, names=filters).write(obs_fname)
+        obsdata = Observations(obs_fname)
+        obsdata.setFilters(filters)
+        obsdata.vega_flux = np.ones(len(filters))
+        obsdatas.append(obsdata)
+
+    # one sweep in chunks smaller than the grid gives the same files as
+    #   trimming for each catalog separately
+    sed_fnames = [str(tmpdir.join('seds_multi_{0}.hd5'.format(i)))
+                  for i in range(2)]
+    noise_fnames = [str(tmpdir.join('noise_multi_{0}.hd5'.format(i)))
+                    for i in range(2)]
+    n_trimmed = trim_models_multi(sedgrid, noise_vals, obsdatas,
+                                  sed_fnames, noise_fnames, sigma_fac=1.,
+                                  chunk_size=100)
+    assert n_trimmed[0] != n_trimmed[1]
+    assert all(0 < n < len(sedgrid.seds) for n in n_trimmed)
+
+    for i, obsdata in enumerate(obsdatas):
+        sed_fname = str(tmpdir.join('seds_{0}.hd5'.format(i)))
+        noise_fname = str(tmpdir.join('noise_{0}.hd5'.format(i)))
+        trim_models(sedgrid, noise_vals, obsdata, sed_fname, noise_fname,
+                    sigma_fac=1.)
+        compare_hdf5(sed_fname, sed_fnames[i], ctype='seds')
+        compare_hdf5(noise_fname, noise_fnames[i], ctype='noise')
+        assert len(FileSEDGrid(sed_fname).seds) == n_trimmed[i]
+    noise_vals.close()
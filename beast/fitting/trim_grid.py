@@ -1,13 +1,16 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import os
+from collections import OrderedDict
+
 import numpy as np
 import tables
 
 from ..physicsmodel.grid import SpectralGrid
 from ..external.eztables import Table
 
-__all__ = ['trim_models']
+__all__ = ['trim_models', 'trim_models_multi']
 
 
 def trim_models(sedgrid, sedgrid_noisemodel, obsdata, sed_outname,
@@ -54,27 +57,87 @@ def trim_models(sedgrid, sedgrid_noisemodel, obsdata, sed_outname,
     trunchen: boolean
         if true use the trunchen noise model (default: False)
     """
-    # Store the brigtest and faintest fluxes in each band (for data and asts)
-    n_filters = len(obsdata.filters)
-    min_data = np.zeros(n_filters)
-    max_data = np.zeros(n_filters)
-    min_models = np.zeros(n_filters)
-    max_models = np.zeros(n_filters)
-    for k, filtername in enumerate(obsdata.filters):
-        sfiltname = obsdata.data.resolve_alias(filtername)
-        if inFlux:
-            min_data[k] = np.amin(obsdata.data[sfiltname]
-                                  * obsdata.vega_flux[k])
-            max_data[k] = np.amax(obsdata.data[sfiltname]
-                                  * obsdata.vega_flux[k])
-        else:
-            min_data[k] = np.amin(10**(-0.4*obsdata.data[sfiltname])
-                                  * obsdata.vega_flux[k])
-            max_data[k] = np.amax(10**(-0.4*obsdata.data[sfiltname])
-                                  * obsdata.vega_flux[k])
+    n_trimmed = trim_models_multi(sedgrid, sedgrid_noisemodel, [obsdata],
+                                  [sed_outname], [noisemodel_outname],
+                                  sigma_fac=sigma_fac, n_detected=n_detected,
+                                  inFlux=inFlux, trunchen=trunchen)
+    if n_trimmed[0] == 0:
+        exit()
+
+
+def trim_models_multi(sedgrid, sedgrid_noisemodel, obsdatas, sed_outnames,
+                      noisemodel_outnames,
+                      sigma_fac=3., n_detected=4, inFlux=True,
+                      trunchen=False, chunk_size=1000000):
+    """
+    Trim the model grid for several observation catalogs (e.g., the
+    source density and sub-catalogs of a brick) sharing the same noise
+    model (see trim_models).
+
+    The model flux envelopes (flux + bias +/- sigma_fac * unc) and the
+    number of AST detections are computed once, the data ranges of all
+    the catalogs are tested in one pass, and the selected models are
+    written to all the trimmed grid and noise model files in one sweep
+    over the model grid (in chunks of models).
+
+    Parameters
+    ----------
+    sedgrid: grid.SEDgrid instance
+        model grid
+
+    sedgrid_noisemodel: beast noisemodel instance
+        noise model data
+
+    obsdatas: list of Observation object instances
+        observation catalogs
+
+    sed_outnames: list of str
+        names for output sed files (one per catalog)
+
+    noisemodel_outnames: list of str
+        names for output noisemodel files (one per catalog)
+
+    sigma_fac: float
+        factor for trimming the upper and lower range of grid so that
+        the model range cuts off sigma_fac above and below the brightest
+        and faintest models, respectively (default: 3.)
+
+    n_detected: int
+        minimum number of bands where ASTs yielded a detection for
+        a given model, if fewer detections than n_detected this model
+        gets eliminated (default: 4)
+
+    inFlux: boolean
+        if true data are in fluxes (default: True)
 
-        min_models[k] = np.amin(sedgrid.seds[:, k])
-        max_models[k] = np.amax(sedgrid.seds[:, k])
+    trunchen: boolean
+        if true use the trunchen noise model (default: False)
+
+    chunk_size: int
+        number of models read and written at once (default: 1000000)
+
+    Returns
+    -------
+    n_trimmed: list of int
+        number of trimmed models for each catalog (0 if no models are
+        within the data range, nothing is written for these catalogs)
+    """
+    # Store the brigtest and faintest fluxes in each band for the data
+    #   of each catalog
+    n_cats = len(obsdatas)
+    n_filters = len(obsdatas[0].filters)
+    min_data = np.zeros((n_cats, n_filters))
+    max_data = np.zeros((n_cats, n_filters))
+    for i, obsdata in enumerate(obsdatas):
+        for k, filtername in enumerate(obsdata.filters):
+            sfiltname = obsdata.data.resolve_alias(filtername)
+            if inFlux:
+                fluxes = obsdata.data[sfiltname] * obsdata.vega_flux[k]
+            else:
+                fluxes = (10**(-0.4*obsdata.data[sfiltname])
+                          * obsdata.vega_flux[k])
+            min_data[i, k] = np.amin(fluxes)
+            max_data[i, k] = np.amax(fluxes)
 
     # first remove all models that have any band with fluxes below the
     #    faintest ASTs run
@@ -91,13 +154,18 @@ def trim_models(sedgrid, sedgrid_noisemodel, obsdata, sed_outname,
     indxs, = np.where(sum_above_ast >= n_detected)
 
     # cache the noisemodel values
-    model_bias = sedgrid_noisemodel.root.bias[:]
-    model_unc = np.fabs(sedgrid_noisemodel.root.error[:])
-    model_compl = sedgrid_noisemodel.root.completeness[:]
+    noise_vals = OrderedDict()
+    noise_vals['bias'] = sedgrid_noisemodel.root.bias[:]
+    noise_vals['error'] = np.fabs(model_unc)
+    noise_vals['completeness'] = sedgrid_noisemodel.root.completeness[:]
     if trunchen:
-        model_q_norm = sedgrid_noisemodel.root.q_norm[:]
-        model_icov_diag = sedgrid_noisemodel.root.icov_diag[:]
-        model_icov_offdiag = sedgrid_noisemodel.root.icov_offdiag[:]
+        noise_vals['q_norm'] = sedgrid_noisemodel.root.q_norm[:]
+        noise_vals['icov_diag'] = sedgrid_noisemodel.root.icov_diag[:]
+        noise_vals['icov_offdiag'] = sedgrid_noisemodel.root.icov_offdiag[:]
+        if 'icov_chol' in sedgrid_noisemodel.root:
+            noise_vals['icov_chol'] = sedgrid_noisemodel.root.icov_chol[:]
+    model_bias = noise_vals['bias']
+    model_unc = noise_vals['error']
 
     if len(indxs) <= 0:
         print('no models are brighter than the minimum ASTs run')
@@ -105,7 +173,11 @@ def trim_models(sedgrid, sedgrid_noisemodel, obsdata, sed_outname,
 
     n_ast_indxs = len(indxs)
 
-    # Find models with fluxes (with margin) between faintest and brightest data
+    # Find models with fluxes (with margin) between faintest and brightest
+    #   data for all the catalogs at once
+    #   (a filter that would remove all the remaining models of a catalog
+    #   is skipped for this catalog)
+    keep = np.ones((n_ast_indxs, n_cats), dtype=bool)
     for k in range(n_filters):
         print('working on filter # = ', k)
 
@@ -115,45 +187,109 @@ def trim_models(sedgrid, sedgrid_noisemodel, obsdata, sed_outname,
         model_down = model_val - sigma_fac*model_unc[indxs, k]
         model_up = model_val + sigma_fac*model_unc[indxs, k]
 
-        nindxs, = np.where((model_up >= min_data[k]) &
-                           (model_down <= max_data[k]))
-        if len(nindxs) > 0:
-            indxs = indxs[nindxs]
-
-    if len(indxs) == 0:
-        print('no models that are within the data range')
-        exit()
+        in_range = keep & ((model_up[:, None] >= min_data[:, k])
+                           & (model_down[:, None] <= max_data[:, k]))
+        not_empty = in_range.any(axis=0)
+        keep[:, not_empty] = in_range[:, not_empty]
 
     print('number of original models = ', len(sedgrid.seds[:, 0]))
     print('number of ast trimmed models = ', n_ast_indxs)
-    print(' number of trimmed models = ', len(indxs))
-
-    # Save the grid
-    print('Writing trimmed sedgrid to disk into {0:s}'.format(sed_outname))
-    cols = {}
-    for key in list(sedgrid.grid.keys()):
-        cols[key] = sedgrid.grid[key][indxs]
-
-    # New column to save the index of the model in the full grid
-    cols['fullgrid_idx'] = indxs.astype(int)
-    g = SpectralGrid(sedgrid.lamb, seds=sedgrid.seds[indxs],
-                     grid=Table(cols), backend='memory')
-    filternames = obsdata.filters
-    g.grid.header['filters'] = ' '.join(filternames)
-
-    # trimmed grid name
-    g.writeHDF(sed_outname)
-
-    # save the trimmed noise model
-    print('Writing trimmed noisemodel to disk into {0:s}'.
-          format(noisemodel_outname))
-    with tables.open_file(noisemodel_outname, 'w') as outfile:
-        outfile.create_array(outfile.root, 'bias', model_bias[indxs])
-        outfile.create_array(outfile.root, 'error', model_unc[indxs])
-        outfile.create_array(outfile.root, 'completeness', model_compl[indxs])
-        if trunchen:
-            outfile.create_array(outfile.root, 'q_norm', model_q_norm[indxs])
-            outfile.create_array(outfile.root, 'icov_diag',
-                                 model_icov_diag[indxs])
-            outfile.create_array(outfile.root, 'icov_offdiag',
-                                 model_icov_offdiag[indxs])
+
+    cat_indxs = []
+    for i in range(n_cats):
+        cur_indxs = indxs[keep[:, i]]
+        if len(cur_indxs) == 0:
+            print('no models that are within the data range')
+        else:
+            print(' number of trimmed models = ', len(cur_indxs))
+        cat_indxs.append(cur_indxs)
+
+    _write_trimmed(sedgrid, noise_vals, cat_indxs,
+                   [obsdata.filters for obsdata in obsdatas],
+                   sed_outnames, noisemodel_outnames, chunk_size)
+
+    return [len(cur_indxs) for cur_indxs in cat_indxs]
+
+
+def _write_trimmed(sedgrid, noise_vals, cat_indxs, cat_filters,
+                   sed_outnames, noisemodel_outnames, chunk_size):
+    """
+    Write the trimmed grids and noise models of several catalogs in one
+    sweep over the model grid
+
+    Parameters
+    ----------
+    sedgrid: grid.SEDgrid instance
+        model grid
+
+    noise_vals: dict
+        noise model arrays (bias, error, etc.) of the full grid
+
+    cat_indxs: list of int ndarrays
+        sorted indices of the trimmed models of each catalog
+
+    cat_filters: list of lists of str
+        filters of each catalog
+
+    sed_outnames, noisemodel_outnames: lists of str
+        output file names for each catalog
+
+    chunk_size: int
+        number of models read at once
+    """
+    cats = [i for i in range(len(cat_indxs)) if len(cat_indxs[i]) > 0]
+    for i in cats:
+        print('Writing trimmed sedgrid to disk into {0:s}'.format(
+            sed_outnames[i]))
+        print('Writing trimmed noisemodel to disk into {0:s}'.
+              format(noisemodel_outnames[i]))
+        # the grids are appended chunk by chunk
+        if os.path.isfile(sed_outnames[i]):
+            os.remove(sed_outnames[i])
+
+    noise_files = {i: tables.open_file(noisemodel_outnames[i], 'w')
+                   for i in cats}
+    written = dict((i, False) for i in cats)
+    grid_keys = list(sedgrid.grid.keys())
+    n_models = len(noise_vals['bias'])
+    try:
+        for start in range(0, n_models, chunk_size):
+            stop = min(start + chunk_size, n_models)
+
+            # models of the chunk selected for each catalog
+            chunk_sel = {}
+            for i in cats:
+                lo, hi = np.searchsorted(cat_indxs[i], [start, stop])
+                if hi > lo:
+                    chunk_sel[i] = cat_indxs[i][lo:hi] - start
+            if len(chunk_sel) == 0:
+                continue
+
+            # read the chunk once
+            chunk_seds = sedgrid.seds[start:stop]
+            chunk_grid = {key: sedgrid.grid[key][start:stop]
+                          for key in grid_keys}
+
+            for i, sel in chunk_sel.items():
+                cols = {key: chunk_grid[key][sel] for key in grid_keys}
+
+                # New column to save the index of the model in the full grid
+                cols['fullgrid_idx'] = (sel + start).astype(int)
+                g = SpectralGrid(sedgrid.lamb, seds=chunk_seds[sel],
+                                 grid=Table(cols), backend='memory')
+                g.grid.header['filters'] = ' '.join(cat_filters[i])
+                g.writeHDF(sed_outnames[i], append=written[i])
+
+                # save the trimmed noise model
+                outfile = noise_files[i]
+                for name, vals in noise_vals.items():
+                    if written[i]:
+                        outfile.get_node('/' + name).append(
+                            vals[sel + start])
+                    else:
+                        outfile.create_earray(outfile.root, name,
+                                              obj=vals[sel + start])
+                written[i] = True
+    finally:
+        for outfile in noise_files.values():
+            outfile.close()
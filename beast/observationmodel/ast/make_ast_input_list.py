@@ -10,6 +10,7 @@ from astropy.table import Column
 
 from ..vega import Vega
 from beast.physicsmodel.grid import FileSEDGrid
+from beast.physicsmodel.helpers.gridinfo import code_dtype
 
 
 def mag_limits(seds, faint_cut, Nfilter=1, bright_cut=None):
@@ -62,7 +63,8 @@ def mag_limits(seds, faint_cut, Nfilter=1, bright_cut=None):
 def pick_models_toothpick_style(sedgrid_fname, filters, mag_cuts, Nfilter,
                                 N_fluxes, min_N_per_flux,
                                 outfile=None, outfile_params=None,
-                                bins_outfile=None, bright_cut=None):
+                                bins_outfile=None, bright_cut=None,
+                                ranseed=None):
     """
     Creates a fake star catalog from a BEAST model grid. The chosen seds
     are optimized for the toothpick model, by working with a given
@@ -108,6 +110,9 @@ def pick_models_toothpick_style(sedgrid_fname, filters, mag_cuts, Nfilter,
         List of magnitude limits for each filter (won't sample model
         SEDs that are too bright)
 
+    ranseed: None or int
+        seed of the random number generator (for reproducible lists)
+
     Returns
     -------
     sedsMags: astropy Table
@@ -148,63 +153,33 @@ def pick_models_toothpick_style(sedgrid_fname, filters, mag_cuts, Nfilter,
     assert (len(bin_mins) == N_fluxes)
     assert (len(bin_maxs) == N_fluxes)
 
+    # Find in which bin each model belongs, for each filter (once)
+    # (models of which the flux is equal to the max are assigned bin nr
+    # N_fluxes. Move these down to bin nr N_fluxes - 1)
+    fluxbins = np.zeros(sedsMags_cut.shape, dtype=code_dtype(N_fluxes))
+    for fltr in range(Nf):
+        fluxbins[:, fltr] = np.clip(
+            np.digitize(sedsMags_cut[:, fltr], bin_maxs[:, fltr]),
+            0, N_fluxes - 1)
+
+    rng = np.random.RandomState(ranseed)
+    n_picks = toothpick_quota_picks(fluxbins, N_fluxes, min_N_per_flux,
+                                    rng=rng)
+
+    # the chosen models (repeated for the bins with too few models) in
+    # random order
+    order = rng.permutation(len(idxs))
+    chosen_cut = np.repeat(order, n_picks[order])
+    chosen_idxs = idxs[chosen_cut]
+
     bin_count = np.zeros((N_fluxes, Nf))
-    chosen_idxs = []
-    counter = 0
-    successes = 0
-    include_mask = np.full(idxs.shape, True, dtype=bool)
-    chunksize = 100000
-    while True:
-        counter += 1
-        # pick some random models
-        rand_idx = np.random.choice(idxs[include_mask], size=chunksize)
-        randomseds = sedsMags[rand_idx, :]
-
-        # Find in which bin each model belongs, for each filter
-        fluxbins = np.zeros(randomseds.shape, dtype=int)
-        for fltr in range(Nf):
-            fluxbins[:, fltr] = np.digitize(randomseds[:, fltr],
-                                            bin_maxs[:, fltr])
-
-        # Clip in place (models of which the flux is equal to the max
-        # are assigned bin nr N_fluxes. Move these down to bin nr
-        # N_fluxes - 1)
-        np.clip(fluxbins, a_min=0, a_max=N_fluxes - 1, out=fluxbins)
-
-        add_these = np.full((len(rand_idx)), False, dtype=bool)
-        for r in range(len(rand_idx)):
-            # If any of the flux bins that this model falls into does
-            # not have enough samples yet, add it to the list of model
-            # spectra to be output
-            if (bin_count[fluxbins[r, :], range(Nf)] < min_N_per_flux).any():
-                bin_count[fluxbins[r, :], range(Nf)] += 1
-                successes += 1
-                add_these[r] = True
-
-            # If all these bins are full...
-            else:
-                # ... do not include this model again, since we will reject it
-                # anyway.
-                include_mask[idxs == rand_idx] = False
-
-        # Add the approved models
-        chosen_idxs.extend(rand_idx[add_these])
-
-        # If some of the randomly picked models were not added
-        if not add_these.any():
-            # ... check if we have enough samples everywhere, or if all
-            # the models have been exhausted (and hence the bins are
-            # impossible to fill).
-            enough_samples = (bin_count.flatten() >= min_N_per_flux).all()
-            still_models_left = include_mask.any()
-            if enough_samples or not still_models_left:
-                break
-
-        if not counter % 10:
-            print('Sampled {} models. {} successfull seds. Ratio = {}'.format(
-                counter * chunksize, successes, successes / counter / chunksize))
-            print('Bin array:')
-            print(bin_count)
+    for fltr in range(Nf):
+        bin_count[:, fltr] = np.bincount(fluxbins[chosen_cut, fltr],
+                                         minlength=N_fluxes)
+    print('Selected {} models ({} distinct) from {} models'.format(
+        len(chosen_idxs), np.count_nonzero(n_picks), len(idxs)))
+    print('Bin array:')
+    print(bin_count)
 
     # Gather the selected model seds in a table
     sedsMags = Table(sedsMags[chosen_idxs, :], names=filters)
@@ -234,6 +209,67 @@ def pick_models_toothpick_style(sedgrid_fname, filters, mag_cuts, Nfilter,
     return sedsMags
 
 
+def toothpick_quota_picks(fluxbins, N_fluxes, min_N_per_flux, rng=None):
+    """
+    Number of times each model is picked so that every flux bin of every
+    filter contains at least min_N_per_flux models.
+
+    For each filter, the first min_N_per_flux models of each bin in a
+    random order are picked (a random sample without replacement). The
+    models of the bins with fewer models are all picked, and picked
+    again at random to fill the bin. A model is picked the maximum
+    number of times it is needed over the filters.
+
+    Parameters
+    ----------
+    fluxbins: 2D ndarray of int
+        flux bin of each model (rows) for each filter (columns)
+
+    N_fluxes: integer
+        number of flux bins
+
+    min_N_per_flux: integer
+        minimum number of models in each bin
+
+    rng: numpy.random.RandomState
+        random number generator (default: a new unseeded one)
+
+    Returns
+    -------
+    n_picks: ndarray of int
+        number of times each model is picked
+    """
+    if rng is None:
+        rng = np.random.RandomState()
+    n_models, Nf = fluxbins.shape
+
+    order = rng.permutation(n_models)
+    n_picks = np.zeros(n_models, dtype=int)
+    filter_picks = np.zeros(n_models, dtype=int)
+    for fltr in range(Nf):
+        # group the models by bin, keeping the random order in each bin
+        codes = fluxbins[order, fltr]
+        bin_order = order[np.argsort(codes, kind='mergesort')]
+        counts = np.bincount(codes, minlength=N_fluxes)
+        starts = np.cumsum(counts) - counts
+
+        # rank of each model in its bin
+        ranks = np.arange(n_models) - np.repeat(starts, counts)
+
+        filter_picks[:] = 0
+        filter_picks[bin_order[ranks < min_N_per_flux]] = 1
+
+        # repeat the models of the bins with too few models
+        for b in np.flatnonzero((counts > 0) & (counts < min_N_per_flux)):
+            members = bin_order[starts[b]:starts[b] + counts[b]]
+            extra = rng.choice(members, min_N_per_flux - counts[b])
+            np.add.at(filter_picks, extra, 1)
+
+        np.maximum(n_picks, filter_picks, out=n_picks)
+
+    return n_picks
+
+
 def pick_models(sedgrid_fname, filters, mag_cuts, Nfilter=3, N_stars=70, Nrealize=20,
                 outfile=None, outfile_params=None, bright_cut=None, vega_fname=None, ranseed=None):
     """Creates a fake star catalog from a BEAST model grid
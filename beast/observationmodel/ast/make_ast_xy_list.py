@@ -12,8 +12,12 @@ from astropy.wcs import WCS
 from ...tools.pbar import Pbar
 from ...tools import density_map
 
+# maximum number of candidate positions drawn at once
+max_batch_size = 1000000
+
 def pick_positions_from_map(catalog, chosen_seds, input_map, N_bins, Npermodel,
-                            outfile=None, refimage=None, refimage_hdu=1, Nrealize=1, set_coord_boundary=None):
+                            outfile=None, refimage=None, refimage_hdu=1, Nrealize=1, set_coord_boundary=None,
+                            ranseed=None):
     """
     Spreads a set of fake stars across regions of similar values, 
     given a map file generated by 'create background density map' or
@@ -71,6 +75,9 @@ def pick_positions_from_map(catalog, chosen_seds, input_map, N_bins, Npermodel,
         around the region (either CW or CCW).  Requires a refimage to
         convert the RA/Dec to x/y.
 
+    ranseed : None or int
+        seed of the random number generator (for reproducible AST lists)
+
     Returns
     -------
     astropy Table: List of fake stars, with magnitudes and positions
@@ -91,7 +98,7 @@ def pick_positions_from_map(catalog, chosen_seds, input_map, N_bins, Npermodel,
     # there are no ASTs generated outside of the catalog footprint
     colnames = catalog.data.columns    
 
-    if 'X' or 'x' in colnames:
+    if ('X' in colnames) or ('x' in colnames):
         if 'X' in colnames:
            x_positions = catalog.data['X'][:]
            y_positions = catalog.data['Y'][:]
@@ -100,7 +107,7 @@ def pick_positions_from_map(catalog, chosen_seds, input_map, N_bins, Npermodel,
            y_positions = catalog.data['y'][:]
         
     else:
-        if 'RA' or 'ra' in colnames:
+        if ('RA' in colnames) or ('ra' in colnames):
             if 'RA' in colnames:
                 ra_positions = catalog.data['RA'][:]
                 dec_positions = catalog.data['DEC'][:]
@@ -159,9 +166,12 @@ def pick_positions_from_map(catalog, chosen_seds, input_map, N_bins, Npermodel,
     ys = np.zeros(len(out_table))
     bin_indices = np.zeros(len(out_table))
 
-    tile_ra_min, tile_dec_min = bdm.min_ras_decs()
-    tile_ra_delta, tile_dec_delta = bdm.delta_ras_decs()
+    tile_ra_min, tile_dec_min = [np.asarray(v) for v in bdm.min_ras_decs()]
+    tile_ra_delta, tile_dec_delta = [np.asarray(v)
+                                     for v in bdm.delta_ras_decs()]
 
+    # random number generator (seeded for reproducible lists)
+    rng = np.random.RandomState(ranseed)
 
     pbar = Pbar(len(tile_sets),
                 desc='{} models per map bin'.format(Nseds_per_region/Npermodel))
@@ -169,41 +179,45 @@ def pick_positions_from_map(catalog, chosen_seds, input_map, N_bins, Npermodel,
         start = bin_index * Nseds_per_region
         stop = start + Nseds_per_region
         bin_indices[start:stop] = bin_index
-        for i in range(Nseds_per_region):
-            x = -1
-            y = -1
-            # Convert each ra,dec to x,y. If there are negative values, try again
-            while x < 0 or y < 0:
-                # Pick a random tile
-                tile = np.random.choice(tile_set)
-                # Within this tile, pick a random ra and dec
-                ra = tile_ra_min[tile] + \
-                     np.random.random_sample() * tile_ra_delta[tile]
-                dec = tile_dec_min[tile] + \
-                      np.random.random_sample() * tile_dec_delta[tile]
-
-                if wcs is None:
-                    x, y = ra, dec
-                    # check that this x/y is within the catalog footprint
-                    within_bounds = catalog_boundary.contains_points([[x,y]]) # N,2 array of AST X and Y positions
-                    if within_bounds == False:
-                        x = -1
-                    break
-                else:
-                    [x], [y] = wcs.all_world2pix(np.array([ra]), np.array([dec]), 0)
-                    # check that this x/y is within the catalog footprint
-                    within_bounds = catalog_boundary.contains_points([[x,y]]) # N,2 array of AST X and Y positions
-                    if within_bounds == False:
-                        x = -1
-                    # check that this x/y is with any input boundary
-                    # (only relevant if there's a wcs from a refimage)
-                    if set_coord_boundary is not None:
-                        within_bounds = coord_boundary.contains_points([[x,y]])
-                        if within_bounds == False:
-                            x = -1
-            j = bin_index * Nseds_per_region + i
-            xs[j] = x
-            ys[j] = y
+
+        # rejection sampling in batches: draw candidate positions, keep
+        # the ones within the boundaries, and draw again (batch size from
+        # the acceptance rate so far) until the bin is filled
+        n_accepted = 0
+        n_tried = 0
+        while n_accepted < Nseds_per_region:
+            n_left = Nseds_per_region - n_accepted
+            accept_rate = (n_accepted + 1.0) / (n_tried + 1.0)
+            n_batch = min(int(1.2 * n_left / accept_rate) + 10,
+                          max_batch_size)
+
+            # Pick random tiles, and within these tiles random ras and decs
+            tiles = rng.choice(tile_set, n_batch)
+            ras = tile_ra_min[tiles] + \
+                rng.random_sample(n_batch) * tile_ra_delta[tiles]
+            decs = tile_dec_min[tiles] + \
+                rng.random_sample(n_batch) * tile_dec_delta[tiles]
+
+            # Convert the ra,dec to x,y, and check that the positions are
+            # within the catalog footprint (and any input boundary, only
+            # relevant if there's a wcs from a refimage)
+            if wcs is None:
+                x, y = ras, decs
+                good = np.ones(n_batch, dtype=bool)
+            else:
+                x, y = wcs.all_world2pix(ras, decs, 0)
+                good = (x >= 0) & (y >= 0)
+            xy = np.column_stack([x, y])
+            good &= catalog_boundary.contains_points(xy)
+            if (wcs is not None) and (set_coord_boundary is not None):
+                good &= coord_boundary.contains_points(xy)
+
+            keep = np.flatnonzero(good)[:n_left]
+            j = start + n_accepted
+            xs[j:j + len(keep)] = x[keep]
+            ys[j:j + len(keep)] = y[keep]
+            n_accepted += len(keep)
+            n_tried += n_batch
 
 
     # I'm just mimicking the format that is produced by the examples
@@ -6,6 +6,7 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 import numpy as np
+import tables
 
 from scipy.spatial import cKDTree
 
@@ -14,7 +15,7 @@ from ..vega import Vega
 
 from ...tools.pbar import Pbar
 
-__all__ = ['MultiFilterASTs']
+__all__ = ['MultiFilterASTs', 'icov_cholesky', 'add_icov_cholesky']
 
 
 class MultiFilterASTs(NoiseModel):
@@ -277,7 +278,7 @@ class MultiFilterASTs(NoiseModel):
 
     def __call__(self, sedgrid,
                  generic_absflux_a_matrix=None,
-                 progress=True):
+                 progress=True, return_icov_chol=False):
         """
         Interpolate the results of the ASTs on the model grid
 
@@ -288,9 +289,16 @@ class MultiFilterASTs(NoiseModel):
 
         Returns
         -------
+        (biases, sigmas, compls, q_norm, icov_diag, icov_offdiag,
+         cov_diag, cov_offdiag)
+        with icov_chol added at the end if return_icov_chol is set
 
         progress: bool, optional
             if set, display a progress bar
+
+        return_icov_chol: bool, optional
+            if set, also return the packed whitening factors
+            (see icov_cholesky)
         """
         flux = sedgrid.seds
         if generic_absflux_a_matrix is not None:
@@ -309,7 +317,7 @@ class MultiFilterASTs(NoiseModel):
             model_absflux_cov = False
 
         n_models, n_filters = flux.shape
-        n_offdiag = (((n_filters**2)-n_filters)/2)
+        n_offdiag = (((n_filters**2)-n_filters)//2)
 
         if n_filters != len(self.filters):
             raise AttributeError('the grid of models does not seem to' +
@@ -323,6 +331,10 @@ class MultiFilterASTs(NoiseModel):
         icov_offdiag = np.empty((n_models, n_offdiag), dtype=np.float64)
         q_norm = np.empty((n_models), dtype=np.float64)
         compls = np.empty((n_models), dtype=float)
+        if return_icov_chol:
+            n_packed = (n_filters*(n_filters+1))//2
+            icov_chol = np.empty((n_models, n_packed), dtype=np.float64)
+            chol_indxs = np.triu_indices(n_filters)
 
         if progress is True:
             it = Pbar(desc='Evaluating model').iterover(list(range(n_models)))
@@ -411,5 +423,81 @@ class MultiFilterASTs(NoiseModel):
                 print(det)
             q_norm[i] = -0.5*det[1]
 
-        return (biases, sigmas, compls, q_norm, icov_diag, icov_offdiag,
-                cov_diag, cov_offdiag)
+            # save the packed whitening factor
+            if return_icov_chol:
+                icov_chol[i, :] = np.linalg.cholesky(
+                    inv_cur_cov_matrix).T[chol_indxs]
+
+        if return_icov_chol:
+            return (biases, sigmas, compls, q_norm, icov_diag, icov_offdiag,
+                    cov_diag, cov_offdiag, icov_chol)
+        else:
+            return (biases, sigmas, compls, q_norm, icov_diag, icov_offdiag,
+                    cov_diag, cov_offdiag)
+
+
+def icov_cholesky(icov_diag, icov_offdiag, chunk_size=100000):
+    """
+    Compute the whitening factors of the covariance matrices from the
+    diagonal and packed off-diagonal terms of their inverses
+
+    The whitening factor of each model is the upper triangular matrix U
+    with U^T U = C^-1, so that chi2 = |U (flux - model)|^2.  U is
+    packed by rows: U[0,0], U[0,1], ..., U[0,n-1], U[1,1], ..., U[n-1,n-1].
+    The diagonal terms give the normalization: -0.5 ln(det(C)) =
+    sum(ln(U[k,k])).
+
+    Parameters
+    ----------
+    icov_diag: np.ndarray[float, ndim=2]
+        diagonal terms of the covariance matrix inverses
+        (n_models, n_filters)
+
+    icov_offdiag: np.ndarray[float, ndim=2]
+        packed off diagonal terms of the covariance matrix inverses
+        (n_models, n_filters*(n_filters-1)/2)
+
+    chunk_size: int
+        number of matrices to decompose at once
+
+    Returns
+    -------
+    icov_chol: np.ndarray[float, ndim=2]
+        packed whitening factors (n_models, n_filters*(n_filters+1)/2)
+    """
+    n_models, n_filters = icov_diag.shape
+    diag_indxs = np.diag_indices(n_filters)
+    up_indxs = np.triu_indices(n_filters, 1)
+    chol_indxs = np.triu_indices(n_filters)
+
+    icov_chol = np.empty((n_models, len(chol_indxs[0])), dtype=np.float64)
+    for i in range(0, n_models, chunk_size):
+        j = min(i + chunk_size, n_models)
+        icov = np.zeros((j - i, n_filters, n_filters))
+        icov[:, diag_indxs[0], diag_indxs[1]] = icov_diag[i:j]
+        icov[:, up_indxs[0], up_indxs[1]] = icov_offdiag[i:j]
+        icov[:, up_indxs[1], up_indxs[0]] = icov_offdiag[i:j]
+        # lower cholesky factor L of C^-1 = L L^T, hence U = L^T
+        chol = np.linalg.cholesky(icov)
+        icov_chol[i:j, :] = chol[:, chol_indxs[1], chol_indxs[0]]
+
+    return icov_chol
+
+
+def add_icov_cholesky(noisemodel_fname):
+    """
+    Add the packed whitening factors ('icov_chol') to a trunchen noise
+    model file (used by the fitting instead of icov_diag/icov_offdiag if
+    requested, see use_icov_chol in beast.fitting.fit.Q_all_memory)
+
+    Parameters
+    ----------
+    noisemodel_fname: str
+        noise model file with the icov_diag and icov_offdiag arrays
+    """
+    with tables.open_file(noisemodel_fname, 'a') as nmfile:
+        icov_chol = icov_cholesky(nmfile.root.icov_diag[:],
+                                  nmfile.root.icov_offdiag[:])
+        if 'icov_chol' in nmfile.root:
+            nmfile.remove_node(nmfile.root, 'icov_chol')
+        nmfile.create_array(nmfile.root, 'icov_chol', icov_chol)
@@ -4,13 +4,18 @@ Defines a generic interface to observation catalog
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+from multiprocessing import Pool
+
 import numpy as np
+import tables
 
 from astropy.table import Table, Column
 
 from beast.observationmodel.vega import Vega
+from beast.tools.pbar import Pbar
 
-__all__ = ['Observations', 'gen_SimObs_from_sedgrid']
+__all__ = ['Observations', 'gen_SimObs_from_sedgrid', 'model_sampling_cdf',
+           'draw_correlated_noise', 'write_SimObs_from_sedgrid']
 
 
 class Observations(object):
@@ -165,7 +170,9 @@ def gen_SimObs_from_sedgrid(sedgrid, sedgrid_noisemodel,
     The observation model gives the noise, bias, and completeness all of
     which are used in simulating the observations.
 
-    Currently written to only work for the toothpick noisemodel.
+    Currently written to only work for the toothpick noisemodel
+    (see write_SimObs_from_sedgrid for the trunchen noisemodel and
+    large simulations).
 
     Parameters
     ----------
@@ -222,13 +229,12 @@ def gen_SimObs_from_sedgrid(sedgrid, sedgrid_noisemodel,
     # need to sum to 1
     gridweights = gridweights/np.sum(gridweights)
 
-    # set the random seed - mainly for testing
-    if not None:
-        np.random.seed(ranseed)
+    # local random number generator (seeded mainly for testing)
+    rng = np.random.RandomState(ranseed)
 
     # sample to get the indexes of the picked models
     indx = range(n_models)
-    sim_indx = np.random.choice(indx, size=nsim, p=gridweights)
+    sim_indx = rng.choice(indx, size=nsim, p=gridweights)
 
     # get the vega fluxes for the filters
     _, vega_flux, _ = Vega(source=vega_fname).getFlux(sedgrid.filters)
@@ -240,11 +246,282 @@ def gen_SimObs_from_sedgrid(sedgrid, sedgrid_noisemodel,
     for k, filter in enumerate(sedgrid.filters):
         colname = '%s_rate' % filter.split(sep='_')[-1].lower()
         simflux_wbias = flux[sim_indx, k] + model_bias[sim_indx, k]
-        simflux = np.random.normal(loc=simflux_wbias,
-                                   scale=model_unc[sim_indx, k])
+        simflux = rng.normal(loc=simflux_wbias,
+                             scale=model_unc[sim_indx, k])
         ot[colname] = Column(simflux/vega_flux[k])
     # model parmaeters
     for qname in qnames:
         ot[qname] = Column(sedgrid[qname][sim_indx])
 
     return ot
+
+
+def model_sampling_cdf(weights):
+    """
+    Cumulative distribution of the models to draw them with a single
+    search per draw (np.searchsorted(cdf, u, side='right') for u uniform
+    in [0, 1))
+
+    Parameters
+    ----------
+    weights: np.ndarray
+        weights of the models (e.g., prior and grid weights times the
+        completeness)
+
+    Returns
+    -------
+    cdf: np.ndarray
+        normalized cumulative sum of the weights
+    """
+    cdf = np.cumsum(weights, dtype=np.float64)
+    if (len(cdf) == 0) or (cdf[-1] <= 0):
+        raise ValueError('the models have no weight to be drawn from')
+    cdf /= cdf[-1]
+    return cdf
+
+
+def draw_correlated_noise(rng, cov_diag, cov_offdiag):
+    """
+    Draw one noise vector per covariance matrix, using the Cholesky
+    factors of all the matrices computed at once
+
+    Parameters
+    ----------
+    rng: np.random.Generator or RandomState
+        random number generator
+
+    cov_diag: np.ndarray[float, ndim=2]
+        diagonal terms of the covariance matrices (n, n_filters)
+
+    cov_offdiag: np.ndarray[float, ndim=2]
+        off diagonal terms of the covariance matrices packed by rows as in
+        the trunchen noise model (n, n_filters*(n_filters-1)/2)
+
+    Returns
+    -------
+    noise: np.ndarray[float, ndim=2]
+        noise vectors (n, n_filters)
+    """
+    return _noise_from_cov(rng, _unpack_cov(cov_diag, cov_offdiag))
+
+
+def _noise_from_cov(rng, cov):
+    """ noise vectors for covariance matrices (n, n_filters, n_filters) """
+    chol = np.linalg.cholesky(cov)
+    z = rng.standard_normal(cov.shape[:2])
+    return np.einsum('nij,nj->ni', chol, z)
+
+
+def _unpack_cov(cov_diag, cov_offdiag):
+    """ symmetric matrices from their diagonal and packed upper terms """
+    n, n_filters = cov_diag.shape
+    up_indxs = np.triu_indices(n_filters, 1)
+    cov = np.zeros((n, n_filters, n_filters))
+    cov[:, np.arange(n_filters), np.arange(n_filters)] = cov_diag
+    cov[:, up_indxs[0], up_indxs[1]] = cov_offdiag
+    cov[:, up_indxs[1], up_indxs[0]] = cov_offdiag
+    return cov
+
+
+# sampling distributions of the simulations, computed once per process
+_simobs_models = {}
+
+
+def _load_simobs_models(sedgrid_fname, noisemodel_fname, compl_filter):
+    """
+    Filters and sampling distribution of the models, cached per process
+    (by the worker processes in parallel).  Only the weights and the
+    completeness in one filter are read, the fluxes, parameters and noise
+    model of the drawn models are read for each chunk.
+    """
+    key = (sedgrid_fname, noisemodel_fname, compl_filter)
+    if key in _simobs_models:
+        return _simobs_models[key]
+
+    with tables.open_file(sedgrid_fname, 'r') as sfile:
+        weights = sfile.root.grid.col('weight')
+        filters = sfile.root.grid.attrs['filters']
+        if isinstance(filters, bytes):
+            filters = filters.decode('utf-8')
+        filters = filters.split(' ')
+
+    # completeness per model (trunchen) or in the completeness filter
+    with tables.open_file(noisemodel_fname, 'r') as nfile:
+        if nfile.root.completeness.ndim > 1:
+            short_filters = [cfilter.split('_')[-1].lower()
+                             for cfilter in filters]
+            if compl_filter.lower() not in short_filters:
+                raise ValueError('completeness filter {0} not in {1}'.format(
+                    compl_filter, short_filters))
+            compl = nfile.root.completeness[
+                :, short_filters.index(compl_filter.lower())]
+        else:
+            compl = nfile.root.completeness.read()
+
+    models = {'filters': filters,
+              'cdf': model_sampling_cdf(weights * compl)}
+    _simobs_models[key] = models
+    return models
+
+
+def _simobs_chunk(args):
+    """
+    Simulate a chunk of observations
+
+    Parameters
+    ----------
+    args: tuple
+        sedgrid_fname, noisemodel_fname, compl_filter, use_cov, n_sim,
+        seed (np.random.SeedSequence), vega_flux
+
+    Returns
+    -------
+    simobs: np.ndarray
+        structured array with the simulated fluxes (band_rate, in
+        normalized vega fluxes) and the model parameters
+    """
+    (sedgrid_fname, noisemodel_fname, compl_filter, use_cov, n_sim,
+     seed, vega_flux) = args
+    models = _load_simobs_models(sedgrid_fname, noisemodel_fname,
+                                 compl_filter)
+    rng = np.random.default_rng(seed)
+
+    # draw the models
+    sim_indx = np.searchsorted(models['cdf'], rng.random(n_sim),
+                               side='right')
+
+    # read the rows of the drawn models (sorted and unique for the HDF5
+    #   selections)
+    rows, inv = np.unique(sim_indx, return_inverse=True)
+
+    def read_rows(node):
+        return node[rows, :][inv]
+
+    with tables.open_file(sedgrid_fname, 'r') as sfile:
+        simflux = read_rows(sfile.root.seds)
+        grid = sfile.root.grid.read_coordinates(rows)[inv]
+    with tables.open_file(noisemodel_fname, 'r') as nfile:
+        root = nfile.root
+        simflux += read_rows(root.bias)
+
+        # add the noise, correlated between the filters if the covariance
+        #   matrices are available
+        if use_cov and ('cov_diag' in root) and ('cov_offdiag' in root):
+            simflux += draw_correlated_noise(rng, read_rows(root.cov_diag),
+                                             read_rows(root.cov_offdiag))
+        elif use_cov and ('icov_diag' in root) and ('icov_offdiag' in root):
+            icov = _unpack_cov(read_rows(root.icov_diag),
+                               read_rows(root.icov_offdiag))
+            simflux += _noise_from_cov(rng, np.linalg.inv(icov))
+        else:
+            simflux += (np.fabs(read_rows(root.error))
+                        * rng.standard_normal(simflux.shape))
+
+    names = ['%s_rate' % cfilter.split('_')[-1].lower()
+             for cfilter in models['filters']]
+    dtype = ([(name, np.float64) for name in names]
+             + [(name, grid.dtype[name]) for name in grid.dtype.names])
+    simobs = np.empty(n_sim, dtype=dtype)
+    for k, name in enumerate(names):
+        simobs[name] = simflux[:, k] / vega_flux[k]
+    for name in grid.dtype.names:
+        simobs[name] = grid[name]
+    return simobs
+
+
+def write_SimObs_from_sedgrid(sedgrid_fname, noisemodel_fname, outname,
+                              nsim=100, compl_filter='F475W',
+                              chunk_size=100000, nprocs=1, use_cov=True,
+                              ranseed=None, vega_fname=None):
+    """
+    Generate simulated observations using the physics and observation
+    grids (as gen_SimObs_from_sedgrid) in chunks written to disk as they
+    are simulated, so that large numbers of observations can be
+    simulated.
+
+    The models are drawn from the cumulative distribution of the prior
+    and grid weights times the completeness.  When the noise model has
+    covariance matrices (trunchen cov_diag/cov_offdiag, or their
+    inverses icov_diag/icov_offdiag), the noise is correlated between
+    the filters.  Each chunk has its own random number generator from
+    ranseed, so the results depend on the seed and the chunk size but
+    not on the number of processes.
+
+    Parameters
+    ----------
+    sedgrid_fname: str
+        physics model grid file
+
+    noisemodel_fname: str
+        noise model file
+
+    outname: str
+        output HDF5 file, the simulated observations are saved as the
+        'simobs' table (can be read with Table.read(outname, path='simobs'))
+
+    nsim : int
+        number of observations to simulate
+
+    compl_filter : str
+        filter to use for completeness (toothpick model, the trunchen
+        model has a completeness per model)
+
+    chunk_size : int
+        number of observations simulated at once
+
+    nprocs : int
+        number of processes simulating the chunks in parallel (each keeps
+        the sampling distribution of the models and reads the drawn
+        models from the files)
+
+    use_cov : bool
+        set to use the covariance matrices of the noise model if
+        available
+
+    ranseed : int
+        seed of the random number generators
+
+    vega_fname : string
+        filename for the vega info
+
+    Returns
+    -------
+    nsim : int
+        number of simulated observations written
+    """
+    with tables.open_file(sedgrid_fname, 'r') as sfile:
+        filters = sfile.root.grid.attrs['filters']
+    if isinstance(filters, bytes):
+        filters = filters.decode('utf-8')
+    _, vega_flux, _ = Vega(source=vega_fname).getFlux(filters.split(' '))
+
+    n_chunks = (nsim + chunk_size - 1) // chunk_size
+    seeds = np.random.SeedSequence(ranseed).spawn(n_chunks)
+    args = [(sedgrid_fname, noisemodel_fname, compl_filter, use_cov,
+             min(chunk_size, nsim - k * chunk_size), seeds[k], vega_flux)
+            for k in range(n_chunks)]
+
+    if nprocs > 1:
+        p = Pool(nprocs)
+        chunks = p.imap(_simobs_chunk, args)
+    else:
+        p = None
+        chunks = map(_simobs_chunk, args)
+
+    with tables.open_file(outname, 'w') as outfile:
+        simtable = None
+        for simobs in Pbar(n_chunks, desc='Simulating observations').iterover(
+                chunks):
+            if simtable is None:
+                simtable = outfile.create_table(
+                    outfile.root, 'simobs', description=simobs.dtype,
+                    expectedrows=nsim)
+            simtable.append(simobs)
+        if simtable is not None:
+            simtable.flush()
+
+    if p is not None:
+        p.close()
+        p.join()
+
+    return nsim
@@ -37,5 +37,33 @@ def test_pick_models():
     compare_tables(table_new, table_cache)
 
 
+def test_toothpick_quota_picks():
+    # flux bins of models in 3 filters, with some bins having fewer models
+    #   than the quota and some empty bins
+    rng = np.random.RandomState(1)
+    N_fluxes = 8
+    fluxbins = np.column_stack([rng.randint(0, N_fluxes, 200),
+                                rng.randint(2, 6, 200),
+                                np.minimum(rng.poisson(1.5, 200),
+                                           N_fluxes - 1)])
+    min_N_per_flux = 10
+
+    n_picks = make_ast_input_list.toothpick_quota_picks(
+        fluxbins, N_fluxes, min_N_per_flux, rng=np.random.RandomState(1234))
+
+    # every non-empty bin of every filter has at least min_N_per_flux picks
+    for k in range(fluxbins.shape[1]):
+        counts = np.bincount(fluxbins[:, k], minlength=N_fluxes)
+        picks = np.bincount(fluxbins[:, k], weights=n_picks,
+                            minlength=N_fluxes)
+        assert np.all(picks[counts > 0] >= min_N_per_flux)
+        assert np.all(picks[counts == 0] == 0)
+
+    # same picks for the same random seed
+    n_picks_again = make_ast_input_list.toothpick_quota_picks(
+        fluxbins, N_fluxes, min_N_per_flux, rng=np.random.RandomState(1234))
+    np.testing.assert_equal(n_picks_again, n_picks)
+
+
 if __name__ == '__main__':
     test_pick_models()
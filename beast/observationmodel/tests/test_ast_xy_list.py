@@ -0,0 +1,125 @@
+import numpy as np
+from matplotlib.path import Path
+from scipy.spatial import ConvexHull
+
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+
+from beast.observationmodel.ast.make_ast_xy_list import pick_positions_from_map
+
+
+class Catalog(object):
+    """ minimal observed catalog (positions in the data table) """
+    def __init__(self, data):
+        self.data = data
+
+
+def make_map(n_x=4, n_y=3, seed=1):
+    """ tiles of a map with random values """
+    rng = np.random.RandomState(seed)
+    ra_grid = 10. + 0.01 * np.arange(n_x + 1)
+    dec_grid = 41. + 0.01 * np.arange(n_y + 1)
+    x, y = np.meshgrid(np.arange(n_x), np.arange(n_y), indexing='ij')
+    x = x.ravel()
+    y = y.ravel()
+    tile_data = Table([x.astype(float), y.astype(float),
+                       rng.uniform(0., 10., n_x * n_y),
+                       ra_grid[x], ra_grid[x + 1],
+                       dec_grid[y], dec_grid[y + 1]],
+                      names=['i_ra', 'i_dec', 'value',
+                             'min_ra', 'max_ra', 'min_dec', 'max_dec'])
+    tile_data.meta['ra_grid'] = ra_grid
+    tile_data.meta['dec_grid'] = dec_grid
+    return tile_data
+
+
+def make_inputs(seed=2):
+    """ catalog covering a triangle of the map, and models to place """
+    rng = np.random.RandomState(seed)
+    n_stars = 300
+    u = rng.uniform(size=n_stars)
+    v = rng.uniform(size=n_stars)
+    flip = u + v > 1
+    u[flip] = 1 - u[flip]
+    v[flip] = 1 - v[flip]
+    catalog = Catalog(Table({'RA': 10. + 0.04 * u, 'DEC': 41. + 0.03 * v}))
+    chosen_seds = Table({'F0': rng.uniform(20., 25., 15),
+                         'F1': rng.uniform(20., 25., 15)})
+    return catalog, chosen_seds
+
+
+def catalog_hull(x, y):
+    coords = np.column_stack([x, y])
+    return Path(coords[ConvexHull(coords).vertices])
+
+
+def test_pick_positions_from_map():
+    catalog, chosen_seds = make_inputs()
+    N_bins = 3
+    Nrealize = 2
+
+    out_table = pick_positions_from_map(catalog, chosen_seds, make_map(),
+                                        N_bins, 1, Nrealize=Nrealize,
+                                        ranseed=1234)
+
+    # models repeated for each map bin, at positions in the catalog
+    #   footprint (without a reference image, the positions are ra, dec)
+    n_sets = len(out_table) // (len(chosen_seds) * Nrealize)
+    assert n_sets > 1
+    assert len(out_table) == n_sets * len(chosen_seds) * Nrealize
+    assert out_table.colnames[:4] == ['zeros', 'ones', 'RA', 'DEC']
+    np.testing.assert_equal(
+        np.asarray(out_table['F0']),
+        np.repeat(np.repeat(np.asarray(chosen_seds['F0']), Nrealize),
+                  n_sets))
+    boundary = catalog_hull(catalog.data['RA'], catalog.data['DEC'])
+    xy = np.column_stack([out_table['RA'], out_table['DEC']])
+    assert np.all(boundary.contains_points(xy))
+
+    # same seed, same list
+    same_table = pick_positions_from_map(catalog, chosen_seds, make_map(),
+                                         N_bins, 1, Nrealize=Nrealize,
+                                         ranseed=1234)
+    np.testing.assert_equal(np.asarray(same_table['RA']),
+                            np.asarray(out_table['RA']))
+    np.testing.assert_equal(np.asarray(same_table['DEC']),
+                            np.asarray(out_table['DEC']))
+    other_table = pick_positions_from_map(catalog, chosen_seds, make_map(),
+                                          N_bins, 1, Nrealize=Nrealize,
+                                          ranseed=4321)
+    assert np.any(np.asarray(other_table['RA']) != np.asarray(out_table['RA']))
+
+
+def test_pick_positions_from_map_refimage(tmpdir):
+    catalog, chosen_seds = make_inputs()
+
+    # reference image with the map partly outside of it
+    w = WCS(naxis=2)
+    w.wcs.crpix = [0., 0.]
+    w.wcs.crval = [10.025, 41.005]
+    w.wcs.cdelt = [-0.0001, 0.0001]
+    w.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    refimage = str(tmpdir.join('image.fits'))
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.ImageHDU(np.zeros((10, 10)),
+                                header=w.to_header())]).writeto(refimage)
+
+    # additional boundary around the catalog
+    coord_boundary = [np.array([10., 10.03, 10.03, 10.]),
+                      np.array([41., 41., 41.02, 41.02])]
+    out_table = pick_positions_from_map(
+        catalog, chosen_seds, make_map(), 3, 1, refimage=refimage,
+        set_coord_boundary=coord_boundary, ranseed=1234)
+
+    assert out_table.colnames[:4] == ['zeros', 'ones', 'X', 'Y']
+    x = np.asarray(out_table['X'])
+    y = np.asarray(out_table['Y'])
+    xy = np.column_stack([x, y])
+    assert np.all((x >= 0) & (y >= 0))
+    cat_x, cat_y = w.all_world2pix(catalog.data['RA'], catalog.data['DEC'], 0)
+    assert np.all(catalog_hull(cat_x, cat_y).contains_points(xy))
+    bounds_x, bounds_y = w.all_world2pix(coord_boundary[0],
+                                         coord_boundary[1], 0)
+    assert np.all(Path(np.column_stack([bounds_x, bounds_y]))
+                  .contains_points(xy))
@@ -1,10 +1,15 @@
+import numpy as np
+import pytest
+import tables
 from astropy.tests.helper import remote_data
 from astropy.table import Table
 
 from ..noisemodel import generic_noisemodel as noisemodel
 from ...physicsmodel.grid import FileSEDGrid
-from beast.observationmodel.observations import gen_SimObs_from_sedgrid
-from beast.tests.helpers import (download_rename, compare_tables)
+from beast.observationmodel.observations import (gen_SimObs_from_sedgrid,
+                                                 write_SimObs_from_sedgrid)
+from beast.tests.helpers import (download_rename, compare_tables,
+                                 make_sed_grid, make_noisemodel)
 
 
 @remote_data
@@ -36,3 +41,86 @@ def test_trim_grid():
     table_cache = Table.read(simobs_fname_cache)
 
     compare_tables(table_cache, table_new)
+
+
+@pytest.fixture
+def simobs_files(tmpdir):
+    """ synthetic grid, noise model with covariances and vega files """
+    sedgrid = make_sed_grid(n_age=2, n_mass=3, n_av=2)
+    filters = sedgrid.header['filters'].split()
+    seds_fname = str(tmpdir.join('seds.grid.hd5'))
+    sedgrid.writeHDF(seds_fname)
+
+    # covariance matrices with a correlation of 0.3 between the filters
+    noise_fname = make_noisemodel(sedgrid, str(tmpdir.join('noise.hd5')))
+    up_indxs = np.triu_indices(len(filters), 1)
+    with tables.open_file(noise_fname, 'a') as nfile:
+        sigmas = nfile.root.error[:]
+        nfile.create_array(nfile.root, 'cov_diag', sigmas**2)
+        nfile.create_array(nfile.root, 'cov_offdiag',
+                           0.3 * sigmas[:, up_indxs[0]]
+                           * sigmas[:, up_indxs[1]])
+
+    # vega fluxes of 1 to keep the fluxes of the model grid
+    vega_fname = str(tmpdir.join('vega.hd5'))
+    vega = Table()
+    vega['FNAME'] = np.array(filters, dtype='S')
+    vega['LUM'] = np.ones(len(filters))
+    vega['MAG'] = np.zeros(len(filters))
+    vega['CWAVE'] = sedgrid.lamb
+    vega.write(vega_fname, path='sed', format='hdf5')
+
+    return sedgrid, seds_fname, noise_fname, vega_fname
+
+
+def test_write_simobs_nprocs(tmpdir, simobs_files):
+    (sedgrid, seds_fname, noise_fname, vega_fname) = simobs_files
+
+    # same simulations for a given seed and chunk size whatever the number
+    #   of processes, with and without the covariances
+    for use_cov in [True, False]:
+        simobs = []
+        for nprocs in [1, 2]:
+            outname = str(tmpdir.join('simobs_{0}.hd5'.format(nprocs)))
+            write_SimObs_from_sedgrid(seds_fname, noise_fname, outname,
+                                      nsim=1000, chunk_size=300,
+                                      compl_filter="F1", nprocs=nprocs,
+                                      use_cov=use_cov,
+                                      ranseed=1234, vega_fname=vega_fname)
+            simobs.append(Table.read(outname, path='simobs'))
+        assert len(simobs[0]) == 1000
+        compare_tables(simobs[0], simobs[1])
+
+
+def test_write_simobs_cov(tmpdir, simobs_files):
+    (sedgrid, seds_fname, noise_fname, vega_fname) = simobs_files
+    filters = sedgrid.header['filters'].split()
+    n_sim = 20000
+
+    outname = str(tmpdir.join('simobs.hd5'))
+    write_SimObs_from_sedgrid(seds_fname, noise_fname, outname, nsim=n_sim,
+                              compl_filter="F1", chunk_size=3000,
+                              ranseed=1234,
+                              vega_fname=vega_fname)
+    simobs = Table.read(outname, path='simobs')
+
+    # models of the simulated observations
+    model_indxs = {key: k for k, key in enumerate(zip(
+        sedgrid.grid['logA'], sedgrid.grid['M_ini'], sedgrid.grid['Av']))}
+    sim_indx = np.array([model_indxs[key] for key in zip(
+        simobs['logA'], simobs['M_ini'], simobs['Av'])])
+
+    # noise normalized by the uncertainties: unit variances and the
+    #   correlations of the covariance matrices
+    simflux = np.array([simobs['{0}_rate'.format(cfilter.lower())]
+                        for cfilter in filters]).T
+    with tables.open_file(noise_fname, 'r') as nfile:
+        residuals = ((simflux - sedgrid.seds[sim_indx]
+                      - nfile.root.bias[:][sim_indx])
+                     / np.sqrt(nfile.root.cov_diag[:][sim_indx]))
+    corr = 0.3 * np.ones((len(filters), len(filters))) \
+        + 0.7 * np.eye(len(filters))
+    np.testing.assert_allclose(np.mean(residuals, axis=0), 0.,
+                               atol=5. / np.sqrt(n_sim))
+    np.testing.assert_allclose(np.cov(residuals, rowvar=False), corr,
+                               atol=5. * np.sqrt(2. / n_sim))
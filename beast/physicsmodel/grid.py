@@ -31,6 +31,7 @@ from .dust import extinction
 from .helpers.gridbackends import (MemoryBackend, CacheBackend,
                                    HDFBackend, GridBackend)
 from .helpers.gridhelpers import pretty_size_print, isNestedInstance
+from .helpers.gridinfo import CodedColumn, encode_column, read_grid_codes
 
 try:
     unicode = unicode
@@ -196,6 +197,35 @@ class ModelGrid(object):
         else:
             return self.grid[name]
 
+    def get_coded(self, name):
+        """ returns a grid column as codes into its unique values
+
+        Parameters
+        ----------
+
+        name: str
+            name of the column
+
+        returns
+        -------
+
+        column: CodedColumn or None
+            codes saved in the grid file (writeHDF with grid_codes=True)
+            or computed from the column with the codebook of the grid
+            metadata, None if the column has no codebook
+        """
+        info = getattr(self._backend, 'grid_info', None)
+        if (info is None) or (name not in info) or \
+           (info[name]['unique'] is None):
+            return None
+        column = read_grid_codes(self._backend.fname, name,
+                                 n_models=len(self._backend))
+        if column is None:
+            codebook = info[name]['unique']
+            column = CodedColumn(encode_column(self[name], codebook),
+                                 codebook)
+        return column
+
     def copy(self):
         """ returns a copy of the object """
         return self.__class__(backend=self._backend.copy())
@@ -38,6 +38,7 @@ TODO: check read(field=) exists into all backends.grid, give direct access
 """
 from __future__ import (absolute_import, division, print_function)
 
+import os
 import sys
 import numpy
 import astropy.io.fits as pyfits
@@ -46,6 +47,7 @@ import copy
 from ...external.eztables import Table
 from .hdfstore import HDFStore
 from .gridhelpers import isNestedInstance, pretty_size_print
+from .gridinfo import read_grid_info, update_grid_info
 
 try:
     unicode = unicode
@@ -78,6 +80,8 @@ class GridBackend(object):
         self._header = None
         self.fname = None
         self._aliases = {}
+        self._grid_info = None
+        self._grid_info_loaded = False
 
     @property
     def nbytes(self):
@@ -96,6 +100,18 @@ class GridBackend(object):
         """filters"""
         return self._filters
 
+    @property
+    def grid_info(self):
+        """metadata of the grid columns saved in the grid file
+        (min, max, number of unique values, codebook), None if not
+        available (see helpers.gridinfo)"""
+        if not self._grid_info_loaded:
+            if (self.fname is not None) and os.path.isfile(self.fname):
+                self._grid_info = read_grid_info(self.fname,
+                                                 n_models=len(self))
+            self._grid_info_loaded = True
+        return self._grid_info
+
     def __len__(self):
         return len(self.grid)
 
@@ -283,6 +299,8 @@ class MemoryBackend(GridBackend):
                 except:
                     self.cov_offdiag = None
             self.grid = Table(fname, tablename='/grid')
+            self._grid_info = read_grid_info(fname, n_models=len(self.grid))
+        self._grid_info_loaded = True
 
         self._header = self.grid.header
 
@@ -306,7 +324,8 @@ class MemoryBackend(GridBackend):
                     self.grid.header['FILTERS'] = ' '.join(self.filters)
             self.grid.write(fname, append=True)
 
-    def writeHDF(self, fname, append=False, *args, **kwargs):
+    def writeHDF(self, fname, append=False, grid_codes=False, *args,
+                 **kwargs):
         """write -- export to HDF file
 
         Parameters
@@ -317,6 +336,10 @@ class MemoryBackend(GridBackend):
 
         append: bool, optional (default False)
             if set, it will append data to each Array or Table
+
+        grid_codes: bool, optional (default False)
+            if set, also save the grid columns with few unique values as
+            codes into their codebooks (see helpers.gridinfo)
         """
         if ( (self.lamb is not None) & (self.seds is not None) &
              (self.grid is not None) ):
@@ -345,6 +368,8 @@ class MemoryBackend(GridBackend):
                 if ('FILTERS' not in list(self.grid.header.keys())):
                     self.grid.header['FILTERS'] = ' '.join(self.filters)
             self.grid.write(fname, tablename='grid', append=True)
+            update_grid_info(fname, self.grid, append=append,
+                             save_codes=grid_codes)
 
     def copy(self):
         """ implement a copy method """
@@ -531,7 +556,8 @@ class CacheBackend(GridBackend):
                     self.grid.header['FILTERS'] = ' '.join(self.filters)
             self.grid.write(fname, append=True)
 
-    def writeHDF(self, fname, append=False, *args, **kwargs):
+    def writeHDF(self, fname, append=False, grid_codes=False, *args,
+                 **kwargs):
         """write -- export to HDF file
 
         Parameters
@@ -542,6 +568,10 @@ class CacheBackend(GridBackend):
 
         append: bool, optional (default False)
             if set, it will append data to each Array or Table
+
+        grid_codes: bool, optional (default False)
+            if set, also save the grid columns with few unique values as
+            codes into their codebooks (see helpers.gridinfo)
         """
         if ( (self.lamb is not None) & (self.seds is not None) & (self.grid is not None) ):
             assert(isinstance(self.grid, Table)), 'Only eztables.Table are supported so far'
@@ -560,6 +590,8 @@ class CacheBackend(GridBackend):
                 if ('FILTERS' not in list(self.grid.header.keys())):
                     self.grid.header['FILTERS'] = ' '.join(self.filters)
             self.grid.write(fname, tablename='grid', append=True)
+            update_grid_info(fname, self.grid, append=append,
+                             save_codes=grid_codes)
 
     def copy(self):
         """ implement a copy method """
@@ -633,7 +665,8 @@ class HDFBackend(GridBackend):
         else:
             return []
 
-    def writeHDF(self, fname, append=False, *args, **kwargs):
+    def writeHDF(self, fname, append=False, grid_codes=False, *args,
+                 **kwargs):
         """write -- export to HDF file
 
         Parameters
@@ -644,6 +677,10 @@ class HDFBackend(GridBackend):
 
         append: bool, optional (default False)
             if set, it will append data to each Array or Table
+
+        grid_codes: bool, optional (default False)
+            if set, also save the grid columns with few unique values as
+            codes into their codebooks (see helpers.gridinfo)
         """
         if ( (self.lamb is not None) & (self.seds is not None) & (self.grid is not None) ):
             with HDFStore(fname, mode='a') as hd:
@@ -658,6 +695,8 @@ class HDFBackend(GridBackend):
                         hd['/seds'] = self.seds[:]
                         hd['/lamb'] = self.lamb[:]
                 hd.write(self.grid[:], group='/', tablename='grid', header=self.header, append=append)
+            update_grid_info(fname, self.grid[:], append=append,
+                             save_codes=grid_codes)
 
     def copy(self):
         g = HDFBackend(self.fname)
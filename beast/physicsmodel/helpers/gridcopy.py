@@ -0,0 +1,251 @@
+""" Streaming copies of grid and noise model files
+
+Copies of row ranges (and optionally of a subset of the filters) of the
+HDF5 grid files (seds, grid table, covariances) and noise model files
+(bias, error, completeness, ...) done block by block between the files,
+so that the memory used is set by the block size and not by the size of
+the grid. Used by the grid split/merge and filter removal tools.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import numpy as np
+import tables
+
+from .gridinfo import (compute_grid_info, merge_grid_info, encode_column,
+                       code_dtype, _read_grid_info, _write_grid_info)
+
+__all__ = ['copy_grid_rows', 'copy_noisemodel_rows']
+
+# noise model arrays with one column per filter, the only ones that can be
+#   copied for a subset of the filters (the trunchen arrays, q_norm and the
+#   inverse covariance matrices, depend on all the filters)
+_FILTER_ARRAYS = ['bias', 'error', 'completeness']
+
+
+def _row_range(rows, n_rows):
+    """ start and stop of a slice of rows (None for all the rows) """
+    if rows is None:
+        return 0, n_rows
+    start, stop, step = rows.indices(n_rows)
+    if step != 1:
+        raise ValueError('only contiguous row ranges can be copied')
+    return start, max(start, stop)
+
+
+def _append_rows(dst, name, vals, title=''):
+    """ append rows to an extendable array, created if needed """
+    if '/' + name in dst:
+        dst.get_node('/' + name).append(vals)
+    else:
+        dst.create_earray(dst.root, name, obj=vals, title=title)
+
+
+def copy_grid_rows(src_fname, dst_fname, rows=None, filter_indxs=None,
+                   append=False, header={}, block_size=100000,
+                   cap_unique=1000):
+    """
+    Copy a range of models of a grid file into another grid file, block
+    by block
+
+    Parameters
+    ----------
+    src_fname: str
+        grid file to copy from
+
+    dst_fname: str
+        grid file to copy into (created if needed)
+
+    rows: slice
+        range of models to copy (default: all)
+
+    filter_indxs: list of int
+        indices of the filters (seds columns) to copy (default: all).
+        The covariance matrices are not copied when filters are removed.
+
+    append: bool
+        set to append the models to the grid already in dst_fname
+        (otherwise dst_fname should not contain a grid)
+
+    header: dict
+        grid header values to set or replace (e.g., filters)
+
+    block_size: int
+        number of models copied at once
+
+    cap_unique: int
+        maximum number of unique values to save as the codebook of a
+        column in the grid metadata (see gridinfo)
+
+    Returns
+    -------
+    n_models: int
+        number of models copied
+    """
+    with tables.open_file(src_fname, 'r') as src, \
+            tables.open_file(dst_fname, 'a') as dst:
+        start, stop = _row_range(rows, src.root.seds.shape[0])
+        keep = slice(None) if filter_indxs is None else np.asarray(
+            filter_indxs, dtype=int)
+        new_grid = not (append and '/grid' in dst)
+        n_prev = 0 if new_grid else dst.root.grid.nrows
+        if new_grid and (('/grid' in dst) or ('/seds' in dst)):
+            raise ValueError('{0} already contains a grid'.format(dst_fname))
+
+        # per model arrays of the grid file
+        array_names = ['seds']
+        if filter_indxs is None:
+            array_names += [name for name in ['covdiag', 'covoffdiag']
+                            if '/' + name in src]
+
+        if new_grid:
+            _append_rows(dst, 'lamb', src.root.lamb.read()[keep],
+                         title='lamb')
+            for name in array_names:
+                node = src.get_node('/' + name)
+                shape = (0,) + node.shape[1:]
+                if name == 'seds':
+                    shape = (0,) + node[:1, keep].shape[1:]
+                dst.create_earray(dst.root, name, atom=node.atom, shape=shape,
+                                  title=name)
+            grid_table = dst.create_table(
+                dst.root, 'grid', description=src.root.grid.description,
+                title='grid')
+            for attr in src.root.grid.attrs._v_attrnamesuser:
+                grid_table.attrs[attr] = src.root.grid.attrs[attr]
+        grid_table = dst.root.grid
+        for key in header:
+            grid_table.attrs[key] = header[key]
+
+        info = None
+        for b_start in range(start, stop, block_size):
+            b_stop = min(b_start + block_size, stop)
+            dst.root.seds.append(src.root.seds[b_start:b_stop][:, keep])
+            for name in array_names[1:]:
+                dst.get_node('/' + name).append(
+                    src.get_node('/' + name)[b_start:b_stop])
+            block = src.root.grid.read(b_start, b_stop)
+            grid_table.append(block)
+
+            # metadata of the copied models
+            block_info = compute_grid_info(block, cap_unique=cap_unique)
+            info = (block_info if info is None else
+                    merge_grid_info(info, block_info, cap_unique=cap_unique))
+        grid_table.flush()
+
+        # all the models copied: the metadata of the source grid is exact
+        if (start, stop) == (0, src.root.grid.nrows):
+            src_info = _read_grid_info(src, stop)
+            if src_info is not None:
+                info = src_info
+
+        # metadata of the grid (merged with the one of the models
+        #   already there), with the codes if the grids have them
+        if info is not None:
+            prev_info = None if new_grid else _read_grid_info(dst, n_prev)
+            if (n_prev == 0) or (prev_info is not None):
+                save_codes = (('/grid_info/codes' in src) or
+                              ((prev_info is not None) and
+                               ('/grid_info/codes' in dst)))
+                if prev_info is not None:
+                    info = merge_grid_info(prev_info, info,
+                                           cap_unique=cap_unique)
+                codes = {}
+                if save_codes:
+                    codes = _encode_table_columns(grid_table, info,
+                                                  block_size)
+                _write_grid_info(dst, info, grid_table.nrows, codes=codes)
+
+    return stop - start
+
+
+def _encode_table_columns(grid_table, info, block_size):
+    """ codes of the columns of a grid table with a codebook """
+    codes = {}
+    for name in info:
+        codebook = info[name]['unique']
+        if codebook is None:
+            continue
+        codes[name] = np.empty(grid_table.nrows,
+                               dtype=code_dtype(len(codebook)))
+        for b_start in range(0, grid_table.nrows, block_size):
+            b_stop = min(b_start + block_size, grid_table.nrows)
+            codes[name][b_start:b_stop] = encode_column(
+                grid_table.read(b_start, b_stop, field=name), codebook)
+    return codes
+
+
+def copy_noisemodel_rows(src_fname, dst_fname, rows=None, filter_indxs=None,
+                         names=None, append=False, block_size=100000):
+    """
+    Copy a range of models of a noise model file into another noise model
+    file, block by block
+
+    Parameters
+    ----------
+    src_fname: str
+        noise model file to copy from
+
+    dst_fname: str
+        noise model file to copy into (created if needed)
+
+    rows: slice
+        range of models to copy (default: all)
+
+    filter_indxs: list of int
+        indices of the filters to copy, applied to the second axis of
+        the copied arrays (default: all). Only the per filter arrays
+        (bias, error, completeness) can be copied for a subset of the
+        filters.
+
+    names: list of str
+        names of the arrays to copy (default: all the arrays of the file,
+        e.g., bias, error, completeness, and the trunchen arrays, or only
+        the per filter arrays if filter_indxs is set)
+
+    append: bool
+        set to append the models to the arrays already in dst_fname
+
+    block_size: int
+        number of models copied at once
+
+    Returns
+    -------
+    n_models: int
+        number of models copied
+    """
+    with tables.open_file(src_fname, 'r') as src, \
+            tables.open_file(dst_fname, 'a') as dst:
+        if names is None:
+            names = [node.name for node in src.list_nodes('/',
+                                                          classname='Array')]
+            if filter_indxs is not None:
+                names = [name for name in names if name in _FILTER_ARRAYS]
+        if filter_indxs is not None:
+            for name in names:
+                if (name not in _FILTER_ARRAYS) or \
+                        (src.get_node('/' + name).ndim != 2):
+                    raise ValueError(
+                        '{0} does not have one column per filter, it cannot '
+                        'be copied for a subset of the filters'.format(name))
+        n_models = src.get_node('/' + names[0]).shape[0]
+        start, stop = _row_range(rows, n_models)
+        for name in names:
+            node = src.get_node('/' + name)
+            if not append and ('/' + name in dst):
+                raise ValueError('{0} already contains {1}'.format(
+                    dst_fname, name))
+            for b_start in range(start, stop, block_size):
+                b_stop = min(b_start + block_size, stop)
+                vals = node[b_start:b_stop]
+                if filter_indxs is not None:
+                    vals = vals[:, filter_indxs]
+                _append_rows(dst, name, vals)
+            if ('/' + name not in dst):
+                # no models copied, keep an empty array
+                shape = (0,) + node.shape[1:]
+                if filter_indxs is not None:
+                    shape = (0, len(filter_indxs)) + node.shape[2:]
+                dst.create_earray(dst.root, name, atom=node.atom, shape=shape)
+
+    return stop - start
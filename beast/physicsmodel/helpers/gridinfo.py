@@ -0,0 +1,455 @@
+""" Grid metadata index
+
+Min, max, and number of unique values of each column of the grid table,
+with the unique values (codebook) of the columns with few of them
+(e.g., the grid parameters). Computed by the grid writers and stored in
+the HDF5 grid files (/grid_info group) so that the fitting and the
+subgridding tools do not have to scan the (possibly very large) columns.
+
+The columns with a codebook can also be saved and used as uint8/uint16
+codes into the codebook (CodedColumn), a compact encoding of the grid
+parameters that only take tens to hundreds of values.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import os
+
+import numpy as np
+import tables
+
+__all__ = ['unique_capped', 'compute_grid_info', 'merge_grid_info',
+           'write_grid_info', 'read_grid_info', 'update_grid_info',
+           'CodedColumn', 'code_dtype', 'encode_column', 'read_grid_codes']
+
+
+def unique_capped(vals, cap_unique=1000):
+    """
+    Unique values of an array, stopping once more than cap_unique are found
+
+    The unique values of increasingly larger first parts of the array are
+    computed, so columns with many unique values (e.g., fluxes) are not
+    fully sorted.
+
+    Parameters
+    ----------
+    vals: ndarray
+        values
+
+    cap_unique: int
+        maximum number of unique values to track
+
+    Returns
+    -------
+    uvals: ndarray
+        sorted unique values, all of them if there are at most cap_unique,
+        otherwise more than cap_unique of them
+    """
+    n_vals = len(vals)
+    n_part = min(n_vals, 4*(cap_unique + 1))
+    while True:
+        uvals = np.unique(vals[:n_part])
+        if (len(uvals) > cap_unique) or (n_part >= n_vals):
+            return uvals
+        n_part = min(n_vals, 4*n_part)
+
+
+def code_dtype(n_codes):
+    """
+    Smallest unsigned integer type for a number of codes
+    """
+    if n_codes <= 2**8:
+        return np.uint8
+    elif n_codes <= 2**16:
+        return np.uint16
+    else:
+        return np.uint32
+
+
+def encode_column(vals, codebook):
+    """
+    Codes of the values of a column into its codebook
+
+    Parameters
+    ----------
+    vals: ndarray
+        values of the column
+
+    codebook: ndarray
+        sorted unique values of the column
+
+    Returns
+    -------
+    codes: ndarray
+        index in the codebook of each value (smallest unsigned type)
+    """
+    codes = np.searchsorted(codebook, vals)
+    if (len(codes) > 0) and ((codes.max() >= len(codebook))
+                             or np.any(codebook[codes] != vals)):
+        raise ValueError('values not in the codebook')
+    return codes.astype(code_dtype(len(codebook)))
+
+
+class CodedColumn(object):
+    """
+    Grid column stored as codes into its sorted unique values (codebook)
+
+    The values are only decoded when indexed (e.g., column[indxs]) and
+    aggregations over the models can be done directly on the codes
+    (bincount).
+    """
+    def __init__(self, codes, codebook):
+        """
+        Parameters
+        ----------
+        codes: ndarray
+            index in the codebook of the value of each model
+
+        codebook: ndarray
+            sorted unique values
+        """
+        self.codes = codes
+        self.codebook = codebook
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, indxs):
+        return self.codebook[self.codes[indxs]]
+
+    @property
+    def dtype(self):
+        """ type of the decoded values """
+        return self.codebook.dtype
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.codebook.nbytes
+
+    def decode(self):
+        """
+        Values of all the models
+        """
+        return self.codebook[self.codes]
+
+    def min(self):
+        return self.codebook[0]
+
+    def max(self):
+        return self.codebook[-1]
+
+    def bincount(self, weights=None, indxs=None):
+        """
+        Sum of weights of the models for each codebook value
+        (e.g., marginalized likelihood)
+
+        Parameters
+        ----------
+        weights: ndarray
+            weight of each model (or of the models in indxs)
+
+        indxs: ndarray
+            indices of the models (default is all the models)
+
+        Returns
+        -------
+        sums: ndarray
+            sum of the weights for each value of the codebook
+        """
+        codes = self.codes if indxs is None else self.codes[indxs]
+        return np.bincount(codes, weights=weights,
+                           minlength=len(self.codebook))
+
+
+def _grid_columns(grid):
+    """
+    Names and values of the numerical 1D columns of a grid table
+    (eztables.Table, pytables table or structured array)
+    """
+    if hasattr(grid, 'keys'):
+        names = list(grid.keys())
+    else:
+        names = grid.dtype.names
+    for name in names:
+        vals = np.asarray(grid[name])
+        if (vals.ndim == 1) and (vals.dtype.kind in 'biuf'):
+            yield name, vals
+
+
+def compute_grid_info(grid, cap_unique=1000):
+    """
+    Min, max, and number of unique values of the columns of a grid table
+
+    Parameters
+    ----------
+    grid: eztables.Table or structured ndarray
+        grid table (only the numerical 1D columns are used)
+
+    cap_unique: int
+        maximum number of unique values to save as the codebook of a
+        column
+
+    Returns
+    -------
+    info: dict
+        {name: {'min': float, 'max': float, 'num_unique': int,
+                'unique': ndarray or None}, ...}
+        unique is None for the columns with more than cap_unique unique
+        values, num_unique is then a lower bound (> cap_unique)
+    """
+    info = {}
+    for name, vals in _grid_columns(grid):
+        if len(vals) == 0:
+            continue
+        uvals = unique_capped(vals, cap_unique=cap_unique)
+        info[name] = {'min': float(np.amin(vals)),
+                      'max': float(np.amax(vals)),
+                      'num_unique': len(uvals),
+                      'unique': uvals if len(uvals) <= cap_unique else None}
+    return info
+
+
+def merge_grid_info(info, other_info, cap_unique=1000):
+    """
+    Metadata of the union of two grids (e.g., subgrids)
+
+    Parameters
+    ----------
+    info, other_info: dict
+        metadata of each grid (see compute_grid_info), only the columns
+        in both are merged
+
+    cap_unique: int
+        maximum number of unique values to save as the codebook of a
+        column
+
+    Returns
+    -------
+    merged_info: dict
+        metadata of the union of the grids
+    """
+    merged_info = {}
+    for name in info:
+        if name not in other_info:
+            continue
+        a = info[name]
+        b = other_info[name]
+        merged = {'min': min(a['min'], b['min']),
+                  'max': max(a['max'], b['max'])}
+        if (a['unique'] is not None) and (b['unique'] is not None):
+            uvals = np.union1d(a['unique'], b['unique'])
+            merged['num_unique'] = len(uvals)
+            merged['unique'] = uvals if len(uvals) <= cap_unique else None
+        else:
+            merged['num_unique'] = max(a['num_unique'], b['num_unique'])
+            merged['unique'] = None
+        merged_info[name] = merged
+    return merged_info
+
+
+def _write_grid_info(hd, info, n_models, codes={}):
+    """ save the grid metadata (and codes) in an opened HDF5 file """
+    names = sorted(info)
+    name_len = max([len(name) for name in names] + [1])
+    rows = np.array([(name.encode('utf-8'), info[name]['min'],
+                      info[name]['max'], info[name]['num_unique'])
+                     for name in names],
+                    dtype=[('name', 'S{0:d}'.format(name_len)),
+                           ('min', float), ('max', float),
+                           ('num_unique', np.int64)])
+    if '/grid_info' in hd:
+        hd.remove_node('/grid_info', recursive=True)
+    group = hd.create_group('/', 'grid_info')
+    group._v_attrs.n_models = int(n_models)
+    hd.create_table(group, 'columns', rows)
+    # codebooks stored by index of the column in the table
+    ugroup = hd.create_group(group, 'unique')
+    for k, name in enumerate(names):
+        if info[name]['unique'] is not None:
+            hd.create_array(ugroup, 'col{0:d}'.format(k),
+                            np.asarray(info[name]['unique']))
+    if len(codes) > 0:
+        cgroup = hd.create_group(group, 'codes')
+        for k, name in enumerate(names):
+            if name in codes:
+                hd.create_array(cgroup, 'col{0:d}'.format(k), codes[name])
+
+
+def _read_grid_info(hd, n_models=None):
+    """ read the grid metadata from an opened HDF5 file """
+    if '/grid_info' not in hd:
+        return None
+    group = hd.get_node('/grid_info')
+    if (n_models is not None) and (group._v_attrs.n_models != n_models):
+        return None
+    rows = group.columns.read()
+    info = {}
+    for k, row in enumerate(rows):
+        node_name = 'col{0:d}'.format(k)
+        if node_name in group.unique:
+            uvals = group.unique._f_get_child(node_name).read()
+        else:
+            uvals = None
+        info[row['name'].decode('utf-8')] = {
+            'min': float(row['min']),
+            'max': float(row['max']),
+            'num_unique': int(row['num_unique']),
+            'unique': uvals}
+    return info
+
+
+def _read_grid_codes(hd, info):
+    """ read the codes saved in an opened HDF5 file """
+    codes = {}
+    if '/grid_info/codes' in hd:
+        cgroup = hd.get_node('/grid_info/codes')
+        for k, name in enumerate(sorted(info)):
+            node_name = 'col{0:d}'.format(k)
+            if node_name in cgroup:
+                codes[name] = cgroup._f_get_child(node_name).read()
+    return codes
+
+
+def write_grid_info(fname, info, n_models):
+    """
+    Save the grid metadata in the /grid_info group of an HDF5 grid file
+    (replaced if already present)
+
+    Parameters
+    ----------
+    fname: str
+        HDF5 grid file
+
+    info: dict
+        grid metadata (see compute_grid_info)
+
+    n_models: int
+        number of models in the grid
+    """
+    with tables.open_file(fname, 'a') as hd:
+        _write_grid_info(hd, info, n_models)
+
+
+def read_grid_info(fname, n_models=None):
+    """
+    Read the grid metadata saved in a grid file
+
+    Parameters
+    ----------
+    fname: str
+        grid file
+
+    n_models: int
+        number of models in the grid, the metadata is ignored if it was
+        saved for a different number of models
+
+    Returns
+    -------
+    info: dict or None
+        grid metadata (see compute_grid_info), None if not available
+    """
+    if (fname is None) or (not os.path.isfile(fname)) \
+       or (not tables.is_hdf5_file(fname)):
+        return None
+    with tables.open_file(fname, 'r') as hd:
+        return _read_grid_info(hd, n_models=n_models)
+
+
+def read_grid_codes(fname, name, n_models=None):
+    """
+    Read a coded column saved in a grid file
+
+    Parameters
+    ----------
+    fname: str
+        grid file
+
+    name: str
+        name of the column
+
+    n_models: int
+        number of models in the grid, the codes are ignored if they were
+        saved for a different number of models
+
+    Returns
+    -------
+    column: CodedColumn or None
+        codes and codebook, None if not available
+    """
+    if (fname is None) or (not os.path.isfile(fname)) \
+       or (not tables.is_hdf5_file(fname)):
+        return None
+    with tables.open_file(fname, 'r') as hd:
+        info = _read_grid_info(hd, n_models=n_models)
+        if (info is None) or (name not in info) \
+           or ('/grid_info/codes' not in hd):
+            return None
+        node_name = 'col{0:d}'.format(sorted(info).index(name))
+        cgroup = hd.get_node('/grid_info/codes')
+        if node_name not in cgroup:
+            return None
+        return CodedColumn(cgroup._f_get_child(node_name).read(),
+                           info[name]['unique'])
+
+
+def update_grid_info(fname, grid, append=False, cap_unique=1000,
+                     save_codes=False):
+    """
+    Compute and save the metadata of a grid table written in a file
+
+    Parameters
+    ----------
+    fname: str
+        HDF5 grid file
+
+    grid: eztables.Table or structured ndarray
+        grid table written in the file
+
+    append: bool
+        set if the grid table was appended to the one already in the file
+        (the metadata are then merged)
+
+    cap_unique: int
+        maximum number of unique values to save as the codebook of a
+        column
+
+    save_codes: bool
+        set to also save the codes of the columns with a codebook
+        (see CodedColumn)
+    """
+    info = compute_grid_info(grid, cap_unique=cap_unique)
+    codes = {}
+    if save_codes:
+        for name, vals in _grid_columns(grid):
+            if (name in info) and (info[name]['unique'] is not None):
+                codes[name] = encode_column(vals, info[name]['unique'])
+    n_models = len(grid)
+    # append mode as the writers may still have the file opened
+    with tables.open_file(fname, 'a') as hd:
+        if append:
+            prev_info = _read_grid_info(hd)
+            if prev_info is not None:
+                prev_codes = _read_grid_codes(hd, prev_info)
+                new_info = info
+                info = merge_grid_info(prev_info, new_info,
+                                       cap_unique=cap_unique)
+                n_models += hd.get_node('/grid_info')._v_attrs.n_models
+
+                # codes into the merged codebooks
+                new_codes = codes
+                codes = {}
+                for name in new_codes:
+                    codebook = info[name]['unique']
+                    if (name in prev_codes) and (codebook is not None):
+                        prev_map = np.searchsorted(codebook,
+                                                   prev_info[name]['unique'])
+                        new_map = np.searchsorted(codebook,
+                                                  new_info[name]['unique'])
+                        codes[name] = np.concatenate(
+                            [prev_map[prev_codes[name]],
+                             new_map[new_codes[name]]]).astype(
+                                 code_dtype(len(codebook)))
+            elif n_models != hd.get_node('/grid').nrows:
+                # earlier parts of the grid without metadata
+                return
+        _write_grid_info(hd, info, n_models, codes=codes)
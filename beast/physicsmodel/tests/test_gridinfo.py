@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+import tables
+
+from beast.physicsmodel.grid import FileSEDGrid
+from beast.physicsmodel.helpers.gridinfo import (unique_capped,
+                                                 compute_grid_info,
+                                                 read_grid_info,
+                                                 write_grid_info,
+                                                 read_grid_codes,
+                                                 encode_column)
+from beast.tools.subgridding_tools import subgrid_info
+from beast.tests.helpers import make_sed_grid, make_noisemodel
+
+
+def check_grid_info(info, grid):
+    """ metadata of all the numerical columns of a grid table """
+    names = grid.keys() if hasattr(grid, 'keys') else grid.dtype.names
+    for name in names:
+        vals = np.asarray(grid[name])
+        uvals = np.unique(vals)
+        assert info[name]['min'] == vals.min(), name
+        assert info[name]['max'] == vals.max(), name
+        assert info[name]['num_unique'] == len(uvals), name
+        np.testing.assert_equal(info[name]['unique'], uvals)
+
+
+def test_unique_capped():
+    vals = np.random.RandomState(1).randint(0, 50, 10000)
+    np.testing.assert_equal(unique_capped(vals, cap_unique=50),
+                            np.unique(vals))
+    vals = np.arange(10000)[::-1]
+    assert len(unique_capped(vals, cap_unique=20)) > 20
+
+
+def test_write_read_grid_info(tmpdir):
+    sedgrid = make_sed_grid()
+    fname = str(tmpdir.join('seds.grid.hd5'))
+    sedgrid.writeHDF(fname)
+
+    info = read_grid_info(fname, n_models=len(sedgrid.seds))
+    check_grid_info(info, sedgrid.grid)
+    assert FileSEDGrid(fname).grid_info is not None
+
+    # metadata saved for a different number of models is ignored
+    assert read_grid_info(fname, n_models=len(sedgrid.seds) + 1) is None
+    write_grid_info(fname, info, len(sedgrid.seds) + 1)
+    assert FileSEDGrid(fname).grid_info is None
+
+
+def test_append_grid_info(tmpdir):
+    sedgrid = make_sed_grid()
+    other_grid = make_sed_grid(n_age=3, n_mass=5, n_av=4, seed=4)
+    fname = str(tmpdir.join('seds.grid.hd5'))
+    sedgrid.writeHDF(fname)
+    other_grid.writeHDF(fname, append=True)
+
+    # merged metadata of the two grids
+    n_models = len(sedgrid.seds) + len(other_grid.seds)
+    info = read_grid_info(fname, n_models=n_models)
+    with tables.open_file(fname, 'r') as hd:
+        check_grid_info(info, hd.root.grid.read())
+    assert info['M_ini']['num_unique'] == len(np.union1d(
+        sedgrid.grid['M_ini'], other_grid.grid['M_ini']))
+
+    # capped codebooks of the merged columns
+    merged_info = compute_grid_info(FileSEDGrid(fname).grid, cap_unique=100)
+    assert merged_info['weight']['unique'] is None
+    assert merged_info['weight']['num_unique'] > 100
+    np.testing.assert_equal(merged_info['logA']['unique'],
+                            info['logA']['unique'])
+
+
+def test_subgrid_info(tmpdir):
+    sedgrid = make_sed_grid()
+    filters = sedgrid.header['filters'].split()
+    fname = str(tmpdir.join('seds.grid.hd5'))
+    sedgrid.writeHDF(fname)
+    noise_fname = make_noisemodel(sedgrid, str(tmpdir.join('noise.hd5')))
+
+    info = subgrid_info(fname, noise_fname)
+    check_grid_info(info, sedgrid.grid)
+
+    # unique values of the fluxes (with bias) of each filter
+    with tables.open_file(noise_fname, 'r') as noise:
+        flux = sedgrid.seds + noise.root.bias[:]
+    symlog_flux = np.sign(flux) * np.log1p(
+        np.abs(flux * np.log(10))) / np.log(10)
+    for k, cfilter in enumerate(filters):
+        q = 'symlog' + cfilter + '_wd_bias'
+        uvals = np.unique(symlog_flux[:, k])
+        assert info[q]['num_unique'] == len(uvals)
+        np.testing.assert_allclose(info[q]['unique'], uvals, rtol=1e-12)
+        np.testing.assert_allclose([info[q]['min'], info[q]['max']],
+                                   [uvals[0], uvals[-1]], rtol=1e-12)
+
+
+def test_grid_codes(tmpdir):
+    # the appended grid has ages and masses not in the first codebooks
+    sedgrid = make_sed_grid()
+    other_grid = make_sed_grid(n_age=3, n_mass=5, n_av=4, seed=4)
+    fname = str(tmpdir.join('seds.grid.hd5'))
+    sedgrid.writeHDF(fname, grid_codes=True)
+    other_grid.writeHDF(fname, append=True, grid_codes=True)
+
+    g = FileSEDGrid(fname)
+    n_models = len(g.seds)
+    for name in ['logA', 'M_ini', 'Av', 'specgrid_indx']:
+        # codes saved in the file, remapped to the merged codebooks
+        column = read_grid_codes(fname, name, n_models=n_models)
+        assert column is not None
+        np.testing.assert_equal(column.decode(), g[name])
+        np.testing.assert_equal(g.get_coded(name).decode(), g[name])
+        assert column.min() == g[name].min()
+        assert column.max() == g[name].max()
+
+        # aggregation on the codes
+        weights = g['weight']
+        np.testing.assert_allclose(
+            column.bincount(weights=weights),
+            [np.sum(weights[g[name] == val]) for val in column.codebook])
+        indxs = np.arange(0, n_models, 7)
+        np.testing.assert_equal(column[indxs], g[name][indxs])
+
+    # codes computed from the codebook if not saved
+    fname = str(tmpdir.join('seds_nocodes.grid.hd5'))
+    sedgrid.writeHDF(fname)
+    g = FileSEDGrid(fname)
+    assert read_grid_codes(fname, 'M_ini') is None
+    np.testing.assert_equal(g.get_coded('M_ini').decode(), g['M_ini'])
+
+    with pytest.raises(ValueError):
+        encode_column(np.array([1., 2.5]), np.array([1., 2.]))
@@ -4,12 +4,14 @@ import os.path
 
 import numpy as np
 import h5py
+import tables
 
 from astropy.io import fits
 from astropy.utils.data import download_file
 
 __all__ = ['download_rename', 'compare_tables', 'compare_fits',
-           'compare_hdf5']
+           'compare_hdf5', 'make_sed_grid', 'make_noisemodel',
+           'make_obs_seds']
 
 
 def download_rename(filename):
@@ -107,13 +109,137 @@ def compare_hdf5(fname_cache, fname_new, ctype=None):
             else:
                 osname = sname
             if cvalue.dtype.fields is None:
-                np.testing.assert_allclose(cvalue.value, cvalue_new.value,
+                np.testing.assert_allclose(cvalue[()], cvalue_new[()],
                                            err_msg='testing %s' % (osname),
                                            rtol=1e-6)
             else:
                 for ckey in cvalue.dtype.fields.keys():
                     err_msg = 'testing %s/%s' % (osname, ckey)
-                    np.testing.assert_allclose(cvalue.value[ckey],
-                                               cvalue_new.value[ckey],
+                    np.testing.assert_allclose(cvalue[()][ckey],
+                                               cvalue_new[()][ckey],
                                                err_msg=err_msg,
                                                rtol=1e-5)
+
+
+def make_sed_grid(n_age=6, n_mass=12, n_av=6, n_filters=4, seed=1):
+    """
+    Small synthetic SED grid on a regular (logA, M_ini, Av) lattice with
+    fluxes in physical units (~1e-17 erg/s/cm^2/A), for the tests that do
+    not need the downloaded example files
+
+    Parameters
+    ----------
+    n_age, n_mass, n_av : int
+        number of ages, masses and extinctions
+
+    n_filters : int
+        number of filters
+
+    Returns
+    -------
+    grid.SpectralGrid instance (memory backend)
+    """
+    from beast.physicsmodel import grid
+    from beast.external.eztables import Table
+
+    rng = np.random.RandomState(seed)
+    logA, M_ini, Av = [vals.ravel() for vals in np.meshgrid(
+        np.linspace(7., 9., n_age), np.logspace(0., 1., n_mass),
+        np.linspace(0., 2., n_av), indexing='ij')]
+    n_models = len(logA)
+    lamb = np.linspace(2000., 16000., n_filters)
+
+    seds = (1e-17 * M_ini[:, None]**2.5
+            * 10**(-0.3 * (logA - 7.)[:, None]
+                   * np.log10(lamb / 5500.)[None, :])
+            * 10**(-0.4 * Av[:, None] * (lamb / 5500.)[None, :]**(-1.3))
+            * (1. + 0.01 * rng.randn(n_models, n_filters)))
+
+    filters = ['F{0:d}'.format(k) for k in range(n_filters)]
+    cols = {'logA': logA,
+            'M_ini': M_ini,
+            'Av': Av,
+            'Rv': np.full(n_models, 3.1),
+            'f_A': np.ones(n_models),
+            'Z': np.full(n_models, 0.019),
+            'distance': np.full(n_models, 7.76e5),
+            'weight': rng.uniform(0.5, 1.5, n_models),
+            'prior_weight': np.ones(n_models),
+            'grid_weight': np.ones(n_models),
+            'specgrid_indx': np.arange(n_models) // n_av}
+    g = grid.SpectralGrid(lamb, seds=seds, grid=Table(cols),
+                          header={'filters': ' '.join(filters)},
+                          backend='memory')
+    g.grid.header['filters'] = ' '.join(filters)
+    return g
+
+
+def make_noisemodel(sedgrid, fname, full_cov=False, seed=2):
+    """
+    Noise model file of a synthetic SED grid (5% uncertainties, 1% biases,
+    and correlations of 0.3 between the filters for the full covariance
+    matrices)
+
+    Parameters
+    ----------
+    sedgrid : grid.SpectralGrid instance
+        model grid
+
+    fname : str
+        noise model file to write
+
+    full_cov : bool
+        set to include the full covariance matrix terms
+
+    Returns
+    -------
+    fname : str
+    """
+    seds = sedgrid.seds
+    n_models, n_filters = seds.shape
+    rng = np.random.RandomState(seed)
+    sigmas = 0.05 * seds + 1e-21
+    with tables.open_file(fname, 'w') as outfile:
+        outfile.create_array(outfile.root, 'bias',
+                             0.01 * seds * rng.randn(n_models, n_filters))
+        outfile.create_array(outfile.root, 'error', sigmas)
+        outfile.create_array(outfile.root, 'completeness',
+                             np.ones((n_models, n_filters)))
+        if full_cov:
+            corr = 0.3 * np.ones((n_filters, n_filters)) + 0.7*np.eye(n_filters)
+            icorr = np.linalg.inv(corr)
+            up_indxs = np.triu_indices(n_filters, 1)
+            isig = 1.0 / sigmas
+            outfile.create_array(
+                outfile.root, 'q_norm',
+                -0.5*(np.linalg.slogdet(corr)[1]
+                      + 2.*np.sum(np.log(sigmas), axis=1)))
+            outfile.create_array(outfile.root, 'icov_diag',
+                                 isig**2 * np.diag(icorr)[None, :])
+            outfile.create_array(outfile.root, 'icov_offdiag',
+                                 isig[:, up_indxs[0]] * isig[:, up_indxs[1]]
+                                 * icorr[up_indxs][None, :])
+    return fname
+
+
+def make_obs_seds(sedgrid, n_stars, seed=3):
+    """
+    Observed SEDs of models drawn from a synthetic SED grid with 5% noise
+
+    Parameters
+    ----------
+    sedgrid : grid.SpectralGrid instance
+        model grid
+
+    n_stars : int
+        number of stars
+
+    Returns
+    -------
+    seds : np.ndarray[float, ndim=2]
+        fluxes (n_stars, n_filters) in the units of the model grid
+    """
+    rng = np.random.RandomState(seed)
+    indxs = rng.randint(0, len(sedgrid.seds), n_stars)
+    return sedgrid.seds[indxs] * (1. + 0.05 * rng.randn(
+        n_stars, sedgrid.seds.shape[1]))
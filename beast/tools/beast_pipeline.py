@@ -0,0 +1,462 @@
+"""
+BEAST run (isochrones, spectral grid, priors, SED grid, AST input list,
+noise model, trimming, fitting and merging of the subgrid results)
+declared as a pipeline of stages, so that only the stages whose
+parameters or inputs changed are rerun, and the subgrids and source
+density bins are processed in parallel (see pipeline.py).
+
+The file names follow the ones of examples/phat_small/run_beast.py (one
+grid) and examples/subgridding/run_beast_subgrids.py (subgrids and
+source density bins).
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import importlib.util
+import os
+import pickle
+import sys
+
+import numpy as np
+
+from astropy import constants as const
+
+from beast.physicsmodel.model_grid import (make_iso_table,
+                                           make_spectral_grid,
+                                           add_stellar_priors,
+                                           make_extinguished_sed_grid)
+from beast.physicsmodel.stars.isochrone import ezIsoch
+from beast.physicsmodel import grid
+import beast.observationmodel.noisemodel.generic_noisemodel as noisemodel
+from beast.observationmodel.ast.make_ast_input_list import pick_models
+from beast.fitting import fit
+from beast.fitting import trim_grid
+from beast.tools import subgridding_tools
+from beast.tools.pipeline import Pipeline
+
+__all__ = ['make_beast_pipeline']
+
+
+def iso_stage(project, iso_fname, oiso, logtmin, logtmax, dlogt, z):
+    """ Download and save the isochrones """
+    make_iso_table(project, oiso=oiso, logtmin=logtmin, logtmax=logtmax,
+                   dlogt=dlogt, z=z, iso_fname=iso_fname)
+
+
+def spectral_grid_stage(project, iso_fname, spec_fname, osl, redshift,
+                        distance, distance_unit, extra_kwargs):
+    """ Compute the spectral grid of the isochrones """
+    make_spectral_grid(project, ezIsoch(iso_fname), osl=osl,
+                       redshift=redshift, distance=distance,
+                       distance_unit=distance_unit, spec_fname=spec_fname,
+                       add_spectral_properties_kwargs=extra_kwargs)
+
+
+def priors_stage(project, spec_fname, priors_fname):
+    """ Add the stellar priors to the spectral grid """
+    g_spec = grid.FileSpectralGrid(spec_fname, backend='memory')
+    add_stellar_priors(project, g_spec, priors_fname=priors_fname)
+
+
+def split_stage(priors_fname, nsubs):
+    """ Split the spectral grid with priors into subgrids """
+    subgridding_tools.split_grid(priors_fname, nsubs, overwrite=True)
+
+
+def seds_stage(project, priors_fname, seds_fname, filters, extLaw, av, rv,
+               fA, av_prior_model, rv_prior_model, fA_prior_model,
+               extra_kwargs):
+    """ Compute the extinguished SED grid of a spectral (sub)grid """
+    g_pspec = grid.FileSpectralGrid(priors_fname, backend='memory')
+    make_extinguished_sed_grid(project, g_pspec, filters, extLaw=extLaw,
+                               av=av, rv=rv, fA=fA,
+                               av_prior_model=av_prior_model,
+                               rv_prior_model=rv_prior_model,
+                               fA_prior_model=fA_prior_model,
+                               add_spectral_properties_kwargs=extra_kwargs,
+                               seds_fname=seds_fname)
+
+
+def merge_seds_stage(seds_fname, sub_fnames):
+    """ Merge the SED subgrids into the full SED grid """
+    subgridding_tools.merge_grids(seds_fname, sub_fnames)
+
+
+def ast_input_stage(seds_fname, filters, mag_cuts, Nfilter, N_stars,
+                    Nrealize, outfile, outfile_params, obsfile, get_obscat):
+    """
+    Pick the models of the ASTs, with magnitude cuts relative to the 90th
+    percentile of the observed magnitudes if a single cut is given
+    """
+    if len(mag_cuts) == 1:
+        obsdata = get_obscat(obsfile, filters)
+        min_mags = np.zeros(len(filters))
+        for k, filtername in enumerate(obsdata.filters):
+            sfiltername = obsdata.data.resolve_alias(filtername)
+            sfiltername = sfiltername.replace('rate', 'vega')
+            sfiltername = sfiltername.replace('RATE', 'VEGA')
+            keep, = np.where(obsdata[sfiltername] < 99.)
+            min_mags[k] = np.percentile(obsdata[keep][sfiltername], 90.)
+        mag_cuts = min_mags + mag_cuts
+    pick_models(seds_fname, filters, mag_cuts, Nfilter=Nfilter,
+                N_stars=N_stars, Nrealize=Nrealize, outfile=outfile,
+                outfile_params=outfile_params)
+
+
+def noisemodel_stage(seds_fname, noisefile, astfile, absflux_a_matrix):
+    """ Compute the toothpick noise model of a SED (sub)grid """
+    modelsedgrid = grid.FileSEDGrid(seds_fname)
+    noisemodel.make_toothpick_noise_model(noisefile, astfile, modelsedgrid,
+                                          absflux_a_matrix=absflux_a_matrix)
+
+
+def trim_stage(seds_fname, noisefile, obsfile, filters, get_obscat,
+               sed_trimname, noisemodel_trimname, sigma_fac):
+    """ Trim a SED (sub)grid and noise model for the observations """
+    obsdata = get_obscat(obsfile, filters)
+    modelsedgrid = grid.FileSEDGrid(seds_fname)
+    noisemodel_vals = noisemodel.get_noisemodelcat(noisefile)
+    trim_grid.trim_models(modelsedgrid, noisemodel_vals, obsdata,
+                          sed_trimname, noisemodel_trimname,
+                          sigma_fac=sigma_fac)
+
+
+def grid_info_stage(sed_trimnames, noisemodel_trimnames, grid_info_fname):
+    """
+    Save the ranges and number of unique values of the trimmed subgrids
+    (for compatible fits of the subgrids)
+    """
+    grid_info_dict = subgridding_tools.reduce_grid_info(
+        sed_trimnames, noisemodel_trimnames)
+    with open(grid_info_fname, 'wb') as outfile:
+        pickle.dump(grid_info_dict, outfile)
+
+
+def fit_stage(sed_trimname, noisemodel_trimname, obsfile, filters,
+              get_obscat, stats_fname, pdf1d_fname, lnp_fname,
+              grid_info_fname, fit_kwargs):
+    """ Fit the observations with a trimmed SED (sub)grid """
+    obsdata = get_obscat(obsfile, filters)
+    modelsedgrid = grid.FileSEDGrid(sed_trimname)
+    noisemodel_vals = noisemodel.get_noisemodelcat(noisemodel_trimname)
+    grid_info_dict = None
+    if grid_info_fname is not None:
+        with open(grid_info_fname, 'rb') as infile:
+            grid_info_dict = pickle.load(infile)
+    fit.summary_table_memory(obsdata, noisemodel_vals, modelsedgrid,
+                             stats_outname=stats_fname,
+                             pdf1d_outname=pdf1d_fname,
+                             lnp_outname=lnp_fname,
+                             grid_info_dict=grid_info_dict,
+                             **fit_kwargs)
+
+
+def merge_stage(pdf1d_fnames, stats_fnames, output_fname_base):
+    """ Merge the fit results of the subgrids """
+    subgridding_tools.merge_pdf1d_stats(pdf1d_fnames, stats_fnames,
+                                        output_fname_base=output_fname_base)
+
+
+def _subgrid_fname(fname, sub, nsubs):
+    """ file name of a subgrid (as given by split_grid) """
+    if nsubs == 1:
+        return fname
+    return fname.replace('.hd5', 'sub{0}.hd5'.format(sub))
+
+
+def _bin_fname(fname, dens_bin):
+    """ file name for a source density bin (in a subfolder) """
+    if dens_bin is None:
+        return fname
+    return os.path.join('bin{0}'.format(dens_bin), fname)
+
+
+def _bin_catalog(fname, dens_bin):
+    """ catalog of a source density bin (see split_catalog_using_map) """
+    if dens_bin is None:
+        return fname
+    base, ext = os.path.splitext(fname)
+    return '{0}_bin{1}{2}'.format(base, dens_bin, ext)
+
+
+def make_beast_pipeline(datamodel, nsubs=1, dens_bins=None, ast=True,
+                        cache_dir=None, sigma_fac=3., fit_kwargs=None):
+    """
+    Pipeline of the stages of a BEAST run
+
+    Stages (with _bin{k} and _sub{i} suffixes for the source density bins
+    and subgrids): iso, spec, priors, split (subgrids), seds,
+    merge_seds (subgrids, for the ASTs), ast_input, noisemodel, trim,
+    grid_info (subgrids), fit, merge (subgrids)
+
+    Parameters
+    ----------
+    datamodel: module
+        BEAST datamodel (e.g., examples/phat_small/datamodel.py)
+
+    nsubs: int
+        number of subgrids
+
+    dens_bins: list of int
+        source density bins processed separately, with the observations
+        and ASTs in catalogs with a _bin{k} suffix and the results in bin{k}
+        subfolders (default: no bins)
+
+    ast: bool
+        set to include the stage picking the models of the ASTs
+
+    cache_dir: str
+        directory of the pipeline cache (default: project/pipeline_cache)
+
+    sigma_fac: float
+        trimming factor (see trim_grid.trim_models)
+
+    fit_kwargs: dict
+        other parameters of fit.summary_table_memory
+
+    Returns
+    -------
+    pipe: Pipeline
+        pipeline of the stages
+    """
+    project = datamodel.project
+    if cache_dir is None:
+        cache_dir = os.path.join(project, 'pipeline_cache')
+    pipe = Pipeline(cache_dir=cache_dir)
+    file_prefix = '{0}/{0}_'.format(project)
+    extra_kwargs = getattr(datamodel, 'add_spectral_properties_kwargs', None)
+    if hasattr(datamodel, 'velocity'):
+        redshift = (datamodel.velocity / const.c).decompose().value
+    else:
+        redshift = 0.
+
+    # physics model
+    iso_fname = file_prefix + 'iso.csv'
+    pipe.add_stage('iso', iso_stage,
+                   params={'project': project, 'iso_fname': iso_fname,
+                           'oiso': datamodel.oiso,
+                           'logtmin': datamodel.logt[0],
+                           'logtmax': datamodel.logt[1],
+                           'dlogt': datamodel.logt[2], 'z': datamodel.z},
+                   outputs=[iso_fname])
+    spec_fname = file_prefix + 'spec_grid.hd5'
+    pipe.add_stage('spec', spectral_grid_stage,
+                   params={'project': project, 'iso_fname': iso_fname,
+                           'spec_fname': spec_fname, 'osl': datamodel.osl,
+                           'redshift': redshift,
+                           'distance': datamodel.distances,
+                           'distance_unit': datamodel.distance_unit,
+                           'extra_kwargs': extra_kwargs},
+                   outputs=[spec_fname], depends=['iso'])
+    priors_fname = file_prefix + 'spec_w_priors.grid.hd5'
+    pipe.add_stage('priors', priors_stage,
+                   params={'project': project, 'spec_fname': spec_fname,
+                           'priors_fname': priors_fname},
+                   outputs=[priors_fname], depends=['spec'])
+
+    subs = range(nsubs)
+    sub_suffixes = ['' if nsubs == 1 else '_sub{0}'.format(i) for i in subs]
+    sub_priors = [_subgrid_fname(priors_fname, i, nsubs) for i in subs]
+    prior_stage = 'priors'
+    if nsubs > 1:
+        prior_stage = pipe.add_stage(
+            'split', split_stage,
+            params={'priors_fname': priors_fname, 'nsubs': nsubs},
+            outputs=sub_priors, depends=['priors'])
+
+    seds_fname = file_prefix + 'seds.grid.hd5'
+    sub_seds = [_subgrid_fname(seds_fname, i, nsubs) for i in subs]
+    seds_stages = []
+    for i in subs:
+        seds_stages.append(pipe.add_stage(
+            'seds' + sub_suffixes[i], seds_stage,
+            params={'project': project, 'priors_fname': sub_priors[i],
+                    'seds_fname': sub_seds[i],
+                    'filters': datamodel.filters,
+                    'extLaw': datamodel.extLaw, 'av': datamodel.avs,
+                    'rv': datamodel.rvs, 'fA': datamodel.fAs,
+                    'av_prior_model': datamodel.av_prior_model,
+                    'rv_prior_model': datamodel.rv_prior_model,
+                    'fA_prior_model': datamodel.fA_prior_model,
+                    'extra_kwargs': extra_kwargs},
+            outputs=[sub_seds[i]], depends=[prior_stage]))
+
+    # models of the ASTs (full grid)
+    if ast:
+        full_seds_stage = seds_stages[0]
+        if nsubs > 1:
+            full_seds_stage = pipe.add_stage(
+                'merge_seds', merge_seds_stage,
+                params={'seds_fname': seds_fname, 'sub_fnames': sub_seds},
+                outputs=[seds_fname], depends=seds_stages)
+        ast_fname = file_prefix + 'inputAST.txt'
+        ast_params_fname = file_prefix + 'ASTparams.fits'
+        pipe.add_stage('ast_input', ast_input_stage,
+                       params={'seds_fname': seds_fname,
+                               'filters': datamodel.filters,
+                               'mag_cuts': datamodel.ast_maglimit,
+                               'Nfilter': datamodel.ast_bands_above_maglimit,
+                               'N_stars':
+                               datamodel.ast_models_selected_per_age,
+                               'Nrealize':
+                               datamodel.ast_realization_per_model,
+                               'outfile': ast_fname,
+                               'outfile_params': ast_params_fname,
+                               'obsfile': datamodel.obsfile,
+                               'get_obscat': datamodel.get_obscat},
+                       outputs=[ast_fname, ast_params_fname],
+                       depends=[full_seds_stage],
+                       input_files=[datamodel.obsfile])
+
+    # noise model, trimming and fitting per source density bin and subgrid
+    if fit_kwargs is None:
+        fit_kwargs = {'threshold': -10., 'save_every_npts': 100,
+                      'lnp_npts': 60}
+    if nsubs > 1:
+        fit_kwargs = dict(fit_kwargs, do_not_normalize=True)
+    noisefile = datamodel.noisefile
+    if nsubs > 1:
+        noisefile = seds_fname.replace('seds', 'noisemodel')
+    for dens_bin in (dens_bins or [None]):
+        bin_suffix = '' if dens_bin is None else '_bin{0}'.format(dens_bin)
+        obsfile = _bin_catalog(datamodel.obsfile, dens_bin)
+        astfile = _bin_catalog(datamodel.astfile, dens_bin)
+
+        trim_stages = []
+        sed_trimnames = []
+        noise_trimnames = []
+        for i in subs:
+            suffix = bin_suffix + sub_suffixes[i]
+            sub_noise = _bin_fname(_subgrid_fname(noisefile, i, nsubs),
+                                   dens_bin)
+            noise_stage = pipe.add_stage(
+                'noisemodel' + suffix, noisemodel_stage,
+                params={'seds_fname': sub_seds[i], 'noisefile': sub_noise,
+                        'astfile': astfile,
+                        'absflux_a_matrix': datamodel.absflux_a_matrix},
+                outputs=[sub_noise], depends=[seds_stages[i]],
+                input_files=[astfile])
+
+            sed_trimname = _bin_fname(
+                sub_seds[i].replace('_seds', '_seds_trim'), dens_bin)
+            noise_trimname = sed_trimname.replace('_seds', '_noisemodel')
+            trim_stages.append(pipe.add_stage(
+                'trim' + suffix, trim_stage,
+                params={'seds_fname': sub_seds[i], 'noisefile': sub_noise,
+                        'obsfile': obsfile, 'filters': datamodel.filters,
+                        'get_obscat': datamodel.get_obscat,
+                        'sed_trimname': sed_trimname,
+                        'noisemodel_trimname': noise_trimname,
+                        'sigma_fac': sigma_fac},
+                outputs=[sed_trimname, noise_trimname],
+                depends=[seds_stages[i], noise_stage],
+                input_files=[obsfile]))
+            sed_trimnames.append(sed_trimname)
+            noise_trimnames.append(noise_trimname)
+
+        grid_info_fname = None
+        info_stages = []
+        if nsubs > 1:
+            grid_info_fname = _bin_fname(file_prefix + 'grid_info_dict.pkl',
+                                         dens_bin)
+            info_stages = [pipe.add_stage(
+                'grid_info' + bin_suffix, grid_info_stage,
+                params={'sed_trimnames': sed_trimnames,
+                        'noisemodel_trimnames': noise_trimnames,
+                        'grid_info_fname': grid_info_fname},
+                outputs=[grid_info_fname], depends=trim_stages)]
+
+        fit_stages = []
+        stats_fnames = []
+        pdf1d_fnames = []
+        for i in subs:
+            if nsubs == 1:
+                stats_fname = _bin_fname(file_prefix + 'stats.fits',
+                                         dens_bin)
+            else:
+                stats_fname = _bin_fname(
+                    sub_seds[i].replace('seds', 'stats').replace(
+                        '.hd5', '.fits'), dens_bin)
+            pdf1d_fname = stats_fname.replace('stats', 'pdf1d')
+            lnp_fname = stats_fname.replace('stats', 'lnp').replace(
+                '.fits', '.hd5')
+            fit_stages.append(pipe.add_stage(
+                'fit' + bin_suffix + sub_suffixes[i], fit_stage,
+                params={'sed_trimname': sed_trimnames[i],
+                        'noisemodel_trimname': noise_trimnames[i],
+                        'obsfile': obsfile, 'filters': datamodel.filters,
+                        'get_obscat': datamodel.get_obscat,
+                        'stats_fname': stats_fname,
+                        'pdf1d_fname': pdf1d_fname,
+                        'lnp_fname': lnp_fname,
+                        'grid_info_fname': grid_info_fname,
+                        'fit_kwargs': fit_kwargs},
+                outputs=[stats_fname, pdf1d_fname, lnp_fname],
+                depends=[trim_stages[i]] + info_stages,
+                input_files=[obsfile]))
+            stats_fnames.append(stats_fname)
+            pdf1d_fnames.append(pdf1d_fname)
+
+        if nsubs > 1:
+            output_fname_base = _bin_fname(os.path.join(project, 'combined'),
+                                           dens_bin)
+            pipe.add_stage(
+                'merge' + bin_suffix, merge_stage,
+                params={'pdf1d_fnames': pdf1d_fnames,
+                        'stats_fnames': stats_fnames,
+                        'output_fname_base': output_fname_base},
+                outputs=[output_fname_base + '_pdf1d.fits',
+                         output_fname_base + '_stats.fits'],
+                depends=fit_stages)
+
+    return pipe
+
+
+if __name__ == '__main__':
+    # commandline parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument('datamodel', nargs='?', default='datamodel.py',
+                        help='datamodel file')
+    parser.add_argument('--nsubs', type=int, default=1,
+                        help='number of subgrids')
+    parser.add_argument('--dens_bins', type=int, nargs='*', default=None,
+                        help='source density bins to process separately')
+    parser.add_argument('--no_ast', action='store_true',
+                        help='do not pick the models of the ASTs')
+    parser.add_argument('-n', '--nprocs', type=int, default=1,
+                        help='number of processes running stages')
+    parser.add_argument('--stages', nargs='*', default=None,
+                        help='''names (or start of the names, e.g., fit) of
+                        the stages to run with the stages they depend on''')
+    parser.add_argument('--force', nargs='*', default=[],
+                        help='''names (or start of the names) of the
+                        stages to run even if cached''')
+    parser.add_argument('--status', action='store_true',
+                        help='only print the stages to run')
+    args = parser.parse_args()
+
+    # load the datamodel as an importable module (for parallel processes)
+    spec = importlib.util.spec_from_file_location('datamodel',
+                                                  args.datamodel)
+    datamodel = importlib.util.module_from_spec(spec)
+    sys.modules['datamodel'] = datamodel
+    spec.loader.exec_module(datamodel)
+
+    pipe = make_beast_pipeline(datamodel, nsubs=args.nsubs,
+                               dens_bins=args.dens_bins,
+                               ast=not args.no_ast)
+
+    def match(prefixes):
+        if prefixes is None:
+            return None
+        return [name for name in pipe.stages
+                if any(name.startswith(prefix) for prefix in prefixes)]
+
+    stages = match(args.stages)
+    force = match(args.force)
+    if args.status:
+        for name, status in pipe.status(force=force, stages=stages).items():
+            print('{0}: {1}'.format(name, status))
+    else:
+        pipe.run(nprocs=args.nprocs, force=force, stages=stages)
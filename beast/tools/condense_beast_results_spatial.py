@@ -9,6 +9,7 @@
 import os
 import glob
 import math
+from multiprocessing import Pool
 
 import h5py
 from tqdm import trange, tqdm
@@ -20,7 +21,7 @@ from astropy.io import fits
 from astropy.table import Table, Column, vstack
 
 
-def condense_files(bricknum=None, filedir=None):
+def condense_files(bricknum=None, filedir=None, nprocs=1):
     """
     Condense multiple files for each spatial region into the minimal set.  Each
     spatial region will have files containing the stats, pdf1d, and lnp results
@@ -33,6 +34,10 @@ def condense_files(bricknum=None, filedir=None):
 
     filedir : string
         Directory to put condensed results
+
+    nprocs : int
+        Number of processes to use to condense the spatial regions
+        in parallel (default=1)
     """
 
     if bricknum is not None:
@@ -51,30 +56,66 @@ def condense_files(bricknum=None, filedir=None):
     #    each directory is a different pixel
     pix_dirs = sorted(glob.glob(out_dir + '/*/'))
 
-    # loop over each subdirectory and condense the files as appropriate
-    for cur_dir in tqdm(pix_dirs, desc='spatial regions'):
+    # condense the files of each subdirectory as appropriate
+    args = [(cur_dir, out_dir) for cur_dir in pix_dirs]
+    if nprocs > 1:
+        p = Pool(nprocs)
+        for _ in tqdm(p.imap_unordered(_condense_region, args),
+                      total=len(args), desc='spatial regions'):
+            pass
+        p.close()
+        p.join()
+    else:
+        for cur_args in tqdm(args, desc='spatial regions'):
+            _condense_region(cur_args)
 
-        # get the base name
-        spos = cur_dir.rfind('/',0,len(cur_dir)-1)
-        bname = cur_dir[spos+1:-1]
 
-        # process that catalog (stats) files
-        n_sources = condense_stats_files(bname, cur_dir, out_dir)
+def _condense_region(args):
+    """
+    Condense the files for one spatial region
 
-        # process the pdf1d files
-        condense_pdf1d_files(bname, cur_dir, out_dir, n_sources)
+    Parameters
+    ----------
+    args : tuple
+        (cur_dir, out_dir) directory with the region files and
+        output directory
+    """
+    cur_dir, out_dir = args
 
-        # process the nD lnp files
-        condense_lnp_files(bname, cur_dir, out_dir)
+    # get the base name
+    spos = cur_dir.rfind('/',0,len(cur_dir)-1)
+    bname = cur_dir[spos+1:-1]
 
+    # get all the stats files
+    #   the pdf1d and lnp files are processed in the same order so
+    #   the stars are in the same order in all the condensed files
+    stats_files = sorted(glob.glob(cur_dir + '*_stats.fits'))
+
+    # process that catalog (stats) files
+    n_sources = condense_stats_files(bname, cur_dir, out_dir,
+                                     stats_files=stats_files)
+
+    # process the pdf1d files
+    n_stars = condense_pdf1d_files(
+        bname, cur_dir, out_dir, n_sources,
+        pdf1d_files=[f.replace('_stats.fits', '_pdf1d.fits')
+                     for f in stats_files])
+
+    # process the nD lnp files
+    condense_lnp_files(bname, cur_dir, out_dir,
+                       lnp_files=[f.replace('_stats.fits', '_lnp.hd5')
+                                  for f in stats_files],
+                       n_stars=n_stars)
 
 
 def condense_stats_files(bname,
                          cur_dir,
-                         out_dir):
+                         out_dir,
+                         stats_files=None):
 
     # get all the stats files
-    stats_files = glob.glob(cur_dir + '*_stats.fits')
+    if stats_files is None:
+        stats_files = sorted(glob.glob(cur_dir + '*_stats.fits'))
 
     # loop through the stats files, building up the output table
     cats_list = []
@@ -93,7 +134,7 @@ def condense_stats_files(bname,
             
         # add the reorder tag to each entry in the current catalog
         n_entries = len(cur_cat)
-        cur_cat.add_column(Column([reorder_tag] * n_entries,
+        cur_cat.add_column(Column(np.full(n_entries, reorder_tag),
                                   name='reorder_tag'))
 
         # append to list
@@ -111,59 +152,50 @@ def condense_stats_files(bname,
 def condense_pdf1d_files(bname,
                          cur_dir,
                          out_dir,
-                         n_sources):
-
-    # useful default for the "failure" case of all negative values and log spacing requested
-    n_bins_default = 50 
+                         n_sources,
+                         pdf1d_files=None):
 
     # get all the files
-    pdf1d_files = sorted(glob.glob(cur_dir + '*_pdf1d.fits'))
+    if pdf1d_files is None:
+        pdf1d_files = sorted(glob.glob(cur_dir + '*_pdf1d.fits'))
 
-    # loop over the pdf1d files, accumulating the 1d pdfs and bins
+    # get the names and sizes of the 1d pdfs from the headers
+    #   (last row of each image gives the bin values)
     with fits.open(pdf1d_files[0]) as hdu:
         cond_pdf1d_name = [hdu[i].header['EXTNAME'] for i in range(1,len(hdu))]
     n_qnames = len(cond_pdf1d_name)
-    pdf1d_vals = [[] for i in range(n_qnames)]
-    pdf1d_bins = [[] for i in range(n_qnames)]
-
-    
-    for i,cur_pdf1d in enumerate(pdf1d_files):
 
-        hdulist = fits.open(cur_pdf1d)
-        
-        for k in range(n_qnames):
-            pdf1d_histo = hdulist[k+1].data
-            n_cur_source, n_bins = pdf1d_histo.shape
-            n_cur_source -= 1
- 
-            # copy the 1D PDFs
-            pdf1d_vals[k].append(pdf1d_histo[0:n_cur_source, :])
-            # copy the bin values
-            pdf1d_bins[k].append(pdf1d_histo[-1, :])
+    n_stars = np.zeros(len(pdf1d_files), dtype=int)
+    n_bins = np.zeros((len(pdf1d_files), n_qnames), dtype=int)
+    for i, cur_pdf1d in enumerate(pdf1d_files):
+        with fits.open(cur_pdf1d) as hdulist:
+            n_stars[i] = hdulist[1].header['NAXIS2'] - 1
+            for k in range(n_qnames):
+                n_bins[i, k] = hdulist[k+1].header['NAXIS1']
 
+    tot_stars = n_stars.sum()
+    star_offsets = np.concatenate([[0], np.cumsum(n_stars)])
 
     # condense the info into arrays with dimensions [n_stars, max(n_bins), 2]
+    #   initialized with NaNs to pad the 1d pdfs with fewer bins
+    cond_data = [np.full((tot_stars, n_bins[:, k].max(), 2), np.nan)
+                 for k in range(n_qnames)]
+
+    # copy the 1d pdfs and bin values of each file as blocks
+    for i, cur_pdf1d in enumerate(pdf1d_files):
+        s1 = star_offsets[i]
+        s2 = star_offsets[i+1]
+        with fits.open(cur_pdf1d) as hdulist:
+            for k in range(n_qnames):
+                pdf1d_histo = hdulist[k+1].data
+                n_bin = n_bins[i, k]
+                cond_data[k][s1:s2, 0:n_bin, 0] = pdf1d_histo[:-1, :]
+                cond_data[k][s1:s2, 0:n_bin, 1] = pdf1d_histo[-1, :]
 
-    tot_stars = np.sum(np.array( [i.shape[0] for i in pdf1d_vals[0]] ))
-            
     hdulist = fits.HDUList([fits.PrimaryHDU()])
 
     for k, qname in enumerate(cond_pdf1d_name):
-
-        max_bin_length = np.max([len(pdf1d_bins[k][i]) for i in range(len(pdf1d_bins[k]))])
-
-        # initialize array with NaNs
-        cond_data = np.zeros((tot_stars, max_bin_length, 2)) + np.nan
-        # fill in the array
-        curr_star = 0
-        for i in range(len(pdf1d_bins[k])):
-            n_bin = len(pdf1d_bins[k][i])
-            n_star = pdf1d_vals[k][i].shape[0]
-            cond_data[curr_star:curr_star+n_star, 0:n_bin, 0] = pdf1d_vals[k][i]
-            cond_data[curr_star:curr_star+n_star, 0:n_bin, 1] = pdf1d_bins[k][i]
-            curr_star += n_star
-        
-        chdu = fits.PrimaryHDU(cond_data)
+        chdu = fits.PrimaryHDU(cond_data[k])
         chdu.header.set('XTENSION','IMAGE') 
         chdu.header.set('EXTNAME',qname) 
         
@@ -172,12 +204,27 @@ def condense_pdf1d_files(bname,
     # write the 1D PDFs
     hdulist.writeto(out_dir+'/'+bname+'_pdf1d.fits', overwrite=True)
 
+    # return the number of stars in each file for the lnp offsets
+    return n_stars
+
 def condense_lnp_files(bname,
                        cur_dir,
-                       out_dir):
+                       out_dir,
+                       lnp_files=None,
+                       n_stars=None):
 
     # get all the files
-    lnp_files = glob.glob(cur_dir + '*_lnp.hd5')
+    if lnp_files is None:
+        lnp_files = sorted(glob.glob(cur_dir + '*_lnp.hd5'))
+
+    # number of stars in each file from the matching pdf1d files
+    #   (the last stars of a file may not have an lnp group)
+    if n_stars is None:
+        n_stars = np.zeros(len(lnp_files), dtype=int)
+        for i, cur_lnp in enumerate(lnp_files):
+            with fits.open(cur_lnp.replace('_lnp.hd5',
+                                           '_pdf1d.fits')) as hdulist:
+                n_stars[i] = hdulist[1].header['NAXIS2'] - 1
 
     # open the condensed hd5 file for writing
     #   remove it if it already exisits (h5py does not overwrite)
@@ -187,22 +234,27 @@ def condense_lnp_files(bname,
     except OSError:
         pass
 
-    cond_lnp_file = h5py.File(clfile)
+    cond_lnp_file = h5py.File(clfile, 'w')
 
     # loop over the small lnp files and copy to main lnp file
-    k = 0
-    for cur_lnp in lnp_files:
-        cur_lnpfile = h5py.File(cur_lnp, 'r')
-        
-        # loop over all the stars (groups)
-        for sname in cur_lnpfile.keys():
-            star_group = cond_lnp_file.create_group('star_%d' % k)
-            for cp_name, cp_value in cur_lnpfile[sname].items():
-                star_group.create_dataset(cp_name,data=cp_value.value)
-
-            k += 1
-
-        cur_lnpfile.close()
+    #   the star numbers are offset by the number of stars in the
+    #   previous files (numerical, not alphabetical, order of the groups)
+    #   and the groups are copied whole inside HDF5 (the data are not
+    #   read into memory, the renumbering needs one copy per group)
+    k_offset = 0
+    for cur_lnp, cur_n_stars in zip(lnp_files, n_stars):
+        with h5py.File(cur_lnp, 'r') as cur_lnpfile:
+            star_nums = np.array([int(sname[5:])
+                                  for sname in cur_lnpfile.keys()
+                                  if sname.startswith('star_')], dtype=int)
+            star_nums.sort()
+
+            for snum in star_nums:
+                cur_lnpfile.copy(cur_lnpfile['star_%d' % snum],
+                                 cond_lnp_file,
+                                 name='star_%d' % (k_offset + snum))
+
+        k_offset += cur_n_stars
 
     cond_lnp_file.close()
 
@@ -215,7 +267,10 @@ if __name__ == '__main__':
                         " (supersedes other input)")
     parser.add_argument("-d","--filedir", default=None,
                         help="Directory to condense results")
+    parser.add_argument("-n","--nprocs", default=1, type=int,
+                        help="Number of processes to use")
     args = parser.parse_args()
 
 
-    condense_files(bricknum=args.bricknum, filedir=args.filedir)
+    condense_files(bricknum=args.bricknum, filedir=args.filedir,
+                   nprocs=args.nprocs)
@@ -20,7 +20,7 @@ from matplotlib.patches import Polygon
 from matplotlib.collections import PatchCollection
 import numpy as np
 import photutils as pu
-from density_map import DensityMap
+from beast.tools.density_map import DensityMap
 import itertools as it
 import os
 
@@ -55,6 +55,8 @@ def main():
     # arguments unique to background map
     background_parser.add_argument('-reference', type=str,  metavar='FITSIMAGE', required=True,
                                    help='reference image (FITS)')
+    background_parser.add_argument('--no_masked_image', action='store_true',
+                                   help='do not write the masked reference image')
 
     # arguments unique to sourceden map
     sourceden_parser.add_argument('--mag_cut', type=float, nargs=2,
@@ -118,17 +120,21 @@ def main_make_map(args):
         image = hdul['SCI']
         map_values_array, n_map = make_background_map(cat, ra_grid, dec_grid,
                                                       ref_im=image,
-                                                      output_base=output_base)
+                                                      output_base=output_base,
+                                                      save_masked_image=not args.no_masked_image)
 
     # Save a file describing the properties of the bins in a handy format
+    #   (one row per tile, in the order of xyrange)
+    x, y = np.meshgrid(np.arange(n_x), np.arange(n_y), indexing='ij')
+    x = x.ravel()
+    y = y.ravel()
     bin_details = astropy.table.Table(
+        [x.astype(float), y.astype(float), map_values_array[x, y],
+         ra_grid[x], ra_grid[x + 1],
+         dec_grid[y], dec_grid[y + 1]],
         names=['i_ra', 'i_dec', 'value',
                'min_ra', 'max_ra',
                'min_dec', 'max_dec'])
-    for x, y in xyrange(n_x, n_y):
-        bin_details.add_row([x, y, map_values_array[x, y],
-                             ra_grid[x], ra_grid[x + 1],
-                             dec_grid[y], dec_grid[y + 1]])
 
     # Add the ra and dec grids as metadata
     bin_details.meta['ra_grid'] = ra_grid
@@ -165,7 +171,8 @@ def main_plot(args):
                       dpi=args.dpi)
 
 
-def make_background_map(cat, ra_grid, dec_grid, ref_im, output_base):
+def make_background_map(cat, ra_grid, dec_grid, ref_im, output_base,
+                        save_masked_image=True):
     """
     Divide the image into a number of bins, and calculate the median
     background for the stars that fall within each bin. Create a new
@@ -193,6 +200,10 @@ def make_background_map(cat, ra_grid, dec_grid, ref_im, output_base):
     output_base: string
         base name (without extension) to be used for the output files
 
+    save_masked_image: bool
+        set to write the reference image with the sources masked (see
+        measure_backgrounds)
+
     Returns
     -------
     results: background_map, nsources_map: 2d ndarray, 2d ndarray
@@ -200,7 +211,8 @@ def make_background_map(cat, ra_grid, dec_grid, ref_im, output_base):
     """
     # A list of background values for each source of the catalog will be
     # built up. Mask used is also returned.
-    individual_backgrounds = measure_backgrounds(cat, ref_im)
+    individual_backgrounds = measure_backgrounds(
+        cat, ref_im, save_masked_image=save_masked_image)
 
     w = make_wcs_for_map(ra_grid, dec_grid)
     pix_x, pix_y = get_pix_coords(cat, w)
@@ -211,17 +223,23 @@ def make_background_map(cat, ra_grid, dec_grid, ref_im, output_base):
     background_map = np.zeros((n_x, n_y))
     nsources_map = np.zeros((n_x, n_y))
     median_backgrounds = np.zeros((len(cat),))
-    for x, y in xyrange(n_x, n_y):
-        idxs = indices_for_pixel(pix_x, pix_y, x, y)
-        n = len(idxs)
-        nsources_map[x, y] = n
-        if n:
-            background_map[x, y] = np.median(individual_backgrounds[idxs])
+
+    # group the sources by pixel (sorted by pixel index)
+    pix_indxs = pixel_indices(pix_x, pix_y, n_x, n_y)
+    inside, = np.where(pix_indxs >= 0)
+    order = inside[np.argsort(pix_indxs[inside], kind='mergesort')]
+    pixels, starts, counts = np.unique(pix_indxs[order], return_index=True,
+                                       return_counts=True)
+    nsources_map.ravel()[pixels] = counts
+    for pixel, start, n in zip(pixels, starts, counts):
+        x, y = divmod(pixel, n_y)
+        idxs = order[start:start + n]
+        background_map[x, y] = np.median(individual_backgrounds[idxs])
         if n == 1:
             print('Only 1 source in bin {},{}'.format(x, y))
 
-        # store the median background for each source
-        median_backgrounds[idxs] = background_map[x, y]
+    # store the median background for each source
+    median_backgrounds[inside] = background_map.ravel()[pix_indxs[inside]]
 
     background_map[nsources_map == 0] = 0
 
@@ -240,7 +258,7 @@ def make_background_map(cat, ra_grid, dec_grid, ref_im, output_base):
     return background_map, nsources_map
 
 
-def measure_backgrounds(cat_table, ref_im):
+def measure_backgrounds(cat_table, ref_im, save_masked_image=True):
     """
     Measure the background for all the sources in cat_table, using
     ref_im.
@@ -254,6 +272,10 @@ def measure_backgrounds(cat_table, ref_im):
     ref_im: imageHDU
         fits image which will be used to estimate the background
 
+    save_masked_image: bool
+        set to write the reference image with the sources masked to
+        masked_reference_image.fits
+
     Returns
     -------
 
@@ -283,62 +305,80 @@ def measure_backgrounds(cat_table, ref_im):
 
     # A mask to make sure that no sources end up in the background
     # calculation
-    circles = pu.SkyCircularAperture(c, mask_rad)
-    source_masks = circles.to_pixel(w).to_mask()
-    mask_union = np.zeros(shp)
-    for i, ap_mask in enumerate(source_masks):
-        # the masks have a bounding box which we need to take into
-        # account. Here we will calculate the overlap between the mask
-        # and the image (important if the mask is near the edge, so that
-        # the box might go outside of it).
-        data_slices = list(ap_mask.bbox.slices)
-        # These slices go outside of the box sometimes! In that case we
-        # will override the slices on both sides.
-
-        # Default slices (go over the whole mask)
-        mask_slices = [slice(None, None), slice(None, None)]
-
-        # Adjust the slices in each dimension
-        for j in range(2):
-            # DATA: . . a b c d e f
-            # index - - 0 1 2 3 4 5
-            # ---------------
-            # MASK: - + + + -
-            # index 0 1 2 3 4
-            # --> DATA_SLICE [0:stop]
-            # --> MASK_SLICE [2:]
-            data_start = data_slices[j].start
-            if data_start < 0:
-                # Move the start from negative n to zero
-                data_slices[j] = slice(0, data_slices[j].stop)
-                # Move the start from 0 to positive n
-                mask_slices[j] = slice(-data_start, mask_slices[j].stop)
-                # --> we slice over the part of the small mask that
-                # falls on the positive side of the axis
-
-            data_stop = data_slices[j].stop
-            if data_stop > shp[j]:
-                overflow = data_stop - shp[j]
-                # Move the stop 'overflow' to shp[j]
-                data_slices[j] = slice(data_slices[j].start, shp[j])
-                # Move the stop to 'overflow' pixels from the end
-                mask_slices[j] = slice(mask_slices[j].start, -overflow)
-                # --> slice over the part that falls below the maximum
-
-        mask_union[tuple(data_slices)] += ap_mask.data[tuple(mask_slices)]
-
-    # Threshold
-    mask_union = mask_union > 0
+    x, y = w.all_world2pix(ra, dec, 0)
+    mask_union = source_mask(x, y, mask_rad.value, shp)
 
     # Save the masked reference image
-    hdu = fits.PrimaryHDU(np.where(mask_union, 0, ref_im.data), header=ref_im.header)
-    hdu.writeto('masked_reference_image.fits', overwrite=True)
+    if save_masked_image:
+        hdu = fits.PrimaryHDU(np.where(mask_union, 0, ref_im.data),
+                              header=ref_im.header)
+        hdu.writeto('masked_reference_image.fits', overwrite=True)
 
     # Do the measurements
     phot = pu.aperture_photometry(ref_im.data, annuli, wcs=w, mask=mask_union)
     return phot['aperture_sum'] / area
 
 
+def source_mask(x, y, radius, shape):
+    """
+    Union of the disks around the sources: a pixel is masked if it
+    overlaps the disk of any source (same as thresholding the sum of the
+    exact aperture masks at zero).
+
+    The disks are rasterized all at once as one run of pixels per image
+    row and source, accumulated in a difference image (+1 at the start
+    and -1 after the end of each run) which is then summed along the
+    rows.
+
+    Parameters
+    ----------
+    x, y: 1D array-like of float
+        pixel coordinates of the sources (0-based, pixel centers at
+        integer coordinates)
+
+    radius: float
+        radius of the disks in pixels
+
+    shape: tuple of int
+        shape of the image (rows, columns)
+
+    Returns
+    -------
+    mask: 2D ndarray of bool
+    """
+    n_rows, n_cols = shape
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    good = np.isfinite(x) & np.isfinite(y)
+    # sources in row order (faster accumulation)
+    order = np.lexsort((x[good], np.round(y[good])))
+    x = x[good][order]
+    y = y[good][order]
+
+    diff = np.zeros(n_rows * (n_cols + 1), dtype=np.int32)
+    center_rows = np.round(y).astype(int)
+    n_half = int(np.ceil(radius)) + 1
+    for k in range(-n_half, n_half + 1):
+        rows = center_rows + k
+        # distance of the row to the center, and the half width of the
+        # disk in this row (pixels overlapping the disk)
+        gap = np.maximum(np.abs(rows - y) - 0.5, 0.0)
+        in_row, = np.where((gap < radius) & (rows >= 0) & (rows < n_rows))
+        half = np.sqrt(radius ** 2 - gap[in_row] ** 2) + 0.5
+        starts = np.clip(np.floor(x[in_row] - half).astype(int) + 1,
+                         0, n_cols)
+        stops = np.clip(np.ceil(x[in_row] + half).astype(int), 0, n_cols)
+
+        row_offsets = rows[in_row] * (n_cols + 1)
+        for edges, sign in [(row_offsets + starts, 1),
+                            (row_offsets + stops, -1)]:
+            edges, counts = np.unique(edges, return_counts=True)
+            diff[edges] += sign * counts.astype(np.int32)
+
+    diff = diff.reshape(n_rows, n_cols + 1)
+    return np.cumsum(diff, axis=1, dtype=np.int32)[:, :n_cols] > 0
+
+
 def make_source_dens_map(cat,
                          ra_grid, dec_grid,
                          output_base,
@@ -375,73 +415,57 @@ def make_source_dens_map(cat,
     rate_cols = [s for s in cat.colnames if s[-4:] == 'RATE']
     n_filters = len(rate_cols)
 
-    # create the indexs where any of the rates are zero and non-zero
+    # flag the sources where any of the rates are zero
     #   zero = missing data, etc. -> bad for fitting
     #   non-zero = good data, etc. -> great for fitting
-    initialize_zero = False
-    band_zero_indxs = {}
+    N_stars = len(cat)
+    zero_flags = np.zeros(N_stars, dtype=bool)
+    band_zero_flags = np.zeros((N_stars, n_filters), dtype=bool)
     print('band, good, zero')
-    for cur_rate in rate_cols:
-        cur_good_indxs, = np.where(cat[cur_rate] != 0.0)
-        cur_indxs, = np.where(cat[cur_rate] == 0.0)
-        print(cur_rate, len(cur_good_indxs), len(cur_indxs))
-        if not initialize_zero:
-            initialize_zero = True
-            zero_indxs = cur_indxs
-            nonzero_indxs = cur_good_indxs
-        else:
-            zero_indxs = np.union1d(zero_indxs, cur_indxs)
-            nonzero_indxs = np.intersect1d(nonzero_indxs, cur_good_indxs)
-
-        # save the zero indexs for each band
-        band_zero_indxs[cur_rate] = zero_indxs
-
-    print('all bands', len(nonzero_indxs), len(zero_indxs))
+    for k, cur_rate in enumerate(rate_cols):
+        band_zero_flags[:, k] = (cat[cur_rate] == 0.0)
+        zero_flags |= band_zero_flags[:, k]
+        n_zero = np.count_nonzero(band_zero_flags[:, k])
+        print(cur_rate, N_stars - n_zero, n_zero)
+    nonzero_indxs, = np.where(~zero_flags)
 
-    N_stars = len(cat)
+    print('all bands', len(nonzero_indxs), N_stars - len(nonzero_indxs))
 
     w = make_wcs_for_map(ra_grid, dec_grid)
     pix_x, pix_y = get_pix_coords(cat, w)
 
     n_x = len(ra_grid) - 1
     n_y = len(dec_grid) - 1
-    npts_map = np.zeros([n_x, n_y], dtype=float)
-    npts_zero_map = np.zeros([n_x, n_y], dtype=float)
-    npts_band_zero_map = np.zeros([n_x, n_y, n_filters], dtype=float)
-    source_dens = np.zeros(N_stars, dtype=float)
+    n_pix = n_x * n_y
 
     # area of one pixel in square degrees
     pix_area = w.wcs.cdelt[0] * w.wcs.cdelt[1] * 3600 ** 2
 
-    for i, j in xyrange(n_x, n_y):
-        indxs = indices_for_pixel(pix_x, pix_y, i, j)
-        indxs_for_SD, = np.where(np.logical_and(cat[mag_name][indxs] >= mag_cut[0],
-                                                   cat[mag_name][indxs] <= mag_cut[1]))
-        n_indxs = len(indxs_for_SD)
-        if n_indxs > 0:
-            npts_map[i, j] = n_indxs / pix_area
-
-            # now make a map of the sources with zero fluxes in
-            #   at least one band
-            zindxs, = np.where((pix_x[zero_indxs] > i)
-                               & (pix_x[zero_indxs] <= i+1)
-                               & (pix_y[zero_indxs] > j)
-                               & (pix_y[zero_indxs] <= j+1))
-            if len(zindxs) > 0:
-                npts_zero_map[i, j] = len(zindxs)
-
-            # do the same for each band
-            for k, cur_rate in enumerate(rate_cols):
-                tindxs = band_zero_indxs[cur_rate]
-                zindxs, = np.where((pix_x[tindxs] > i)
-                                   & (pix_x[tindxs] <= i+1)
-                                   & (pix_y[tindxs] > j)
-                                   & (pix_y[tindxs] <= j+1))
-                if len(zindxs) > 0:
-                    npts_band_zero_map[i, j, k] = len(zindxs)
-
-        # save the source density as an entry for each source
-        source_dens[indxs_for_SD] = npts_map[i, j]
+    # pixel of each source (a single pass over the catalog), the maps
+    #   are then histograms of the pixel indices
+    pix_indxs = pixel_indices(pix_x, pix_y, n_x, n_y)
+    inside = pix_indxs >= 0
+    mags = np.asarray(cat[mag_name])
+    for_SD = inside & (mags >= mag_cut[0]) & (mags <= mag_cut[1])
+
+    n_SD = np.bincount(pix_indxs[for_SD], minlength=n_pix)
+    npts_map = (n_SD / pix_area).reshape(n_x, n_y)
+
+    # maps of the sources with zero fluxes in at least one band and in
+    #   each band (only for the pixels with sources for the density)
+    has_SD = (n_SD > 0).reshape(n_x, n_y)
+    npts_zero_map = np.bincount(pix_indxs[inside & zero_flags],
+                                minlength=n_pix).reshape(n_x, n_y)
+    npts_zero_map = np.where(has_SD, npts_zero_map, 0).astype(float)
+    npts_band_zero_map = np.zeros([n_x, n_y, n_filters], dtype=float)
+    for k in range(n_filters):
+        band_map = np.bincount(pix_indxs[inside & band_zero_flags[:, k]],
+                               minlength=n_pix).reshape(n_x, n_y)
+        npts_band_zero_map[:, :, k] = np.where(has_SD, band_map, 0)
+
+    # save the source density of its pixel as an entry for each source
+    source_dens = np.zeros(N_stars, dtype=float)
+    source_dens[inside] = npts_map.ravel()[pix_indxs[inside]]
 
     save_map_fits(npts_map, w, output_base + '_source_den_image.fits')
     save_map_fits(npts_zero_map, w, output_base + '_npts_zero_fluxes_image.fits')
@@ -545,6 +569,22 @@ def xyrange(n_x, n_y):
     return it.product(range(n_x), range(n_y))
 
 
+def pixel_indices(pix_x, pix_y, n_x, n_y):
+    """
+    Return the index of the pixel of each source in the flattened
+    (n_x, n_y) map (x * n_y + y, or -1 for the sources outside of the
+    map). A source is in the x, y pixel if x < pix_x <= x + 1 and
+    y < pix_y <= y + 1 (see indices_for_pixel).
+    """
+    good = np.isfinite(pix_x) & np.isfinite(pix_y)
+    x = np.full(len(pix_x), -1, dtype=np.int64)
+    y = np.full(len(pix_y), -1, dtype=np.int64)
+    x[good] = np.ceil(pix_x[good]) - 1
+    y[good] = np.ceil(pix_y[good]) - 1
+    inside = (x >= 0) & (x < n_x) & (y >= 0) & (y < n_y)
+    return np.where(inside, x * n_y + y, -1)
+
+
 def indices_for_pixel(pix_x, pix_y, x, y):
     """
     Return the indices of the sources for which the coordinates lie in
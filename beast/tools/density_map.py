@@ -43,16 +43,20 @@ class DensityMap:
         self.ra_grid = self.tile_data.meta['ra_grid']
         self.dec_grid = self.tile_data.meta['dec_grid']
 
-        self.min_i_ra = min(self.tile_data['i_ra'])
-        self.max_i_ra = max(self.tile_data['i_ra'])
-        self.min_i_dec = min(self.tile_data['i_dec'])
-        self.max_i_dec = max(self.tile_data['i_dec'])
-
-        # map index pairs to table rows
-        self.tile_for_ij = {}
-        for r in range(len(self.tile_data)):
-            ij_ra_dec = (self.tile_data[r]['i_ra'], self.tile_data[r]['i_dec'])
-            self.tile_for_ij[ij_ra_dec] = r
+        i_ras = np.asarray(self.tile_data['i_ra']).astype(int)
+        i_decs = np.asarray(self.tile_data['i_dec']).astype(int)
+        self.min_i_ra = i_ras.min()
+        self.max_i_ra = i_ras.max()
+        self.min_i_dec = i_decs.min()
+        self.max_i_dec = i_decs.max()
+
+        # map index pairs to table rows with a dense (n_ra, n_dec) array
+        #   (-1 for the index pairs without a tile)
+        self.tile_index = np.full((self.max_i_ra - self.min_i_ra + 1,
+                                   self.max_i_dec - self.min_i_dec + 1),
+                                  -1, dtype=int)
+        self.tile_index[i_ras - self.min_i_ra,
+                        i_decs - self.min_i_dec] = np.arange(len(i_ras))
 
     def write(self, fname):
         """
@@ -64,18 +68,25 @@ class DensityMap:
     def tile_for_position(self, ra, dec):
         """
         Finds which tile a certain ra,dec fits into
+
+        ra, dec: float or array-like of float
+            positions (the positions outside of the map are assigned to
+            the closest edge tile)
+
+        Returns the row index (or array of row indices) of the tile
         """
         # Get index pair
         i_ra = np.searchsorted(self.ra_grid[:-1], ra, side='right') - 1
-        i_ra = max(i_ra, self.min_i_ra)
-        i_ra = min(i_ra, self.max_i_ra)
+        i_ra = np.clip(i_ra, self.min_i_ra, self.max_i_ra)
 
         i_dec = np.searchsorted(self.dec_grid[:-1], dec, side='right') - 1
-        i_dec = max(i_dec, self.min_i_ra)
-        i_dec = min(i_dec, self.max_i_ra)
+        i_dec = np.clip(i_dec, self.min_i_dec, self.max_i_dec)
 
         # Use index pair to row index map
-        return self.tile_for_ij[(i_ra, i_dec)]
+        tiles = self.tile_index[i_ra - self.min_i_ra, i_dec - self.min_i_dec]
+        if np.any(tiles < 0):
+            raise KeyError('no tile for some of the (i_ra, i_dec) pairs')
+        return tiles
 
     def min_ras_decs(self):
         """
@@ -176,11 +187,11 @@ class BinnedDensityMap(DensityMap):
 
     def bin_for_position(self, ra, dec):
         """
-        Finds which density bin a certain ra,dec fits into, and
-        returns its index.
+        Finds which density bin a certain ra,dec (or arrays of ras and
+        decs) fits into, and returns its index.
         """
         t = self.tile_for_position(ra, dec)
-        return self.tile_data[bin_colname][t]
+        return np.asarray(self.tile_data[bin_colname])[t]
 
     def value_foreach_tile(self):
         return self.tile_data[input_column]
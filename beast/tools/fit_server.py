@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+#
+# long running local fitting service
+#
+# the model grid and noise model are loaded once and all the fitting
+#   precomputations (model fluxes with bias, noise model arrays, 1D PDF
+#   mappings, flux index/coarse grid) are kept in memory, fit requests for
+#   one or many SEDs are then answered without the startup cost of a
+#   fitting job
+#
+# requests are JSON POSTs to http://localhost:port/fit
+#   {"seds": [[flux_filter1, flux_filter2, ...], ...],
+#    "ra": [...], "dec": [...], (optional, used for the names)
+#    "pdf1d": true, (optional, to return the 1D PDFs)
+#    "stats_outname": ..., "pdf1d_outname": ..., "lnp_outname": ...
+#    (optional, to also save the results like summary_table_memory, only
+#    if the server has an output directory, the names are relative to it)}
+# the fluxes are in the units of the model grid
+#   (i.e., after the conversion from the catalog values done by the
+#   datamodel observations)
+# the answer is {"stats": {column: [values]},
+#                "pdf1d": {qname: {"bins": [...], "vals": [[...]]}}}
+# invalid requests are answered with a 400 error and failed fits with a
+#   500 error, both as {"error": message}
+# GET http://localhost:port/info gives the filters and the fitted quantities
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import json
+import os
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.request import Request, urlopen
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urllib2 import Request, urlopen
+
+import numpy as np
+
+from beast.physicsmodel.grid import FileSEDGrid
+import beast.observationmodel.noisemodel.generic_noisemodel as noisemodel
+from beast.observationmodel.observations import Observations
+from beast.fitting import fit
+
+
+class SEDObservations(Observations):
+    """
+    Observations from an array of SEDs already in the units of the model
+    grid (no catalog file)
+    """
+    def __init__(self, seds, filters, ra=None, dec=None):
+        """
+        Parameters
+        ----------
+        seds : np.ndarray[float, ndim=2]
+            fluxes (nstars, nfilters)
+
+        filters : list of str
+            filter names (same order as the model grid)
+
+        ra, dec : np.ndarray[float, ndim=1]
+            coordinates of the stars in degrees (optional)
+        """
+        self.seds = np.atleast_2d(np.asarray(seds, dtype=float))
+        if self.seds.shape[1] != len(filters):
+            raise ValueError('the SEDs must have one flux per filter ('
+                             + ', '.join(filters) + ')')
+        data = {}
+        for k, cfilter in enumerate(filters):
+            data[cfilter] = self.seds[:, k]
+        if (ra is not None) and (dec is not None):
+            data['RA'] = np.asarray(ra, dtype=float)
+            data['DEC'] = np.asarray(dec, dtype=float)
+        Observations.__init__(self, data, desc='SEDs to fit')
+        self.setFilters(filters)
+        self.vega_flux = np.ones(len(filters))
+
+    @property
+    def nObs(self):
+        return len(self.seds)
+
+    def getObs(self, num=0):
+        return self.seds[num]
+
+
+class FitService(object):
+    """
+    Model grid and noise model kept in memory with the fitting
+    precomputations to fit SEDs on demand with the same outputs as
+    beast.fitting.fit.summary_table_memory
+    """
+    def __init__(self, sedgrid, noise, keys=None, threshold=-10.,
+                 surveyname='PHAT', nthreads=1, output_dir=None, **kwargs):
+        """
+        Parameters
+        ----------
+        sedgrid : str or grid.SEDgrid instance
+            model grid (read in memory if a filename)
+
+        noise : str or beast noisemodel instance
+            noise model
+
+        keys : list of str
+            names of the quantities to fit (default is all)
+
+        threshold : float
+            sparse likelihood threshold
+
+        surveyname : str
+            survey name used for the IAU names
+
+        nthreads : int
+            number of threads to compute the likelihoods
+
+        output_dir : str
+            directory of the files saved for the requests (default is to
+            not allow requests to save files)
+
+        kwargs : dict
+            other keywords of beast.fitting.fit.setup_fit (e.g.,
+            use_full_cov_matrix, prune_models, coarse_step, use_float32)
+        """
+        if isinstance(sedgrid, str):
+            sedgrid = FileSEDGrid(sedgrid, backend='memory')
+        if isinstance(noise, str):
+            noise = noisemodel.get_noisemodelcat(noise)
+        self.g0 = sedgrid
+        self.noise = noise
+        self.threshold = threshold
+        self.surveyname = surveyname
+        self.nthreads = nthreads
+        self.output_dir = output_dir
+        if output_dir is not None:
+            self.output_dir = os.path.realpath(output_dir)
+        self.filters = list(self.g0.filters)
+
+        # same quantities as summary_table_memory
+        if keys is None:
+            keys = list(self.g0.keys())
+        skip_keys = 'osl keep weight grid_weight prior_weight fullgrid_idx stage specgrid_indx'.split()
+        keys = [k for k in keys if k not in skip_keys]
+        for key in keys:
+            if not (key in list(self.g0.keys())):
+                raise KeyError('Key "{0}" not recognized'.format(key))
+
+        self.fit_setup = fit.setup_fit(self.g0, self.noise, keys, **kwargs)
+        self.qnames = list(self.fit_setup['qnames'])
+
+    def fit(self, seds, ra=None, dec=None, stats_outname=None,
+            pdf1d_outname=None, lnp_outname=None):
+        """
+        Fit SEDs
+
+        Parameters
+        ----------
+        seds : np.ndarray[float, ndim=2]
+            fluxes (nstars, nfilters) in the units of the model grid
+
+        ra, dec : np.ndarray[float, ndim=1]
+            coordinates of the stars in degrees (optional)
+
+        stats_outname, pdf1d_outname, lnp_outname : str
+            files to also save the stats, 1D PDFs and sparse likelihoods
+
+        Returns
+        -------
+        (stats_tab, pdf1d_vals) : astropy.table.Table, list of 2D nparrays
+            the stats and the 1D PDFs of each qname (last row gives the bin
+            values)
+        """
+        obs = SEDObservations(seds, self.filters, ra=ra, dec=dec)
+        res = fit.IAU_names_and_extra_info(obs, surveyname=self.surveyname,
+                                           extraInfo=False)
+        return fit.Q_all_memory(res, obs, self.g0, self.noise,
+                                list(self.qnames), p=[16., 50., 84.],
+                                threshold=self.threshold,
+                                stats_outname=stats_outname,
+                                pdf1d_outname=pdf1d_outname,
+                                lnp_outname=lnp_outname,
+                                nthreads=self.nthreads,
+                                fit_setup=self.fit_setup)
+
+    def output_path(self, fname):
+        """
+        Path of a file requested to be saved
+
+        Parameters
+        ----------
+        fname : str
+            filename relative to the output directory
+
+        Returns
+        -------
+        path : str
+            resolved path in the output directory
+
+        Raises
+        ------
+        ValueError
+            if the server has no output directory or the path is not in it
+        """
+        if self.output_dir is None:
+            raise ValueError('saving files is not enabled on this server')
+        if (not isinstance(fname, str)) or os.path.isabs(fname):
+            raise ValueError('output filenames must be relative to the '
+                             'output directory of the server')
+        path = os.path.realpath(os.path.join(self.output_dir, fname))
+        if ((path == self.output_dir) or
+                (os.path.commonpath([path, self.output_dir])
+                 != self.output_dir)):
+            raise ValueError('output file not in the output directory of '
+                             'the server: ' + fname)
+        return path
+
+    def fit_request(self, request):
+        """
+        Answer a fit request
+
+        Parameters
+        ----------
+        request : dict
+            decoded JSON request (see the top of this file)
+
+        Returns
+        -------
+        answer : dict
+            stats (and 1D PDFs if requested) ready to be JSON encoded
+        """
+        outnames = {}
+        for name in ['stats_outname', 'pdf1d_outname', 'lnp_outname']:
+            if request.get(name) is not None:
+                outnames[name] = self.output_path(request[name])
+
+        (stats_tab, pdf1d_vals) = self.fit(
+            request['seds'], ra=request.get('ra'), dec=request.get('dec'),
+            **outnames)
+
+        answer = {'stats': dict((colname, stats_tab[colname].tolist())
+                                for colname in stats_tab.colnames)}
+        if request.get('pdf1d', False):
+            answer['pdf1d'] = dict((qname, {'bins': vals[-1, :].tolist(),
+                                            'vals': vals[:-1, :].tolist()})
+                                   for qname, vals in zip(self.qnames,
+                                                          pdf1d_vals))
+        return answer
+
+
+class _FitRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP interface of the FitService of the server
+    """
+    def _send_json(self, code, answer):
+        content = json.dumps(answer).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/info':
+            self._send_json(404, {'error': 'unknown path ' + self.path})
+            return
+        service = self.server.fit_service
+        self._send_json(200, {'filters': service.filters,
+                              'qnames': service.qnames,
+                              'n_models': len(service.fit_setup['g0_indxs'])})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/fit':
+            self._send_json(404, {'error': 'unknown path ' + self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            answer = self.server.fit_service.fit_request(request)
+        except (ValueError, KeyError, TypeError) as err:
+            self._send_json(400, {'error': str(err)})
+            return
+        except Exception as err:
+            self._send_json(500, {'error': '{0:s}: {1:s}'.format(
+                type(err).__name__, str(err))})
+            return
+        self._send_json(200, answer)
+
+    def log_message(self, format, *args):
+        # no log of each request
+        pass
+
+
+def serve(fit_service, port=8765, host='localhost'):
+    """
+    Answer the fit requests until interrupted
+
+    Parameters
+    ----------
+    fit_service : FitService instance
+        warm model grid and noise model
+
+    port : int
+        port to listen to
+
+    host : str
+        address to listen to (default is only local requests)
+    """
+    server = HTTPServer((host, port), _FitRequestHandler)
+    server.fit_service = fit_service
+    print('fitting server listening on http://{0:s}:{1:d}'.format(host,
+                                                                   port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def request_fit(seds, url='http://localhost:8765', **kwargs):
+    """
+    Send a fit request to a running server
+
+    Parameters
+    ----------
+    seds : np.ndarray[float, ndim=2]
+        fluxes (nstars, nfilters) in the units of the model grid
+
+    url : str
+        address of the server
+
+    kwargs : dict
+        other request entries (ra, dec, pdf1d, stats_outname, ...)
+
+    Returns
+    -------
+    answer : dict
+        decoded JSON answer of the server
+    """
+    request = dict(kwargs)
+    request['seds'] = np.atleast_2d(seds).tolist()
+    for name in ['ra', 'dec']:
+        if request.get(name) is not None:
+            request[name] = np.atleast_1d(request[name]).tolist()
+    http_request = Request(url.rstrip('/') + '/fit',
+                           data=json.dumps(request).encode('utf-8'),
+                           headers={'Content-Type': 'application/json'})
+    return json.loads(urlopen(http_request).read().decode('utf-8'))
+
+
+if __name__ == '__main__':
+
+    # commandline parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument("physgrid",
+                        help="filename of the physics model grid")
+    parser.add_argument("noisefile",
+                        help="filename of the noise model")
+    parser.add_argument("-p", "--port", default=8765, type=int,
+                        help="port of the server")
+    parser.add_argument("--threshold", default=-10., type=float,
+                        help="sparse likelihood threshold")
+    parser.add_argument("--no_full_cov", action="store_true",
+                        help="do not use the full covariance matrices")
+    parser.add_argument("--prune_models", action="store_true",
+                        help="skip the models that cannot be in the sparse"
+                        " likelihood")
+    parser.add_argument("-n", "--nthreads", default=1, type=int,
+                        help="number of threads to compute the likelihoods")
+    parser.add_argument("-o", "--output_dir", default=None,
+                        help="directory of the files saved for the requests"
+                        " (default is to not save files)")
+    args = parser.parse_args()
+
+    fit_service = FitService(args.physgrid, args.noisefile,
+                             threshold=args.threshold,
+                             nthreads=args.nthreads,
+                             output_dir=args.output_dir,
+                             use_full_cov_matrix=not args.no_full_cov,
+                             prune_models=args.prune_models)
+    serve(fit_service, port=args.port)
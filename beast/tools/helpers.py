@@ -102,7 +102,7 @@ def chunks(l, n):
         if chunk:
             yield chunk
         else:
-            raise StopIteration
+            return
 
 
 def isNestedInstance(obj, cl):
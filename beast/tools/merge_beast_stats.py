@@ -1,46 +1,269 @@
 #!/usr/bin/env python
 #
 # condense separate BEAST stats files into a single stats file
+#
+# the merge is streamed: the headers are scanned first to get the total
+#   number of rows and the output schema, the output is allocated once,
+#   and the rows of each file are copied into place block by block
 
 import glob
 
 import argparse
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import h5py
 
-from astropy.table import Table, Column, vstack
+from astropy.io import fits
+from astropy.table import Table
 
 
 def merge_stats_files(stats_files,
-                      out_stats_filebase):
+                      out_stats_filebase,
+                      out_format='fits',
+                      nthreads=1,
+                      block_size=100000):
+    """
+    Merge stats files into a single stats file with an added column
+    giving the reordering tag of the file each source came from
+
+    Parameters
+    ----------
+    stats_files : list of str
+        stats files to merge (FITS tables with the same columns)
+
+    out_stats_filebase : str
+        output is out_stats_filebase + '_stats.fits' (or '_stats.hd5')
 
-    # loop through the stats files, building up the output table
-    cats_list = []
-    for cur_stat in stats_files:
-        cur_cat = Table.read(cur_stat)
+    out_format : str
+        'fits' or 'hdf5' (dataset 'stats' readable with
+        astropy.table.Table.read(fname, path='stats'))
 
-        # get the source density and subregion name
-        #  in other words, the reordering tag
-        #  bpos is the location after the 2nd underscore of pix coords
-        #  epos is before the _stats.fits ending string
-        bpos = cur_stat.find('_sd') + 1
-        epos = cur_stat.find('_stats')
-        reorder_tag = cur_stat[bpos:epos]
+    nthreads : int
+        number of threads to use to read the input files
+        (each thread reads one full file)
 
-        # add the reorder tag to each entry in the current catalog
-        n_entries = len(cur_cat)
-        cur_cat.add_column(Column([reorder_tag] * n_entries,
-                                  name='reorder_tag'))
+    block_size : int
+        maximum number of rows to copy at once when nthreads=1
+        (bounds the memory used)
 
-        # append to list
-        cats_list.append(cur_cat)
+    Returns
+    -------
+    n_rows : int
+        number of sources in the merged catalog
+    """
+    # scan the headers for the number of rows and the columns
+    tags = [_reorder_tag(cur_stat) for cur_stat in stats_files]
+    n_rows, out_cols = _scan_stats_files(stats_files, tags)
+    offsets = np.concatenate([[0], np.cumsum(n_rows)])
 
-    # concatenate all the small catalogs together
-    full_cat = vstack(cats_list)
+    if out_format == 'fits':
+        out_name = out_stats_filebase + '_stats.fits'
+        writer = _FITSRowWriter(out_name, out_cols, offsets[-1])
+    elif out_format == 'hdf5':
+        out_name = out_stats_filebase + '_stats.hd5'
+        writer = _HDF5RowWriter(out_name, out_cols, offsets[-1])
+    else:
+        raise ValueError('out_format must be fits or hdf5')
 
-    # output the full pixel catalog
-    full_cat.write(out_stats_filebase + '_stats.fits', overwrite=True)
+    if nthreads > 1:
+        # read nthreads files at a time (bounds the memory used)
+        pool = ThreadPool(nthreads)
+        for i in range(0, len(stats_files), nthreads):
+            cur_files = stats_files[i:i+nthreads]
+            cur_data = pool.map(_read_raw_rows, cur_files)
+            for k, data in enumerate(cur_data):
+                writer.write(data, offsets[i+k], tags[i+k])
+        pool.close()
+        pool.join()
+    else:
+        for i, cur_stat in enumerate(stats_files):
+            for start in range(0, n_rows[i], block_size):
+                stop = min(start + block_size, n_rows[i])
+                data = _read_raw_rows(cur_stat, start, stop)
+                writer.write(data, offsets[i] + start, tags[i])
+
+    writer.close()
 
     # return the number of sources in the catalog for later use
-    return len(full_cat)
+    return int(offsets[-1])
+
+
+def _reorder_tag(stats_filename):
+    """
+    Get the source density and subregion name
+    in other words, the reordering tag
+    bpos is the location after the 2nd underscore of pix coords
+    epos is before the _stats.fits ending string
+    """
+    bpos = stats_filename.find('_sd') + 1
+    epos = stats_filename.find('_stats')
+    return stats_filename[bpos:epos]
+
+
+def _scan_stats_files(stats_files, tags):
+    """
+    Read the headers of the stats files to get the number of rows of each
+    and the combined columns (string columns get the maximum width)
+
+    Returns
+    -------
+    n_rows, out_cols : int array, fits.ColDefs
+        number of rows of each file and the output columns
+    """
+    n_rows = np.zeros(len(stats_files), dtype=int)
+    columns = None
+    str_widths = {}
+    for i, cur_stat in enumerate(stats_files):
+        with fits.open(cur_stat, memmap=True) as hdul:
+            n_rows[i] = hdul[1].header['NAXIS2']
+            cur_columns = hdul[1].columns
+            if columns is None:
+                columns = [col.copy() for col in cur_columns]
+            elif cur_columns.names != [col.name for col in columns]:
+                raise ValueError('%s does not have the same columns'
+                                 % cur_stat)
+            for col in cur_columns:
+                if col.format.startswith('A') or col.format.endswith('A'):
+                    width = int(col.format.replace('A', '') or 1)
+                    str_widths[col.name] = max(width,
+                                               str_widths.get(col.name, 0))
+
+    # output columns
+    out_cols = []
+    for col in columns:
+        if col.name in str_widths:
+            out_cols.append(fits.Column(name=col.name,
+                                        format='%dA' % str_widths[col.name],
+                                        unit=col.unit))
+        else:
+            out_cols.append(fits.Column(name=col.name, format=col.format,
+                                        unit=col.unit, bzero=col.bzero,
+                                        bscale=col.bscale, dim=col.dim))
+    tag_width = max([len(tag) for tag in tags] + [1])
+    out_cols.append(fits.Column(name='reorder_tag',
+                                format='%dA' % tag_width))
+
+    return n_rows, fits.ColDefs(out_cols)
+
+
+def _read_raw_rows(stats_filename, start=0, stop=None):
+    """
+    Read the raw (as stored in the FITS file) rows of a stats file
+    """
+    with fits.open(stats_filename, memmap=True) as hdul:
+        data = hdul[1].data
+        if stop is None:
+            stop = len(data)
+        return np.array(data.view(np.ndarray)[start:stop])
+
+
+class _FITSRowWriter(object):
+    """
+    Write the raw rows of a FITS binary table directly into place
+    """
+    def __init__(self, out_name, out_cols, n_rows):
+        empty_hdu = fits.BinTableHDU.from_columns(out_cols, nrows=0)
+        header = empty_hdu.header
+        header['NAXIS2'] = n_rows
+
+        # FITS binary tables are stored big endian
+        self.raw_dtype = \
+            empty_hdu.data.view(np.ndarray).dtype.newbyteorder('>')
+
+        fits.PrimaryHDU().writeto(out_name, overwrite=True)
+        self.outfile = open(out_name, 'r+b')
+        self.outfile.seek(0, 2)
+        self.outfile.write(header.tostring().encode('ascii'))
+        self.data_start = self.outfile.tell()
+        self.data_size = n_rows * self.raw_dtype.itemsize
+
+    def write(self, raw_rows, row_offset, tag):
+        out_rows = np.zeros(len(raw_rows), dtype=self.raw_dtype)
+        for name in raw_rows.dtype.names:
+            out_rows[name] = raw_rows[name]
+        out_rows['reorder_tag'] = tag
+        self.outfile.seek(self.data_start
+                          + row_offset * self.raw_dtype.itemsize)
+        self.outfile.write(out_rows.tobytes())
+
+    def close(self):
+        # pad to a full FITS block
+        self.outfile.seek(self.data_start + self.data_size)
+        n_pad = -self.data_size % 2880
+        self.outfile.write(b'\0' * n_pad)
+        self.outfile.close()
+
+
+class _HDF5RowWriter(object):
+    """
+    Write the rows into a preallocated HDF5 compound dataset
+    """
+    def __init__(self, out_name, out_cols, n_rows):
+        # the FITS columns give the native dtype (e.g., bools, scaling)
+        #   strings are kept as bytes as HDF5 does not support unicode
+        self.columns = out_cols
+        empty_hdu = fits.BinTableHDU.from_columns(out_cols, nrows=1)
+        native_dtype = Table(empty_hdu.data).as_array().dtype
+        raw_dtype = empty_hdu.data.view(np.ndarray).dtype
+        out_dtype = []
+        self.sign_flip = set()
+        for col in out_cols:
+            name = col.name
+            if native_dtype[name].kind == 'U':
+                out_dtype.append((name,
+                                  'S%d' % (native_dtype[name].itemsize // 4)))
+            elif _is_sign_flip(col, raw_dtype[name]):
+                # unsigned integers (or signed bytes) stored with the zero
+                #   point offset (read as integers with uint=True)
+                kind = 'i' if raw_dtype[name].kind == 'u' else 'u'
+                out_dtype.append((name, '%s%d' % (kind,
+                                                  raw_dtype[name].itemsize)))
+                self.sign_flip.add(name)
+            else:
+                out_dtype.append((name, native_dtype[name]))
+        self.out_dtype = np.dtype(out_dtype)
+        self.outfile = h5py.File(out_name, 'w')
+        self.dataset = self.outfile.create_dataset('stats', (n_rows,),
+                                                   dtype=self.out_dtype)
+
+    def write(self, raw_rows, row_offset, tag):
+        # convert the raw values using the FITS column definitions
+        out_rows = np.zeros(len(raw_rows), dtype=self.out_dtype)
+        for col in self.columns:
+            if col.name not in raw_rows.dtype.names:
+                continue
+            vals = raw_rows[col.name]
+            if col.format.endswith('L'):
+                vals = vals == ord('T')
+            elif col.name in self.sign_flip:
+                # adding the zero point offset is flipping the sign bit
+                udtype = np.dtype('u%d' % vals.dtype.itemsize)
+                vals = (vals.astype(vals.dtype.newbyteorder('=')).view(udtype)
+                        ^ udtype.type(1 << (8 * udtype.itemsize - 1))).view(
+                            self.out_dtype[col.name])
+            elif col.bscale is not None or col.bzero is not None:
+                vals = (vals * (col.bscale or 1)
+                        + (col.bzero or 0)).astype(self.out_dtype[col.name])
+            out_rows[col.name] = vals
+        out_rows['reorder_tag'] = tag
+        self.dataset[row_offset:row_offset + len(out_rows)] = out_rows
+
+    def close(self):
+        self.outfile.close()
+
+
+def _is_sign_flip(col, raw_dtype):
+    """
+    Check if a FITS column stores unsigned integers (or signed bytes) with
+    the zero point offset convention
+    """
+    if (col.bscale not in (None, 1)) or not col.bzero:
+        return False
+    if raw_dtype.kind == 'i':
+        return col.bzero == 2**(8 * raw_dtype.itemsize - 1)
+    return (raw_dtype.kind == 'u') and (raw_dtype.itemsize == 1) \
+        and (col.bzero == -128)
 
 
 if __name__ == '__main__':
@@ -49,10 +272,16 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("filebase",
                         help="filebase to use (e.g., xxx_*_stats.fits)")
+    parser.add_argument("--hdf5", action="store_true",
+                        help="write the merged file in HDF5")
+    parser.add_argument("-n", "--nthreads", default=1, type=int,
+                        help="number of threads to read the files")
     args = parser.parse_args()
 
     # get the files to merge
-    stats_files = glob.glob(args.filebase + '*_stats.fits')
+    stats_files = sorted(glob.glob(args.filebase + '*_stats.fits'))
 
     # do the merge
-    n_objs = merge_stats_files(stats_files, args.filebase)
+    n_objs = merge_stats_files(stats_files, args.filebase,
+                               out_format='hdf5' if args.hdf5 else 'fits',
+                               nthreads=args.nthreads)
@@ -0,0 +1,474 @@
+"""
+Pipeline of stages (functions writing files) declared as a DAG and run
+with a cache: each stage has a key, the hash of its function, parameters,
+input files (by content), outputs and the keys of the stages it depends
+on.  A stage is rerun only if no run with its key produced its current
+outputs, or if a stage it depends on is rerun.  Stages that do not depend
+on each other (e.g., subgrids or source density bins) can be run in
+parallel processes.
+
+Usage::
+
+    pipe = Pipeline(cache_dir='project/pipeline_cache')
+    pipe.add_stage('iso', make_isochrones, params={...},
+                   outputs=['project/project_iso.csv'])
+    pipe.add_stage('spec', make_spectra, params={...},
+                   outputs=['project/project_spec_grid.hd5'],
+                   depends=['iso'])
+    pipe.run(nprocs=4)
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from multiprocessing import Pool
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+__all__ = ['Stage', 'Pipeline', 'params_hash', 'file_hash']
+
+
+def _canonical(obj, _seen=None):
+    """
+    JSON serializable version of a parameter value that does not depend
+    on the memory addresses of the objects (for hashing)
+    """
+    if _seen is None:
+        _seen = set()
+    if (obj is None) or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8', 'replace')
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if type(obj).__module__.startswith('astropy.units'):
+        # astropy units and quantities
+        if hasattr(obj, 'unit') and hasattr(obj, 'value'):
+            return {'value': _canonical(obj.value, _seen),
+                    'unit': str(obj.unit)}
+        return str(obj)
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            return {'ndarray': [_canonical(v, _seen) for v in obj.ravel()],
+                    'shape': list(obj.shape)}
+        return {'ndarray': hashlib.sha256(
+                    np.ascontiguousarray(obj).tobytes()).hexdigest(),
+                'dtype': obj.dtype.str, 'shape': list(obj.shape)}
+    if hasattr(obj, '__qualname__') or hasattr(obj, '__name__'):
+        # functions and classes
+        return '{0}.{1}'.format(getattr(obj, '__module__', ''),
+                                getattr(obj, '__qualname__', obj.__name__))
+
+    if id(obj) in _seen:
+        return '<cycle>'
+    _seen = _seen | {id(obj)}
+    if isinstance(obj, dict):
+        return OrderedDict((str(k), _canonical(obj[k], _seen))
+                           for k in sorted(obj, key=str))
+    if isinstance(obj, (list, tuple)):
+        return [_canonical(v, _seen) for v in obj]
+    if isinstance(obj, (set, frozenset)):
+        return sorted([_canonical(v, _seen) for v in obj], key=str)
+    if hasattr(obj, '__dict__'):
+        # other objects (e.g., extinction laws, stellar libraries)
+        return {'class': _canonical(type(obj), _seen),
+                'attrs': _canonical(vars(obj), _seen)}
+    return repr(obj)
+
+
+def params_hash(params):
+    """
+    Hash of parameter values (nested dicts, lists, numpy arrays, astropy
+    quantities, functions and objects)
+
+    Parameters
+    ----------
+    params: object
+        parameter values
+
+    Returns
+    -------
+    hash: str
+        hexadecimal sha256 hash
+    """
+    return hashlib.sha256(json.dumps(_canonical(params),
+                                     sort_keys=True).encode(
+                                         'utf-8')).hexdigest()
+
+
+def file_hash(fname, block_size=1 << 22):
+    """
+    Hash of the content of a file
+
+    Parameters
+    ----------
+    fname: str
+        file name
+
+    block_size: int
+        number of bytes read at once
+
+    Returns
+    -------
+    hash: str
+        hexadecimal sha256 hash
+    """
+    sha = hashlib.sha256()
+    with open(fname, 'rb') as infile:
+        for block in iter(lambda: infile.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _fingerprint(fname):
+    """ size and modification time of a file (None if missing) """
+    if not os.path.isfile(fname):
+        return None
+    stat = os.stat(fname)
+    return [stat.st_size, getattr(stat, 'st_mtime_ns', stat.st_mtime)]
+
+
+class Stage(object):
+    """
+    Stage of a pipeline: a function called with keyword parameters that
+    writes output files
+    """
+    def __init__(self, name, func, params=None, outputs=None, depends=None,
+                 input_files=None):
+        """
+        Parameters
+        ----------
+        name: str
+            name of the stage
+
+        func: function
+            function called as func(**params), it needs to be defined at
+            the top level of a module to be run in parallel processes
+
+        params: dict
+            keyword parameters of the function
+
+        outputs: list of str
+            files written by the function (deleted before the function is
+            run as many functions skip existing files)
+
+        depends: list of str
+            names of the stages whose outputs are used
+
+        input_files: list of str
+            other files used (e.g., observations, AST results), hashed by
+            content
+        """
+        self.name = name
+        self.func = func
+        self.params = params or {}
+        self.outputs = list(outputs or [])
+        self.depends = list(depends or [])
+        self.input_files = list(input_files or [])
+
+
+def _run_stage(func, params, outputs):
+    """
+    run a stage function (in a worker process in parallel)
+
+    The stage functions exit() on errors: SystemExit (and the other
+    exceptions not derived from Exception) are raised as RuntimeError, to
+    be reported as a failure of the stage instead of stopping the
+    pipeline without error (or a worker process without reply).
+    """
+    for fname in outputs:
+        outdir = os.path.dirname(fname)
+        if outdir and not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        if os.path.isfile(fname):
+            os.remove(fname)
+    try:
+        func(**params)
+    except Exception:
+        raise
+    except BaseException as e:
+        raise RuntimeError('{0} stopped: {1}({2})'.format(
+            getattr(func, '__name__', func), type(e).__name__,
+            ', '.join(repr(arg) for arg in e.args)))
+
+
+class Pipeline(object):
+    """
+    Stages declared as a directed acyclic graph (a stage can only depend
+    on stages already added) and run with a cache of their keys and
+    outputs
+    """
+    def __init__(self, cache_dir='pipeline_cache'):
+        """
+        Parameters
+        ----------
+        cache_dir: str
+            directory of the stage manifests (one per stage key, giving the
+            size and modification time of the outputs written) and of the
+            cache of the input file hashes
+        """
+        self.cache_dir = cache_dir
+        self.stages = OrderedDict()
+        self._keys = {}
+        self._file_hashes = None
+
+    def add_stage(self, name, func, params=None, outputs=None, depends=None,
+                  input_files=None):
+        """
+        Add a stage (see Stage for the parameters)
+
+        Returns
+        -------
+        name: str
+            name of the stage (to use in the depends of other stages)
+        """
+        if name in self.stages:
+            raise ValueError('stage {0} already in the pipeline'.format(name))
+        for dep in depends or []:
+            if dep not in self.stages:
+                raise ValueError('stage {0} depends on {1}, not in the '
+                                 'pipeline'.format(name, dep))
+        self.stages[name] = Stage(name, func, params=params, outputs=outputs,
+                                  depends=depends, input_files=input_files)
+        return name
+
+    def _input_file_hash(self, fname):
+        """ hash of an input file, cached by size and modification time """
+        hash_fname = os.path.join(self.cache_dir, 'file_hashes.json')
+        if self._file_hashes is None:
+            self._file_hashes = {}
+            if os.path.isfile(hash_fname):
+                with open(hash_fname, 'r') as infile:
+                    self._file_hashes = json.load(infile)
+        fname = os.path.abspath(fname)
+        fingerprint = _fingerprint(fname)
+        if fingerprint is None:
+            raise ValueError('input file {0} does not exist'.format(fname))
+        cached = self._file_hashes.get(fname)
+        if (cached is not None) and (cached[:2] == fingerprint):
+            return cached[2]
+
+        fhash = file_hash(fname)
+        self._file_hashes[fname] = fingerprint + [fhash]
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        with open(hash_fname, 'w') as outfile:
+            json.dump(self._file_hashes, outfile, indent=1)
+        return fhash
+
+    def stage_key(self, name):
+        """
+        Key of a stage: hash of its function, parameters, outputs, input
+        file contents, and of the keys of the stages it depends on
+
+        Parameters
+        ----------
+        name: str
+            name of the stage
+
+        Returns
+        -------
+        key: str
+            hexadecimal sha256 hash
+        """
+        if name not in self._keys:
+            stage = self.stages[name]
+            self._keys[name] = params_hash(
+                {'name': name,
+                 'func': stage.func,
+                 'params': stage.params,
+                 'outputs': stage.outputs,
+                 'depends': OrderedDict((dep, self.stage_key(dep))
+                                        for dep in stage.depends),
+                 'input_files': OrderedDict(
+                     (fname, self._input_file_hash(fname))
+                     for fname in stage.input_files)})
+        return self._keys[name]
+
+    def _manifest_fname(self, name):
+        return os.path.join(self.cache_dir,
+                            '{0}.json'.format(self.stage_key(name)))
+
+    def is_cached(self, name):
+        """
+        Check if the outputs of a stage were written by a run with the
+        current key of the stage (and not modified since)
+
+        Parameters
+        ----------
+        name: str
+            name of the stage
+
+        Returns
+        -------
+        cached: bool
+        """
+        manifest_fname = self._manifest_fname(name)
+        if not os.path.isfile(manifest_fname):
+            return False
+        with open(manifest_fname, 'r') as infile:
+            manifest = json.load(infile)
+        return all(_fingerprint(fname) == manifest['outputs'].get(fname)
+                   for fname in self.stages[name].outputs)
+
+    def _write_manifest(self, name, run_time):
+        """ save the outputs written by a stage under its key """
+        stage = self.stages[name]
+        missing = [fname for fname in stage.outputs
+                   if not os.path.isfile(fname)]
+        if len(missing) > 0:
+            raise RuntimeError('stage {0} did not write {1}'.format(
+                name, ', '.join(missing)))
+        manifest = OrderedDict([
+            ('stage', name),
+            ('key', self.stage_key(name)),
+            ('run_time', run_time),
+            ('outputs', OrderedDict((fname, _fingerprint(fname))
+                                    for fname in stage.outputs))])
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        with open(self._manifest_fname(name), 'w') as outfile:
+            json.dump(manifest, outfile, indent=1)
+
+    def _needed(self, stages=None):
+        """ names of stages and of the stages they depend on """
+        if stages is None:
+            return set(self.stages)
+        needed = set()
+        todo = list(stages)
+        while len(todo) > 0:
+            name = todo.pop()
+            if name not in self.stages:
+                raise ValueError('stage {0} not in the pipeline'.format(name))
+            if name not in needed:
+                needed.add(name)
+                todo.extend(self.stages[name].depends)
+        return needed
+
+    def status(self, force=None, stages=None):
+        """
+        Stages to run: stages not cached, forced, or depending on a stage
+        to run
+
+        Parameters
+        ----------
+        force: list of str
+            names of stages to run even if cached
+
+        stages: list of str
+            names of the stages to check (and the stages they depend on),
+            default is all the stages
+
+        Returns
+        -------
+        status: OrderedDict
+            'run' or 'cached' for each stage (in the order added)
+        """
+        force = force or []
+        needed = self._needed(stages)
+        status = OrderedDict()
+        for name, stage in self.stages.items():
+            if name not in needed:
+                continue
+            to_run = ((name in force)
+                      or any(status[dep] == 'run' for dep in stage.depends)
+                      or not self.is_cached(name))
+            status[name] = 'run' if to_run else 'cached'
+        return status
+
+    def run(self, nprocs=1, force=None, stages=None):
+        """
+        Run the stages that are not cached, the stages whose dependencies
+        are done being run at the same time in parallel processes
+
+        Parameters
+        ----------
+        nprocs: int
+            number of processes running stages
+
+        force: list of str
+            names of stages to run even if cached
+
+        stages: list of str
+            names of the stages to run (and the stages they depend on),
+            default is all the stages
+
+        Returns
+        -------
+        status: OrderedDict
+            'run' or 'cached' for each stage run or checked
+        """
+        status = self.status(force=force, stages=stages)
+        pending = [name for name in status if status[name] == 'run']
+        done = set(name for name in status if status[name] == 'cached')
+        for name in done:
+            print('{0}: cached'.format(name))
+
+        finished = queue.Queue()
+        p = Pool(nprocs) if nprocs > 1 else None
+        n_running = 0
+        error = None
+        start_times = {}
+        try:
+            while (len(pending) > 0) or (n_running > 0):
+                # start the stages whose dependencies are done
+                ready = [name for name in pending
+                         if all(dep in done
+                                for dep in self.stages[name].depends)]
+                if error is not None:
+                    ready = []
+                for name in ready:
+                    pending.remove(name)
+                    stage = self.stages[name]
+                    print('{0}: running'.format(name))
+                    start_times[name] = time.time()
+                    n_running += 1
+                    if p is None:
+                        try:
+                            _run_stage(stage.func, stage.params,
+                                       stage.outputs)
+                            finished.put((name, None))
+                        except Exception as e:
+                            finished.put((name, e))
+                    else:
+                        p.apply_async(
+                            _run_stage,
+                            (stage.func, stage.params, stage.outputs),
+                            callback=lambda r, name=name: finished.put(
+                                (name, None)),
+                            error_callback=lambda e, name=name: finished.put(
+                                (name, e)))
+
+                if n_running == 0:
+                    # nothing left that can be run
+                    break
+
+                # wait for a stage to finish
+                name, stage_error = finished.get()
+                n_running -= 1
+                if stage_error is not None:
+                    print('{0}: failed ({1})'.format(name, stage_error))
+                    if error is None:
+                        error = stage_error
+                    continue
+                run_time = time.time() - start_times[name]
+                self._write_manifest(name, run_time)
+                done.add(name)
+                print('{0}: done in {1:.1f} s'.format(name, run_time))
+        finally:
+            if p is not None:
+                p.close()
+                p.join()
+
+        if error is not None:
+            raise error
+        return status
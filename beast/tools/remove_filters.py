@@ -5,19 +5,46 @@
 
 import argparse
 
-import numpy as np
+import os
+
 from astropy.table import Table
-import tables
 
-from beast.physicsmodel.grid import (FileSEDGrid, SpectralGrid)
-import beast.observationmodel.noisemodel.generic_noisemodel as noisemodel
+from beast.physicsmodel.grid import FileSEDGrid
+from beast.physicsmodel.helpers.gridcopy import (copy_grid_rows,
+                                                 copy_noisemodel_rows)
 
 
 def remove_filters_from_files(catfile,
                               physgrid,
                               obsgrid,
                               outbase,
-                              rm_filters):
+                              rm_filters,
+                              block_size=100000):
+    """
+    Remove filters from a photometry catalog, and from a physics grid and
+    its observation (noise model) grid. The grids are copied block by
+    block of models, so they do not need to fit in memory.
+
+    Parameters
+    ----------
+    catfile : string
+        filename of the photometry catalog
+
+    physgrid : string
+        filename of the physics (sed) grid
+
+    obsgrid : string
+        filename of the observation (noise model) grid
+
+    outbase : string
+        base of the output filenames
+
+    rm_filters : list of string
+        short names of the filters to remove (e.g., f275w)
+
+    block_size : int
+        number of models copied at once
+    """
 
     # remove the requested filters from the catalog file
     cat = Table.read(catfile)
@@ -29,39 +56,35 @@ def remove_filters_from_files(catfile,
             print('{} not in catalog file'.format(colname))
     cat.write('{}_cat.fits'.format(outbase), overwrite=True)
 
-    # get the sed grid and process
-    g0 = FileSEDGrid(physgrid, backend='cache')
+    # get the sed grid filters and the ones to keep
+    g0 = FileSEDGrid(physgrid, backend='hdf')
     filters = g0.header['filters'].split(' ')
     shortfilters = [(cfilter.split('_'))[-1].lower() for cfilter in filters]
-    nlamb = []
     nfilters = []
-    rindxs = []
-    for csfilter, clamb, cfilter in zip(shortfilters, g0.lamb, filters):
+    kindxs = []
+    for k, (csfilter, cfilter) in enumerate(zip(shortfilters, filters)):
         if csfilter not in rm_filters:
-            nlamb.append(clamb)
             nfilters.append(cfilter)
-        else:
-            rindxs.append(shortfilters.index(csfilter))
-    nseds = np.delete(g0.seds, rindxs, 1)
+            kindxs.append(k)
 
     print('orig filters: {}'.format(' '.join(filters)))
     print(' new filters: {}'.format(' '.join(nfilters)))
 
-    g = SpectralGrid(np.array(nlamb), seds=nseds,
-                     grid=g0.grid, backend='memory')
-    g.grid.header['filters'] = ' '.join(nfilters)
-    g.writeHDF('{}_sed.grid.hd5'.format(outbase))
-
-    # get and process the observation model
-    obsgrid = noisemodel.get_noisemodelcat(obsgrid)
-    with tables.open_file('{}_noisemodel.grid.hd5'.format(outbase), 'w') \
-            as outfile:
-        outfile.create_array(outfile.root, 'bias',
-                             np.delete(obsgrid.root.bias, rindxs, 1))
-        outfile.create_array(outfile.root, 'error',
-                             np.delete(obsgrid.root.error, rindxs, 1))
-        outfile.create_array(outfile.root, 'completeness',
-                             np.delete(obsgrid.root.completeness, rindxs, 1))
+    # copy the sed grid without the removed filters
+    sed_outname = '{}_sed.grid.hd5'.format(outbase)
+    if os.path.isfile(sed_outname):
+        os.remove(sed_outname)
+    copy_grid_rows(physgrid, sed_outname, filter_indxs=kindxs,
+                   header={'filters': ' '.join(nfilters)},
+                   block_size=block_size)
+
+    # copy the observation model without the removed filters
+    noise_outname = '{}_noisemodel.grid.hd5'.format(outbase)
+    if os.path.isfile(noise_outname):
+        os.remove(noise_outname)
+    copy_noisemodel_rows(obsgrid, noise_outname, filter_indxs=kindxs,
+                         names=['bias', 'error', 'completeness'],
+                         block_size=block_size)
 
 
 if __name__ == '__main__':
@@ -15,9 +15,10 @@
 import os
 import glob
 import math
+from multiprocessing import Pool
 
 import h5py
-from tqdm import trange, tqdm
+from tqdm import tqdm
 
 import argparse
 import numpy as np
@@ -31,7 +32,8 @@ def reorder_beast_results_spatial(bricknum=None,
                                       stats_filename=None,
                                       region_filebase=None,
                                       output_filebase=None,
-                                      reg_size=10.):
+                                      reg_size=10.,
+                                      nprocs=1):
     """
     Do the spatial reordering of BEAST results.
 
@@ -54,7 +56,10 @@ def reorder_beast_results_spatial(bricknum=None,
 
     reg_size : float (default=10)
         spatial region size [arcsec]
- 
+
+    nprocs : int
+        Number of processes to use to write the spatial region files
+        in parallel (default=1)
     """
 
     if bricknum is not None:
@@ -93,7 +98,9 @@ def reorder_beast_results_spatial(bricknum=None,
     #      append the sparse nD pdfs
     #      append the completeness function (??)
 
-    #sub_files = sub_files[0:2]
+    if nprocs > 1:
+        p = Pool(nprocs)
+
     for cur_file in tqdm(sub_files, desc="orig sub files"):
         # read in the stats file
         cur_cat = Table.read(cur_file)
@@ -110,9 +117,11 @@ def reorder_beast_results_spatial(bricknum=None,
             cur_pdf1d_vals.append(hdulist[k+1].data)
         hdulist.close()
 
-        # open the lnp file for reading
-        cur_lnpfile = h5py.File(cur_file.replace('_stats.fits',
-                                                 '_lnp.hd5'), 'r')
+        # read all the sparse likelihoods at once
+        #   concatenated arrays with offsets for each star
+        cur_lnp = read_lnp_arrays(cur_file.replace('_stats.fits',
+                                                   '_lnp.hd5'),
+                                  n_stars=n_objs)
         
         # get the source density and subregion tag
         # allows for unique filenames for the spatial regions for output
@@ -123,85 +132,214 @@ def reorder_beast_results_spatial(bricknum=None,
                                       cur_cat['DEC'],
                                       wcs_info)
 
-        # get the unique xy regions
-        xy_names = np.squeeze(xy_vals['name'])
-        uniq_xy_names, rindxs = np.unique(xy_names, 
-                                          return_inverse=True)
+        # add the number of stars found to summary array
+        np.add.at(wcs_nstars, (xy_vals['y'], xy_vals['x']), 1)
+
+        # group the objects by region (stable sort, so the objects keep
+        # their order in each region)
+        order = np.argsort(xy_vals['key'], kind='mergesort')
+        uniq_keys, starts, counts = np.unique(xy_vals['key'][order],
+                                              return_index=True,
+                                              return_counts=True)
+
+        # the outputs of each region (subsets of the stats, 1D PDFs plus
+        #   the last column giving the values of the bins, and lnp)
+        def region_args():
+            for start, count in zip(starts, counts):
+                indxs = order[start:start + count]
+                uxy_name = xy_vals['name'][indxs[0]]
+                region_filebase = out_filebase + '_' + uxy_name + '/' + \
+                    uxy_name + orig_reg_tag
+                yield (region_filebase, cur_cat[indxs],
+                       cur_pdf1d_name,
+                       [pdf1d_vals[np.append(indxs, n_objs), :]
+                        for pdf1d_vals in cur_pdf1d_vals],
+                       subset_lnp_arrays(cur_lnp, indxs))
+
+        if nprocs > 1:
+            for _ in tqdm(p.imap_unordered(_write_region, region_args()),
+                          total=len(uniq_keys),
+                          desc="outputing " + orig_reg_tag, leave=False):
+                pass
+        else:
+            for cur_args in tqdm(region_args(), total=len(uniq_keys),
+                                 desc="outputing " + orig_reg_tag,
+                                 leave=False):
+                _write_region(cur_args)
 
-        #uniq_xy_names = uniq_xy_names[0:5]
+        # Now, write out the WCS info and number of stars per pixel to file
+        #   do every subregion file to have an on-the-fly check
+        header = wcs_info.to_header()
+        hdu = fits.PrimaryHDU(wcs_nstars, header=header)
 
-        # loop over the unique xy regions
-        for k in trange(len(uniq_xy_names), desc="outputing " + orig_reg_tag, 
-                        leave=False):
-            uxy_name = uniq_xy_names[k]
+        # Save to FITS file
+        hdu.writeto(out_filebase+'_nstars.fits', overwrite=True)
 
-            # get the indexes for the objects in this region
-            indxs, = np.where(rindxs == k)
+    if nprocs > 1:
+        p.close()
+        p.join()
 
-            # add the number of stars found to summary array
-            wcs_nstars[xy_vals['y'][indxs[0]], 
-                       xy_vals['x'][indxs[0]]] += len(indxs)
 
-            # create region directory if it does not exist
-            reg_dir = out_filebase + '_' + uxy_name
-            if not os.path.exists(reg_dir):
-                os.makedirs(reg_dir)
+def _write_region(args):
+    """
+    Write the stats, pdf1d, and lnp files of the objects of one spatial
+    region
 
-            # base filename for output
-            reg_filebase = out_filebase + '_' + uxy_name + '/' + \
-                uxy_name + orig_reg_tag
+    Parameters
+    ----------
+    args : tuple
+        (region_filebase, reg_cat, pdf1d_names, reg_pdf1d_vals,
+        reg_lnp) base filename of the region files, stats of the objects,
+        names and 1D PDFs (plus the bin values) of each quantity, and
+        sparse likelihoods (see subset_lnp_arrays)
+    """
+    region_filebase, reg_cat, pdf1d_names, reg_pdf1d_vals, reg_lnp = args
 
-            # write the stats info
-            reg_stats_file = reg_filebase + '_stats.fits'
-            cur_cat[indxs].write(reg_stats_file, overwrite=True)
+    # create region directory if it does not exist
+    reg_dir = os.path.dirname(region_filebase)
+    if not os.path.exists(reg_dir):
+        os.makedirs(reg_dir)
 
-            # write the pdf1d info
-            reg_pdf1d_file = reg_filebase + '_pdf1d.fits'
+    # write the stats info
+    reg_cat.write(region_filebase + '_stats.fits', overwrite=True)
 
-            # setup the primary header and hdulist
-            hdulist = fits.HDUList([fits.PrimaryHDU()])
+    # write the pdf1d info
+    #   setup the primary header and hdulist
+    hdulist = fits.HDUList([fits.PrimaryHDU()])
 
-            # generate the extensions
-            for k, qname in enumerate(cur_pdf1d_name):
-                # get the 1D PDFs for the cur objects 
-                #   plus the last column giving the values of the bins
-                cur_reg_pdf1d = cur_pdf1d_vals[k][np.append(indxs,n_objs),:]
+    # generate the extensions
+    for qname, cur_reg_pdf1d in zip(pdf1d_names, reg_pdf1d_vals):
+        chdu = fits.PrimaryHDU(cur_reg_pdf1d)
+        chdu.header.set('XTENSION','IMAGE')
+        chdu.header.set('EXTNAME',qname)
 
-                chdu = fits.PrimaryHDU(cur_reg_pdf1d)
-                chdu.header.set('XTENSION','IMAGE') 
-                chdu.header.set('EXTNAME',qname) 
+        hdulist.append(chdu)
 
-                hdulist.append(chdu)
+    # write the 1D PDFs
+    hdulist.writeto(region_filebase + '_pdf1d.fits', overwrite=True)
 
-            # write the 1D PDFs
-            hdulist.writeto(reg_pdf1d_file, overwrite=True)
+    # write the nD sparse likelihood info
+    write_lnp_arrays(region_filebase + '_lnp.hd5', reg_lnp,
+                     np.arange(reg_lnp['n_stars']))
 
-            # write the nD sparse likelihood info
-            reg_lnp_file = reg_filebase + '_lnp.hd5'
 
-            # open the file (overwrites an existing file)
-            reg_lnpfile = h5py.File(reg_lnp_file, 'w')
-            
-            for i, k in enumerate(indxs):
-                star_group = reg_lnpfile.create_group('star_%d' % i)
 
-                # transfer the information
-                for cp_name, cp_value in cur_lnpfile['star_%d' % k].items():
-                    star_group.create_dataset(cp_name,data=cp_value.value)
+def read_lnp_arrays(lnp_filename, n_stars=None):
+    """
+    Read the sparse likelihoods of all the stars in an lnp file into
+    concatenated arrays
 
-            reg_lnpfile.close()
+    Parameters
+    ----------
+    lnp_filename : string
+       filename of the lnp file (one group per star)
 
-        cur_lnpfile.close()
+    n_stars : int
+       number of stars, for files where the last stars have no group
+       (default: from the star groups in the file)
 
-        # Now, write out the WCS info and number of stars per pixel to file
-        #   do every subregion file to have an on-the-fly check
-        header = wcs_info.to_header()
-        hdu = fits.PrimaryHDU(wcs_nstars, header=header)
+    Returns
+    -------
+    dictonary of:
 
-        # Save to FITS file
-        hdu.writeto(out_filebase+'_nstars.fits', overwrite=True)
+    n_stars : int
+      number of stars (star_0 to star_n_stars-1)
+
+    names : list of str
+      names of the datasets of each star
+
+    offsets : dict of int arrays
+      start of the values of each star in the concatenated arrays
+      (n_stars + 1 values, for each dataset)
+
+    vals : dict of arrays
+      concatenated values of all the stars for each dataset
+      (the first axis is the concatenated one)
+    """
+    with h5py.File(lnp_filename, 'r') as lnp_file:
+        star_nums = np.array([int(sname[5:]) for sname in lnp_file.keys()
+                              if sname.startswith('star_')], dtype=int)
+        if n_stars is None:
+            n_stars = star_nums.max() + 1 if len(star_nums) > 0 else 0
+        if len(star_nums) > 0:
+            first_group = lnp_file['star_%d' % star_nums.min()]
+            names = list(first_group.keys())
+        else:
+            names = []
+
+        offsets = {}
+        vals = {}
+        for cp_name in names:
+            # stars missing from the file (e.g., partial runs) are empty
+            empty_shape = (0,) + first_group[cp_name].shape[1:]
+            empty_vals = np.zeros(empty_shape,
+                                  dtype=first_group[cp_name].dtype)
+            cur_vals = [lnp_file['star_%d' % k][cp_name][()]
+                        if ('star_%d' % k) in lnp_file else empty_vals
+                        for k in range(n_stars)]
+            offsets[cp_name] = np.concatenate(
+                [[0], np.cumsum([len(v) for v in cur_vals])]).astype(int)
+            vals[cp_name] = np.concatenate(cur_vals)
+
+    return {'n_stars': n_stars, 'names': names,
+            'offsets': offsets, 'vals': vals}
+
+def subset_lnp_arrays(lnp_arrays, indxs):
+    """
+    Sparse likelihoods of a subset of stars as concatenated arrays
 
+    Parameters
+    ----------
+    lnp_arrays : dict
+       output of read_lnp_arrays
 
+    indxs : int array
+       indexes of the stars in the subset
+
+    Returns
+    -------
+    dictonary in the format of read_lnp_arrays with the stars of the
+    subset (renumbered from 0)
+    """
+    offsets = {}
+    vals = {}
+    for cp_name in lnp_arrays['names']:
+        cur_offsets = lnp_arrays['offsets'][cp_name]
+        starts = cur_offsets[indxs]
+        n_vals = cur_offsets[np.asarray(indxs) + 1] - starts
+        offsets[cp_name] = np.concatenate([[0], np.cumsum(n_vals)]).astype(int)
+        # gather the values of all the stars in one indexing
+        vals_indxs = (np.repeat(starts - offsets[cp_name][:-1], n_vals)
+                      + np.arange(offsets[cp_name][-1]))
+        vals[cp_name] = lnp_arrays['vals'][cp_name][vals_indxs]
+
+    return {'n_stars': len(indxs), 'names': lnp_arrays['names'],
+            'offsets': offsets, 'vals': vals}
+
+def write_lnp_arrays(lnp_filename, lnp_arrays, indxs):
+    """
+    Write the sparse likelihoods for a subset of stars to an lnp file
+    (one group per star, renumbered from 0)
+
+    Parameters
+    ----------
+    lnp_filename : string
+       filename of the output lnp file (overwritten)
+
+    lnp_arrays : dict
+       output of read_lnp_arrays
+
+    indxs : int array
+       indexes of the stars to write
+    """
+    with h5py.File(lnp_filename, 'w') as reg_lnpfile:
+        for i, k in enumerate(indxs):
+            star_group = reg_lnpfile.create_group('star_%d' % i)
+            for cp_name in lnp_arrays['names']:
+                offsets = lnp_arrays['offsets'][cp_name]
+                star_group.create_dataset(
+                    cp_name,
+                    data=lnp_arrays['vals'][cp_name][offsets[k]:offsets[k+1]])
 
 def setup_spatial_regions(cat_filename,
                           pix_size=10.0):
@@ -282,6 +420,9 @@ def regions_for_objects(ra,
 
     name : str array
       string array composed of x_y
+
+    key : int array
+      integer key of the regions (unique for each x,y of this call)
     """
 
     # generate the array needed for fast conversion
@@ -295,17 +436,16 @@ def regions_for_objects(ra,
     # get the arrays to return
     x = pixcrd[:,0].astype(int)
     y = pixcrd[:,1].astype(int)
-    xy_name = [None]*len(ra)
+    xy_name = np.char.add(np.char.add(x.astype(str), '_'), y.astype(str))
+
+    if len(x) > 0:
+        xy_key = (y - y.min()) * (x.max() - x.min() + 1) + (x - x.min())
+    else:
+        xy_key = np.zeros(0, dtype=int)
 
-    x_str = x.astype(np.string_)
-    y_str = y.astype(np.string_)
-                  
-    for k in range(len(x)):
-        xy_name[k] = str(x[k]) + '_' + str(y[k])
-    
     # return the results as a dictonary
     #   values are truncated to provide the ids for the subregions
-    return {'x': x, 'y': y, 'name': xy_name}
+    return {'x': x, 'y': y, 'name': xy_name, 'key': xy_key}
 
 if __name__ == '__main__':
 
@@ -325,6 +465,8 @@ if __name__ == '__main__':
                         help="Filebase to use for output")
     parser.add_argument("-p","--reg_size", default=10., type=float,
                         help="spatial region size [arcsec]")
+    parser.add_argument("-n","--nprocs", default=1, type=int,
+                        help="number of processes to write the regions")
     args = parser.parse_args()
 
     
@@ -332,4 +474,5 @@ if __name__ == '__main__':
                                       stats_filename=args.stats_filename,
                                       region_filebase=args.region_filebase,
                                       output_filebase=args.output_filebase,
-                                      reg_size=args.reg_size)
+                                      reg_size=args.reg_size,
+                                      nprocs=args.nprocs)
@@ -2,7 +2,8 @@ import argparse
 
 from beast.physicsmodel.grid import FileSEDGrid
 import beast.observationmodel.noisemodel.generic_noisemodel as noisemodel
-from beast.observationmodel.observations import gen_SimObs_from_sedgrid
+from beast.observationmodel.observations import (gen_SimObs_from_sedgrid,
+                                                 write_SimObs_from_sedgrid)
 
 
 if __name__ == '__main__':
@@ -21,17 +22,35 @@ if __name__ == '__main__':
                         help='filter name to use for completeness')
     parser.add_argument('--ranseed', default=None, type=int,
                         help='seed for random number generator')
+    parser.add_argument('--chunk_size', default=None, type=int,
+                        help='simulate the objects in chunks of this size '
+                        + 'written to the outfile (HDF5) as they are done')
+    parser.add_argument('-n', '--nprocs', default=1, type=int,
+                        help='number of processes simulating the chunks')
+    parser.add_argument('--no_cov', action='store_true',
+                        help='do not correlate the noise with the '
+                        + 'covariance matrices of the noise model')
     args = parser.parse_args()
 
-    # get the physics model grid - includes priors
-    modelsedgrid = FileSEDGrid(args.physgrid)
-
-    # read in the noise model - includes bias, unc, and completeness
-    noisegrid = noisemodel.get_noisemodelcat(args.obsgrid)
-
-    simtable = gen_SimObs_from_sedgrid(modelsedgrid, noisegrid,
-                                       nsim=args.nsim,
-                                       compl_filter=args.compl_filter,
-                                       ranseed=args.ranseed)
-
-    simtable.write(args.outfile, overwrite=True)
+    if args.chunk_size is not None:
+        # simulate in chunks streamed to disk
+        write_SimObs_from_sedgrid(args.physgrid, args.obsgrid, args.outfile,
+                                  nsim=args.nsim,
+                                  compl_filter=args.compl_filter,
+                                  chunk_size=args.chunk_size,
+                                  nprocs=args.nprocs,
+                                  use_cov=not args.no_cov,
+                                  ranseed=args.ranseed)
+    else:
+        # get the physics model grid - includes priors
+        modelsedgrid = FileSEDGrid(args.physgrid)
+
+        # read in the noise model - includes bias, unc, and completeness
+        noisegrid = noisemodel.get_noisemodelcat(args.obsgrid)
+
+        simtable = gen_SimObs_from_sedgrid(modelsedgrid, noisegrid,
+                                           nsim=args.nsim,
+                                           compl_filter=args.compl_filter,
+                                           ranseed=args.ranseed)
+
+        simtable.write(args.outfile, overwrite=True)
@@ -12,7 +12,7 @@ regions.
 import argparse
 import numpy as np
 from astropy.table import Table
-from density_map import BinnedDensityMap
+from beast.tools.density_map import BinnedDensityMap
 
 
 def main():
@@ -37,20 +37,21 @@ def main():
 def split_catalog_using_map(catfile, binned_density_map, n, ra_colname='RA', dec_colname='DEC'):
     cat = Table.read(catfile)
 
-    ras = cat[ra_colname]
-    decs = cat[dec_colname]
+    ras = np.asarray(cat[ra_colname])
+    decs = np.asarray(cat[dec_colname])
 
-    bin_foreach_source = np.zeros(len(cat), dtype=int)
-    for i in range(len(cat)):
-        bin_foreach_source[i] = binned_density_map.bin_for_position(ras[i], decs[i])
+    bin_foreach_source = binned_density_map.bin_for_position(ras, decs)
 
-    binnrs = np.unique(bin_foreach_source)
-        
-    for b in binnrs:
-        sources_for_bin = np.where(bin_foreach_source == b)
-        subcat = cat[sources_for_bin]
+    # group the sources by bin (stable sort, so the sources keep their
+    # catalog order within each bin)
+    order = np.argsort(bin_foreach_source, kind='mergesort')
+    binnrs, starts = np.unique(bin_foreach_source[order], return_index=True)
+    stops = np.append(starts[1:], len(order))
+
+    for b, start, stop in zip(binnrs, starts, stops):
+        subcat = cat[order[start:stop]]
         subcat.write(catfile.replace('.fits', '_bin{}.fits'.format(b)))
-    
+
 
 if __name__ == '__main__':
     main()
@@ -9,7 +9,10 @@ from astropy.table import Table
 
 from ..observationmodel.noisemodel.generic_noisemodel import get_noisemodelcat
 from ..physicsmodel import grid
-from ..external import eztables
+from ..physicsmodel.helpers.gridcopy import copy_grid_rows
+from ..physicsmodel.helpers.gridinfo import (compute_grid_info,
+                                             merge_grid_info,
+                                             read_grid_info, unique_capped)
 from ..fitting.fit import save_pdf1d
 from ..fitting.fit_metrics import percentile
 
@@ -32,11 +35,14 @@ def uniform_slices(num_points, num_slices):
     return slices
 
 
-def split_grid(grid_fname, num_subgrids, overwrite=False):
+def split_grid(grid_fname, num_subgrids, overwrite=False, block_size=100000):
     """
     Splits a spectral or sed grid (they are the same class actually)
     according to grid point index (so basically, arbitrarily).
 
+    The subgrids are copied from the file block by block, so the grid
+    does not need to fit in memory.
+
     Parameters
     ----------
     grid_fname: string
@@ -49,6 +55,9 @@ def split_grid(grid_fname, num_subgrids, overwrite=False):
         any subgrids that already exist will be deleted if set to True.
         If set to False, skip over any grids that are already there.
 
+    block_size: integer
+        number of models copied at once
+
     Returns
     -------
     list of string
@@ -75,23 +84,21 @@ def split_grid(grid_fname, num_subgrids, overwrite=False):
 
         print('constructing subgrid ' + str(i))
 
-        # Load a slice as a SpectralGrid object
-        sub_g = grid.SpectralGrid(g.lamb[:], seds=g.seds[slc],
-                                  grid=eztables.Table(g.grid[slc]), backend='memory')
-        if g.filters is not None:
-            sub_g.grid.header['filters'] = ' '.join(g.filters)
-
-        # Save it to a new file
-        sub_g.writeHDF(subgrid_fname, append=False)
+        # Copy the slice to a new file
+        copy_grid_rows(grid_fname, subgrid_fname, rows=slc,
+                       block_size=block_size)
 
     return fnames
 
 
-def merge_grids(seds_fname, sub_names):
+def merge_grids(seds_fname, sub_names, block_size=100000):
     """
     Merges a set of grids into one big grid. The grids need to have the
     same columns
 
+    The subgrids are appended to the file block by block, so the grids
+    do not need to fit in memory.
+
     Parameters
     ----------
     seds_fname: string
@@ -99,18 +106,21 @@ def merge_grids(seds_fname, sub_names):
 
     sub_names: list of strings
         paths for the input grids
+
+    block_size: integer
+        number of models copied at once
     """
 
     if not os.path.isfile(seds_fname):
         for n in sub_names:
             print('Appending {} to {}'.format(n, seds_fname))
-            g = grid.FileSEDGrid(n)
-            g.writeHDF(seds_fname, append=True)
+            copy_grid_rows(n, seds_fname, append=True,
+                           block_size=block_size)
     else:
         print('{} already exists'.format(seds_fname))
 
 
-def subgrid_info(grid_fname, noise_fname=None):
+def subgrid_info(grid_fname, noise_fname=None, cap_unique=1000):
     """
     Generates a list of mins and maxes of all the quantities in the given grid
 
@@ -125,28 +135,34 @@ def subgrid_info(grid_fname, noise_fname=None):
         fluxes are added too, under the name 'log'+filter+'_wd_bias'
         (needs to conform to the name used in fit.py).
 
+    cap_unique: int
+        Stop keeping track of the unique values once there are more
+        than this number (see reduce_grid_info)
+
     Returns
     -------
     info_dict: dictionary
-        {name of quantity [string]: {'min': min, 'max': max, 'unique': unique values}}
+        {name of quantity [string]: {'min': min, 'max': max,
+                                     'num_unique': number of unique values,
+                                     'unique': unique values}}
+        unique is None (and num_unique a lower bound) if there are more
+        than cap_unique unique values
     """
 
     # Use the HDFStore (pytables) backend
     sedgrid = grid.FileSEDGrid(grid_fname, backend='hdf')
     seds = sedgrid.seds
 
-    info_dict = {}
-
-    qnames = sedgrid.keys()
-    for q in qnames:
-        qvals = sedgrid[q]
-        qmin = np.amin(qvals)
-        qmax = np.amax(qvals)
-        qunique = np.unique(qvals)
-        info_dict[q] = {}
-        info_dict[q]['min'] = qmin
-        info_dict[q]['max'] = qmax
-        info_dict[q]['unique'] = qunique
+    # metadata saved in the grid file, computed from the grid otherwise
+    info_dict = read_grid_info(grid_fname, n_models=len(seds))
+    if info_dict is None:
+        info_dict = compute_grid_info(sedgrid.grid[:],
+                                      cap_unique=cap_unique)
+    else:
+        # the saved codebooks may be longer than cap_unique
+        for q in info_dict:
+            if info_dict[q]['num_unique'] > cap_unique:
+                info_dict[q]['unique'] = None
 
     if noise_fname is not None:
         noisemodel = get_noisemodelcat(noise_fname)
@@ -165,13 +181,15 @@ def subgrid_info(grid_fname, noise_fname=None):
             # Be sure to cut out the -100's in the calculation of the minimum
             qmin = np.amin(f_fluxes[f_fluxes > -99.99])
             qmax = np.amax(f_fluxes)
-            qunique = np.unique(qvals)
+            qunique = unique_capped(f_fluxes, cap_unique=cap_unique)
 
             q = 'symlog' + f + '_wd_bias'
             info_dict[q] = {}
             info_dict[q]['min'] = qmin
             info_dict[q]['max'] = qmax
-            info_dict[q]['unique'] = qunique
+            info_dict[q]['num_unique'] = len(qunique)
+            info_dict[q]['unique'] = (qunique if len(qunique) <= cap_unique
+                                      else None)
 
     print('Gathered grid info for {}'.format(grid_fname))
     return info_dict
@@ -213,13 +231,16 @@ def reduce_grid_info(grid_fnames, noise_fnames=None, nprocs=1, cap_unique=1000):
     Returns
     -------
     info_dict: dictionary
-        {name of quantity: (min, max), ...}
+        {name of quantity: {'min': min, 'max': max,
+                            'num_unique': number of unique values}, ...}
     """
     # Gather the mins and maxes for the subgrid
+    #   (read from the metadata saved in the subgrid files if available)
     if noise_fnames is None:
-        arguments = [(g, None) for g in grid_fnames]
+        arguments = [(g, None, cap_unique) for g in grid_fnames]
     else:
-        arguments = list(zip(grid_fnames, noise_fnames))
+        arguments = [(g, n, cap_unique)
+                     for g, n in zip(grid_fnames, noise_fnames)]
 
     # Use generators here for memory efficiency
     parallel = nprocs > 1
@@ -230,37 +251,17 @@ def reduce_grid_info(grid_fnames, noise_fnames=None, nprocs=1, cap_unique=1000):
         info_dicts_generator = (subgrid_info(*a) for a in arguments)
 
     # Assume that all info dicts have the same keys
-    first_info_dict = next(info_dicts_generator)
-    qs = [q for q in first_info_dict]
-
-    union_min = {}
-    union_max = {}
-    union_unique = {}
-    # This last field can take up a lot of memory. A solution would be
-    # to allow a maximum number of values (50 is the default maximum
-    # number of bins anyway, and this value is needed to determine the
-    # number of bins).
-
-    for q in qs:
-        # Combine the values of the first subgrid
-        union_min[q] = first_info_dict[q]['min']
-        union_max[q] = first_info_dict[q]['max']
-        union_unique[q] = first_info_dict[q]['unique']
-
-    # And all the other subgrids (the generator just continues)
+    #   the unique values are only kept up to cap_unique of them
+    union_info = next(info_dicts_generator)
     for individual_dict in info_dicts_generator:
-        for q in qs:
-            union_min[q] = min(union_min[q], individual_dict[q]['min'])
-            union_max[q] = max(union_max[q], individual_dict[q]['max'])
-            if len(union_unique[q]) < cap_unique:
-                union_unique[q] = np.union1d(union_unique[q],
-                                             individual_dict[q]['unique'])
+        union_info = merge_grid_info(union_info, individual_dict,
+                                     cap_unique=cap_unique)
 
     result_dict = {}
-    for q in qs:
-        result_dict[q] = {'min': union_min[q],
-                          'max': union_max[q],
-                          'num_unique': len(union_unique[q])}
+    for q in union_info:
+        result_dict[q] = {'min': union_info[q]['min'],
+                          'max': union_info[q]['max'],
+                          'num_unique': union_info[q]['num_unique']}
 
     return result_dict
 
@@ -0,0 +1,132 @@
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+from beast.tools.create_background_density_map import (make_source_dens_map,
+                                                       make_wcs_for_map,
+                                                       get_pix_coords,
+                                                       pixel_indices,
+                                                       indices_for_pixel,
+                                                       xyrange,
+                                                       source_mask)
+
+
+def test_pixel_indices():
+    # sources exactly on the pixel edges, outside of the map and
+    #   without coordinates
+    n_x, n_y = 4, 3
+    pix_x = np.array([0., 0.5, 1., 1.5, 2., 4., 4.5, -1., 2.5, np.nan, 3.])
+    pix_y = np.array([1., 1., 0., 3., 2.5, 3., 1., 1., 3.5, 1., np.nan])
+
+    pix_indxs = pixel_indices(pix_x, pix_y, n_x, n_y)
+    expected = np.full(len(pix_x), -1)
+    for x, y in xyrange(n_x, n_y):
+        expected[indices_for_pixel(pix_x, pix_y, x, y)] = x * n_y + y
+    np.testing.assert_equal(pix_indxs, expected)
+    assert np.count_nonzero(pix_indxs >= 0) == 4
+
+
+def test_make_source_dens_map(tmpdir):
+    rng = np.random.RandomState(1)
+    n_x, n_y = 5, 4
+    ra_grid = 10. + np.linspace(0., 0.01, n_x + 1)
+    dec_grid = 41. + np.linspace(0., 0.008, n_y + 1)
+    w = make_wcs_for_map(ra_grid, dec_grid)
+
+    # random sources, sources on the pixel edges (up to the round off of
+    #   the WCS conversions, see test_pixel_indices for the exact edges)
+    #   and outside of the map
+    n_random = 300
+    edge_x, edge_y = np.meshgrid(np.arange(n_x + 1.), np.arange(n_y + 1.))
+    out_x = np.array([-0.5, n_x + 0.5, 2.5, 1.5, -2.])
+    out_y = np.array([1.5, 2.5, -0.5, n_y + 0.5, -2.])
+    pix = np.concatenate(
+        [np.column_stack([rng.uniform(0., n_x, n_random),
+                          rng.uniform(0., n_y, n_random)]),
+         np.column_stack([edge_x.ravel(), edge_y.ravel()]),
+         np.column_stack([out_x, out_y])])
+    world = w.wcs_pix2world(pix, 1)
+    n_stars = len(world)
+
+    cat = Table()
+    cat['RA'] = world[:, 0]
+    cat['DEC'] = world[:, 1]
+    cat['F475W_VEGA'] = rng.uniform(23., 28., n_stars)
+    for cur_rate in ['F475W_RATE', 'F814W_RATE', 'F336W_RATE']:
+        cat[cur_rate] = np.where(rng.uniform(size=n_stars) < 0.2, 0.,
+                                 rng.uniform(1., 2., n_stars))
+    rate_cols = ['F475W_RATE', 'F814W_RATE', 'F336W_RATE']
+    mag_cut = [24.5, 27]
+
+    output_base = str(tmpdir.join('cat'))
+    npts_map = make_source_dens_map(cat, ra_grid, dec_grid, output_base,
+                                    mag_name='F475W_VEGA', mag_cut=mag_cut)
+
+    # brute force maps, one pixel at a time
+    pix_x, pix_y = get_pix_coords(cat, w)
+    pix_area = w.wcs.cdelt[0] * w.wcs.cdelt[1] * 3600 ** 2
+    mags = np.asarray(cat['F475W_VEGA'])
+    for_SD = (mags >= mag_cut[0]) & (mags <= mag_cut[1])
+    band_zero = np.column_stack([cat[cur_rate] == 0.
+                                 for cur_rate in rate_cols])
+    expected_map = np.zeros((n_x, n_y))
+    expected_zero_map = np.zeros((n_x, n_y))
+    expected_band_maps = np.zeros((n_x, n_y, len(rate_cols)))
+    expected_dens = np.zeros(n_stars)
+    for x, y in xyrange(n_x, n_y):
+        indxs = indices_for_pixel(pix_x, pix_y, x, y)
+        n_SD = np.count_nonzero(for_SD[indxs])
+        expected_map[x, y] = n_SD / pix_area
+        if n_SD > 0:
+            expected_zero_map[x, y] = np.count_nonzero(
+                np.any(band_zero[indxs, :], axis=1))
+            expected_band_maps[x, y, :] = np.count_nonzero(
+                band_zero[indxs, :], axis=0)
+        # all the sources of the pixel, in the magnitude cut or not
+        expected_dens[indxs] = expected_map[x, y]
+
+    np.testing.assert_allclose(npts_map, expected_map, rtol=1e-12)
+    np.testing.assert_allclose(cat['SourceDensity'], expected_dens,
+                               rtol=1e-12)
+    assert np.all(expected_dens[-len(out_x):] == 0)
+    np.testing.assert_equal(
+        fits.getdata(output_base + '_npts_zero_fluxes_image.fits').T,
+        expected_zero_map)
+    for k, cur_rate in enumerate(rate_cols):
+        np.testing.assert_equal(
+            fits.getdata(output_base + cur_rate + '_image.fits').T,
+            expected_band_maps[:, :, k])
+
+    # catalog of the sources with non-zero fluxes in all the bands
+    good_cat = Table.read(output_base + '_with_sourceden.fits')
+    good = ~np.any(band_zero, axis=1)
+    np.testing.assert_allclose(good_cat['SourceDensity'], expected_dens[good],
+                               rtol=1e-12)
+
+
+def test_source_mask():
+    # sources inside the image, close to and off its edges, and without
+    #   coordinates
+    rng = np.random.RandomState(2)
+    shape = (40, 55)
+    radius = 4.3
+    x = np.concatenate([rng.uniform(-8., shape[1] + 8., 30),
+                        [-3., shape[1] + 2.5, 10.2, -20., np.nan]])
+    y = np.concatenate([rng.uniform(-8., shape[0] + 8., 30),
+                        [12.7, 20., -2.6, -20., 5.]])
+
+    mask = source_mask(x, y, radius, shape)
+
+    # brute force: pixels (centers at integer coordinates) overlapping
+    #   the disk of any source
+    rows, cols = np.mgrid[0:shape[0], 0:shape[1]]
+    expected = np.zeros(shape, dtype=bool)
+    for cur_x, cur_y in zip(x, y):
+        dx = np.maximum(np.abs(cols - cur_x) - 0.5, 0.)
+        dy = np.maximum(np.abs(rows - cur_y) - 0.5, 0.)
+        expected |= dx ** 2 + dy ** 2 < radius ** 2
+    np.testing.assert_equal(mask, expected)
+    assert not np.all(mask)
+
+    # no sources
+    assert not np.any(source_mask([], [], radius, shape))
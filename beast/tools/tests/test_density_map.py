@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+from astropy.table import Table
+
+from beast.tools.density_map import DensityMap, BinnedDensityMap
+from beast.tools.split_catalog_using_map import split_catalog_using_map
+
+
+def make_tile_data(n_x=3, n_y=5, seed=1):
+    """ tiles of a map with more DEC than RA tiles, in a random order """
+    rng = np.random.RandomState(seed)
+    ra_grid = 10. + 0.01 * np.arange(n_x + 1)
+    dec_grid = 41. + 0.005 * np.arange(n_y + 1)
+    x, y = np.meshgrid(np.arange(n_x), np.arange(n_y), indexing='ij')
+    order = rng.permutation(n_x * n_y)
+    x = x.ravel()[order]
+    y = y.ravel()[order]
+    tile_data = Table([x.astype(float), y.astype(float),
+                       rng.uniform(0., 10., n_x * n_y),
+                       ra_grid[x], ra_grid[x + 1],
+                       dec_grid[y], dec_grid[y + 1]],
+                      names=['i_ra', 'i_dec', 'value',
+                             'min_ra', 'max_ra', 'min_dec', 'max_dec'])
+    tile_data.meta['ra_grid'] = ra_grid
+    tile_data.meta['dec_grid'] = dec_grid
+    return tile_data
+
+
+def brute_force_tiles(tile_data, ras, decs):
+    """ tile of each position, one tile at a time (the outer edges of the
+    map are extended to infinity) """
+    min_ra = np.where(tile_data['i_ra'] == 0, -np.inf, tile_data['min_ra'])
+    max_ra = np.where(tile_data['i_ra'] == tile_data['i_ra'].max(), np.inf,
+                      tile_data['max_ra'])
+    min_dec = np.where(tile_data['i_dec'] == 0, -np.inf,
+                       tile_data['min_dec'])
+    max_dec = np.where(tile_data['i_dec'] == tile_data['i_dec'].max(),
+                       np.inf, tile_data['max_dec'])
+    tiles = np.full(len(ras), -1)
+    for k in range(len(tile_data)):
+        in_tile = ((ras >= min_ra[k]) & (ras < max_ra[k])
+                   & (decs >= min_dec[k]) & (decs < max_dec[k]))
+        assert np.all(tiles[in_tile] < 0)
+        tiles[in_tile] = k
+    return tiles
+
+
+def test_tile_for_position():
+    tile_data = make_tile_data()
+    dm = DensityMap(tile_data)
+    ra_grid = tile_data.meta['ra_grid']
+    dec_grid = tile_data.meta['dec_grid']
+
+    # positions inside, on the tile edges, and outside of the map
+    rng = np.random.RandomState(2)
+    ras = np.concatenate([rng.uniform(ra_grid[0], ra_grid[-1], 50),
+                          ra_grid, [ra_grid[0] - 1., ra_grid[-1] + 1.,
+                                    ra_grid[1], ra_grid[-1] + 0.001]])
+    decs = np.concatenate([rng.uniform(dec_grid[0], dec_grid[-1], 50),
+                           dec_grid[:len(ra_grid)],
+                           [dec_grid[2], dec_grid[-1] + 0.002,
+                            dec_grid[0] - 1., dec_grid[-1]]])
+    expected = brute_force_tiles(tile_data, ras, decs)
+
+    np.testing.assert_equal(dm.tile_for_position(ras, decs), expected)
+    for ra, dec, tile in zip(ras, decs, expected):
+        assert dm.tile_for_position(ra, dec) == tile
+
+
+def test_tile_for_position_missing_tile():
+    tile_data = make_tile_data()
+    dm = DensityMap(tile_data[1:])
+    i_ra = int(tile_data['i_ra'][0])
+    i_dec = int(tile_data['i_dec'][0])
+    with pytest.raises(KeyError):
+        dm.tile_for_position(tile_data['min_ra'][0] + 0.001,
+                             tile_data['min_dec'][0] + 0.001)
+    assert dm.tile_index[i_ra, i_dec] == -1
+
+
+def test_split_catalog_using_map(tmpdir):
+    bdm = BinnedDensityMap.create(make_tile_data(), N_bins=3)
+    ra_grid = bdm.ra_grid
+    dec_grid = bdm.dec_grid
+
+    rng = np.random.RandomState(3)
+    n_stars = 200
+    cat = Table({'ID': np.arange(n_stars),
+                 'RA': rng.uniform(ra_grid[0] - 0.005, ra_grid[-1] + 0.005,
+                                   n_stars),
+                 'DEC': rng.uniform(dec_grid[0], dec_grid[-1], n_stars)})
+    catfile = str(tmpdir.join('cat.fits'))
+    cat.write(catfile)
+
+    split_catalog_using_map(catfile, bdm, 3)
+
+    # the sources of each bin, in the catalog order
+    bins = np.asarray(bdm.tile_data['bin'])[
+        brute_force_tiles(bdm.tile_data, cat['RA'], cat['DEC'])]
+    assert len(np.unique(bins)) > 1
+    for b in np.unique(bins):
+        subcat = Table.read(catfile.replace('.fits',
+                                            '_bin{}.fits'.format(b)))
+        np.testing.assert_equal(np.asarray(subcat['ID']),
+                                np.asarray(cat['ID'][bins == b]))
@@ -0,0 +1,115 @@
+import json
+import threading
+
+import numpy as np
+import pytest
+from astropy.table import Table
+from astropy.io import fits
+
+try:
+    from http.server import HTTPServer
+    from urllib.error import HTTPError
+except ImportError:
+    from BaseHTTPServer import HTTPServer
+    from urllib2 import HTTPError
+
+import beast.observationmodel.noisemodel.generic_noisemodel as noisemodel
+from beast.fitting import fit
+from beast.tools.fit_server import (FitService, SEDObservations,
+                                    _FitRequestHandler, request_fit)
+from beast.tests.helpers import (make_sed_grid, make_noisemodel,
+                                 make_obs_seds, compare_tables)
+
+
+@pytest.fixture
+def fit_inputs(tmpdir):
+    sedgrid = make_sed_grid()
+    noise = noisemodel.get_noisemodelcat(
+        make_noisemodel(sedgrid, str(tmpdir.join('noise.hd5'))))
+    seds = make_obs_seds(sedgrid, 10)
+    yield (sedgrid, noise, seds)
+    noise.close()
+
+
+def test_fit_service(tmpdir, fit_inputs):
+    (sedgrid, noise, seds) = fit_inputs
+    filters = sedgrid.header['filters'].split()
+    ra = 10. + 0.01*np.arange(len(seds))
+    dec = 41. + 0.01*np.arange(len(seds))
+    keys = ['logA', 'M_ini', 'Av']
+
+    # same stats and 1D PDFs as the fitting of a catalog
+    stats_fname = str(tmpdir.join('stats.fits'))
+    pdf1d_fname = str(tmpdir.join('pdf1d.fits'))
+    obs = SEDObservations(seds, filters, ra=ra, dec=dec)
+    fit.summary_table_memory(obs, noise, sedgrid, keys=list(keys),
+                             threshold=-10., stats_outname=stats_fname,
+                             pdf1d_outname=pdf1d_fname)
+
+    service = FitService(sedgrid, noise, keys=list(keys), threshold=-10.)
+    (stats_tab, pdf1d_vals) = service.fit(seds, ra=ra, dec=dec)
+
+    compare_tables(Table.read(stats_fname), stats_tab)
+    pdf1d_tab = fits.open(pdf1d_fname)
+    for qname, vals in zip(service.qnames, pdf1d_vals):
+        np.testing.assert_allclose(vals, pdf1d_tab[qname].data)
+    pdf1d_tab.close()
+
+
+def test_fit_service_output_files(tmpdir, fit_inputs):
+    (sedgrid, noise, seds) = fit_inputs
+    keys = ['logA', 'M_ini', 'Av']
+
+    # no files saved without an output directory
+    service = FitService(sedgrid, noise, keys=list(keys))
+    with pytest.raises(ValueError):
+        service.fit_request({'seds': seds.tolist(),
+                             'stats_outname': 'stats.fits'})
+
+    # files only saved in the output directory
+    outdir = tmpdir.mkdir('out')
+    service = FitService(sedgrid, noise, keys=list(keys),
+                         output_dir=str(outdir))
+    for fname in ['../stats.fits', str(tmpdir.join('stats.fits')),
+                  'sub/../../stats.fits']:
+        with pytest.raises(ValueError):
+            service.fit_request({'seds': seds.tolist(),
+                                 'stats_outname': fname})
+    answer = service.fit_request({'seds': seds.tolist(),
+                                  'stats_outname': 'stats.fits'})
+    stats_tab = Table.read(str(outdir.join('stats.fits')))
+    np.testing.assert_allclose(stats_tab['Pmax'], answer['stats']['Pmax'])
+
+
+def test_fit_server_errors(fit_inputs):
+    (sedgrid, noise, seds) = fit_inputs
+    service = FitService(sedgrid, noise, keys=['logA', 'M_ini', 'Av'])
+
+    server = HTTPServer(('localhost', 0), _FitRequestHandler)
+    server.fit_service = service
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    url = 'http://localhost:{0:d}'.format(server.server_address[1])
+    try:
+        answer = request_fit(seds, url=url)
+        assert len(answer['stats']['Pmax']) == len(seds)
+
+        # invalid request
+        with pytest.raises(HTTPError) as err:
+            request_fit(seds[:, :2], url=url)
+        assert err.value.code == 400
+        assert 'error' in json.loads(err.value.read().decode('utf-8'))
+
+        # failed fit
+        def fail(*args, **kwargs):
+            raise RuntimeError('fit failed')
+        service.fit = fail
+        with pytest.raises(HTTPError) as err:
+            request_fit(seds, url=url)
+        assert err.value.code == 500
+        assert 'fit failed' in json.loads(
+            err.value.read().decode('utf-8'))['error']
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
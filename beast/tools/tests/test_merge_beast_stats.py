@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from astropy.table import Table, Column, vstack
+
+from beast.tools.merge_beast_stats import merge_stats_files, _reorder_tag
+
+
+def make_stats_files(tmpdir):
+    """ small stats files with strings of different widths, bool and
+    integer columns with zero point offsets """
+    rng = np.random.RandomState(1)
+    stats_files = []
+    for k, n_stars in enumerate([7, 12, 5]):
+        tab = Table()
+        tab['Name'] = ['star{0}'.format('x' * (3*k + i % 4))
+                       for i in range(n_stars)]
+        tab['RA'] = rng.uniform(10., 11., n_stars)
+        tab['Pmax'] = rng.normal(size=n_stars).astype(np.float32)
+        tab['Pmax_indx'] = rng.randint(0, 1000, n_stars)
+        tab['n_models'] = Column(rng.randint(0, 60000, n_stars),
+                                 dtype=np.uint16)
+        tab['n_bins'] = Column(rng.randint(0, 2**32, n_stars),
+                               dtype=np.uint32)
+        tab['coarse_edge'] = rng.uniform(size=n_stars) > 0.5
+        fname = str(tmpdir.join('proj_sd{0}-{1}_sub{2}_stats.fits'.format(
+            k, k + 1, k % 2)))
+        tab.write(fname)
+        stats_files.append(fname)
+    return stats_files
+
+
+def as_array(col):
+    """ column values with the strings decoded """
+    vals = np.asarray(col)
+    if vals.dtype.kind == 'S':
+        vals = np.char.decode(vals, 'utf-8')
+    return vals
+
+
+def expected_merge(stats_files):
+    tabs = []
+    for fname in stats_files:
+        tab = Table.read(fname)
+        tab['reorder_tag'] = _reorder_tag(fname)
+        tabs.append(tab)
+    return vstack(tabs)
+
+
+@pytest.mark.parametrize('out_format', ['fits', 'hdf5'])
+@pytest.mark.parametrize('nthreads,block_size', [(1, 100000), (1, 4),
+                                                 (2, 100000)])
+def test_merge_files(tmpdir, out_format, nthreads, block_size):
+    # (the reorder tag is found in the full path, so the name of the test,
+    #   giving the tmpdir, must not contain _sd or _stats)
+    stats_files = make_stats_files(tmpdir)
+    out_base = str(tmpdir.join('merged'))
+    n_rows = merge_stats_files(stats_files, out_base, out_format=out_format,
+                               nthreads=nthreads, block_size=block_size)
+
+    expected = expected_merge(stats_files)
+    assert n_rows == len(expected)
+    if out_format == 'fits':
+        merged = Table.read(out_base + '_stats.fits')
+    else:
+        merged = Table.read(out_base + '_stats.hd5', path='stats')
+
+    assert merged.colnames == expected.colnames
+    assert as_array(merged['reorder_tag'])[0] == 'sd0-1_sub0'
+    for name in expected.colnames:
+        vals = as_array(merged[name])
+        expected_vals = as_array(expected[name])
+        np.testing.assert_equal(vals, expected_vals, err_msg=name)
+        assert vals.dtype.kind == expected_vals.dtype.kind, name
+        if vals.dtype.kind != 'U':
+            assert vals.dtype.itemsize == expected_vals.dtype.itemsize, name
@@ -0,0 +1,191 @@
+import os
+import time
+
+import pytest
+
+from beast.tools.pipeline import Pipeline
+
+
+def write_value(outname, value, log_fname, input_files=()):
+    """ stage writing a value (and the inputs), logging its runs """
+    with open(log_fname, 'a') as logfile:
+        logfile.write(os.path.basename(outname) + '\n')
+    contents = [str(value)]
+    for fname in input_files:
+        with open(fname, 'r') as infile:
+            contents.append(infile.read())
+    with open(outname, 'w') as outfile:
+        outfile.write(' '.join(contents))
+
+
+def write_when_other(outname, other_fname, timeout=60.):
+    """ stage writing its output and waiting for the output of another """
+    with open(outname, 'w') as outfile:
+        outfile.write('done')
+    start = time.time()
+    while not os.path.isfile(other_fname):
+        if time.time() - start > timeout:
+            raise RuntimeError('{0} not written'.format(other_fname))
+        time.sleep(0.05)
+
+
+def fail_raise(outname):
+    raise ValueError('bad parameters')
+
+
+def fail_exit(outname):
+    print('stage failed')
+    exit()
+
+
+def make_pipeline(tmpdir, value_a=1, value_b=2):
+    """ stages a and b, and c depending on both """
+    log_fname = str(tmpdir.join('runs.log'))
+    fnames = dict((name, str(tmpdir.join(name + '.txt')))
+                  for name in ['a', 'b', 'c'])
+    pipe = Pipeline(cache_dir=str(tmpdir.join('cache')))
+    pipe.add_stage('a', write_value,
+                   params={'outname': fnames['a'], 'value': value_a,
+                           'log_fname': log_fname},
+                   outputs=[fnames['a']])
+    pipe.add_stage('b', write_value,
+                   params={'outname': fnames['b'], 'value': value_b,
+                           'log_fname': log_fname},
+                   outputs=[fnames['b']])
+    pipe.add_stage('c', write_value,
+                   params={'outname': fnames['c'], 'value': 0,
+                           'log_fname': log_fname,
+                           'input_files': [fnames['a'], fnames['b']]},
+                   outputs=[fnames['c']], depends=['a', 'b'])
+    return pipe, fnames
+
+
+def read_runs(tmpdir):
+    """ stages run since the last call """
+    log_fname = str(tmpdir.join('runs.log'))
+    if not os.path.isfile(log_fname):
+        return []
+    with open(log_fname, 'r') as logfile:
+        runs = [os.path.splitext(line.strip())[0] for line in logfile]
+    os.remove(log_fname)
+    return sorted(runs)
+
+
+@pytest.mark.parametrize('nprocs', [1, 2])
+def test_pipeline_cache(tmpdir, nprocs):
+    pipe, fnames = make_pipeline(tmpdir)
+    status = pipe.run(nprocs=nprocs)
+    assert list(status.values()) == ['run', 'run', 'run']
+    assert read_runs(tmpdir) == ['a', 'b', 'c']
+    with open(fnames['c'], 'r') as infile:
+        assert infile.read() == '0 1 2'
+
+    # nothing run again
+    pipe, fnames = make_pipeline(tmpdir)
+    status = pipe.run(nprocs=nprocs)
+    assert list(status.values()) == ['cached', 'cached', 'cached']
+    assert read_runs(tmpdir) == []
+
+    # a forced stage and the stages depending on it are run
+    status = pipe.run(nprocs=nprocs, force=['a'])
+    assert dict(status) == {'a': 'run', 'b': 'cached', 'c': 'run'}
+    assert read_runs(tmpdir) == ['a', 'c']
+
+    # only the stages needed for the requested stages
+    pipe, fnames = make_pipeline(tmpdir)
+    assert dict(pipe.run(nprocs=nprocs, stages=['b'], force=['b'])) == \
+        {'b': 'run'}
+    assert read_runs(tmpdir) == ['b']
+
+
+def test_pipeline_invalidation(tmpdir):
+    pipe, fnames = make_pipeline(tmpdir)
+    pipe.run()
+    read_runs(tmpdir)
+
+    # a changed parameter reruns the stage and the stages depending on it
+    pipe, fnames = make_pipeline(tmpdir, value_b=3)
+    assert dict(pipe.run()) == {'a': 'cached', 'b': 'run', 'c': 'run'}
+    assert read_runs(tmpdir) == ['b', 'c']
+    with open(fnames['c'], 'r') as infile:
+        assert infile.read() == '0 1 3'
+
+    # previous runs are kept in the cache
+    pipe, fnames = make_pipeline(tmpdir)
+    pipe.run()
+    read_runs(tmpdir)
+    pipe, fnames = make_pipeline(tmpdir, value_b=3)
+    assert dict(pipe.run()) == {'a': 'cached', 'b': 'run', 'c': 'run'}
+    read_runs(tmpdir)
+
+    # a modified or missing output reruns the stage
+    with open(fnames['a'], 'a') as outfile:
+        outfile.write(' modified')
+    pipe, fnames = make_pipeline(tmpdir, value_b=3)
+    assert dict(pipe.run()) == {'a': 'run', 'b': 'cached', 'c': 'run'}
+    assert read_runs(tmpdir) == ['a', 'c']
+    os.remove(fnames['c'])
+    pipe, fnames = make_pipeline(tmpdir, value_b=3)
+    assert dict(pipe.run()) == {'a': 'cached', 'b': 'cached', 'c': 'run'}
+    assert read_runs(tmpdir) == ['c']
+
+    # a modified input file reruns the stage
+    input_fname = str(tmpdir.join('input.txt'))
+    for content in ['obs', 'new obs']:
+        with open(input_fname, 'w') as outfile:
+            outfile.write(content)
+        pipe = Pipeline(cache_dir=str(tmpdir.join('cache')))
+        pipe.add_stage('d', write_value,
+                       params={'outname': str(tmpdir.join('d.txt')),
+                               'value': 0,
+                               'log_fname': str(tmpdir.join('runs.log')),
+                               'input_files': [input_fname]},
+                       outputs=[str(tmpdir.join('d.txt'))],
+                       input_files=[input_fname])
+        assert dict(pipe.run()) == {'d': 'run'}
+        assert read_runs(tmpdir) == ['d']
+
+
+def test_pipeline_parallel(tmpdir):
+    # the two first stages only finish if they run at the same time
+    fnames = dict((name, str(tmpdir.join(name + '.txt')))
+                  for name in ['a', 'b', 'c'])
+    pipe = Pipeline(cache_dir=str(tmpdir.join('cache')))
+    pipe.add_stage('a', write_when_other,
+                   params={'outname': fnames['a'],
+                           'other_fname': fnames['b']},
+                   outputs=[fnames['a']])
+    pipe.add_stage('b', write_when_other,
+                   params={'outname': fnames['b'],
+                           'other_fname': fnames['a']},
+                   outputs=[fnames['b']])
+    pipe.add_stage('c', write_value,
+                   params={'outname': fnames['c'], 'value': 0,
+                           'log_fname': str(tmpdir.join('runs.log')),
+                           'input_files': [fnames['a'], fnames['b']]},
+                   outputs=[fnames['c']], depends=['a', 'b'])
+    pipe.run(nprocs=2)
+    with open(fnames['c'], 'r') as infile:
+        assert infile.read() == '0 done done'
+
+
+@pytest.mark.parametrize('nprocs', [1, 2])
+@pytest.mark.parametrize('func,error', [(fail_raise, ValueError),
+                                        (fail_exit, RuntimeError)])
+def test_pipeline_failure(tmpdir, nprocs, func, error):
+    pipe, fnames = make_pipeline(tmpdir)
+    fail_fname = str(tmpdir.join('fail.txt'))
+    pipe.add_stage('fail', func, params={'outname': fail_fname},
+                   outputs=[fail_fname], depends=['a'])
+    pipe.add_stage('d', write_value,
+                   params={'outname': str(tmpdir.join('d.txt')), 'value': 0,
+                           'log_fname': str(tmpdir.join('runs.log'))},
+                   outputs=[str(tmpdir.join('d.txt'))], depends=['fail'])
+
+    # the error of the stage is raised once the running stages are done,
+    #   the stages depending on it are not run
+    with pytest.raises(error):
+        pipe.run(nprocs=nprocs)
+    assert 'd' not in read_runs(tmpdir)
+    assert not pipe.is_cached('fail')
+    assert pipe.is_cached('a')
@@ -0,0 +1,158 @@
+import os
+import glob
+
+import h5py
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table, vstack
+
+from beast.tools.reorder_beast_results_spatial import (
+    reorder_beast_results_spatial, setup_spatial_regions, regions_for_objects)
+from beast.tools.condense_beast_results_spatial import condense_files
+
+
+def write_results(filebase, cat, n_bins, rng, missing_lnp=()):
+    """ stats, pdf1d (2 quantities), and lnp files for the stars of a
+    catalog, without the lnp groups of the stars in missing_lnp """
+    cat.write(filebase + '_stats.fits', overwrite=True)
+
+    n_stars = len(cat)
+    hdulist = fits.HDUList([fits.PrimaryHDU()])
+    for qname, n_bin in zip(['logA', 'M_ini'], n_bins):
+        pdf1d = np.empty((n_stars + 1, n_bin))
+        pdf1d[:-1, :] = rng.uniform(size=(n_stars, n_bin))
+        pdf1d[-1, :] = np.arange(n_bin)
+        chdu = fits.PrimaryHDU(pdf1d)
+        chdu.header.set('XTENSION', 'IMAGE')
+        chdu.header.set('EXTNAME', qname)
+        hdulist.append(chdu)
+    hdulist.writeto(filebase + '_pdf1d.fits', overwrite=True)
+
+    with h5py.File(filebase + '_lnp.hd5', 'w') as lnp_file:
+        for k in range(n_stars):
+            if k in missing_lnp:
+                continue
+            n_models = rng.randint(1, 6)
+            star_group = lnp_file.create_group('star_%d' % k)
+            star_group.create_dataset('idx', data=rng.randint(0, 1000,
+                                                              n_models))
+            star_group.create_dataset('lnp', data=rng.normal(size=n_models))
+
+
+def read_results(filebase):
+    """ stats, pdf1d, and lnp of the stars of a set of results files """
+    cat = Table.read(filebase + '_stats.fits')
+    with fits.open(filebase + '_pdf1d.fits') as hdulist:
+        pdf1d = [hdu.data for hdu in hdulist[1:]]
+    with h5py.File(filebase + '_lnp.hd5', 'r') as lnp_file:
+        lnp = dict((sname, dict((name, lnp_file[sname][name][()])
+                                for name in lnp_file[sname]))
+                   for sname in lnp_file.keys())
+    return cat, pdf1d, lnp
+
+
+def check_lnp(lnp, k, expected_lnp, expected_k):
+    """ lnp group k is the same as expected_k (both missing or empty) """
+    star = lnp.get('star_%d' % k, {'idx': [], 'lnp': []})
+    expected_star = expected_lnp.get('star_%d' % expected_k,
+                                     {'idx': [], 'lnp': []})
+    for name in ['idx', 'lnp']:
+        np.testing.assert_equal(star[name], expected_star[name])
+
+
+def test_condense_lnp_offsets(tmpdir):
+    # the last star of the first file has no lnp group
+    rng = np.random.RandomState(1)
+    reg_dir = tmpdir.mkdir('spatial').mkdir('b1_0_0')
+    filebases = [str(reg_dir.join('0_0_sd0-1_sub%d' % k)) for k in [0, 1]]
+    for filebase, n_stars, missing in zip(filebases, [3, 2], [(2,), ()]):
+        cat = Table({'Name': ['s%d' % k for k in range(n_stars)],
+                     'RA': rng.uniform(size=n_stars),
+                     'DEC': rng.uniform(size=n_stars)})
+        write_results(filebase, cat, [4, 5], rng, missing_lnp=missing)
+
+    condense_files(filedir=str(tmpdir.join('spatial')))
+    cat, pdf1d, lnp = read_results(str(tmpdir.join('spatial', 'b1_0_0')))
+
+    assert len(cat) == 5
+    assert sorted(lnp.keys()) == ['star_0', 'star_1', 'star_3', 'star_4']
+    sub_lnp = [read_results(filebase)[2] for filebase in filebases]
+    for k, (i, sub_k) in enumerate([(0, 0), (0, 1), (0, 2), (1, 0), (1, 1)]):
+        check_lnp(lnp, k, sub_lnp[i], sub_k)
+
+
+def test_reorder_condense(tmpdir):
+    # (the reorder tag is found in the full path, so the name of the test,
+    #   giving the tmpdir, must not contain _sd or _stats)
+    rng = np.random.RandomState(2)
+    n_stars = 60
+    full_cat = Table({'Name': ['star%d' % k for k in range(n_stars)],
+                      'RA': 10. + rng.uniform(0., 30., n_stars) / 3600.,
+                      'DEC': 41. + rng.uniform(0., 30., n_stars) / 3600.,
+                      'Pmax': rng.normal(size=n_stars)})
+    stats_filename = str(tmpdir.join('full_cat.fits'))
+    full_cat.write(stats_filename)
+
+    # BEAST run split in 3 files with different pdf1d sizes, some stars
+    #   without lnp groups (including the last star of a file)
+    tmpdir.mkdir('run')
+    tmpdir.mkdir('spatial')
+    splits = [(0, 25), (25, 45), (45, 60)]
+    run_filebases = [str(tmpdir.join('run', 'proj_sd0-1_sub%d' % k))
+                     for k in range(3)]
+    for filebase, (k1, k2), n_bins, missing in zip(
+            run_filebases, splits, [[4, 6], [5, 6], [4, 3]],
+            [(3, 24), (), (0,)]):
+        write_results(filebase, full_cat[k1:k2], n_bins, rng,
+                      missing_lnp=missing)
+
+    out_filebase = str(tmpdir.join('spatial', 'b1'))
+    reorder_beast_results_spatial(stats_filename=stats_filename,
+                                  region_filebase=str(tmpdir.join('run',
+                                                                  'proj')),
+                                  output_filebase=out_filebase,
+                                  reg_size=10.)
+    condense_files(filedir=str(tmpdir.join('spatial')))
+
+    # expected regions of the stars
+    wcs_info, n_x, n_y = setup_spatial_regions(stats_filename, pix_size=10.)
+    xy_vals = regions_for_objects(full_cat['RA'], full_cat['DEC'], wcs_info)
+    with fits.open(out_filebase + '_nstars.fits') as hdulist:
+        nstars = hdulist[0].data
+    assert nstars.sum() == n_stars
+    np.testing.assert_equal(
+        nstars[xy_vals['y'], xy_vals['x']],
+        [np.sum(xy_vals['name'] == name) for name in xy_vals['name']])
+
+    run_results = [read_results(filebase) for filebase in run_filebases]
+    cond_files = sorted(glob.glob(out_filebase + '_*_stats.fits'))
+    assert len(cond_files) == len(np.unique(xy_vals['name']))
+    for uxy_name in np.unique(xy_vals['name']):
+        cat, pdf1d, lnp = read_results(out_filebase + '_' + uxy_name)
+
+        # stars of the region, by file and in their order in each file
+        expected = [(i, k - k1) for i, (k1, k2) in enumerate(splits)
+                    for k in range(k1, k2) if xy_vals['name'][k] == uxy_name]
+        expected_cat = vstack([run_results[i][0][k:k+1]
+                               for i, k in expected])
+        np.testing.assert_equal(np.asarray(cat['Name']),
+                                np.asarray(expected_cat['Name']))
+        np.testing.assert_equal(np.asarray(cat['Pmax']),
+                                np.asarray(expected_cat['Pmax']))
+        assert np.all(cat['reorder_tag'] == [
+            os.path.basename(run_filebases[i])[5:] for i, k in expected])
+
+        for q in range(2):
+            n_bin = max(run_results[i][1][q].shape[1] for i, k in expected)
+            assert pdf1d[q].shape == (len(expected), n_bin, 2)
+            for j, (i, k) in enumerate(expected):
+                run_pdf1d = run_results[i][1][q]
+                n_run_bin = run_pdf1d.shape[1]
+                np.testing.assert_equal(pdf1d[q][j, :n_run_bin, 0],
+                                        run_pdf1d[k, :])
+                np.testing.assert_equal(pdf1d[q][j, :n_run_bin, 1],
+                                        run_pdf1d[-1, :])
+                assert np.all(np.isnan(pdf1d[q][j, n_run_bin:, :]))
+
+        for j, (i, k) in enumerate(expected):
+            check_lnp(lnp, j, run_results[i][2], k)
@@ -1,13 +1,17 @@
 import os
 
 import numpy as np
+import pytest
 from astropy.tests.helper import remote_data
 from astropy.table import Table
 from astropy.io import fits
 import tables
 
 from beast.tools import subgridding_tools
-from beast.tests.helpers import download_rename
+from beast.tools.remove_filters import remove_filters_from_files
+from beast.tests.helpers import (download_rename, make_sed_grid,
+                                 make_noisemodel)
+from beast.physicsmodel.helpers.gridcopy import copy_noisemodel_rows
 from beast.physicsmodel.grid import FileSEDGrid
 from beast.observationmodel.noisemodel.generic_noisemodel import get_noisemodelcat
 from beast.fitting.tests.test_fit_grid import get_obscat
@@ -44,6 +48,76 @@ def split_and_check(grid_fname, num_subgrids):
         os.remove(f)
 
 
+def test_split_merge_grid(tmpdir):
+    grid_fname = str(tmpdir.join('seds.grid.hd5'))
+    make_sed_grid().writeHDF(grid_fname)
+
+    # split in blocks smaller than the subgrids, and merged back
+    sub_fnames = subgridding_tools.split_grid(grid_fname, 3, block_size=50)
+    merged_fname = str(tmpdir.join('merged.grid.hd5'))
+    subgridding_tools.merge_grids(merged_fname, sub_fnames, block_size=70)
+
+    complete_g = FileSEDGrid(grid_fname)
+    merged_g = FileSEDGrid(merged_fname)
+    np.testing.assert_equal(merged_g.lamb, complete_g.lamb)
+    np.testing.assert_equal(merged_g.seds, complete_g.seds)
+    np.testing.assert_equal(merged_g.grid.data, complete_g.grid.data)
+    assert merged_g.header['filters'] == complete_g.header['filters']
+
+
+def test_remove_filters(tmpdir):
+    sedgrid = make_sed_grid()
+    filters = sedgrid.header['filters'].split()
+    grid_fname = str(tmpdir.join('seds.grid.hd5'))
+    sedgrid.writeHDF(grid_fname)
+    noise_fname = make_noisemodel(sedgrid, str(tmpdir.join('noise.hd5')),
+                                  full_cov=True)
+    cat_fname = str(tmpdir.join('cat.fits'))
+    Table(sedgrid.seds[:10],
+          names=['{}_rate'.format(cfilter.lower())
+                 for cfilter in filters]).write(cat_fname)
+
+    outbase = str(tmpdir.join('lessfilters'))
+    remove_filters_from_files(cat_fname, grid_fname, noise_fname, outbase,
+                              ['f1', 'f3'], block_size=50)
+
+    # same as removing the filters from the grid and noise model in memory
+    kindxs = [0, 2]
+    new_g = FileSEDGrid('{}_sed.grid.hd5'.format(outbase))
+    assert new_g.header['filters'].split() == [filters[k] for k in kindxs]
+    np.testing.assert_equal(new_g.seds, sedgrid.seds[:, kindxs])
+    np.testing.assert_equal(new_g.lamb, sedgrid.lamb[kindxs])
+    for key in sedgrid.grid.keys():
+        np.testing.assert_equal(new_g.grid[key], sedgrid.grid[key])
+
+    noise = get_noisemodelcat(noise_fname)
+    new_noise = get_noisemodelcat('{}_noisemodel.grid.hd5'.format(outbase))
+    for name in ['bias', 'error', 'completeness']:
+        np.testing.assert_equal(new_noise.get_node('/' + name)[:],
+                                noise.get_node('/' + name)[:, kindxs])
+    assert '/q_norm' not in new_noise
+    new_noise.close()
+    noise.close()
+
+    new_cat = Table.read('{}_cat.fits'.format(outbase))
+    assert new_cat.colnames == ['f0_rate', 'f2_rate']
+
+    # the arrays that depend on all the filters cannot be copied for a
+    #   subset of the filters
+    for name in ['q_norm', 'icov_diag', 'icov_offdiag']:
+        with pytest.raises(ValueError):
+            copy_noisemodel_rows(noise_fname,
+                                 str(tmpdir.join(name + '.hd5')),
+                                 filter_indxs=kindxs, names=[name])
+
+    # only the per filter arrays copied by default
+    copy_noisemodel_rows(noise_fname, str(tmpdir.join('noise_sub.hd5')),
+                         filter_indxs=kindxs)
+    with tables.open_file(str(tmpdir.join('noise_sub.hd5'))) as noise_sub:
+        assert sorted(node.name for node in noise_sub.list_nodes('/')) == \
+            ['bias', 'completeness', 'error']
+
+
 @remote_data
 def test_split_grid():
     seds_trim_fname = download_rename('beast_example_phat_seds_trim.grid.hd5')
@@ -0,0 +1,51 @@
+import pytest
+import tables
+
+import beast.observationmodel.noisemodel.generic_noisemodel as noisemodel
+from beast.tools.fit_server import SEDObservations
+from beast.tools.validate_float32_fitting import (validate_float32_fitting,
+                                                  check_float32_setup)
+from beast.tests.helpers import (make_sed_grid, make_noisemodel,
+                                 make_obs_seds)
+
+
+@pytest.mark.parametrize('full_cov', [False, True])
+def test_validate_float32_fitting(tmpdir, full_cov):
+    # grid and noise model in physical flux units (the inverse variances
+    #   are beyond the float32 range without scaling)
+    sedgrid = make_sed_grid()
+    noise = noisemodel.get_noisemodelcat(
+        make_noisemodel(sedgrid, str(tmpdir.join('noise.hd5')),
+                        full_cov=full_cov))
+    obs = SEDObservations(make_obs_seds(sedgrid, 20),
+                          sedgrid.header['filters'].split())
+
+    comp_tab = validate_float32_fitting(obs, noise, sedgrid,
+                                        str(tmpdir.join('val')),
+                                        keys=['logA', 'M_ini', 'Av'])
+    noise.close()
+
+    comp = dict(zip(comp_tab['column'], comp_tab))
+    for colname in comp:
+        if colname.endswith(('_Best', '_Exp', '_p16', '_p50', '_p84')):
+            assert comp[colname]['max_sigma_diff'] < 1e-3, colname
+    assert comp['Pmax_indx']['max_diff'] == 0
+    assert comp['chi2min_indx']['max_diff'] == 0
+    assert comp['Pmax']['max_diff'] < 1e-3
+    assert comp['chi2min']['max_diff'] < 1e-3
+
+
+def test_check_float32_setup(tmpdir):
+    sedgrid = make_sed_grid()
+    noise_fname = make_noisemodel(sedgrid, str(tmpdir.join('noise.hd5')))
+    with tables.open_file(noise_fname, 'r') as noise:
+        n_nonfinite = check_float32_setup(noise, sedgrid)
+    assert n_nonfinite == {'model_seds_with_bias': 0, 'ast_ivar': 0}
+
+    # an uncertainty far below the fluxes of the filter overflows the
+    #   float32 inverse variance even with the scaling
+    with tables.open_file(noise_fname, 'a') as noise:
+        noise.root.error[0, 0] = 1e-40
+    with tables.open_file(noise_fname, 'r') as noise:
+        with pytest.raises(ValueError):
+            check_float32_setup(noise, sedgrid)
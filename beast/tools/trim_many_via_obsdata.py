@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 """
 Code to create many trimmed model grids for batch runs
-  Saves time by only reading the potentially huge modelsed grid once
-  and only reads in the noisemodel/astfile if it has changed 
+  Saves time by only reading the potentially huge modelsed grid once,
+  reading each noisemodel once, and trimming all the catalogs that use
+  the same noisemodel in a single pass
 """
 
 # system imports
@@ -11,6 +12,7 @@ import sys
 import os
 import argparse
 import time
+from collections import OrderedDict
 
 # BEAST imports
 import beast.observationmodel.noisemodel.generic_noisemodel as noisemodel 
@@ -28,7 +30,7 @@ if __name__ == '__main__':
                         help="file with modelgrid, astfiles, obsfiles to use")
     args = parser.parse_args()
 
-    start_time = time.clock()
+    start_time = time.time()
 
     f = open(args.trimfile, 'r')
     file_lines = list(f)
@@ -42,12 +44,12 @@ if __name__ == '__main__':
     # get the modesedgrid on which to generate the noisemodel  
     modelsedgrid = FileSEDGrid(modelfile)  
 
-    new_time = time.clock()
+    new_time = time.time()
     print('time to read: ',(new_time - start_time)/60., ' min')
 
-    ext_brick = ''
-    
-    old_noisefile = ''
+    # group the catalogs by noise model, so each noise model is read
+    #   once and all its catalogs are trimmed in a single pass
+    noise_groups = OrderedDict()
     for k in range(2,len(file_lines)):
         line = file_lines[k]
         line_bits = line.split()
@@ -69,31 +71,35 @@ if __name__ == '__main__':
         sed_trimname = stats_filebase + '_sed_trim.grid.hd5'
         noisemodel_trimname = stats_filebase + '_noisemodel_trim.hd5'
 
-        print('working on ' + sed_trimname)
-        
-        start_time = time.clock()
+        noise_groups.setdefault(noisefile, []).append(
+            (obsfile, sed_trimname, noisemodel_trimname))
+
+    for noisefile, cat_files in noise_groups.items():
+        start_time = time.time()
 
-        if noisefile == old_noisefile:
-            print('not reading noisefile - same as last')
-            #print(noisefile)
-            #print(astfile)
-        else:
-            print('reading noisefile/astfile')
-            # read in the noise model
-            noisemodel_vals = noisemodel.get_noisemodelcat(noisefile)
-            old_noisefile = noisefile
+        print('reading noisefile/astfile')
+        # read in the noise model
+        noisemodel_vals = noisemodel.get_noisemodelcat(noisefile)
 
         # read in the observed data
         print('getting the observed data')
-        obsdata = datamodel.get_obscat(obsfile, modelsedgrid.filters)
+        obsdatas = [datamodel.get_obscat(obsfile, modelsedgrid.filters)
+                    for obsfile, _, _ in cat_files]
 
-        # trim the model sedgrid
+        print('working on ' + ', '.join([sed_trimname for _, sed_trimname, _
+                                        in cat_files]))
+
+        # trim the model sedgrid for all the catalogs
         #   set n_detected = 0 to disable the trimming of models based on 
         #      the ASTs (e.g. extrapolations are ok)
         #   this is needed as the ASTs in the NIR bands do not go faint enough
-        trim_grid.trim_models(modelsedgrid, noisemodel_vals, 
-                              obsdata, sed_trimname, noisemodel_trimname, 
-                              sigma_fac=3.)
-
-        new_time = time.clock()
+        trim_grid.trim_models_multi(modelsedgrid, noisemodel_vals,
+                                    obsdatas,
+                                    [sed_trimname for _, sed_trimname, _
+                                     in cat_files],
+                                    [noise_trimname for _, _, noise_trimname
+                                     in cat_files],
+                                    sigma_fac=3.)
+
+        new_time = time.time()
         print('time to trim: ',(new_time - start_time)/60., ' min')
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+#
+# quantify the differences between the fitting results computed with the
+#   model and noise model grids in float64 (default) and float32
+#   (use_float32=True in beast.fitting.fit.summary_table_memory)
+
+import argparse
+
+import numpy as np
+from astropy.table import Table
+
+from beast.fitting import fit
+
+# model and noise model arrays of the fitting setup stored in float32
+SETUP_ARRAYS = ['model_seds_with_bias', 'ast_ivar', 'ast_icov_diag',
+                'two_ast_icov_offdiag', 'ast_icov_chol']
+
+
+def check_float32_setup(noisemodel, sedgrid, **kwargs):
+    """
+    Check that the model and noise model arrays used for the fitting in
+    float32 are finite wherever they are in float64 (e.g., no overflow of
+    the inverse variances)
+
+    Parameters
+    ----------
+    noisemodel : beast noisemodel instance
+        noise model data
+
+    sedgrid : str or grid.SEDgrid instance
+        model grid
+
+    kwargs : dict
+        other keywords for beast.fitting.fit.setup_fit
+
+    Returns
+    -------
+    n_nonfinite : dict
+        number of non-finite values of each array in float32
+
+    Raises
+    ------
+    ValueError
+        if any array has more non-finite values in float32 than in float64
+    """
+    n_nonfinite = {}
+    bad_names = []
+    for name in SETUP_ARRAYS:
+        n_nonfinite[name] = []
+    for use_float32 in [False, True]:
+        fit_setup = fit.setup_fit(sedgrid, noisemodel, [],
+                                  use_float32=use_float32, **kwargs)
+        for name in SETUP_ARRAYS:
+            if fit_setup[name] is not None:
+                n_nonfinite[name].append(
+                    int(np.sum(~np.isfinite(fit_setup[name]))))
+        del fit_setup
+
+    for name in SETUP_ARRAYS:
+        if len(n_nonfinite[name]) == 0:
+            del n_nonfinite[name]
+            continue
+        n64, n32 = n_nonfinite[name]
+        n_nonfinite[name] = n32
+        if n32 > n64:
+            bad_names.append('{0:s} ({1:d} values)'.format(name, n32 - n64))
+
+    if len(bad_names) > 0:
+        raise ValueError('non-finite float32 values in the fitting setup: '
+                         + ', '.join(bad_names))
+
+    return n_nonfinite
+
+
+def compare_stats(stats64, stats32):
+    """
+    Compare the stats computed in float64 and float32
+
+    Parameters
+    ----------
+    stats64, stats32 : str or astropy.table.Table
+        stats from the float64 and float32 fits of the same catalog
+
+    Returns
+    -------
+    comp_tab : astropy.table.Table
+        one row per stats column with the maximum and median absolute
+        differences, the maximum difference in units of the 1 sigma width
+        of the pPDF (p84 - p16)/2 for the _Best, _Exp, and _pXX columns,
+        and the fraction of stars with different values
+    """
+    if isinstance(stats64, str):
+        stats64 = Table.read(stats64)
+    if isinstance(stats32, str):
+        stats32 = Table.read(stats32)
+
+    if len(stats64) != len(stats32):
+        raise ValueError('stats do not have the same number of stars')
+
+    names = []
+    max_diff = []
+    median_diff = []
+    max_sigma_diff = []
+    frac_diff = []
+    for colname in stats64.colnames:
+        vals64 = np.asarray(stats64[colname])
+        if (colname not in stats32.colnames) or (vals64.dtype.kind
+                                                 not in 'iuf'):
+            continue
+        vals32 = np.asarray(stats32[colname])
+
+        diff = np.abs(vals64.astype(float) - vals32.astype(float))
+        names.append(colname)
+        max_diff.append(np.nanmax(diff))
+        median_diff.append(np.nanmedian(diff))
+        frac_diff.append(np.mean(vals64 != vals32))
+
+        # difference relative to the width of the pPDF
+        qname = colname.rsplit('_', 1)[0]
+        p16 = '{0:s}_p16'.format(qname)
+        p84 = '{0:s}_p84'.format(qname)
+        if (p16 in stats64.colnames) and (p84 in stats64.colnames):
+            sigma = 0.5*(stats64[p84] - stats64[p16])
+            good = sigma > 0
+            if np.any(good):
+                max_sigma_diff.append(np.nanmax(diff[good] / sigma[good]))
+            else:
+                max_sigma_diff.append(np.nan)
+        else:
+            max_sigma_diff.append(np.nan)
+
+    comp_tab = Table()
+    comp_tab['column'] = names
+    comp_tab['max_diff'] = max_diff
+    comp_tab['median_diff'] = median_diff
+    comp_tab['max_sigma_diff'] = max_sigma_diff
+    comp_tab['frac_diff'] = frac_diff
+
+    return comp_tab
+
+
+def validate_float32_fitting(obs, noisemodel, sedgrid, outbase,
+                             threshold=-10., **kwargs):
+    """
+    Fit a catalog with the grids in float64 and float32 and compare
+    the results, after checking the float32 fitting setup
+    (see check_float32_setup)
+
+    Parameters
+    ----------
+    obs : Observation object instance
+        observation catalog (reference catalog)
+
+    noisemodel : beast noisemodel instance
+        noise model data
+
+    sedgrid : str or grid.SEDgrid instance
+        model grid
+
+    outbase : str
+        stats are saved in outbase + '_float64_stats.fits' and
+        outbase + '_float32_stats.fits' and the comparison in
+        outbase + '_float32_comparison.fits'
+
+    threshold : float
+        sparse likelihood threshold
+
+    kwargs : dict
+        other keywords for beast.fitting.fit.summary_table_memory
+
+    Returns
+    -------
+    comp_tab : astropy.table.Table
+        comparison of the stats (see compare_stats)
+
+    Raises
+    ------
+    ValueError
+        if the float32 fitting setup has non-finite values
+    """
+    setup_kwargs = {}
+    for key in ['use_full_cov_matrix', 'use_icov_chol', 'do_not_normalize']:
+        if key in kwargs:
+            setup_kwargs[key] = kwargs[key]
+    check_float32_setup(noisemodel, sedgrid, **setup_kwargs)
+
+    stats_fnames = []
+    for use_float32 in [False, True]:
+        stats_fname = '{0:s}_float{1:d}_stats.fits'.format(
+            outbase, 32 if use_float32 else 64)
+        fit.summary_table_memory(obs, noisemodel, sedgrid,
+                                 threshold=threshold,
+                                 stats_outname=stats_fname,
+                                 use_float32=use_float32, **kwargs)
+        stats_fnames.append(stats_fname)
+
+    comp_tab = compare_stats(stats_fnames[0], stats_fnames[1])
+    comp_tab.write('{0:s}_float32_comparison.fits'.format(outbase),
+                   overwrite=True)
+
+    return comp_tab
+
+
+if __name__ == '__main__':
+
+    # commandline parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument("stats64",
+                        help="stats file of the float64 fit")
+    parser.add_argument("stats32",
+                        help="stats file of the float32 fit")
+    parser.add_argument("-o", "--outfile", default=None,
+                        help="file to save the comparison")
+    args = parser.parse_args()
+
+    comp_tab = compare_stats(args.stats64, args.stats32)
+    comp_tab.pprint(max_lines=-1, max_width=-1)
+
+    if args.outfile is not None:
+        comp_tab.write(args.outfile, overwrite=True)
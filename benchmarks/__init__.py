@@ -0,0 +1,2 @@
+# the synthetic libraries need to be set before any beast module is imported
+from . import synthetic  # noqa: F401
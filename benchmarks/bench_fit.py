@@ -0,0 +1,102 @@
+# end to end fitting (Q_all_memory) versus the grid size and number of stars
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import os
+import shutil
+import tempfile
+import time
+
+import tables
+
+from .synthetic import make_sed_grid, make_noisemodel, make_catalog
+
+from beast.fitting import fit
+
+
+def _fit(g, ast, obs, outdir, **kwargs):
+    """
+    Fit the catalog saving the stats, 1D PDFs and sparse likelihoods
+    """
+    res = fit.IAU_names_and_extra_info(obs, surveyname='BENCH')
+    fit.Q_all_memory(res, obs, g, ast, ['logA', 'M_ini', 'Av', 'Rv'],
+                     threshold=-10.,
+                     stats_outname=os.path.join(outdir, 'stats.fits'),
+                     pdf1d_outname=os.path.join(outdir, 'pdf1d.fits'),
+                     lnp_outname=os.path.join(outdir, 'lnp.hd5'),
+                     **kwargs)
+
+
+class FitGrid(object):
+    """
+    Fitting of a catalog with the diagonal and full covariance noise models
+    """
+    params = ([10000, 100000, 1000000], [10, 100], [False, True])
+    param_names = ['n_models', 'n_stars', 'full_cov']
+    timeout = 1200
+
+    def setup(self, n_models, n_stars, full_cov):
+        self.g = make_sed_grid(n_models)
+        self.ast = tables.open_file(make_noisemodel(self.g,
+                                                    full_cov=full_cov))
+        self.obs = make_catalog(self.g, n_stars)
+        self.outdir = tempfile.mkdtemp()
+
+    def teardown(self, n_models, n_stars, full_cov):
+        self.ast.close()
+        shutil.rmtree(self.outdir)
+
+    def time_Q_all_memory(self, n_models, n_stars, full_cov):
+        _fit(self.g, self.ast, self.obs, self.outdir)
+
+    def peakmem_Q_all_memory(self, n_models, n_stars, full_cov):
+        _fit(self.g, self.ast, self.obs, self.outdir)
+
+    def track_stars_per_second(self, n_models, n_stars, full_cov):
+        start = time.time()
+        _fit(self.g, self.ast, self.obs, self.outdir)
+        return n_stars / (time.time() - start)
+
+    track_stars_per_second.unit = 'stars/s'
+
+
+class FitPruning(object):
+    """
+    Speedup of the fitting per star when skipping the models that cannot
+    be in the sparse likelihood (prune_models) versus the grid size
+    (the setup of the grids, including the flux index, is not timed)
+    """
+    params = ([10000, 100000, 1000000], [False, True])
+    param_names = ['n_models', 'full_cov']
+    timeout = 1200
+
+    def setup(self, n_models, full_cov):
+        self.g = make_sed_grid(n_models)
+        self.ast = tables.open_file(make_noisemodel(self.g,
+                                                    full_cov=full_cov))
+        self.obs = make_catalog(self.g, 50)
+        self.outdir = tempfile.mkdtemp()
+        self.fit_setups = {}
+        for prune_models in [False, True]:
+            self.fit_setups[prune_models] = fit.setup_fit(
+                self.g, self.ast, ['logA', 'M_ini', 'Av', 'Rv'],
+                use_full_cov_matrix=full_cov, prune_models=prune_models)
+
+    def teardown(self, n_models, full_cov):
+        self.ast.close()
+        shutil.rmtree(self.outdir)
+
+    def time_Q_all_memory_pruned(self, n_models, full_cov):
+        _fit(self.g, self.ast, self.obs, self.outdir,
+             fit_setup=self.fit_setups[True])
+
+    def track_prune_speedup(self, n_models, full_cov):
+        times = []
+        for prune_models in [False, True]:
+            start = time.time()
+            _fit(self.g, self.ast, self.obs, self.outdir,
+                 fit_setup=self.fit_setups[prune_models])
+            times.append(time.time() - start)
+        return times[0] / times[1]
+
+    track_prune_speedup.unit = 'x'
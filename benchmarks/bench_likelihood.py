@@ -0,0 +1,55 @@
+# likelihood kernels of the fitting versus the number of models
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import numpy as np
+import tables
+
+from .synthetic import make_sed_grid, make_noisemodel
+
+from beast.fitting.fit_metrics.likelihood import (N_logLikelihood_NM,
+                                                  N_covar_logLikelihood,
+                                                  N_covar_logLikelihood_chol)
+from beast.observationmodel.noisemodel.trunchen import icov_cholesky
+
+
+class Likelihood(object):
+    """
+    Likelihood of one observed SED for all the models
+    """
+    params = [10000, 100000, 1000000]
+    param_names = ['n_models']
+    timeout = 300
+
+    def setup(self, n_models):
+        g = make_sed_grid(n_models)
+        with tables.open_file(make_noisemodel(g, full_cov=True)) as ast:
+            self.model_seds = np.asfortranarray(g.seds + ast.root.bias[:])
+            self.ivar = np.asfortranarray(1. / ast.root.error[:]**2)
+            self.q_norm = np.asfortranarray(ast.root.q_norm[:])
+            icov_diag = ast.root.icov_diag[:]
+            icov_offdiag = ast.root.icov_offdiag[:]
+        self.icov_diag = np.asfortranarray(icov_diag)
+        self.two_icov_offdiag = 2.0 * np.asfortranarray(icov_offdiag)
+        self.icov_chol = np.asfortranarray(icov_cholesky(icov_diag,
+                                                         icov_offdiag))
+        self.sed = g.seds[len(g.seds) // 2] * 1.02
+        self.mask = np.zeros(len(self.sed), dtype=bool)
+
+    def time_N_logLikelihood_NM(self, n_models):
+        N_logLikelihood_NM(self.sed, self.model_seds, self.ivar,
+                           mask=self.mask, lnp_threshold=10.)
+
+    def time_N_covar_logLikelihood(self, n_models):
+        N_covar_logLikelihood(self.sed, self.model_seds, self.q_norm,
+                              self.icov_diag, self.two_icov_offdiag,
+                              lnp_threshold=10.)
+
+    def time_N_covar_logLikelihood_chol(self, n_models):
+        N_covar_logLikelihood_chol(self.sed, self.model_seds, self.q_norm,
+                                   self.icov_chol, lnp_threshold=10.)
+
+    def peakmem_N_covar_logLikelihood(self, n_models):
+        N_covar_logLikelihood(self.sed, self.model_seds, self.q_norm,
+                              self.icov_diag, self.two_icov_offdiag,
+                              lnp_threshold=10.)
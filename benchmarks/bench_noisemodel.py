@@ -0,0 +1,53 @@
+# evaluation of the noise models on the model grid versus the grid size
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from .synthetic import FILTERS, BASE_FILTERS, make_sed_grid, make_asts
+
+from beast.observationmodel.noisemodel import trunchen
+from beast.observationmodel.noisemodel.generic_noisemodel import (
+    Generic_ToothPick_Noisemodel)
+
+
+class ToothPick(object):
+    """
+    Interpolation of the binned AST results (toothpick model)
+    """
+    params = [10000, 100000, 1000000]
+    param_names = ['n_models']
+
+    def setup(self, n_models):
+        self.g = make_sed_grid(n_models)
+        self.model = Generic_ToothPick_Noisemodel(make_asts(self.g, 500),
+                                                  FILTERS)
+        self.model.fit_bins(nbins=30, completeness_mag_cut=80,
+                            progress=False)
+
+    def time_fit_bins(self, n_models):
+        self.model.fit_bins(nbins=30, completeness_mag_cut=80,
+                            progress=False)
+
+    def time_interpolate(self, n_models):
+        self.model.interpolate(self.g, progress=False)
+
+
+class TruncHen(object):
+    """
+    Evaluation of the covariance matrices interpolated from the AST
+    results (trunchen model)
+    """
+    params = [1000, 10000]
+    param_names = ['n_models']
+    timeout = 600
+
+    def setup(self, n_models):
+        self.g = make_sed_grid(n_models)
+        self.model = trunchen.MultiFilterASTs(make_asts(self.g, 200),
+                                              FILTERS)
+        self.model.process_asts(BASE_FILTERS)
+
+    def time_evaluate(self, n_models):
+        self.model(self.g, progress=False)
+
+    def time_evaluate_icov_chol(self, n_models):
+        self.model(self.g, progress=False, return_icov_chol=True)
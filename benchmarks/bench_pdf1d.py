@@ -0,0 +1,29 @@
+# 1D PDF mappings versus the number of models
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import numpy as np
+
+from beast.fitting.pdf1d import pdf1d
+
+
+class PDF1D(object):
+    """
+    1D PDF of a sparse likelihood (1% of the models)
+    """
+    params = [10000, 100000, 1000000]
+    param_names = ['n_models']
+
+    def setup(self, n_models):
+        rng = np.random.RandomState(6)
+        self.gridvals = rng.uniform(0., 10., n_models)
+        self.pdf = pdf1d(self.gridvals, 50)
+        self.gindxs = np.sort(rng.choice(n_models, n_models // 100,
+                                         replace=False))
+        self.weights = rng.rand(len(self.gindxs))
+
+    def time_setup(self, n_models):
+        pdf1d(self.gridvals, 50)
+
+    def time_gen1d(self, n_models):
+        self.pdf.gen1d(self.gindxs, self.weights)
@@ -0,0 +1,52 @@
+# creation of the SED grid from the spectral grid versus the grid size
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import numpy as np
+
+from .synthetic import FILTERS, make_spectral_grid
+
+from beast.observationmodel import phot
+from beast.physicsmodel.creategrid import make_extinguished_grid
+from beast.physicsmodel.dust import extinction
+
+
+class ExtractSEDs(object):
+    """
+    Integration of the spectra through the filters
+    """
+    params = [1000, 10000]
+    param_names = ['n_models']
+
+    def setup(self, n_models):
+        self.g = make_spectral_grid(n_models)
+        self.flist = phot.load_filters(FILTERS, interp=True,
+                                       lamb=self.g.lamb)
+
+    def time_extractSEDs(self, n_models):
+        phot.extractSEDs(self.g, self.flist)
+
+
+class ExtinguishedGrid(object):
+    """
+    Extinguished SED grid for a grid of A(V) and R(V)
+    """
+    params = ([1000, 10000], [5, 20])
+    param_names = ['n_spectra', 'n_av']
+    timeout = 600
+
+    def setup(self, n_spectra, n_av):
+        self.g = make_spectral_grid(n_spectra)
+        self.avs = np.linspace(0., 5., n_av)
+        self.rvs = np.array([2.5, 3.1, 4.0])
+        self.extlaw = extinction.Cardelli89()
+
+    def time_make_extinguished_grid(self, n_spectra, n_av):
+        for g in make_extinguished_grid(self.g, FILTERS, self.extlaw,
+                                        self.avs, self.rvs):
+            pass
+
+    def peakmem_make_extinguished_grid(self, n_spectra, n_av):
+        for g in make_extinguished_grid(self.g, FILTERS, self.extlaw,
+                                        self.avs, self.rvs):
+            pass
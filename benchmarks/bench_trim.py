@@ -0,0 +1,39 @@
+# trimming of the model grid for a catalog versus the grid size
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import os
+import shutil
+import tempfile
+
+import tables
+
+from .synthetic import make_sed_grid, make_noisemodel, make_catalog
+
+from beast.fitting.trim_grid import trim_models
+
+
+class TrimModels(object):
+    """
+    Trimming of the models that cannot fit the catalog
+    """
+    params = ([10000, 100000, 1000000], [False, True])
+    param_names = ['n_models', 'full_cov']
+    timeout = 600
+
+    def setup(self, n_models, full_cov):
+        self.g = make_sed_grid(n_models)
+        self.ast = tables.open_file(make_noisemodel(self.g,
+                                                    full_cov=full_cov))
+        self.obs = make_catalog(self.g, 1000)
+        self.outdir = tempfile.mkdtemp()
+
+    def teardown(self, n_models, full_cov):
+        self.ast.close()
+        shutil.rmtree(self.outdir)
+
+    def time_trim_models(self, n_models, full_cov):
+        trim_models(self.g, self.ast, self.obs,
+                    os.path.join(self.outdir, 'seds_trim.grid.hd5'),
+                    os.path.join(self.outdir, 'noisemodel_trim.grid.hd5'),
+                    trunchen=full_cov)
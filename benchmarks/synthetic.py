@@ -0,0 +1,361 @@
+# synthetic inputs for the benchmarks
+#
+# the model grids, noise models, ASTs, and catalogs are generated locally
+#   with sizes set by the benchmark parameters (no downloads) and the files
+#   are cached in BEAST_BENCH_CACHE (default is a temporary directory)
+# a synthetic library directory (filters and vega) is created and set as
+#   BEAST_LIBS before beast is imported so that the code paths reading the
+#   libraries run as with the real libraries
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import os
+import tempfile
+
+import numpy as np
+import tables
+from astropy.io import fits
+
+CACHE_DIR = os.environ.get('BEAST_BENCH_CACHE',
+                           os.path.join(tempfile.gettempdir(),
+                                        'beast_benchmarks'))
+LIB_DIR = os.path.join(CACHE_DIR, 'libs')
+
+# filters and their pivot wavelengths [A]
+FILTERS = ['HST_WFC3_F275W', 'HST_WFC3_F336W', 'HST_ACS_WFC_F475W',
+           'HST_ACS_WFC_F814W', 'HST_WFC3_F110W', 'HST_WFC3_F160W']
+BASE_FILTERS = [cfilter.split('_')[-1] for cfilter in FILTERS]
+PIVOTS = np.array([2704., 3355., 4747., 8057., 11534., 15369.])
+
+
+def _blackbody(lamb, temp):
+    """
+    Planck function (arbitrary units) for wavelengths in A
+    """
+    x = 1.4387769e8 / (lamb * temp)
+    return 1.0 / (lamb**5 * np.expm1(np.minimum(x, 700.)))
+
+
+def _filter_transmissions(lamb):
+    """
+    Gaussian filter curves (8% width) on the wavelengths
+    """
+    trans = np.exp(-0.5 * ((lamb[None, :] - PIVOTS[:, None])
+                           / (0.08 * PIVOTS[:, None]))**2)
+    trans[trans < 1e-3] = 0.0
+    return trans
+
+
+def make_libs():
+    """
+    Create the synthetic filter and vega libraries (if needed)
+
+    Returns
+    -------
+    lib_dir : str
+        directory with filters.hd5 and vega.hd5
+    """
+    filter_lib = os.path.join(LIB_DIR, 'filters.hd5')
+    vega_lib = os.path.join(LIB_DIR, 'vega.hd5')
+    if os.path.isfile(filter_lib) and os.path.isfile(vega_lib):
+        return LIB_DIR
+    if not os.path.isdir(LIB_DIR):
+        os.makedirs(LIB_DIR)
+
+    lamb = np.arange(1000., 25000., 5.)
+    trans = _filter_transmissions(lamb)
+
+    # filters
+    content_desc = {'TABLENAME': tables.StringCol(64, pos=0),
+                    'CWAVE': tables.Float64Col(pos=1)}
+    filter_desc = {'WAVELENGTH': tables.Float64Col(pos=0),
+                   'THROUGHPUT': tables.Float64Col(pos=1)}
+    with tables.open_file(filter_lib, 'w') as ftab:
+        content = ftab.create_table('/', 'content', content_desc)
+        ftab.create_group('/', 'filters')
+        for k, cfilter in enumerate(FILTERS):
+            content.append([(cfilter.encode('ascii'), PIVOTS[k])])
+            good, = np.where(trans[k] > 0)
+            ctab = ftab.create_table('/filters', cfilter, filter_desc)
+            ctab.append(list(zip(lamb[good], trans[k, good])))
+
+    # vega (9600K blackbody normalized at 5556A)
+    vega_spec = _blackbody(lamb, 9600.)
+    vega_spec *= 3.63e-9 / np.interp(5556., lamb, vega_spec)
+    vega_desc = {'FNAME': tables.StringCol(64, pos=0),
+                 'LUM': tables.Float64Col(pos=1),
+                 'MAG': tables.Float64Col(pos=2),
+                 'CWAVE': tables.Float64Col(pos=3)}
+    with tables.open_file(vega_lib, 'w') as vtab:
+        sed = vtab.create_table('/', 'sed', vega_desc)
+        for k, cfilter in enumerate(FILTERS):
+            lum = (np.trapz(lamb * trans[k] * vega_spec, lamb)
+                   / np.trapz(lamb * trans[k], lamb))
+            sed.append([(cfilter.encode('ascii'), lum, 0.03, PIVOTS[k])])
+
+    return LIB_DIR
+
+
+# the libraries need to be set before beast is imported
+os.environ['BEAST_LIBS'] = make_libs() + '/'
+
+from beast.physicsmodel import grid  # noqa: E402
+from beast.external.eztables import Table  # noqa: E402
+from beast.observationmodel.observations import Observations  # noqa: E402
+from beast.observationmodel.vega import Vega  # noqa: E402
+
+
+def get_vega_fluxes():
+    """
+    Vega fluxes of the synthetic library in FILTERS
+    """
+    with Vega() as v:
+        _, vega_flux, _ = v.getFlux(FILTERS)
+    return vega_flux
+
+
+def make_spectral_grid(n_models, n_lamb=1000, seed=1):
+    """
+    Grid of stellar spectra (blackbodies) with the physical parameters
+    expected by the SED grid creation
+
+    Parameters
+    ----------
+    n_models : int
+        number of spectra
+
+    n_lamb : int
+        number of wavelengths (log spaced between 1000 and 25000 A)
+
+    Returns
+    -------
+    grid.SpectralGrid instance (memory backend)
+    """
+    rng = np.random.RandomState(seed)
+    lamb = np.logspace(3., np.log10(25000.), n_lamb)
+
+    logT = rng.uniform(3.5, 4.5, n_models)
+    logL = rng.uniform(-1., 4., n_models)
+    radius = np.sqrt(10**logL) * (5772. / 10**logT)**2
+    seds = (_blackbody(lamb[None, :], 10**logT[:, None])
+            * (radius**2 * 10**(4*logT))[:, None])
+    seds *= 1e-4 / seds.max()
+
+    cols = {'logT': logT,
+            'logL': logL,
+            'logg': rng.uniform(0., 5., n_models),
+            'logA': rng.uniform(6., 10., n_models),
+            'M_ini': 10**rng.uniform(-0.5, 1.5, n_models),
+            'Z': rng.choice([0.004, 0.008, 0.019], n_models),
+            'radius': radius,
+            'weight': np.ones(n_models),
+            'prior_weight': np.ones(n_models),
+            'grid_weight': np.ones(n_models)}
+    return grid.SpectralGrid(lamb, seds=seds, grid=Table(cols),
+                             backend='memory')
+
+
+def make_sed_grid(n_models, seed=2):
+    """
+    SED grid on a regular lattice of (logA, M_ini, Av, Rv) with smooth
+    fluxes in FILTERS
+
+    Parameters
+    ----------
+    n_models : int
+        approximate number of models (10 ages, 10 Av, 2 Rv, and enough
+        masses)
+
+    Returns
+    -------
+    grid.SpectralGrid instance (memory backend)
+    """
+    rng = np.random.RandomState(seed)
+    n_mass = max(1, int(round(n_models / 200.)))
+    logA, M_ini, Av, Rv = [vals.ravel() for vals in np.meshgrid(
+        np.linspace(6.5, 10., 10), np.logspace(-0.3, 1.5, n_mass),
+        np.linspace(0., 5., 10), np.array([3.1, 5.0]), indexing='ij')]
+    n = len(logA)
+
+    # bluer young massive stars, extinction law steeper for lower R(V)
+    color = 10**(-0.3 * (logA - 6.5)[:, None]
+                 * np.log10(PIVOTS / 5500.)[None, :])
+    alam = (PIVOTS[None, :] / 5500.)**(-1.3 * 3.1 / Rv[:, None])
+    seds = (1e-17 * M_ini[:, None]**2.5 * color
+            * 10**(-0.4 * Av[:, None] * alam)
+            * (1. + 0.01 * rng.randn(n, len(FILTERS))))
+
+    cols = {'logA': logA,
+            'M_ini': M_ini,
+            'Av': Av,
+            'Rv': Rv,
+            'f_A': np.ones(n),
+            'Z': np.full(n, 0.019),
+            'distance': np.full(n, 7.76e5),
+            'weight': rng.uniform(0.5, 1.5, n),
+            'prior_weight': np.ones(n),
+            'grid_weight': np.ones(n),
+            'specgrid_indx': np.arange(n) // 20}
+    g = grid.SpectralGrid(PIVOTS, seds=seds, grid=Table(cols),
+                          header={'filters': ' '.join(FILTERS)},
+                          backend='memory')
+    g.grid.header['filters'] = ' '.join(FILTERS)
+    return g
+
+
+def make_noisemodel(sedgrid, full_cov=False, seed=3):
+    """
+    Noise model of the SED grid (5% uncertainties, 1% biases, and
+    correlations of 0.3 between the filters for the full covariance
+    matrices)
+
+    Parameters
+    ----------
+    sedgrid : grid.SpectralGrid instance
+        model grid
+
+    full_cov : bool
+        set to include the full covariance matrix terms (trunchen format)
+
+    Returns
+    -------
+    fname : str
+        noise model file (cached)
+    """
+    seds = sedgrid.seds
+    n_models, n_filters = seds.shape
+    fname = os.path.join(CACHE_DIR, 'noisemodel_{0:d}{1:s}.hd5'.format(
+        n_models, '_cov' if full_cov else ''))
+    if os.path.isfile(fname):
+        return fname
+
+    rng = np.random.RandomState(seed)
+    sigmas = 0.05 * seds + 1e-21
+    with tables.open_file(fname, 'w') as outfile:
+        outfile.create_array(outfile.root, 'bias',
+                             0.01 * seds * rng.randn(n_models, n_filters))
+        outfile.create_array(outfile.root, 'error', sigmas)
+        outfile.create_array(outfile.root, 'completeness',
+                             np.ones((n_models, n_filters)))
+        if full_cov:
+            corr = 0.3 * np.ones((n_filters, n_filters)) + 0.7*np.eye(n_filters)
+            icorr = np.linalg.inv(corr)
+            up_indxs = np.triu_indices(n_filters, 1)
+            isig = 1.0 / sigmas
+            outfile.create_array(
+                outfile.root, 'q_norm',
+                -0.5*(np.linalg.slogdet(corr)[1]
+                      + 2.*np.sum(np.log(sigmas), axis=1)))
+            outfile.create_array(outfile.root, 'icov_diag',
+                                 isig**2 * np.diag(icorr)[None, :])
+            outfile.create_array(outfile.root, 'icov_offdiag',
+                                 isig[:, up_indxs[0]] * isig[:, up_indxs[1]]
+                                 * icorr[up_indxs][None, :])
+    return fname
+
+
+class SyntheticCatalog(Observations):
+    """
+    Catalog of vega normalized fluxes (<filter>_RATE columns) as used by the
+    datamodels of the examples
+    """
+    def __init__(self, inputFile):
+        Observations.__init__(self, inputFile, desc='synthetic catalog')
+        self.setFilters(FILTERS)
+        self.vega_flux = get_vega_fluxes()
+        for cfilter, bfilter in zip(FILTERS, BASE_FILTERS):
+            self.data.set_alias(cfilter, bfilter + '_RATE')
+
+    def getFlux(self, num):
+        d = self.data[num]
+        return np.array([d[self.data.resolve_alias(ok)]
+                         for ok in self.filters]) * self.vega_flux
+
+    def getObs(self, num=0):
+        return self.getFlux(num)
+
+
+def make_catalog(sedgrid, n_stars, seed=4):
+    """
+    Catalog of stars drawn from the SED grid with 5% noise
+
+    Parameters
+    ----------
+    sedgrid : grid.SpectralGrid instance
+        model grid
+
+    n_stars : int
+        number of stars
+
+    Returns
+    -------
+    SyntheticCatalog instance
+    """
+    n_models = len(sedgrid.seds)
+    fname = os.path.join(CACHE_DIR, 'catalog_{0:d}_{1:d}.fits'.format(
+        n_models, n_stars))
+    if not os.path.isfile(fname):
+        rng = np.random.RandomState(seed)
+        indxs = rng.randint(0, n_models, n_stars)
+        fluxes = sedgrid.seds[indxs] * (1. + 0.05 * rng.randn(
+            n_stars, len(FILTERS)))
+        cols = [fits.Column(name='RA', format='D',
+                            array=10. + 0.1 * rng.rand(n_stars)),
+                fits.Column(name='DEC', format='D',
+                            array=41. + 0.1 * rng.rand(n_stars))]
+        for k, bfilter in enumerate(BASE_FILTERS):
+            cols.append(fits.Column(name=bfilter + '_RATE', format='D',
+                                    array=fluxes[:, k] / get_vega_fluxes()[k]))
+        fits.BinTableHDU.from_columns(cols).writeto(fname, overwrite=True)
+    return SyntheticCatalog(fname)
+
+
+def make_asts(sedgrid, n_ast_models, n_repeats=20, seed=5):
+    """
+    ASTs of models drawn from the SED grid (same columns as the DOLPHOT
+    ASTs: <filter>_IN, <filter>_VEGA, <filter>_RATE)
+
+    Parameters
+    ----------
+    sedgrid : grid.SpectralGrid instance
+        model grid
+
+    n_ast_models : int
+        number of input SEDs
+
+    n_repeats : int
+        number of ASTs of each input SED
+
+    Returns
+    -------
+    fname : str
+        AST file (cached)
+    """
+    n_models = len(sedgrid.seds)
+    fname = os.path.join(CACHE_DIR, 'asts_{0:d}_{1:d}_{2:d}.fits'.format(
+        n_models, n_ast_models, n_repeats))
+    if os.path.isfile(fname):
+        return fname
+
+    rng = np.random.RandomState(seed)
+    vega_flux = get_vega_fluxes()
+    indxs = np.repeat(rng.choice(n_models, n_ast_models, replace=False),
+                      n_repeats)
+    in_fluxes = sedgrid.seds[indxs] / vega_flux[None, :]
+    out_fluxes = in_fluxes * (1. + 0.01 * rng.randn(len(indxs), 1)
+                              + 0.05 * rng.randn(*in_fluxes.shape))
+    out_fluxes -= 0.02 * np.median(in_fluxes, axis=0)[None, :]
+    cols = []
+    for k, bfilter in enumerate(BASE_FILTERS):
+        in_mag = -2.5 * np.log10(in_fluxes[:, k])
+        out_mag = np.full(len(indxs), 99.999)
+        detected = out_fluxes[:, k] > 0
+        out_mag[detected] = -2.5 * np.log10(out_fluxes[detected, k])
+        cols.append(fits.Column(name=bfilter + '_IN', format='D',
+                                array=in_mag))
+        cols.append(fits.Column(name=bfilter + '_VEGA', format='D',
+                                array=out_mag))
+        cols.append(fits.Column(name=bfilter + '_RATE', format='D',
+                                array=out_fluxes[:, k]))
+    fits.BinTableHDU.from_columns(cols).writeto(fname, overwrite=True)
+    return fname